@@ -0,0 +1,74 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Compare the cost of validating API responses against their schema with the
+cost of encoding them, for dataset listings of different sizes.
+
+Run from the top of the source tree with::
+
+    PYTHONPATH=. python benchmark/output_validation.py
+"""
+
+from __future__ import print_function
+
+from json import dumps
+from timeit import default_timer
+from uuid import uuid4
+
+from flocker.control.httpapi import SCHEMAS
+from flocker.restapi import get_validator
+
+
+DATASET_COUNTS = [10, 100, 1000, 10000]
+
+
+def build_datasets(count):
+    """
+    :param int count: Number of datasets.
+
+    :return list: ``count`` dataset descriptions, as returned by
+        ``GET /v1/state/datasets``.
+    """
+    return [{u"dataset_id": unicode(uuid4()),
+             u"primary": u"192.0.2.%d" % (i % 250 + 1,),
+             u"maximum_size": 1024 * 1024 * 1024,
+             u"metadata": {u"name": u"dataset%d" % (i,)}}
+            for i in range(count)]
+
+
+def measure(function, argument):
+    """
+    :param function: One-argument callable to time.
+    :param argument: The argument to pass.
+
+    :return: Tuple of the best time in seconds over several runs and the
+        result of the last call.
+    """
+    best = None
+    for _ in range(5):
+        start = default_timer()
+        result = function(argument)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    """
+    Print a table of response sizes and validation and encoding times.
+    """
+    validator = get_validator(
+        {'$ref': '/v1/endpoints.json#/definitions/state_datasets'}, SCHEMAS)
+    print("{:>8} {:>10} {:>12} {:>10}".format(
+        "datasets", "bytes", "validate ms", "encode ms"))
+    for count in DATASET_COUNTS:
+        datasets = build_datasets(count)
+        validate_time, _ = measure(validator.validate, datasets)
+        encode_time, data = measure(dumps, datasets)
+        print("{:>8} {:>10} {:>12.2f} {:>10.2f}".format(
+            count, len(data), validate_time * 1000, encode_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
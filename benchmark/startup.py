@@ -0,0 +1,131 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Measure how long the modules behind Flocker's command line tools take to
+import, since a new process is started for every ``flocker-volume``,
+``flocker-changestate`` and ``flocker-reportstate`` call.
+
+Run from the top of the source tree with::
+
+    PYTHONPATH=. python benchmark/startup.py
+
+to print the best wall-clock time to import each entry point in a fresh
+interpreter, or::
+
+    PYTHONPATH=. python benchmark/startup.py flocker.volume.script
+
+to print a report of the time taken by each module imported by one entry
+point, in the format of Python 3's ``python -X importtime``.
+"""
+
+from __future__ import print_function
+
+import __builtin__
+import sys
+from subprocess import check_call
+from timeit import default_timer
+
+
+ENTRY_POINTS = [
+    "flocker",
+    "flocker.volume.script",
+    "flocker.node.script",
+    "flocker.cli.script",
+    "flocker.control.script",
+]
+
+
+def measure(module):
+    """
+    :param str module: The name of a module.
+
+    :return float: The best time in seconds over several runs to start a new
+        interpreter and import the module.
+    """
+    best = None
+    for _ in range(5):
+        start = default_timer()
+        check_call([sys.executable, "-c", "import " + module])
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _resolve(name, globals):
+    """
+    :param str name: The name of an imported module, possibly relative.
+    :param globals: The globals of the importing module, or ``None``.
+
+    :return str: The absolute name of the module.
+    """
+    if globals and name:
+        package = globals.get("__package__")
+        if not package:
+            package = globals.get("__name__") or ""
+            if "__path__" not in globals:
+                package = package.rpartition(".")[0]
+        if package and sys.modules.get(package + "." + name) is not None:
+            return package + "." + name
+    return name
+
+
+def import_times(module):
+    """
+    Import a module, timing it and every module it imports.
+
+    :param str module: The name of a module, which must not have been
+        imported yet.
+
+    :return list: Tuples of self time in seconds, cumulative time in seconds,
+        nesting depth and name for each module imported, in the order the
+        imports finished.
+    """
+    original_import = __builtin__.__import__
+    times = []
+    stack = []
+
+    def timed_import(name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        before = set(sys.modules)
+        stack.append(0.0)
+        start = default_timer()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = default_timer() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if set(sys.modules) - before:
+                times.append((elapsed - nested, elapsed, len(stack),
+                              _resolve(name, globals)))
+
+    __builtin__.__import__ = timed_import
+    try:
+        __import__(module)
+    finally:
+        __builtin__.__import__ = original_import
+    return times
+
+
+def main(arguments):
+    """
+    Print the startup time of each entry point, or an import time report
+    for the one given.
+    """
+    if arguments:
+        print("import time: self [us] | cumulative | imported package",
+              file=sys.stderr)
+        for self_time, cumulative, depth, name in import_times(arguments[0]):
+            print("import time: {:>9} | {:>10} | {}{}".format(
+                int(self_time * 1e6), int(cumulative * 1e6),
+                "  " * depth, name), file=sys.stderr)
+        return
+    print("{:<25} {:>10}".format("module", "startup ms"))
+    for module in ENTRY_POINTS:
+        print("{:<25} {:>10.1f}".format(module, measure(module) * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
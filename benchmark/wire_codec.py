@@ -0,0 +1,97 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Compare the size and speed of ``flocker.control._wire`` with pickle for
+deployments of different sizes.
+
+Run from the top of the source tree with::
+
+    PYTHONPATH=. python benchmark/wire_codec.py
+"""
+
+from __future__ import print_function
+
+from pickle import dumps, loads
+from timeit import default_timer
+from uuid import uuid4
+
+from flocker.control._model import (
+    Deployment, Application, DockerImage, Node, Manifestation, Dataset,
+    AttachedVolume, Port,
+)
+from flocker.control._wire import wire_encode, wire_decode
+
+from twisted.python.filepath import FilePath
+
+
+NODE_COUNTS = [10, 100, 1000]
+
+
+def build_deployment(count):
+    """
+    :param int count: Number of nodes.
+
+    :return Deployment: A deployment with ``count`` nodes, each running a
+        web server and a database with its own dataset, as would be received
+        from the network (that is, with no objects shared between nodes).
+    """
+    nodes = []
+    for i in range(count):
+        dataset = Dataset(dataset_id=unicode(uuid4()))
+        nodes.append(Node(
+            hostname=u'node%d.example.com' % (i,),
+            applications=frozenset([
+                Application(
+                    name=u'web%d' % (i,),
+                    image=DockerImage.from_string(u'nginx:1.7'),
+                    ports=frozenset([Port(internal_port=80,
+                                          external_port=8000 + i)])),
+                Application(
+                    name=u'database%d' % (i,),
+                    image=DockerImage.from_string(u'postgresql:9.4'),
+                    volume=AttachedVolume(
+                        manifestation=Manifestation(dataset=dataset,
+                                                    primary=True),
+                        mountpoint=FilePath(b"/var/lib/postgresql"))),
+            ])))
+    return Deployment(nodes=frozenset(nodes))
+
+
+def measure(function, argument):
+    """
+    :param function: One-argument callable to time.
+    :param argument: The argument to pass.
+
+    :return: Tuple of the best time in seconds over several runs and the
+        result of the last call.
+    """
+    best = None
+    for _ in range(5):
+        start = default_timer()
+        result = function(argument)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    """
+    Print a table of encoded sizes and encoding and decoding times.
+    """
+    print("{:>6} {:>8} {:>10} {:>10} {:>10}".format(
+        "nodes", "codec", "bytes", "encode ms", "decode ms"))
+    for count in NODE_COUNTS:
+        deployment = build_deployment(count)
+        for name, encode, decode in [(u"pickle", dumps, loads),
+                                     (u"wire", wire_encode, wire_decode)]:
+            encode_time, data = measure(encode, deployment)
+            decode_time, result = measure(decode, data)
+            assert result == deployment
+            print("{:>6} {:>8} {:>10} {:>10.2f} {:>10.2f}".format(
+                count, name, len(data), encode_time * 1000,
+                decode_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
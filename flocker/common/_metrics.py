@@ -0,0 +1,314 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.common.test.test_metrics -*-
+
+"""
+Aggregate statistics about a process, published in the Prometheus text
+exposition format.
+
+See http://prometheus.io/docs/instrumenting/exposition_formats/.
+"""
+
+from bisect import bisect_left
+
+
+# Suitable for durations in seconds of operations that are expected to be
+# quick:
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+# Suitable for sizes in bytes of messages:
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def _format_value(value):
+    """
+    :param value: A number.
+
+    :return bytes: The number formatted for the text format.
+    """
+    if value == float("inf"):
+        return b"+Inf"
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    """
+    :param tuple names: The names of some labels.
+    :param tuple values: The values of the labels.
+
+    :return bytes: The labels formatted for the text format.
+    """
+    if not names:
+        return b""
+    return b"{" + b",".join(
+        b'%s="%s"' % (name, unicode(value).encode("utf-8").replace(
+            b"\\", b"\\\\").replace(b'"', b'\\"').replace(b"\n", b"\\n"))
+        for name, value in zip(names, values)) + b"}"
+
+
+class _CounterValue(object):
+    """
+    The value of a counter for one set of label values.
+    """
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        """
+        Increase the counter.
+
+        :param amount: The amount to add, which must not be negative.
+        """
+        self.value += amount
+
+    def samples(self, name, label_names, label_values):
+        """
+        :param bytes name: The name of the metric.
+        :param tuple label_names: The names of the labels of the metric.
+        :param tuple label_values: The label values this value is for.
+
+        :return: Iterable of tuples of sample name, formatted labels and
+            value.
+        """
+        yield name, _format_labels(label_names, label_values), self.value
+
+
+class _GaugeValue(_CounterValue):
+    """
+    The value of a gauge for one set of label values.
+    """
+    def dec(self, amount=1):
+        """
+        Decrease the gauge.
+
+        :param amount: The amount to subtract.
+        """
+        self.value -= amount
+
+    def set(self, value):
+        """
+        Set the gauge.
+
+        :param value: The new value.
+        """
+        self.value = value
+
+
+class _HistogramValue(object):
+    """
+    The observations of a histogram for one set of label values.
+
+    :ivar list counts: The number of observations in each bucket, not
+        cumulative, with an extra bucket for those larger than all the
+        bounds.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        Record an observation.
+
+        :param value: The observed value.
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, label_names, label_values):
+        """
+        :see: ``_CounterValue.samples``
+        """
+        names = label_names + (b"le",)
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield (name + b"_bucket",
+                   _format_labels(names, label_values + (
+                       _format_value(bound),)),
+                   total)
+        labels = _format_labels(label_names, label_values)
+        yield name + b"_sum", labels, self.sum
+        yield name + b"_count", labels, total
+
+
+class _Metric(object):
+    """
+    A named statistic, with a value for each combination of label values.
+
+    Metrics without labels have a single value, returned by ``labels()``.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, label_names):
+        """
+        :param bytes name: The name of the metric.
+        :param bytes documentation: A description of the metric.
+        :param tuple label_names: The names of the labels of the metric.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = {}
+        if not label_names:
+            self.labels()
+
+    def _new_value(self):
+        """
+        :return: A new value for a combination of label values.
+        """
+        raise NotImplementedError()
+
+    def labels(self, *label_values):
+        """
+        :param label_values: A value for each of the metric's labels.
+
+        :return: The metric's value for those label values.
+        """
+        value = self._values.get(label_values)
+        if value is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError("Expected values for %r" % (
+                    self.label_names,))
+            value = self._values[label_values] = self._new_value()
+        return value
+
+    def render(self):
+        """
+        :return bytes: The metric in the text format.
+        """
+        lines = [b"# HELP %s %s" % (self.name, self.documentation),
+                 b"# TYPE %s %s" % (self.name, self.kind)]
+        for label_values, value in sorted(self._values.items()):
+            for name, labels, sample in value.samples(
+                    self.name, self.label_names, label_values):
+                lines.append(b"%s%s %s" % (
+                    name, labels, _format_value(sample)))
+        return b"\n".join(lines) + b"\n"
+
+
+class Counter(_Metric):
+    """
+    A metric which only increases, such as a number of events.
+    """
+    kind = b"counter"
+
+    def _new_value(self):
+        return _CounterValue()
+
+
+class Gauge(_Metric):
+    """
+    A metric which can increase and decrease, such as a number of ongoing
+    operations.
+    """
+    kind = b"gauge"
+
+    def _new_value(self):
+        return _GaugeValue()
+
+
+class Histogram(_Metric):
+    """
+    A metric counting observations, such as durations, in buckets.
+    """
+    kind = b"histogram"
+
+    def __init__(self, name, documentation, label_names, buckets):
+        """
+        :param tuple buckets: The upper bounds of the buckets, in increasing
+            order.
+        """
+        self.buckets = tuple(buckets)
+        _Metric.__init__(self, name, documentation, label_names)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+
+class MetricsRegistry(object):
+    """
+    A collection of metrics.
+
+    Metrics are created on first use and shared by all later users of the
+    same name, so that different parts of a process can contribute to them.
+
+    :ivar clock: ``IReactorTime`` provider used to time operations.
+    """
+    def __init__(self, clock=None):
+        """
+        :param clock: ``IReactorTime`` provider used to time operations.
+            Defaults to the global reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self._metrics = {}
+
+    def _metric(self, cls, name, *args):
+        """
+        Get or create a metric.
+
+        :param type cls: The ``_Metric`` subclass of the metric.
+        :param bytes name: The name of the metric.
+        :param args: Further arguments for ``cls`` if it is created.
+
+        :raises ValueError: If there is already a different kind of metric
+            with the name.
+
+        :return: The metric.
+        """
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args)
+        elif not isinstance(metric, cls):
+            raise ValueError("%s is already a %s" % (name, metric.kind))
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        """
+        Get or create a counter.
+
+        :param bytes name: The name of the metric.
+        :param bytes documentation: A description of the metric.
+        :param tuple label_names: The names of the labels of the metric.
+
+        :return Counter: The metric.
+        """
+        return self._metric(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, label_names=()):
+        """
+        Get or create a gauge.
+
+        :param bytes name: The name of the metric.
+        :param bytes documentation: A description of the metric.
+        :param tuple label_names: The names of the labels of the metric.
+
+        :return Gauge: The metric.
+        """
+        return self._metric(Gauge, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(),
+                  buckets=LATENCY_BUCKETS):
+        """
+        Get or create a histogram.
+
+        :param bytes name: The name of the metric.
+        :param bytes documentation: A description of the metric.
+        :param tuple label_names: The names of the labels of the metric.
+        :param tuple buckets: The upper bounds of the buckets, in increasing
+            order.
+
+        :return Histogram: The metric.
+        """
+        return self._metric(
+            Histogram, name, documentation, label_names, buckets)
+
+    def render(self):
+        """
+        :return bytes: All of the metrics in the text format.
+        """
+        return b"".join(self._metrics[name].render()
+                        for name in sorted(self._metrics))
@@ -0,0 +1,143 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.common.test.test_profile -*-
+
+"""
+Profiling of Flocker processes, enabled with the ``--profile`` and
+``--profile-interval`` options of ``flocker_standard_options``.
+"""
+
+import signal
+from cProfile import Profile
+from collections import Counter
+
+from twisted.python.filepath import FilePath
+
+
+class DeterministicProfiler(object):
+    """
+    Profile every function call with ``cProfile``.
+
+    The results are written in the ``pstats`` format, so they can be
+    examined with ``python -m pstats <path>`` or converted for other tools.
+    """
+    def __init__(self, path):
+        """
+        :param FilePath path: Where to write the results.
+        """
+        self.path = path
+        self._profile = Profile()
+        self._running = False
+
+    def start(self):
+        """
+        Start profiling.
+        """
+        self._running = True
+        self._profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling.
+        """
+        self._profile.disable()
+        self._running = False
+
+    def dump(self):
+        """
+        Write the results so far, replacing any previously written.
+
+        Profiling continues if it was running.
+        """
+        # Writing the results stops profiling, so it needs to be resumed:
+        self._profile.dump_stats(self.path.path)
+        if self._running:
+            self._profile.enable()
+
+
+class SamplingProfiler(object):
+    """
+    Profile by recording the call stack of the main thread periodically.
+
+    The overhead is much lower than ``DeterministicProfiler``'s, making it
+    suitable for production processes. The interval is measured in CPU time
+    used by the process, so idle processes aren't sampled.
+
+    The results are written with one line per distinct call stack, giving
+    the functions from outermost to innermost separated by semicolons
+    followed by the number of times the stack was seen. This is the format
+    read by flame graph tools.
+
+    :ivar Counter samples: Map call stacks, as ``bytes`` in the output
+        format, to the number of times they were seen.
+    """
+    def __init__(self, path, interval, signal_module=signal):
+        """
+        :param FilePath path: Where to write the results.
+        :param float interval: Seconds of CPU time between samples.
+        :param signal_module: An optional ``signal`` like module for use in
+            testing. Defaults to ``signal``.
+        """
+        self.path = path
+        self.interval = interval
+        self.samples = Counter()
+        self._signal = signal_module
+
+    def start(self):
+        """
+        Start sampling.
+        """
+        self._signal.signal(self._signal.SIGPROF, self._sample)
+        self._signal.setitimer(
+            self._signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        self._signal.setitimer(self._signal.ITIMER_PROF, 0, 0)
+        self._signal.signal(self._signal.SIGPROF, self._signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        """
+        Record the call stack which was interrupted.
+
+        :param int signum: The signal number.
+        :param frame: The innermost frame of the stack.
+        """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(b"%s:%d:%s" % (
+                code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        self.samples[b";".join(reversed(stack))] += 1
+
+    def dump(self):
+        """
+        Write the results so far, replacing any previously written.
+        """
+        temporary = self.path.temporarySibling()
+        temporary.setContent(b"".join(
+            b"%s %d\n" % (stack, count)
+            for stack, count in sorted(self.samples.items())))
+        temporary.moveTo(self.path)
+
+
+def profiler_from_options(options):
+    """
+    Create the profiler requested by command line options.
+
+    :param options: The parsed options of a command, which may include
+        those added by ``flocker_standard_options``.
+
+    :return: ``None`` if profiling wasn't requested, otherwise an unstarted
+        ``DeterministicProfiler`` or ``SamplingProfiler``.
+    """
+    path = options.get("profile")
+    if path is None:
+        return None
+    path = FilePath(path)
+    interval = options.get("profile-interval")
+    if interval is None:
+        return DeterministicProfiler(path)
+    return SamplingProfiler(path, interval)
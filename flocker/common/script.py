@@ -4,6 +4,7 @@
 
 import sys
 import os
+import signal
 
 from twisted.internet import task
 from twisted.internet.defer import Deferred, maybeDeferred
@@ -15,6 +16,7 @@ from twisted.python.log import (
 from zope.interface import Interface
 
 from .. import __version__
+from ._profile import profiler_from_options
 
 
 __all__ = [
@@ -43,9 +45,23 @@ def flocker_standard_options(cls):
         """
         self._sys_module = kwargs.pop('sys_module', sys)
         self['verbosity'] = 0
+        self['profile'] = None
+        self['profile-interval'] = None
         original_init(self, *args, **kwargs)
     cls.__init__ = __init__
 
+    original_postOptions = cls.postOptions
+
+    def postOptions(self):
+        """Check the profiling options are consistent.
+
+        Calls the original ``cls.postOptions`` method finally.
+        """
+        if self['profile-interval'] is not None and self['profile'] is None:
+            raise usage.UsageError("--profile-interval requires --profile.")
+        original_postOptions(self)
+    cls.postOptions = postOptions
+
     def opt_version(self):
         """Print the program's version and exit."""
         self._sys_module.stdout.write(__version__.encode('utf-8') + b'\n')
@@ -58,6 +74,27 @@ def flocker_standard_options(cls):
     cls.opt_verbose = opt_verbose
     cls.opt_v = opt_verbose
 
+    def opt_profile(self, path):
+        """Profile the command, writing the results to the given path when
+        it exits or receives SIGUSR1.
+        """
+        self['profile'] = path
+    cls.opt_profile = opt_profile
+
+    def opt_profile_interval(self, interval):
+        """Profile by sampling the call stack every given number of seconds
+        of CPU time, rather than by recording every function call. Requires
+        --profile.
+        """
+        try:
+            interval = float(interval)
+        except ValueError:
+            raise usage.UsageError("--profile-interval must be a number.")
+        if interval <= 0:
+            raise usage.UsageError("--profile-interval must be positive.")
+        self['profile-interval'] = interval
+    cls.opt_profile_interval = opt_profile_interval
+
     return cls
 
 
@@ -77,8 +114,11 @@ class FlockerScriptRunner(object):
     :ivar ICommandLineScript script: See ``script`` of ``__init__``.
     :ivar _react: A reference to ``task.react`` which can be overridden for
         testing purposes.
+    :ivar _signal: A reference to the ``signal`` module which can be
+        overridden for testing purposes.
     """
     _react = staticmethod(task.react)
+    _signal = signal
 
     # Location where logs will be written, overrideable by tests:
     log_directory = FilePath(b"/var/log/flocker/")
@@ -133,10 +173,21 @@ class FlockerScriptRunner(object):
             pass
 
         options = self._parse_options(self.sys_module.argv[1:])
-        # XXX: We shouldn't be using this private _reactor API. See
-        # https://twistedmatrix.com/trac/ticket/6200 and
-        # https://twistedmatrix.com/trac/ticket/7527
-        self._react(self.script.main, (options,), _reactor=self._reactor)
+        profiler = profiler_from_options(options)
+        if profiler is not None:
+            # Long-running services can be asked for results so far:
+            self._signal.signal(
+                self._signal.SIGUSR1, lambda signum, frame: profiler.dump())
+            profiler.start()
+        try:
+            # XXX: We shouldn't be using this private _reactor API. See
+            # https://twistedmatrix.com/trac/ticket/6200 and
+            # https://twistedmatrix.com/trac/ticket/7527
+            self._react(self.script.main, (options,), _reactor=self._reactor)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                profiler.dump()
 
         # Not strictly necessary, but nice cleanup for tests:
         if observer is not None:
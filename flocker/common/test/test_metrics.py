@@ -0,0 +1,121 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.common._metrics``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._metrics import MetricsRegistry
+
+
+class MetricsRegistryTests(SynchronousTestCase):
+    """
+    Tests for ``MetricsRegistry``.
+    """
+    def test_clock(self):
+        """
+        ``MetricsRegistry.clock`` is the given clock.
+        """
+        clock = Clock()
+        self.assertIs(MetricsRegistry(clock).clock, clock)
+
+    def test_same_metric(self):
+        """
+        Getting a metric with the same name twice returns the same object.
+        """
+        registry = MetricsRegistry()
+        self.assertIs(registry.counter(b"events", b"Events."),
+                      registry.counter(b"events", b"Events."))
+
+    def test_different_kind(self):
+        """
+        Getting a metric with the name of a different kind of metric raises
+        ``ValueError``.
+        """
+        registry = MetricsRegistry()
+        registry.counter(b"events", b"Events.")
+        self.assertRaises(ValueError, registry.gauge, b"events", b"Events.")
+
+    def test_wrong_labels(self):
+        """
+        ``labels`` raises ``ValueError`` if it isn't given a value for each
+        label of the metric.
+        """
+        counter = MetricsRegistry().counter(
+            b"events", b"Events.", (b"kind", b"origin"))
+        self.assertRaises(ValueError, counter.labels, u"a")
+
+    def test_counter(self):
+        """
+        A counter is rendered with its help, type and a sample for each
+        combination of label values, in order.
+        """
+        registry = MetricsRegistry()
+        counter = registry.counter(b"events", b"Events.", (b"kind",))
+        counter.labels(u"b").inc()
+        counter.labels(u"a").inc(2)
+        counter.labels(u"b").inc()
+        self.assertEqual(registry.render(), b"""\
+# HELP events Events.
+# TYPE events counter
+events{kind="a"} 2.0
+events{kind="b"} 2.0
+""")
+
+    def test_unlabelled(self):
+        """
+        A metric without labels has a single value, which is rendered even
+        if it was never changed.
+        """
+        registry = MetricsRegistry()
+        registry.counter(b"events", b"Events.")
+        registry.gauge(b"level", b"Level.").labels().set(5)
+        self.assertEqual(registry.render(), b"""\
+# HELP events Events.
+# TYPE events counter
+events 0.0
+# HELP level Level.
+# TYPE level gauge
+level 5.0
+""")
+
+    def test_gauge(self):
+        """
+        A gauge can be increased and decreased.
+        """
+        gauge = MetricsRegistry().gauge(b"level", b"Level.").labels()
+        gauge.inc(3)
+        gauge.dec()
+        self.assertEqual(gauge.value, 2)
+
+    def test_histogram(self):
+        """
+        A histogram is rendered with cumulative counts for each bucket, the
+        sum and the count of the observations.
+        """
+        registry = MetricsRegistry()
+        histogram = registry.histogram(
+            b"duration", b"Duration.", (b"kind",), buckets=(1, 10))
+        for value in [0.5, 1, 5, 20]:
+            histogram.labels(u"a").observe(value)
+        self.assertEqual(registry.render(), b"""\
+# HELP duration Duration.
+# TYPE duration histogram
+duration_bucket{kind="a",le="1.0"} 2.0
+duration_bucket{kind="a",le="10.0"} 3.0
+duration_bucket{kind="a",le="+Inf"} 4.0
+duration_sum{kind="a"} 26.5
+duration_count{kind="a"} 4.0
+""")
+
+    def test_label_escaping(self):
+        """
+        Backslashes, double quotes and newlines in label values are escaped.
+        """
+        registry = MetricsRegistry()
+        registry.counter(b"events", b"Events.", (b"kind",)).labels(
+            u'a\\b"c\nd').inc()
+        self.assertIn(b'events{kind="a\\\\b\\"c\\nd"} 1.0',
+                      registry.render())
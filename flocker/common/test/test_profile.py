@@ -0,0 +1,165 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.common._profile``.
+"""
+
+import signal
+import sys
+from pstats import Stats
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._profile import (
+    DeterministicProfiler, SamplingProfiler, profiler_from_options,
+)
+
+
+def profiled():
+    """
+    A function for profilers to find.
+    """
+    return sys._getframe()
+
+
+class FakeSignalModule(object):
+    """
+    A ``signal`` like substitute that records handlers and timers.
+
+    :ivar dict handlers: Map signal numbers to their handlers.
+    :ivar dict timers: Map timer numbers to tuples of their delay and
+        interval.
+    """
+    SIGPROF = signal.SIGPROF
+    SIGUSR1 = signal.SIGUSR1
+    ITIMER_PROF = signal.ITIMER_PROF
+    SIG_DFL = signal.SIG_DFL
+
+    def __init__(self):
+        self.handlers = {}
+        self.timers = {}
+
+    def signal(self, signum, handler):
+        self.handlers[signum] = handler
+
+    def setitimer(self, which, delay, interval):
+        self.timers[which] = (delay, interval)
+
+
+class DeterministicProfilerTests(SynchronousTestCase):
+    """
+    Tests for ``DeterministicProfiler``.
+    """
+    def test_dump(self):
+        """
+        ``DeterministicProfiler.dump`` writes ``pstats`` results including the
+        functions called while profiling.
+        """
+        path = FilePath(self.mktemp())
+        profiler = DeterministicProfiler(path)
+        profiler.start()
+        profiled()
+        profiler.stop()
+        profiler.dump()
+        self.assertIn(
+            profiled.__name__,
+            [name for (_, _, name) in Stats(path.path).stats])
+
+    def test_dump_while_running(self):
+        """
+        Profiling continues after ``DeterministicProfiler.dump`` is called
+        while profiling.
+        """
+        path = FilePath(self.mktemp())
+        profiler = DeterministicProfiler(path)
+        profiler.start()
+        profiler.dump()
+        profiled()
+        profiler.stop()
+        profiler.dump()
+        self.assertIn(
+            profiled.__name__,
+            [name for (_, _, name) in Stats(path.path).stats])
+
+
+class SamplingProfilerTests(SynchronousTestCase):
+    """
+    Tests for ``SamplingProfiler``.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        self.signal = FakeSignalModule()
+        self.profiler = SamplingProfiler(self.path, 0.01, self.signal)
+
+    def test_start(self):
+        """
+        ``SamplingProfiler.start`` arranges for ``SIGPROF`` to be received at
+        the interval, and to be handled by taking a sample.
+        """
+        self.profiler.start()
+        self.assertEqual(
+            (self.signal.handlers, self.signal.timers),
+            ({signal.SIGPROF: self.profiler._sample},
+             {signal.ITIMER_PROF: (0.01, 0.01)}))
+
+    def test_stop(self):
+        """
+        ``SamplingProfiler.stop`` stops the timer and restores the default
+        ``SIGPROF`` handler.
+        """
+        self.profiler.start()
+        self.profiler.stop()
+        self.assertEqual(
+            (self.signal.handlers, self.signal.timers),
+            ({signal.SIGPROF: signal.SIG_DFL},
+             {signal.ITIMER_PROF: (0, 0)}))
+
+    def test_dump(self):
+        """
+        ``SamplingProfiler.dump`` writes one line per distinct call stack,
+        with the functions from outermost to innermost followed by the
+        number of samples.
+        """
+        frame = profiled()
+        self.profiler._sample(signal.SIGPROF, frame)
+        self.profiler._sample(signal.SIGPROF, frame)
+        self.profiler.dump()
+        [line] = self.path.getContent().splitlines()
+        stack, count = line.rsplit(b" ", 1)
+        functions = stack.split(b";")
+        self.assertEqual(
+            (functions[-2].endswith(b":test_dump"),
+             functions[-1].endswith(b":profiled"), count),
+            (True, True, b"2"))
+
+
+class ProfilerFromOptionsTests(SynchronousTestCase):
+    """
+    Tests for ``profiler_from_options``.
+    """
+    def test_not_profiled(self):
+        """
+        ``None`` is returned if profiling wasn't requested.
+        """
+        self.assertIs(profiler_from_options({}), None)
+
+    def test_deterministic(self):
+        """
+        A ``DeterministicProfiler`` writing to the ``profile`` path is
+        returned if no sampling interval is given.
+        """
+        profiler = profiler_from_options(
+            {"profile": b"out.prof", "profile-interval": None})
+        self.assertEqual((type(profiler), profiler.path),
+                         (DeterministicProfiler, FilePath(b"out.prof")))
+
+    def test_sampling(self):
+        """
+        A ``SamplingProfiler`` is returned if a sampling interval is given.
+        """
+        profiler = profiler_from_options(
+            {"profile": b"out.prof", "profile-interval": 0.5})
+        self.assertEqual(
+            (type(profiler), profiler.path, profiler.interval),
+            (SamplingProfiler, FilePath(b"out.prof"), 0.5))
@@ -4,6 +4,8 @@
 
 import sys
 from os import getpid
+from pstats import Stats
+from signal import SIGUSR1
 
 from twisted.internet import task
 from twisted.internet.defer import succeed
@@ -22,6 +24,7 @@ from ...testtools import (
     skip_on_broken_permissions, attempt_effective_uid,
     MemoryCoreReactor,
     )
+from .test_profile import FakeSignalModule
 
 
 class FlockerScriptRunnerInitTests(SynchronousTestCase):
@@ -260,6 +263,59 @@ class TestOptions(usage.Options):
     """An unmodified ``usage.Options`` subclass for use in testing."""
 
 
+class FlockerScriptRunnerProfileTests(SynchronousTestCase):
+    """
+    Tests for :py:class:`FlockerScriptRunner` profiling.
+    """
+    def run_script(self, *arguments):
+        """
+        Run ``LoggingScript`` with the given arguments.
+
+        :param arguments: Command line arguments.
+
+        :return: The ``FakeSignalModule`` used by the runner.
+        """
+        sys = FakeSysModule(argv=[b"mythingie"] + list(arguments))
+        from twisted.test.test_task import _FakeReactor
+        runner = FlockerScriptRunner(LoggingScript(), TestOptions(),
+                                     reactor=_FakeReactor(), sys_module=sys)
+        runner.log_directory = FilePath(self.mktemp())
+        runner._signal = FakeSignalModule()
+        try:
+            runner.main()
+        except SystemExit:
+            pass
+        return runner._signal
+
+    def test_profile(self):
+        """
+        ``FlockerScriptRunner.main`` profiles the script if ``--profile`` is
+        given, writing the results when it exits.
+        """
+        path = FilePath(self.mktemp())
+        self.run_script(b"--profile", path.path)
+        self.assertIn(
+            LoggingScript.main.__name__,
+            [name for (_, _, name) in Stats(path.path).stats])
+
+    def test_dump_on_signal(self):
+        """
+        While profiling, ``SIGUSR1`` causes the results so far to be written.
+        """
+        path = FilePath(self.mktemp())
+        signal = self.run_script(b"--profile", path.path)
+        path.remove()
+        signal.handlers[SIGUSR1](SIGUSR1, None)
+        self.assertTrue(path.exists())
+
+    def test_not_profiled(self):
+        """
+        ``FlockerScriptRunner.main`` doesn't handle ``SIGUSR1`` if
+        ``--profile`` isn't given.
+        """
+        self.assertEqual(self.run_script().handlers, {})
+
+
 class FlockerStandardOptionsTests(StandardOptionsTestsMixin,
                                   SynchronousTestCase):
     """Tests for ``flocker_standard_options``
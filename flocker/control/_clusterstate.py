@@ -1,12 +1,17 @@
 # Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.control.test.test_clusterstate -*-
 
 """
 Combine and retrieve current cluster state.
 """
 
+from collections import deque
+
 from twisted.application.service import Service
+from twisted.internet.defer import Deferred, succeed
 
 from ._model import Deployment, Node
+from ._views import DeploymentIndex
 
 
 class ClusterStateService(Service):
@@ -17,9 +22,34 @@ class ClusterStateService(Service):
     https://clusterhq.atlassian.net/browse/FLOC-1269 will deal with
     semantics of expiring data, which should happen so stale information
     isn't treated as correct.
+
+    :ivar int generation: Incremented every time the cluster state changes.
+    :ivar dict _nodes: Map hostnames to the ``Node`` describing that node's
+        state.
+    :ivar Deployment _deployment: The current state of the cluster.
+    :ivar DeploymentIndex _index: Indexes of the state of the cluster, not
+        necessarily up to date.
+    :ivar deque _changed: ``(generation, dataset identifiers)`` tuples for
+        the recent generations in which the manifestations of any datasets
+        changed, oldest first.
+    :ivar int _horizon: The generation after which every change is recorded
+        in ``_changed``.
+    :ivar list _waiting: ``Deferred`` instances to fire when the generation
+        next changes.
     """
-    def __init__(self):
+    def __init__(self, change_retention=10000):
+        """
+        :param int change_retention: The number of generations for which to
+            remember which datasets changed.
+        """
+        self.generation = 0
         self._nodes = {}
+        self._deployment = Deployment(nodes=frozenset())
+        self._index = DeploymentIndex(self._deployment)
+        self._change_retention = change_retention
+        self._changed = deque()
+        self._horizon = 0
+        self._waiting = []
 
     def update_node_state(self, hostname, node_state):
         """
@@ -31,17 +61,105 @@ class ClusterStateService(Service):
         :param unicode hostname: The node's identifier.
         :param NodeState node_state: The state of the node.
         """
-        self._nodes[hostname] = node_state
+        node = Node(
+            hostname=hostname,
+            other_manifestations=node_state.other_manifestations,
+            applications=frozenset(
+                node_state.running + node_state.not_running))
+        old_node = self._nodes.get(hostname)
+        if old_node == node:
+            # Agents report their state periodically even if it hasn't
+            # changed, and not everything they report is part of the
+            # cluster state; there's no need to invalidate anything:
+            return
+        nodes = self._deployment.nodes
+        if old_node is not None:
+            nodes = nodes - frozenset([old_node])
+        self._nodes[hostname] = node
+        # Set operations reuse the hashes of the other nodes, so this is
+        # much cheaper than building a new set of nodes:
+        self._deployment = Deployment(nodes=nodes | frozenset([node]))
+        self.generation += 1
+        self._record_changes(old_node, node)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(self.generation)
+
+    def _record_changes(self, old_node, new_node):
+        """
+        Record which datasets changed in the current generation.
+
+        :param old_node: The previous ``Node`` for a hostname, or ``None``.
+        :param Node new_node: The new ``Node`` for that hostname.
+        """
+        old = {} if old_node is None else {
+            manifestation.dataset.dataset_id: manifestation
+            for manifestation in old_node.manifestations()}
+        new = {manifestation.dataset.dataset_id: manifestation
+               for manifestation in new_node.manifestations()}
+        changed = frozenset(
+            dataset_id for dataset_id in set(old) | set(new)
+            if old.get(dataset_id) != new.get(dataset_id))
+        if changed:
+            self._changed.append((self.generation, changed))
+        oldest = self.generation - self._change_retention
+        while self._changed and self._changed[0][0] <= oldest:
+            self._horizon = self._changed.popleft()[0]
+
+    def changed_datasets(self, generation):
+        """
+        Find the datasets whose manifestations changed after a generation.
+
+        :param int generation: A generation no later than the current one.
+
+        :return: A ``set`` of the identifiers of datasets which changed in
+            any later generation, including datasets which no longer have
+            any manifestations, or ``None`` if the generation is too old for
+            the changes since it to be known.
+        """
+        if generation < self._horizon:
+            return None
+        changed = set()
+        for changed_in, dataset_ids in reversed(self._changed):
+            if changed_in <= generation:
+                break
+            changed |= dataset_ids
+        return changed
+
+    def wait(self, generation):
+        """
+        Wait for the cluster state to change.
+
+        :param int generation: The generation to wait to be superseded.
+
+        :return Deferred: Fires with the current generation once it is later
+            than ``generation``. Cancelling it stops waiting.
+        """
+        if self.generation > generation:
+            return succeed(self.generation)
+        waiting = Deferred(lambda d: self._waiting.remove(d))
+        self._waiting.append(waiting)
+        return waiting
 
     def as_deployment(self):
         """
         Return cluster state as a Deployment object.
 
+        The same object is returned until the state changes, so callers can
+        cheaply tell whether anything changed.
+
         :return Deployment: Current state of the cluster.
         """
-        return Deployment(nodes=frozenset([
-            Node(hostname=hostname,
-                 other_manifestations=node_state.other_manifestations,
-                 applications=frozenset(
-                     node_state.running + node_state.not_running))
-            for hostname, node_state in self._nodes.items()]))
+        return self._deployment
+
+    def index(self):
+        """
+        Return indexes of the cluster state.
+
+        Only nodes whose state changed since the last call are re-indexed.
+
+        :return DeploymentIndex: Indexes of the result of ``as_deployment``.
+            They must not be mutated.
+        """
+        self._index.update(self._deployment)
+        return self._index
@@ -0,0 +1,139 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.control.test.test_diff -*-
+
+"""
+Structural differences between ``Deployment`` objects.
+
+These allow the control service to tell convergence agents only what has
+changed in the cluster since the last update, rather than sending the
+whole cluster every time.
+"""
+
+from characteristic import attributes, Attribute
+
+from ._model import Deployment, Node
+
+
+@attributes(["hostname",
+             Attribute("applications_removed", default_value=frozenset()),
+             Attribute("applications_added", default_value=frozenset()),
+             Attribute("manifestations_removed", default_value=frozenset()),
+             Attribute("manifestations_added", default_value=frozenset())])
+class NodeDiff(object):
+    """
+    The changes to a single ``Node``.
+
+    A changed application or manifestation is represented by removing the
+    old version and adding the new one.
+
+    :ivar unicode hostname: The hostname of the changed node.
+    :ivar frozenset applications_removed: The names of ``Application``
+        instances which are no longer on the node.
+    :ivar frozenset applications_added: ``Application`` instances which are
+        new on the node.
+    :ivar frozenset manifestations_removed: ``Manifestation`` instances which
+        are no longer in the node's ``other_manifestations``.
+    :ivar frozenset manifestations_added: ``Manifestation`` instances which
+        are new in the node's ``other_manifestations``.
+    """
+    def apply(self, node):
+        """
+        Apply these changes to a node.
+
+        :param Node node: The node to change.
+
+        :return Node: The changed node.
+        """
+        applications = frozenset(
+            application for application in node.applications
+            if application.name not in self.applications_removed)
+        manifestations = (
+            node.other_manifestations - self.manifestations_removed)
+        return Node(
+            hostname=node.hostname,
+            applications=applications | self.applications_added,
+            other_manifestations=manifestations | self.manifestations_added)
+
+
+@attributes([Attribute("nodes_removed", default_value=frozenset()),
+             Attribute("nodes_added", default_value=frozenset()),
+             Attribute("nodes_changed", default_value=frozenset())])
+class DeploymentDiff(object):
+    """
+    The changes between two ``Deployment`` instances.
+
+    :ivar frozenset nodes_removed: The hostnames of ``Node`` instances which
+        are no longer part of the deployment.
+    :ivar frozenset nodes_added: ``Node`` instances which are new in the
+        deployment.
+    :ivar frozenset nodes_changed: ``NodeDiff`` instances describing nodes
+        which are in both deployments but differ.
+    """
+    def apply(self, deployment):
+        """
+        Apply these changes to a deployment.
+
+        :param Deployment deployment: The deployment to change.
+
+        :raises KeyError: If a changed node is not part of ``deployment``.
+
+        :return Deployment: The changed deployment.
+        """
+        nodes = {node.hostname: node for node in deployment.nodes
+                 if node.hostname not in self.nodes_removed}
+        for node_diff in self.nodes_changed:
+            nodes[node_diff.hostname] = node_diff.apply(
+                nodes[node_diff.hostname])
+        for node in self.nodes_added:
+            nodes[node.hostname] = node
+        return Deployment(nodes=frozenset(nodes.values()))
+
+
+def _diff_nodes(old, new):
+    """
+    Calculate the changes between two versions of a node.
+
+    :param Node old: The old version of the node.
+    :param Node new: The new version of the node.
+
+    :return NodeDiff: The changes necessary to turn ``old`` into ``new``.
+    """
+    return NodeDiff(
+        hostname=new.hostname,
+        applications_removed=frozenset(
+            application.name for application
+            in old.applications - new.applications),
+        applications_added=new.applications - old.applications,
+        manifestations_removed=(
+            old.other_manifestations - new.other_manifestations),
+        manifestations_added=(
+            new.other_manifestations - old.other_manifestations))
+
+
+def diff_deployments(old, new):
+    """
+    Calculate the changes between two deployments.
+
+    :param Deployment old: The old deployment.
+    :param Deployment new: The new deployment.
+
+    :return DeploymentDiff: The changes which turn ``old`` into ``new`` when
+        applied.
+    """
+    old_nodes = {node.hostname: node for node in old.nodes}
+    new_nodes = {node.hostname: node for node in new.nodes}
+    nodes_added = []
+    nodes_changed = []
+    # Nodes that are equal in both deployments need no further attention:
+    for node in new.nodes - old.nodes:
+        old_node = old_nodes.get(node.hostname)
+        if old_node is None:
+            nodes_added.append(node)
+        else:
+            nodes_changed.append(_diff_nodes(old_node, node))
+    return DeploymentDiff(
+        nodes_removed=frozenset(
+            hostname for hostname in old_nodes
+            if hostname not in new_nodes),
+        nodes_added=frozenset(nodes_added),
+        nodes_changed=frozenset(nodes_changed))
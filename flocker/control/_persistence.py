@@ -1,19 +1,57 @@
 # Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.control.test.test_persistence -*-
 
 """
 Persistence of cluster configuration.
+
+The configuration is stored as a snapshot plus an append-only log of the
+changes made since the snapshot was written:
+
+* ``configuration.snapshot`` contains a single record with a complete
+  ``Deployment``.
+* ``configuration.log`` contains one record per saved configuration, each
+  with the ``DeploymentDiff`` from the previous configuration.
+
+Each record is a header giving a sequence number, the payload length and
+the payload's CRC32, followed by the payload encoded with
+``flocker.control._wire``. The snapshot's sequence number is that of the
+last change it includes, so log records it already covers are skipped when
+replaying. A partially written record at the end of the log, as left by a
+crash, is discarded.
+
+Saving therefore costs time proportional to the size of the change rather
+than of the whole configuration. Once the log reaches a certain number of
+records it is compacted into a new snapshot.
+
+Saves are group-committed: all saves made while a write is in progress, or
+within a configurable window of each other, are written as a single change
+with a single notification of registered callbacks.
+
+Each save is given a trace identifier, which follows the change out to the
+convergence agents so that the time taken for it to take effect on the
+cluster can be measured. See ``flocker.control._protocol``.
 """
 
+import os
 from pickle import dumps, loads
+from struct import Struct
+from uuid import uuid4
+from zlib import crc32
 
 from twisted.application.service import Service
-from twisted.internet.defer import succeed
+from twisted.python.failure import Failure
+from twisted.internet.defer import Deferred, DeferredLock, maybeDeferred
+from twisted.internet.threads import deferToThreadPool
 
 from ._model import Deployment
+from ._diff import DeploymentDiff, diff_deployments
+from ._wire import wire_encode, wire_decode
+from ._views import DeploymentIndex
 
 
 # These should not use Pickle!@!
 # https://clusterhq.atlassian.net/browse/FLOC-1241
+# They're now only used to read configuration saved by older versions.
 def serialize_deployment(deployment):
     """
     Convert a ``Deployment`` object to ``bytes``.
@@ -37,55 +75,317 @@ def deserialize_deployment(data):
     return loads(data)
 
 
+# Sequence number, payload length, payload CRC32:
+_RECORD_HEADER = Struct(b"!QII")
+
+_SNAPSHOT = b"configuration.snapshot"
+_LOG = b"configuration.log"
+_LEGACY = b"current_configuration.pickle"
+
+
+class CorruptConfiguration(Exception):
+    """
+    The persisted configuration could not be loaded.
+    """
+
+
+def _record(sequence, obj):
+    """
+    :param int sequence: The sequence number of the record.
+    :param obj: The object to store in the record.
+
+    :return bytes: The encoded record.
+    """
+    payload = wire_encode(obj)
+    return _RECORD_HEADER.pack(
+        sequence, len(payload), crc32(payload) & 0xffffffff) + payload
+
+
+def _read_records(data):
+    """
+    Parse the complete, valid records at the start of some data.
+
+    :param bytes data: Concatenated records.
+
+    :return: Tuple of a ``list`` of ``(sequence, payload)`` tuples and the
+        number of bytes of ``data`` they occupy.
+    """
+    records = []
+    offset = 0
+    while len(data) - offset >= _RECORD_HEADER.size:
+        sequence, length, checksum = _RECORD_HEADER.unpack_from(data, offset)
+        start = offset + _RECORD_HEADER.size
+        payload = data[start:start + length]
+        if (len(payload) < length or
+                crc32(payload) & 0xffffffff != checksum):
+            break
+        records.append((sequence, payload))
+        offset = start + length
+    return records, offset
+
+
+def _fsync_directory(path):
+    """
+    Make sure changes to the entries of a directory are on disk.
+
+    :param FilePath path: The directory.
+    """
+    fd = os.open(path.path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _ConfigurationStore(object):
+    """
+    Blocking storage of configuration as a snapshot and change log.
+
+    The methods of this class do file I/O and must not be called
+    concurrently.
+
+    :ivar int _sequence: Sequence number of the last change stored.
+    :ivar int _entries: Number of records in the log since the snapshot.
+    :ivar bool _unlogged: Whether storing a change failed, so the log no
+        longer describes the configuration and the next change must be
+        stored as a snapshot.
+    """
+    def __init__(self, path, snapshot_interval):
+        """
+        :param FilePath path: Directory in which to store the configuration.
+        :param int snapshot_interval: Number of log records after which the
+            log is compacted into a new snapshot.
+        """
+        self._path = path
+        self._snapshot_interval = snapshot_interval
+        self._sequence = 0
+        self._entries = 0
+        self._unlogged = False
+        self._log = None
+
+    def load(self):
+        """
+        Load the configuration, creating the storage if necessary.
+
+        :raises CorruptConfiguration: If the snapshot is unreadable or the log
+            doesn't apply to it.
+
+        :return Deployment: The stored configuration.
+        """
+        if not self._path.exists():
+            self._path.makedirs()
+        snapshot = self._path.child(_SNAPSHOT)
+        legacy = self._path.child(_LEGACY)
+        if not snapshot.exists():
+            if legacy.exists():
+                deployment = deserialize_deployment(legacy.getContent())
+            else:
+                deployment = Deployment(nodes=frozenset())
+            self.snapshot(deployment)
+            return deployment
+
+        records, _ = _read_records(snapshot.getContent())
+        if len(records) != 1:
+            raise CorruptConfiguration("Invalid snapshot %s" % (
+                snapshot.path,))
+        [(self._sequence, payload)] = records
+        deployment = wire_decode(payload)
+
+        log = self._path.child(_LOG)
+        data = log.getContent() if log.exists() else b""
+        records, length = _read_records(data)
+        for sequence, payload in records:
+            if sequence <= self._sequence:
+                # Already included in the snapshot:
+                continue
+            try:
+                deployment = wire_decode(payload).apply(deployment)
+            except KeyError:
+                raise CorruptConfiguration(
+                    "Change %d in %s doesn't apply" % (sequence, log.path))
+            self._sequence = sequence
+            self._entries += 1
+        self._log = open(log.path, "ab")
+        if length < len(data):
+            # Discard an incomplete record left by a crash:
+            self._log.truncate(length)
+        return deployment
+
+    def append(self, old, new):
+        """
+        Durably store a change to the configuration, compacting the log if
+        it has grown long enough.
+
+        :param Deployment old: The configuration before the change.
+        :param Deployment new: The configuration after the change.
+        """
+        if self._unlogged:
+            self.snapshot(new)
+            return
+        diff = diff_deployments(old, new)
+        if diff == DeploymentDiff():
+            return
+        try:
+            self._log.write(_record(self._sequence + 1, diff))
+            self._log.flush()
+            os.fsync(self._log.fileno())
+        except:
+            self._unlogged = True
+            raise
+        self._sequence += 1
+        self._entries += 1
+        if self._entries >= self._snapshot_interval:
+            self.snapshot(new)
+
+    def snapshot(self, deployment):
+        """
+        Durably store a complete configuration and empty the log.
+
+        :param Deployment deployment: The configuration to store.
+        """
+        self._unlogged = True
+        snapshot = self._path.child(_SNAPSHOT)
+        temporary = snapshot.temporarySibling()
+        with open(temporary.path, "wb") as f:
+            f.write(_record(self._sequence, deployment))
+            f.flush()
+            os.fsync(f.fileno())
+        temporary.moveTo(snapshot)
+        _fsync_directory(self._path)
+        # Log records up to the snapshot's sequence number are ignored from
+        # now on, so a crash before the log is emptied is harmless:
+        self.close()
+        self._log = open(self._path.child(_LOG).path, "wb")
+        self._entries = 0
+        self._unlogged = False
+
+    def close(self):
+        """
+        Close the log.
+        """
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
 class ConfigurationPersistenceService(Service):
     """
     Persist configuration to disk, and load it back.
 
+    File I/O for saves happens in the reactor's thread pool, one batch of
+    saves at a time.
+
     :ivar Deployment _deployment: The current desired deployment configuration.
+    :ivar DeploymentIndex _index: Indexes of the current configuration.
+    :ivar Deployment _durable: The configuration most recently written, or
+        being written, to disk.
+    :ivar list _waiting: ``Deferred`` instances for saves which will be
+        written by the next batch.
+    :ivar bool _scheduled: Whether the next batch has been scheduled.
+    :ivar _commit: ``IDelayedCall`` that will schedule the next batch at the
+        end of the commit window, or ``None``.
+    :ivar trace: ``None`` if nothing has been saved, otherwise a tuple of
+        the ``unicode`` trace identifier of the latest save and the time it
+        was made.
     """
-    def __init__(self, reactor, path):
+    def __init__(self, reactor, path, snapshot_interval=1000,
+                 commit_window=0, clock=None):
         """
-        :param reactor: Reactor to use for thread pool.
+        :param reactor: Reactor to use for thread pool and for timing the
+            commit window, or ``None`` to do file I/O synchronously.
         :param FilePath path: Directory where desired deployment will be
             persisted.
+        :param int snapshot_interval: Number of writes after which the change
+            log is compacted into a new snapshot.
+        :param float commit_window: Seconds to wait for further saves before
+            writing a save to disk. ``0`` writes as soon as any previous
+            write has finished. Ignored if ``reactor`` is ``None``.
+        :param clock: ``IReactorTime`` provider used to time saves. Defaults
+            to ``reactor``, or the global reactor if that is ``None``.
         """
+        if clock is None:
+            clock = reactor
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self._reactor = reactor
         self._path = path
+        self._store = _ConfigurationStore(path, snapshot_interval)
+        self.commit_window = commit_window
+        self._lock = DeferredLock()
+        self._waiting = []
+        self._scheduled = False
+        self._commit = None
         self._change_callbacks = []
+        self.trace = None
 
     def startService(self):
-        if not self._path.exists():
-            self._path.makedirs()
-        self._config_path = self._path.child(b"current_configuration.pickle")
-        if self._config_path.exists():
-            self._deployment = deserialize_deployment(
-                self._config_path.getContent())
-        else:
-            self._deployment = Deployment(nodes=frozenset())
-            self._sync_save(self._deployment)
+        self._deployment = self._durable = self._store.load()
+        self._index = DeploymentIndex(self._deployment)
 
-    def register(self, change_callback):
+    def stopService(self):
+        if self._commit is not None:
+            self._commit.cancel()
+            self._queue_batch()
+        return self._lock.run(self._io, self._store.close)
+
+    def _io(self, function, *args):
         """
-        Register a function to be called whenever the configuration changes.
+        Call a function that does file I/O.
 
-        :param change_callback: Callable that takes no arguments, will be
-            called when configuration changes.
+        :param function: The function to call.
+        :param args: Positional arguments for the function.
+
+        :return Deferred: Fires with the function's result.
         """
-        self._change_callbacks.append(change_callback)
+        if self._reactor is None:
+            return maybeDeferred(function, *args)
+        return deferToThreadPool(
+            self._reactor, self._reactor.getThreadPool(), function, *args)
 
-    def _sync_save(self, deployment):
+    def _queue_batch(self):
         """
-        Save and flush new deployment to disk synchronously.
+        Write a batch of saves once all previous writes have finished.
         """
-        self._config_path.setContent(serialize_deployment(deployment))
+        self._commit = None
+        self._lock.run(self._write_batch)
 
-    def save(self, deployment):
+    def _write_batch(self):
         """
-        Save and flush new deployment to disk.
+        Write the latest configuration, covering all saves made so far.
 
-        :return Deferred: Fires when write is finished.
+        :return Deferred: Fires when the write has finished.
         """
-        self._sync_save(deployment)
-        self._deployment = deployment
+        self._scheduled = False
+        waiting, self._waiting = self._waiting, []
+        previous, self._durable = self._durable, self._deployment
+        writing = self._io(self._store.append, previous, self._durable)
+        writing.addBoth(self._batch_written, waiting, previous)
+        return writing
+
+    def _batch_written(self, result, waiting, previous):
+        """
+        Notify registered callbacks and the callers of ``save`` that a batch
+        was written.
+
+        If writing failed the configuration reverts to the last one written,
+        unless further saves have been made since the batch started; those
+        are written by the next batch.
+
+        :param result: ``None``, or ``Failure`` if writing failed.
+        :param list waiting: ``Deferred`` instances for the saves in the
+            batch.
+        :param Deployment previous: The configuration written before this
+            batch.
+        """
+        if isinstance(result, Failure):
+            self._durable = previous
+            if not self._waiting:
+                self._deployment = previous
+                self._index.update(previous)
+            for d in waiting:
+                d.errback(result)
+            return
         # At some future point this will likely involve talking to a
         # distributed system (e.g. ZooKeeper or etcd), so the API doesn't
         # guarantee immediate saving of the data.
@@ -93,7 +393,44 @@ class ConfigurationPersistenceService(Service):
             # Handle errors by catching and logging them
             # https://clusterhq.atlassian.net/browse/FLOC-1311
             callback()
-        return succeed(None)
+        for d in waiting:
+            d.callback(None)
+
+    def register(self, change_callback):
+        """
+        Register a function to be called whenever the configuration changes.
+
+        :param change_callback: Callable that takes no arguments, will be
+            called when configuration changes.
+        """
+        self._change_callbacks.append(change_callback)
+
+    def save(self, deployment):
+        """
+        Save and flush new deployment to disk.
+
+        The new deployment is returned by ``get`` immediately, so that
+        further changes can be based on it. It is written to disk together
+        with any other saves made within the commit window or while a
+        previous write is in progress.
+
+        The save is given a new trace identifier, available from ``trace``.
+
+        :return Deferred: Fires when write is finished.
+        """
+        self.trace = (unicode(uuid4()), self._clock.seconds())
+        self._deployment = deployment
+        self._index.update(deployment)
+        saving = Deferred()
+        self._waiting.append(saving)
+        if not self._scheduled:
+            self._scheduled = True
+            if self._reactor is not None and self.commit_window > 0:
+                self._commit = self._reactor.callLater(
+                    self.commit_window, self._queue_batch)
+            else:
+                self._queue_batch()
+        return saving
 
     def get(self):
         """
@@ -104,3 +441,15 @@ class ConfigurationPersistenceService(Service):
         :return Deployment: The current desired configuration.
         """
         return self._deployment
+
+    def index(self):
+        """
+        Retrieve indexes of the current configuration.
+
+        The indexes are updated by ``save``, re-indexing only the nodes which
+        aren't the same objects as in the previous configuration.
+
+        :return DeploymentIndex: Indexes of the result of ``get``. They must
+            not be mutated.
+        """
+        return self._index
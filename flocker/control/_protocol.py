@@ -22,42 +22,208 @@ Interactions:
   NodeStateCommand, the control service then aggregates that update with
   the rest of the nodes' state and sends a ClusterStatusCommand to all
   convergence agents.
+
+Each distinct combination of configuration and state is numbered with a
+generation. Convergence agents which announce support for minor protocol
+version 1 via the VersionCommand are sent a ClusterStatusDeltaCommand
+describing only the changes since the generation they last received,
+rather than the full configuration and state. If the agent rejects the
+changes, the full ClusterStatusCommand is sent instead.
+
+Convergence agents which announce support for minor protocol version 2
+are, once they have reported the state of their node, only sent the parts
+of the configuration and state relevant to that node. See
+``flocker.control._views``.
+
+Each connection has at most one cluster status command outstanding at a
+time. Updates made while a command is outstanding are not queued: once the
+convergence agent responds, it is sent the latest configuration and state,
+superseding any intermediate versions. A slow convergence agent thus
+receives fewer updates rather than causing unbounded buffering in the
+control service.
+
+Cluster status commands carry the trace identifier of the latest saved
+configuration change. A convergence agent passes it back in the first
+NodeStateCommand reporting the state it reached after acting on that
+configuration, and the control service records how long the change took
+to converge on each node and on the whole cluster. The identifiers are
+optional arguments, so agents and control services which don't know about
+them interoperate with those that do.
 """
 
-from pickle import dumps, loads
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from zope.interface import Interface
 
+from eliot import Logger, MessageType, Field, writeFailure
+
 from twisted.application.service import Service
 from twisted.protocols.amp import (
-    Argument, Command, Integer, String, CommandLocator, BoxDispatcher, AMP,
+    Argument, Command, Integer, Unicode, CommandLocator, BoxDispatcher, AMP,
+    MAX_VALUE_LENGTH,
 )
+from twisted.internet.error import ConnectionClosed
 from twisted.internet.protocol import ServerFactory
 from twisted.application.internet import StreamServerEndpointService
 
-from ._persistence import serialize_deployment, deserialize_deployment
+from ..common import MetricsRegistry
+from ..common._metrics import SIZE_BUCKETS, LATENCY_BUCKETS
+from ._wire import wire_encode, wire_decode, WireDecoder
+from ._diff import diff_deployments
+from ._views import DeploymentIndex, cluster_view
+
+
+# The major protocol version supported by this implementation. Major
+# version 2 replaced pickle with ``flocker.control._wire``.
+PROTOCOL_MAJOR_VERSION = 2
+
+# The minor protocol version supported by this implementation. Minor
+# version 1 adds ClusterStatusDeltaCommand, minor version 2 adds filtering
+# of the cluster status to the parts relevant to the agent's node.
+PROTOCOL_MINOR_VERSION = 2
+
+# The minor protocol version required for ClusterStatusDeltaCommand:
+DELTA_MINOR_VERSION = 1
+
+# The minor protocol version required for filtered cluster status:
+FILTERED_MINOR_VERSION = 2
 
+# The maximum number of configuration changes whose convergence is tracked
+# at once; older ones are forgotten:
+MAX_TRACES = 1000
 
-class NodeStateArgument(Argument):
+# Suitable for the time taken for configuration changes to converge, in
+# seconds:
+CONVERGENCE_BUCKETS = LATENCY_BUCKETS + (30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+def _chunks(data):
     """
-    AMP argument that takes a ``NodeState`` object.
+    Split data into pieces small enough to be AMP values.
+
+    :param bytes data: The data to split.
+
+    :return tuple: ``bytes`` of at most ``MAX_VALUE_LENGTH`` each.
+    """
+    return tuple(data[i:i + MAX_VALUE_LENGTH]
+                 for i in range(0, max(len(data), 1), MAX_VALUE_LENGTH))
+
+
+class _CachingEncoder(object):
+    """
+    Encode objects with ``wire_encode``, optionally re-using the result of
+    encoding the same object earlier.
+
+    Sending the same ``ClusterStatusCommand`` to every connected agent
+    would otherwise serialize the same configuration and state once per
+    connection. Within a ``cache()`` block each distinct object is
+    serialized only once and the resulting ``bytes`` are shared by all
+    the boxes that are sent.
+
+    :ivar int encodes: Number of times an object was actually serialized
+        within the current (or most recent) ``cache()`` block.
+    :ivar int encoded_bytes: Total size of the serializations counted by
+        ``encodes``.
+    """
+    def __init__(self):
+        self._cache = None
+        self.encodes = 0
+        self.encoded_bytes = 0
+
+    def encode(self, obj):
+        """
+        Serialize an object, using a cached result if one is available.
+
+        :param obj: Object to serialize.
+
+        :return tuple: The serialized object, split into ``bytes`` small
+            enough to be AMP values.
+        """
+        if self._cache is None:
+            return _chunks(wire_encode(obj))
+        # Objects are kept alive by the caller for the duration of the
+        # cache() block, so their ids are stable and unique:
+        key = id(obj)
+        result = self._cache.get(key)
+        if result is None:
+            data = wire_encode(obj)
+            result = _chunks(data)
+            self._cache[key] = result
+            self.encodes += 1
+            self.encoded_bytes += len(data)
+        return result
+
+    @contextmanager
+    def cache(self):
+        """
+        Cache encoded results for the duration of the ``with`` block.
+        """
+        self._cache = {}
+        self.encodes = 0
+        self.encoded_bytes = 0
+        try:
+            yield self
+        finally:
+            self._cache = None
+
+
+_CACHING_ENCODER = _CachingEncoder()
+
+
+class _WireArgument(Argument):
+    """
+    AMP argument that takes an object encoded with ``wire_encode``.
+
+    AMP values are limited to 64KiB, so the encoded object is split across
+    as many keys of the box as necessary: ``<name>.0``, ``<name>.1`` and so
+    on. The pieces are decoded incrementally when the box is received.
     """
     def fromString(self, in_bytes):
-        return loads(in_bytes)
+        return wire_decode(in_bytes)
+
+    def toString(self, obj):
+        return wire_encode(obj)
+
+    def toBox(self, name, strings, objects, proto):
+        obj = self.retrieve(objects, name, proto)
+        for index, chunk in enumerate(_CACHING_ENCODER.encode(obj)):
+            strings[b"%s.%d" % (name, index)] = chunk
 
-    def toString(self, node_state):
-        return dumps(node_state)
+    def fromBox(self, name, strings, objects, proto):
+        decoder = WireDecoder()
+        index = 0
+        chunk = strings.get(b"%s.%d" % (name, index))
+        while chunk is not None:
+            decoder.feed(chunk)
+            index += 1
+            chunk = strings.get(b"%s.%d" % (name, index))
+        objects[name] = decoder.result()
 
 
-class DeploymentArgument(Argument):
+class NodeStateArgument(_WireArgument):
+    """
+    AMP argument that takes a ``NodeState`` object.
+    """
+
+
+class DeploymentArgument(_WireArgument):
     """
     AMP argument that takes a ``Deployment`` object.
     """
-    def fromString(self, in_bytes):
-        return deserialize_deployment(in_bytes)
 
-    def toString(self, deployment):
-        return serialize_deployment(deployment)
+
+class DeploymentDiffArgument(_WireArgument):
+    """
+    AMP argument that takes a ``DeploymentDiff`` object.
+    """
+
+
+class StaleGeneration(Exception):
+    """
+    A convergence agent was sent changes relative to a generation of the
+    cluster status which it does not have.
+    """
 
 
 class VersionCommand(Command):
@@ -65,9 +231,13 @@ class VersionCommand(Command):
     Return configuration protocol version of the control service.
 
     Semantic versioning: Major version changes implies incompatibility.
+
+    A convergence agent may pass the highest minor version it supports; the
+    response then includes the minor version both sides will use.
     """
-    arguments = []
-    response = [('major', Integer())]
+    arguments = [('minor', Integer(optional=True))]
+    response = [('major', Integer()),
+                ('minor', Integer(optional=True))]
 
 
 class ClusterStatusCommand(Command):
@@ -79,53 +249,155 @@ class ClusterStatusCommand(Command):
     in the convergence agent during startup.
     """
     arguments = [('configuration', DeploymentArgument()),
-                 ('state', DeploymentArgument())]
+                 ('state', DeploymentArgument()),
+                 ('generation', Integer(optional=True)),
+                 ('trace_id', Unicode(optional=True))]
+    response = []
+
+
+class ClusterStatusDeltaCommand(Command):
+    """
+    Used by the control service to inform a convergence agent of changes
+    to the cluster state and desired configuration since a generation the
+    agent was previously sent.
+
+    Only sent to agents which negotiated minor version
+    ``DELTA_MINOR_VERSION`` or later.
+    """
+    arguments = [('from_generation', Integer()),
+                 ('generation', Integer()),
+                 ('configuration', DeploymentDiffArgument()),
+                 ('state', DeploymentDiffArgument()),
+                 ('trace_id', Unicode(optional=True))]
     response = []
+    errors = {StaleGeneration: 'STALE_GENERATION'}
 
 
 class NodeStateCommand(Command):
     """
     Used by a convergence agent to update the control service about the
     status of a particular node.
+
+    ``trace_id`` identifies the latest configuration change the agent has
+    finished acting on, if it hasn't reported it before.
     """
-    arguments = [('hostname', String()),
-                 ('node_state', NodeStateArgument())]
+    arguments = [('hostname', Unicode()),
+                 ('node_state', NodeStateArgument()),
+                 ('trace_id', Unicode(optional=True))]
     response = []
 
 
+_CONNECTIONS = Field.forTypes(
+    u"connections", [int],
+    u"The number of connections the cluster status was sent to.")
+_ENCODES = Field.forTypes(
+    u"encodes", [int],
+    u"The number of times a deployment was serialized for the broadcast.")
+_ENCODED_BYTES = Field.forTypes(
+    u"encoded_bytes", [int],
+    u"The total size of the serialized deployments.")
+_NODE_UPDATES = Field.forTypes(
+    u"node_updates", [int],
+    u"The number of node state updates merged into the broadcast.")
+
+CLUSTER_STATUS_BROADCAST = MessageType(
+    u"flocker:control:cluster_status_broadcast",
+    [_CONNECTIONS, _ENCODES, _ENCODED_BYTES, _NODE_UPDATES],
+    u"The cluster status was sent to a set of connected agents.")
+
+_TRACE_ID = Field.forTypes(
+    u"trace_id", [unicode],
+    u"The trace identifier of a configuration change.")
+_SECONDS = Field.forTypes(
+    u"seconds", [float],
+    u"The time between the change being saved and it converging.")
+
+CHANGE_CONVERGED = MessageType(
+    u"flocker:control:change_converged",
+    [_TRACE_ID, _SECONDS],
+    u"All the convergence agents sent a configuration change have reported "
+    u"acting on it.")
+
+
 class ControlServiceLocator(CommandLocator):
     """
     Control service side of the protocol.
     """
-    def __init__(self, control_amp_service):
+    def __init__(self, control_amp_service, connection=None):
         """
         :param ControlAMPService control_amp_service: The service managing AMP
              connections to the control service.
+        :param ControlAMP connection: The connection this locator handles
+             commands for.
         """
         CommandLocator.__init__(self)
         self.control_amp_service = control_amp_service
+        self.connection = connection
 
     @VersionCommand.responder
-    def version(self):
-        return {"major": 1}
+    def version(self, minor):
+        if minor is None:
+            minor = 0
+        minor = min(minor, PROTOCOL_MINOR_VERSION)
+        if self.connection is not None:
+            self.connection.protocol_minor = minor
+        return {"major": PROTOCOL_MAJOR_VERSION, "minor": minor}
 
     @NodeStateCommand.responder
-    def node_changed(self, hostname, node_state):
-        self.control_amp_service.node_changed(hostname, node_state)
+    def node_changed(self, hostname, node_state, trace_id):
+        if self.connection is not None:
+            self.connection.hostname = hostname
+        self.control_amp_service.node_changed(hostname, node_state, trace_id)
         return {}
 
 
 class ControlAMP(AMP):
     """
     AMP protocol for control service server.
+
+    :ivar int protocol_minor: The minor protocol version negotiated with the
+        convergence agent.
+    :ivar generation: The generation of cluster status most recently sent
+        to the convergence agent, or ``None`` if none has been sent.
+    :ivar cluster_status: Tuple of the configuration ``Deployment`` and
+        state ``Deployment`` most recently sent to the convergence agent, or
+        ``None`` if none has been sent.
+    :ivar hostname: The hostname of the node the convergence agent reported
+        state for, or ``None`` if it hasn't done so yet.
+    :ivar bool in_flight: Whether a cluster status command has been sent
+        and not yet responded to.
+    :ivar bool pending: Whether the cluster status has changed since the
+        outstanding command was sent, so that the latest status needs to be
+        sent once it is responded to.
+    :ivar int superseded: Number of times a pending update was replaced by
+        a newer one before it could be sent.
+    :ivar trace_id: The trace identifier of the configuration change most
+        recently sent to the convergence agent, or ``None``.
     """
     def __init__(self, control_amp_service):
         """
         :param ControlAMPService control_amp_service: The service managing AMP
              connections to the control service.
         """
-        AMP.__init__(self, locator=ControlServiceLocator(control_amp_service))
+        AMP.__init__(self, locator=ControlServiceLocator(control_amp_service,
+                                                         self))
         self.control_amp_service = control_amp_service
+        self.protocol_minor = 0
+        self.generation = None
+        self.cluster_status = None
+        self.hostname = None
+        self.in_flight = False
+        self.pending = False
+        self.superseded = 0
+        self.trace_id = None
+
+    @property
+    def queue_depth(self):
+        """
+        The number of cluster status updates waiting for this connection,
+        including the outstanding one: at most 2.
+        """
+        return int(self.in_flight) + int(self.pending)
 
     def connectionMade(self):
         AMP.connectionMade(self)
@@ -141,46 +413,460 @@ class ControlAMPService(Service):
     Control Service AMP server.
 
     Convergence agents connect to this server.
+
+    Node state updates are coalesced: rather than notifying every agent as
+    soon as an update arrives, the service waits until no further updates
+    have arrived for ``broadcast_window`` seconds and then sends a single
+    broadcast covering all of them. A steady stream of updates delays the
+    broadcast by at most ``broadcast_max_delay`` seconds.
+
+    :ivar int broadcasts: Number of times cluster status was sent out.
+    :ivar int broadcast_encodes: Total number of deployment serializations
+        done for all broadcasts.
+    :ivar int broadcast_bytes: Total size of those serializations.
+    :ivar int node_updates: Total number of node state updates received.
+    :ivar int merged_node_updates: Number of node state updates covered by
+        the most recent broadcast.
+    :ivar int superseded: Total number of pending updates to connections
+        which were replaced by newer ones before they could be sent.
+    :ivar MetricsRegistry metrics: Statistics about connected agents,
+        broadcasts, how long agents take to respond to them and how long
+        configuration changes take to converge.
+    :ivar OrderedDict _traces: Map the trace identifiers of configuration
+        changes which haven't yet converged, oldest first, to tuples of the
+        time the change was saved and the ``set`` of hostnames of the nodes
+        which have yet to report acting on it.
+    :ivar _latest_trace_id: The trace identifier of the latest configuration
+        change that was sent out, or ``None``.
     """
-    def __init__(self, cluster_state, configuration_service, endpoint):
+    logger = Logger()
+
+    def __init__(self, cluster_state, configuration_service, endpoint,
+                 reactor=None, broadcast_window=0, broadcast_max_delay=None,
+                 metrics=None):
         """
         :param ClusterStateService cluster_state: Object that records known
             cluster state.
         :param ConfigurationPersistenceService configuration_service:
             Persistence service for desired cluster configuration.
         :param endpoint: Endpoint to listen on.
+        :param reactor: ``IReactorTime`` provider used to schedule coalesced
+            broadcasts. Defaults to the global reactor.
+        :param float broadcast_window: Seconds to wait for further node state
+            updates before broadcasting. ``0`` broadcasts immediately.
+        :param broadcast_max_delay: Maximum number of seconds a node state
+            update may be delayed by coalescing, or ``None`` to use
+            ``broadcast_window``.
+        :param MetricsRegistry metrics: Registry in which to record
+            statistics, or ``None`` to create one using ``reactor``.
         """
+        if reactor is None:
+            from twisted.internet import reactor
+        if metrics is None:
+            metrics = MetricsRegistry(reactor)
+        if broadcast_max_delay is None:
+            broadcast_max_delay = broadcast_window
+        self._reactor = reactor
+        self.broadcast_window = broadcast_window
+        self.broadcast_max_delay = max(broadcast_window, broadcast_max_delay)
+        self._pending_broadcast = None
+        self._pending_since = None
+        self._pending_updates = 0
+        self._generation = 0
+        self._latest = None
         self.connections = set()
+        self.broadcasts = 0
+        self.broadcast_encodes = 0
+        self.broadcast_bytes = 0
+        self.node_updates = 0
+        self.merged_node_updates = 0
+        self.superseded = 0
+        self.metrics = metrics
+        self._connected_agents = metrics.gauge(
+            b"flocker_control_connected_agents",
+            b"Convergence agents connected to the control service.",
+        ).labels()
+        self._queued_updates = metrics.gauge(
+            b"flocker_control_queued_updates",
+            b"Cluster status updates outstanding or waiting to be sent to "
+            b"convergence agents.",
+        ).labels()
+        self._node_updates = metrics.counter(
+            b"flocker_control_node_updates_total",
+            b"Node state updates received from convergence agents.",
+        ).labels()
+        self._broadcast_seconds = metrics.histogram(
+            b"flocker_control_broadcast_encode_seconds",
+            b"Time taken to serialize and send a cluster status broadcast.",
+        ).labels()
+        self._broadcast_bytes = metrics.histogram(
+            b"flocker_control_broadcast_bytes",
+            b"Serialized size of the deployments in a cluster status "
+            b"broadcast.",
+            buckets=SIZE_BUCKETS).labels()
+        self._round_trip = metrics.histogram(
+            b"flocker_control_cluster_status_seconds",
+            b"Time taken by convergence agents to respond to cluster status "
+            b"commands.",
+            (b"agent",))
+        self._node_convergence = metrics.histogram(
+            b"flocker_control_node_convergence_seconds",
+            b"Time from a configuration change being saved to a node "
+            b"reporting acting on it.",
+            (b"node",), CONVERGENCE_BUCKETS)
+        self._convergence = metrics.histogram(
+            b"flocker_control_convergence_seconds",
+            b"Time from a configuration change being saved to all the nodes "
+            b"it was sent to reporting acting on it.",
+            buckets=CONVERGENCE_BUCKETS).labels()
+        self._traces = OrderedDict()
+        self._latest_trace_id = None
         self.cluster_state = cluster_state
         self.configuration_service = configuration_service
         self.endpoint_service = StreamServerEndpointService(
             endpoint, ServerFactory.forProtocol(lambda: ControlAMP(self)))
         # When configuration changes, notify all connected clients:
-        self.configuration_service.register(
-            lambda: self._send_state_to_connections(self.connections))
+        self.configuration_service.register(self._broadcast)
 
     def startService(self):
         self.endpoint_service.startService()
 
     def stopService(self):
+        self._cancel_pending_broadcast()
         self.endpoint_service.stopService()
         for connection in self.connections:
             connection.transport.loseConnection()
 
-    def _send_state_to_connections(self, connections):
+    def _cancel_pending_broadcast(self):
         """
-        Send desired configuration and cluster state to all given connections.
+        Cancel a scheduled coalesced broadcast, if there is one.
+        """
+        if self._pending_broadcast is not None:
+            if self._pending_broadcast.active():
+                self._pending_broadcast.cancel()
+            self._pending_broadcast = None
+            self._pending_since = None
 
-        :param connections: A collection of ``AMP`` instances.
+    def _schedule_broadcast(self):
+        """
+        Arrange for a broadcast to all connections, coalescing it with any
+        other updates that arrive within the broadcast window.
+        """
+        self._pending_updates += 1
+        if self.broadcast_window <= 0:
+            self._broadcast()
+            return
+        now = self._reactor.seconds()
+        if self._pending_broadcast is None:
+            self._pending_since = now
+            self._pending_broadcast = self._reactor.callLater(
+                self.broadcast_window, self._broadcast)
+        else:
+            deadline = min(now + self.broadcast_window,
+                           self._pending_since + self.broadcast_max_delay)
+            self._pending_broadcast.reset(max(0, deadline - now))
+
+    def _broadcast(self):
+        """
+        Send desired configuration and cluster state to all connections,
+        covering all node state updates received so far.
+        """
+        self._cancel_pending_broadcast()
+        node_updates, self._pending_updates = self._pending_updates, 0
+        self.merged_node_updates = node_updates
+        self._send_state_to_connections(self.connections, node_updates)
+
+    def _current_generation(self):
+        """
+        Retrieve the current desired configuration and cluster state,
+        starting a new generation if either has changed.
+
+        :return: Tuple of the generation number, the configuration
+            ``Deployment`` and the state ``Deployment``.
         """
         configuration = self.configuration_service.get()
         state = self.cluster_state.as_deployment()
-        for connection in connections:
-            connection.callRemote(ClusterStatusCommand,
-                                  configuration=configuration,
-                                  state=state)
-            # Handle errors from callRemote by logging them
-            # https://clusterhq.atlassian.net/browse/FLOC-1311
+        if (self._latest is None or
+                (configuration, state) != self._latest[1:]):
+            self._generation += 1
+        # Keep the latest objects even if they're equal to the previous
+        # ones, since the services' indexes describe those:
+        self._latest = (self._generation, configuration, state)
+        return self._latest
+
+    def _cluster_view(self, connection, configuration, state):
+        """
+        Determine the configuration and state to send to a connection.
+
+        :param ControlAMP connection: The connection to send to.
+        :param Deployment configuration: The current configuration.
+        :param Deployment state: The current state.
+
+        :return: Tuple of configuration ``Deployment`` and state
+            ``Deployment``, restricted to the parts relevant to the
+            connection's node if it supports that.
+        """
+        if (connection.hostname is None or
+                connection.protocol_minor < FILTERED_MINOR_VERSION):
+            return configuration, state
+        return cluster_view(
+            connection.hostname,
+            self._index(self.configuration_service.index(), configuration),
+            self._index(self.cluster_state.index(), state))
+
+    def _index(self, index, deployment):
+        """
+        :param DeploymentIndex index: Indexes maintained by a service.
+        :param Deployment deployment: The deployment the indexes should
+            describe.
+
+        :return DeploymentIndex: ``index`` if it describes ``deployment``,
+            otherwise new indexes of ``deployment``.
+        """
+        if index.deployment is deployment:
+            return index
+        return DeploymentIndex(deployment)
+
+    def _set_queue(self, connection, in_flight, pending):
+        """
+        Change the state of a connection's queue of cluster status updates.
+
+        :param ControlAMP connection: The connection.
+        :param bool in_flight: Whether a command is outstanding.
+        :param bool pending: Whether an update is waiting to be sent.
+        """
+        before = connection.queue_depth
+        connection.in_flight = in_flight
+        connection.pending = pending
+        self._queued_updates.inc(connection.queue_depth - before)
+
+    def _start_trace(self):
+        """
+        Start tracking the convergence of the latest configuration change,
+        if that hasn't been done already.
+
+        :return: The trace identifier of the latest configuration change,
+            or ``None`` if there hasn't been one.
+        """
+        trace = self.configuration_service.trace
+        if trace is None:
+            return None
+        trace_id, saved = trace
+        if trace_id != self._latest_trace_id:
+            self._latest_trace_id = trace_id
+            hostnames = set(connection.hostname for connection
+                            in self.connections) - {None}
+            if hostnames:
+                self._traces[trace_id] = (saved, hostnames)
+                while len(self._traces) > MAX_TRACES:
+                    self._traces.popitem(last=False)
+        return trace_id
+
+    def _unchanged(self, connection, trace_id):
+        """
+        A connection didn't need to be sent a configuration change; stop
+        waiting for its node to report acting on the changes it wasn't sent.
+
+        :param ControlAMP connection: The connection.
+        :param trace_id: The trace identifier of the latest configuration
+            change, or ``None``.
+        """
+        for key in reversed(self._traces.keys()):
+            if key == connection.trace_id:
+                break
+            self._traces[key][1].discard(connection.hostname)
+            if not self._traces[key][1]:
+                del self._traces[key]
+        connection.trace_id = trace_id
+
+    def _converged(self, hostname, trace_id):
+        """
+        A node has reported acting on a configuration change, and so on all
+        earlier ones; record how long they took to converge.
+
+        :param unicode hostname: The hostname of the node.
+        :param unicode trace_id: The trace identifier of the change.
+        """
+        if trace_id not in self._traces:
+            return
+        now = self._reactor.seconds()
+        for key in self._traces.keys():
+            saved, hostnames = self._traces[key]
+            if hostname in hostnames:
+                hostnames.remove(hostname)
+                self._node_convergence.labels(hostname).observe(now - saved)
+                if not hostnames:
+                    del self._traces[key]
+                    self._convergence.observe(now - saved)
+                    CHANGE_CONVERGED(
+                        trace_id=key, seconds=float(now - saved),
+                    ).write(self.logger)
+            if key == trace_id:
+                break
+
+    def _send_state_to_connection(self, connection, generation,
+                                  configuration, state, changes, trace_id):
+        """
+        Send desired configuration and cluster state to a connection, as
+        changes since what it was last sent if possible.
+
+        :param ControlAMP connection: The connection to send to.
+        :param int generation: The current generation.
+        :param Deployment configuration: The current configuration.
+        :param Deployment state: The current state.
+        :param dict changes: Changes already calculated during this
+            broadcast, so connections which were sent the same cluster
+            status can share them.
+        :param trace_id: The trace identifier of the latest configuration
+            change, or ``None``.
+        """
+        if connection.in_flight:
+            # The latest status will be sent once the agent responds:
+            if connection.pending:
+                connection.superseded += 1
+                self.superseded += 1
+            self._set_queue(connection, True, True)
+            return
+        configuration, state = self._cluster_view(
+            connection, configuration, state)
+        sent = self._reactor.seconds()
+        previous = connection.cluster_status
+        if (previous is not None and
+                connection.protocol_minor >= DELTA_MINOR_VERSION):
+            if previous == (configuration, state):
+                # Nothing has changed since the last update:
+                self._unchanged(connection, trace_id)
+                return
+            key = tuple(id(deployment) for deployment
+                        in previous + (configuration, state))
+            if key not in changes:
+                # Keep the deployments alive so their ids aren't reused:
+                changes[key] = (
+                    previous, (configuration, state),
+                    diff_deployments(previous[0], configuration),
+                    diff_deployments(previous[1], state))
+            configuration_diff, state_diff = changes[key][2:]
+            from_generation = connection.generation
+            connection.generation = generation
+            connection.cluster_status = (configuration, state)
+            connection.trace_id = trace_id
+            d = connection.callRemote(
+                ClusterStatusDeltaCommand,
+                from_generation=from_generation, generation=generation,
+                configuration=configuration_diff, state=state_diff,
+                trace_id=trace_id)
+            d.addCallback(self._acknowledged, connection, sent)
+            d.addErrback(self._stale_generation, connection)
+        else:
+            connection.generation = generation
+            connection.cluster_status = (configuration, state)
+            connection.trace_id = trace_id
+            d = connection.callRemote(ClusterStatusCommand,
+                                      configuration=configuration,
+                                      state=state,
+                                      generation=generation,
+                                      trace_id=trace_id)
+            d.addCallback(self._acknowledged, connection, sent)
+        self._set_queue(connection, True, connection.pending)
+        d.addErrback(self._send_failed)
+        d.addCallback(lambda _: self._send_completed(connection))
+
+    def _acknowledged(self, result, connection, sent):
+        """
+        Record how long a convergence agent took to respond to a cluster
+        status command.
+
+        :param result: The response.
+        :param ControlAMP connection: The connection which responded.
+        :param float sent: The time the command was sent.
+
+        :return: ``result``.
+        """
+        self._round_trip.labels(connection.hostname or u"").observe(
+            self._reactor.seconds() - sent)
+        return result
+
+    def _stale_generation(self, reason, connection):
+        """
+        A convergence agent rejected changes; arrange for it to be sent the
+        full configuration and state instead.
+
+        :param Failure reason: The reason the changes were rejected.
+        :param ControlAMP connection: The connection which rejected them.
+        """
+        reason.trap(StaleGeneration)
+        connection.cluster_status = None
+        self._set_queue(connection, connection.in_flight, True)
+
+    def _send_failed(self, reason):
+        """
+        Log a failure to send cluster status to a convergence agent.
+
+        :param Failure reason: The reason sending failed.
+        """
+        if not reason.check(ConnectionClosed):
+            writeFailure(reason, self.logger, u"flocker:control")
+
+    def _send_completed(self, connection):
+        """
+        A convergence agent has responded to a cluster status command; send
+        it the latest cluster status if that has changed meanwhile.
+
+        :param ControlAMP connection: The connection which responded.
+        """
+        pending = connection.pending
+        self._set_queue(connection, False, False)
+        if pending:
+            if connection in self.connections:
+                self._send_latest_state(connection)
+
+    def _send_latest_state(self, connection):
+        """
+        Send the latest desired configuration and cluster state to a single
+        connection.
+
+        Unlike ``_send_state_to_connections`` this is not a broadcast, so it
+        is not counted, logged or measured as one.
+
+        :param ControlAMP connection: The connection to send to.
+        """
+        generation, configuration, state = self._current_generation()
+        trace_id = self._start_trace()
+        with _CACHING_ENCODER.cache():
+            self._send_state_to_connection(
+                connection, generation, configuration, state, {}, trace_id)
+
+    def _send_state_to_connections(self, connections, node_updates=0):
+        """
+        Send desired configuration and cluster state to all given connections.
+
+        The configuration and state, or the changes to them, are serialized
+        only once no matter how many connections there are.
+
+        :param connections: A collection of ``AMP`` instances.
+        :param int node_updates: The number of node state updates this
+            broadcast covers.
+        """
+        generation, configuration, state = self._current_generation()
+        trace_id = self._start_trace()
+        connections = list(connections)
+        changes = {}
+        started = self._reactor.seconds()
+        with _CACHING_ENCODER.cache() as encoder:
+            for connection in connections:
+                self._send_state_to_connection(
+                    connection, generation, configuration, state, changes,
+                    trace_id)
+            encodes, encoded_bytes = encoder.encodes, encoder.encoded_bytes
+        self._broadcast_seconds.observe(self._reactor.seconds() - started)
+        self._broadcast_bytes.observe(encoded_bytes)
+        self.broadcasts += 1
+        self.broadcast_encodes += encodes
+        self.broadcast_bytes += encoded_bytes
+        CLUSTER_STATUS_BROADCAST(
+            connections=len(connections), encodes=encodes,
+            encoded_bytes=encoded_bytes,
+            node_updates=node_updates).write(self.logger)
 
     def connected(self, connection):
         """
@@ -189,7 +875,8 @@ class ControlAMPService(Service):
         :param ControlAMP connection: The new connection.
         """
         self.connections.add(connection)
-        self._send_state_to_connections([connection])
+        self._connected_agents.set(len(self.connections))
+        self._send_latest_state(connection)
 
     def disconnected(self, connection):
         """
@@ -198,16 +885,29 @@ class ControlAMPService(Service):
         :param ControlAMP connection: The lost connection.
         """
         self.connections.remove(connection)
+        self._connected_agents.set(len(self.connections))
+        # Changes which only this node had yet to act on won't converge:
+        for key in self._traces.keys():
+            self._traces[key][1].discard(connection.hostname)
+            if not self._traces[key][1]:
+                del self._traces[key]
 
-    def node_changed(self, hostname, node_state):
+    def node_changed(self, hostname, node_state, trace_id=None):
         """
         We've received a node state update from a connected client.
 
         :param bytes hostname: The hostname of the node.
         :param NodeState node_state: The changed state for the node.
+        :param trace_id: The trace identifier of the latest configuration
+            change the node has acted on, if it is reporting it, otherwise
+            ``None``.
         """
         self.cluster_state.update_node_state(hostname, node_state)
-        self._send_state_to_connections(self.connections)
+        self.node_updates += 1
+        self._node_updates.inc()
+        if trace_id is not None:
+            self._converged(hostname, trace_id)
+        self._schedule_broadcast()
 
 
 class IConvergenceAgent(Interface):
@@ -227,7 +927,7 @@ class IConvergenceAgent(Interface):
         The client has disconnected from the control service.
         """
 
-    def cluster_updated(configuration, cluster_state):
+    def cluster_updated(configuration, cluster_state, trace_id):
         """
         The cluster's desired configuration or actual state have changed.
 
@@ -238,12 +938,20 @@ class IConvergenceAgent(Interface):
             cluster. Mostly useful for what it tells the agent about
             non-local state, since the agent's knowledge of local state is
             canonical.
+
+        :param trace_id: The trace identifier of the latest change to the
+            configuration, or ``None``. It should be passed to
+            ``Deployer.change_node_state`` and reported back in the next
+            ``NodeStateCommand`` sent after that has finished.
         """
 
 
 class _AgentLocator(CommandLocator):
     """
     Command locator for convergence agent.
+
+    Remembers the most recent cluster status so that changes to it can be
+    applied.
     """
     def __init__(self, agent):
         """
@@ -251,17 +959,39 @@ class _AgentLocator(CommandLocator):
         """
         CommandLocator.__init__(self)
         self.agent = agent
+        self._generation = None
+        self._configuration = None
+        self._state = None
 
     @ClusterStatusCommand.responder
-    def cluster_updated(self, configuration, state):
-        self.agent.cluster_updated(configuration, state)
+    def cluster_updated(self, configuration, state, generation, trace_id):
+        self._generation = generation
+        self._configuration = configuration
+        self._state = state
+        self.agent.cluster_updated(configuration, state, trace_id)
+        return {}
+
+    @ClusterStatusDeltaCommand.responder
+    def cluster_changed(self, from_generation, generation, configuration,
+                        state, trace_id):
+        if self._generation is None or from_generation != self._generation:
+            raise StaleGeneration()
+        self._generation = generation
+        self._configuration = configuration.apply(self._configuration)
+        self._state = state.apply(self._state)
+        self.agent.cluster_updated(self._configuration, self._state,
+                                   trace_id)
         return {}
 
 
 class _AgentBoxReceiver(BoxDispatcher):
     """
     Box receiver for convergence agent.
+
+    Negotiates the protocol version with the control service once connected.
     """
+    logger = Logger()
+
     def __init__(self, agent, locator):
         """
         :param IConvergenceAgent agent: Convergence agent to notify of changes.
@@ -273,6 +1003,18 @@ class _AgentBoxReceiver(BoxDispatcher):
     def startReceivingBoxes(self, box_sender):
         BoxDispatcher.startReceivingBoxes(self, box_sender)
         self.agent.connected()
+        d = self.callRemote(VersionCommand, minor=PROTOCOL_MINOR_VERSION)
+        d.addErrback(self._version_failed)
+
+    def _version_failed(self, reason):
+        """
+        Log failures to negotiate the protocol version, other than those due
+        to the connection being lost.
+
+        :param Failure reason: The reason negotiation failed.
+        """
+        if not reason.check(ConnectionClosed):
+            writeFailure(reason, self.logger, u"flocker:agent")
 
     def stopReceivingBoxes(self, reason):
         BoxDispatcher.stopReceivingBoxes(self, reason)
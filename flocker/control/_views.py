@@ -0,0 +1,235 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.control.test.test_views -*-
+
+"""
+Views of a cluster restricted to what is relevant to a single node.
+
+A convergence agent only needs to know about its own node and the parts of
+other nodes it interacts with:
+
+* Applications with ports on other nodes, which it proxies to.
+* Manifestations of datasets it has or wants, which it may need to hand
+  off, acquire or resize.
+
+See ``flocker.node._deploy.Deployer.calculate_necessary_state_changes`` and
+``flocker.node._deploy.find_dataset_changes`` for the code that relies on
+this information.
+"""
+
+from bisect import bisect_left, insort
+
+from ._model import Deployment, Node
+
+
+def _discard(ordered, value):
+    """
+    Remove a value from a sorted list if it is present.
+
+    :param list ordered: A sorted list.
+    :param value: The value to remove.
+    """
+    i = bisect_left(ordered, value)
+    if i < len(ordered) and ordered[i] == value:
+        del ordered[i]
+
+
+class DeploymentIndex(object):
+    """
+    Indexes of a ``Deployment`` allowing nodes and datasets to be looked up
+    without looking at every node.
+
+    The indexes can be updated to describe a new deployment, re-indexing
+    only the nodes which changed. Nodes are compared by identity, so this
+    is cheap when the new deployment was made by replacing some of the
+    nodes of the old one.
+
+    The indexes must not be mutated by users.
+
+    :ivar Deployment deployment: The indexed deployment.
+    :ivar dict nodes: Map hostnames to ``Node`` instances.
+    :ivar dict manifestations: Map dataset identifiers to ``dict`` mapping
+        the hostnames of the nodes which have a manifestation of that
+        dataset to the ``Manifestation``.
+    :ivar dict published: Map hostnames to ``Node`` instances containing only
+        those applications which expose ports, for nodes that have any.
+    :ivar list ordered: The identifiers of all datasets with manifestations,
+        sorted.
+    :ivar dict metadata: Map ``(key, value)`` metadata items to ``set`` of
+        ``(dataset_id, hostname)`` tuples identifying the manifestations of
+        datasets with that item.
+    :ivar list sizes: Sorted ``(maximum_size, dataset_id, hostname)`` tuples
+        for the manifestations of datasets with a maximum size.
+    """
+    def __init__(self, deployment):
+        """
+        :param Deployment deployment: The deployment to index.
+        """
+        self.deployment = None
+        self.nodes = {}
+        self.manifestations = {}
+        self.published = {}
+        self.ordered = []
+        self.metadata = {}
+        self.sizes = []
+        self.update(deployment)
+
+    def update(self, deployment):
+        """
+        Change the indexes to describe a new deployment.
+
+        :param Deployment deployment: The deployment to index.
+        """
+        if deployment is self.deployment:
+            return
+        nodes = {node.hostname: node for node in deployment.nodes}
+        for hostname, node in self.nodes.items():
+            if nodes.get(hostname) is not node:
+                self._remove(node)
+        for hostname, node in nodes.items():
+            if self.nodes.get(hostname) is not node:
+                self._add(node)
+        self.nodes = nodes
+        self.deployment = deployment
+
+    def _add(self, node):
+        """
+        Add a node to the indexes.
+
+        :param Node node: The node to add.
+        """
+        for manifestation in node.manifestations():
+            dataset = manifestation.dataset
+            by_hostname = self.manifestations.get(dataset.dataset_id)
+            if by_hostname is None:
+                by_hostname = self.manifestations[dataset.dataset_id] = {}
+                insort(self.ordered, dataset.dataset_id)
+            by_hostname[node.hostname] = manifestation
+            key = (dataset.dataset_id, node.hostname)
+            for item in dataset.metadata.items():
+                self.metadata.setdefault(item, set()).add(key)
+            if dataset.maximum_size is not None:
+                insort(self.sizes, (dataset.maximum_size,) + key)
+        published = frozenset(application for application
+                              in node.applications if application.ports)
+        if published:
+            self.published[node.hostname] = Node(
+                hostname=node.hostname, applications=published)
+
+    def _remove(self, node):
+        """
+        Remove a node from the indexes.
+
+        :param Node node: The node to remove.
+        """
+        for manifestation in node.manifestations():
+            dataset = manifestation.dataset
+            # The dataset may have appeared twice on the node, in which case
+            # it is already gone:
+            by_hostname = self.manifestations.get(dataset.dataset_id, {})
+            by_hostname.pop(node.hostname, None)
+            if not by_hostname and dataset.dataset_id in self.manifestations:
+                del self.manifestations[dataset.dataset_id]
+                _discard(self.ordered, dataset.dataset_id)
+            key = (dataset.dataset_id, node.hostname)
+            for item in dataset.metadata.items():
+                keys = self.metadata.get(item, set())
+                keys.discard(key)
+                if not keys:
+                    self.metadata.pop(item, None)
+            if dataset.maximum_size is not None:
+                _discard(self.sizes, (dataset.maximum_size,) + key)
+        self.published.pop(node.hostname, None)
+
+    def dataset_ids(self, hostname):
+        """
+        :param unicode hostname: The hostname of a node.
+
+        :return set: The identifiers of all datasets with manifestations on
+            the given node.
+        """
+        node = self.nodes.get(hostname)
+        if node is None:
+            return set()
+        return set(manifestation.dataset.dataset_id
+                   for manifestation in node.manifestations())
+
+
+def _relevant_parts(node, dataset_ids, include_published):
+    """
+    Restrict a node to the parts relevant to another node.
+
+    :param Node node: The node to restrict.
+    :param set dataset_ids: Identifiers of the datasets of interest.
+    :param bool include_published: Whether to include applications which
+        expose ports.
+
+    :return Node: ``node`` with only the relevant applications and
+        manifestations.
+    """
+    return Node(
+        hostname=node.hostname,
+        applications=frozenset(
+            application for application in node.applications
+            if (include_published and application.ports) or (
+                application.volume is not None and
+                application.volume.dataset.dataset_id in dataset_ids)),
+        other_manifestations=frozenset(
+            manifestation for manifestation in node.other_manifestations
+            if manifestation.dataset.dataset_id in dataset_ids))
+
+
+def _view(index, hostname, dataset_ids, include_published):
+    """
+    Extract the view of an indexed deployment relevant to a node.
+
+    :param DeploymentIndex index: The indexed deployment.
+    :param unicode hostname: The hostname of the node the view is for.
+    :param set dataset_ids: Identifiers of the datasets of interest.
+    :param bool include_published: Whether to include applications which
+        expose ports.
+
+    :return Deployment: The relevant parts of the deployment.
+    """
+    nodes = {}
+    if include_published:
+        nodes.update(index.published)
+    related = set()
+    for dataset_id in dataset_ids:
+        related.update(index.manifestations.get(dataset_id, ()))
+    related.discard(hostname)
+    for other in related:
+        nodes[other] = _relevant_parts(
+            index.nodes[other], dataset_ids, include_published)
+    nodes.pop(hostname, None)
+    node = index.nodes.get(hostname)
+    if node is not None:
+        nodes[hostname] = node
+    return Deployment(nodes=frozenset(nodes.values()))
+
+
+def cluster_view(hostname, configuration, state):
+    """
+    Extract the parts of the desired configuration and cluster state which
+    are relevant to the convergence agent for a particular node.
+
+    The node's own configuration and state are included in full. Other nodes
+    are included only with their applications that expose ports (from the
+    configuration) and their applications and manifestations using datasets
+    the node has or wants. Nodes with nothing relevant are omitted.
+
+    If the configuration has datasets without an identifier the agent must
+    match them by name against the whole cluster, so no filtering is done.
+
+    :param unicode hostname: The hostname of the node.
+    :param DeploymentIndex configuration: The indexed desired configuration.
+    :param DeploymentIndex state: The indexed cluster state.
+
+    :return: Tuple of configuration ``Deployment`` and state ``Deployment``
+        for the node.
+    """
+    if None in configuration.manifestations:
+        return configuration.deployment, state.deployment
+    dataset_ids = (configuration.dataset_ids(hostname) |
+                   state.dataset_ids(hostname))
+    return (_view(configuration, hostname, dataset_ids, True),
+            _view(state, hostname, dataset_ids, False))
@@ -0,0 +1,350 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.control.test.test_wire -*-
+
+"""
+Serialization of configuration and state for communication between the
+control service and convergence agents.
+
+The encoding is versioned and compact:
+
+* Encoded data starts with a three byte header: ``b"FW"`` followed by the
+  version number as a single byte.
+* The header is followed by frames, each a four byte big-endian length
+  followed by that many bytes of JSON. A ``Deployment`` is encoded as a
+  frame giving the number of nodes followed by one frame per ``Node``, so
+  it can be decoded a node at a time as data arrives. Anything else is
+  encoded as a single frame.
+* Records from ``flocker.control._model`` and ``flocker.control._diff`` are
+  encoded as JSON arrays of the class name followed by attribute values in
+  declaration order. Other containers are also arrays, tagged with a
+  single letter: ``L`` for ``list``, ``T`` for ``tuple``, ``S`` for
+  ``frozenset``, ``s`` for ``set``, ``M`` for ``PMap`` (alternating keys
+  and values), ``P`` for ``FilePath`` and ``B`` for ``bytes``.
+* Records and strings of ``_INTERN_MINIMUM`` or more characters are
+  interned: each occurrence after the first of an equal value is replaced
+  by ``["$", index]`` where ``index`` counts such values in the order they
+  were first completely encoded. Both sides traverse values in the same
+  order so no table needs to be sent. A cluster typically runs the same
+  applications with the same images on many nodes, so this keeps the
+  encoding of large deployments small.
+"""
+
+from json import dumps, loads
+from struct import Struct
+
+from pyrsistent import PMap, pmap
+
+from twisted.python.filepath import FilePath
+
+from ._model import (
+    DockerImage, AttachedVolume, RestartNever, RestartAlways,
+    RestartOnFailure, Application, Manifestation, Dataset, Node, Deployment,
+    Port, Link, NodeState,
+)
+from ._diff import NodeDiff, DeploymentDiff
+
+
+WIRE_VERSION = 1
+
+_HEADER = b"FW" + chr(WIRE_VERSION)
+_LENGTH = Struct(b"!I")
+
+# Shorter strings take less space written out than as a reference:
+_INTERN_MINIMUM = 8
+
+_RECORDS = {cls.__name__: cls for cls in [
+    DockerImage, AttachedVolume, RestartNever, RestartAlways,
+    RestartOnFailure, Application, Manifestation, Dataset, Node, Deployment,
+    Port, Link, NodeState, NodeDiff, DeploymentDiff,
+]}
+
+# Marks the first frame of a Deployment encoded a node at a time:
+_DEPLOYMENT_FRAMES = u"Deployment*"
+
+# Marks a value that hasn't been decoded yet:
+_NOTHING = object()
+
+
+class WireDecodeError(ValueError):
+    """
+    Data could not be decoded.
+    """
+
+
+def _attribute_names(cls):
+    """
+    :param type cls: A ``characteristic``-decorated class.
+
+    :return list: The names of the attributes of the class, in declaration
+        order.
+    """
+    return [attribute.name for attribute in cls.characteristic_attributes]
+
+
+class _Encoder(object):
+    """
+    Convert objects to JSON-compatible values, interning repeated strings
+    and records.
+
+    The same ``_Encoder`` must be used for all frames of a single encoded
+    value.
+    """
+    def __init__(self):
+        self._interned = {}
+
+    def _string(self, value):
+        if len(value) < _INTERN_MINIMUM:
+            return value
+        index = self._interned.get(value)
+        if index is not None:
+            return [u"$", index]
+        self._interned[value] = len(self._interned)
+        return value
+
+    def _record(self, obj):
+        try:
+            index = self._interned.get(obj)
+        except TypeError:
+            # Records containing lists can't be interned:
+            hashable = False
+        else:
+            if index is not None:
+                return [u"$", index]
+            hashable = True
+        encode = self.encode
+        result = [obj.__class__.__name__] + [
+            encode(getattr(obj, attribute))
+            for attribute in _attribute_names(obj.__class__)]
+        if hashable:
+            self._interned[obj] = len(self._interned)
+        return result
+
+    def encode(self, obj):
+        """
+        :param obj: The object to convert.
+
+        :raises TypeError: If the object (or something it contains) can't
+            be encoded.
+
+        :return: A JSON-compatible value.
+        """
+        encode = self.encode
+        if obj is None or isinstance(obj, (bool, int, long, float)):
+            return obj
+        if isinstance(obj, unicode):
+            return self._string(obj)
+        if isinstance(obj, bytes):
+            return [u"B", self._string(obj.decode("latin-1"))]
+        if isinstance(obj, list):
+            return [u"L"] + [encode(item) for item in obj]
+        if isinstance(obj, tuple):
+            return [u"T"] + [encode(item) for item in obj]
+        if isinstance(obj, frozenset):
+            return [u"S"] + [encode(item) for item in obj]
+        if isinstance(obj, set):
+            return [u"s"] + [encode(item) for item in obj]
+        if isinstance(obj, PMap):
+            result = [u"M"]
+            for key, value in obj.items():
+                result.append(encode(key))
+                result.append(encode(value))
+            return result
+        if isinstance(obj, FilePath):
+            return [u"P", self._string(obj.path.decode("latin-1"))]
+        if _RECORDS.get(obj.__class__.__name__) is not obj.__class__:
+            raise TypeError("Can't encode %r" % (obj,))
+        return self._record(obj)
+
+
+class _Decoder(object):
+    """
+    Convert JSON-compatible values created by ``_Encoder`` back to objects.
+
+    The same ``_Decoder`` must be used for all frames of a single encoded
+    value.
+    """
+    def __init__(self):
+        self._interned = []
+
+    def _string(self, value):
+        if len(value) >= _INTERN_MINIMUM:
+            self._interned.append(value)
+        return value
+
+    def _record(self, cls, values):
+        obj = cls(**dict(zip(_attribute_names(cls),
+                             [self.decode(item) for item in values])))
+        try:
+            hash(obj)
+        except TypeError:
+            pass
+        else:
+            self._interned.append(obj)
+        return obj
+
+    def decode(self, value):
+        """
+        :param value: A JSON-compatible value created by ``_Encoder``.
+
+        :raises WireDecodeError: If the value is not valid.
+
+        :return: The decoded object.
+        """
+        if isinstance(value, unicode):
+            return self._string(value)
+        if not isinstance(value, list):
+            return value
+        try:
+            tag = value[0]
+            decode = self.decode
+            if tag == u"$":
+                return self._interned[value[1]]
+            if tag == u"B":
+                return decode(value[1]).encode("latin-1")
+            if tag == u"L":
+                return [decode(item) for item in value[1:]]
+            if tag == u"T":
+                return tuple(decode(item) for item in value[1:])
+            if tag == u"S":
+                return frozenset(decode(item) for item in value[1:])
+            if tag == u"s":
+                return set(decode(item) for item in value[1:])
+            if tag == u"M":
+                items = [decode(item) for item in value[1:]]
+                return pmap(dict(zip(items[::2], items[1::2])))
+            if tag == u"P":
+                return FilePath(decode(value[1]).encode("latin-1"))
+            return self._record(_RECORDS[tag], value[1:])
+        except WireDecodeError:
+            raise
+        except Exception as e:
+            raise WireDecodeError("Invalid value %r: %s" % (value, e))
+
+
+def _frame(value):
+    """
+    :param value: A JSON-compatible value.
+
+    :return bytes: A length-prefixed frame containing the value as JSON.
+    """
+    data = dumps(value, separators=(",", ":"))
+    return _LENGTH.pack(len(data)) + data
+
+
+def wire_encode(obj):
+    """
+    Encode an object for sending to the control service or a convergence
+    agent.
+
+    :param obj: A ``Deployment``, ``NodeState``, ``DeploymentDiff`` or other
+        object made of records from ``flocker.control._model``.
+
+    :raises TypeError: If the object can't be encoded.
+
+    :return bytes: The encoded object.
+    """
+    encoder = _Encoder()
+    if isinstance(obj, Deployment):
+        frames = [_frame([_DEPLOYMENT_FRAMES, len(obj.nodes)])]
+        frames.extend(_frame(encoder.encode(node)) for node in obj.nodes)
+    else:
+        frames = [_frame(encoder.encode(obj))]
+    return _HEADER + b"".join(frames)
+
+
+class WireDecoder(object):
+    """
+    Incrementally decode data created by ``wire_encode``.
+
+    Data may be passed to ``feed`` in arbitrarily sized pieces as it
+    arrives; each complete frame is decoded as soon as it is available.
+    """
+    def __init__(self):
+        self._buffer = b""
+        self._header = False
+        self._decoder = _Decoder()
+        self._result = _NOTHING
+        self._nodes = None
+        self._remaining = None
+
+    def feed(self, data):
+        """
+        Decode more data.
+
+        :param bytes data: The next part of the encoded value.
+
+        :raises WireDecodeError: If the data is not valid.
+        """
+        self._buffer += data
+        if not self._header:
+            if len(self._buffer) < len(_HEADER):
+                return
+            if self._buffer[:len(_HEADER)] != _HEADER:
+                raise WireDecodeError(
+                    "Unsupported header %r" % (self._buffer[:len(_HEADER)],))
+            self._buffer = self._buffer[len(_HEADER):]
+            self._header = True
+        offset = 0
+        while len(self._buffer) - offset >= _LENGTH.size:
+            (length,) = _LENGTH.unpack_from(self._buffer, offset)
+            end = offset + _LENGTH.size + length
+            if len(self._buffer) < end:
+                break
+            self._frame_received(self._buffer[offset + _LENGTH.size:end])
+            offset = end
+        self._buffer = self._buffer[offset:]
+
+    def _frame_received(self, frame):
+        """
+        Decode a single complete frame.
+
+        :param bytes frame: The JSON contents of the frame.
+        """
+        if self._remaining == 0 or (
+                self._remaining is None and self._result is not _NOTHING):
+            raise WireDecodeError("Unexpected data after end of value")
+        try:
+            value = loads(frame)
+        except ValueError as e:
+            raise WireDecodeError("Invalid frame: %s" % (e,))
+        if self._remaining is not None:
+            self._nodes.append(self._decoder.decode(value))
+            self._remaining -= 1
+        elif (isinstance(value, list) and value and
+              value[0] == _DEPLOYMENT_FRAMES):
+            self._nodes = []
+            self._remaining = value[1]
+        else:
+            self._result = self._decoder.decode(value)
+
+    def result(self):
+        """
+        :raises WireDecodeError: If the value has not been completely
+            received.
+
+        :return: The decoded object.
+        """
+        if self._buffer or not self._header:
+            raise WireDecodeError("Incomplete data")
+        if self._remaining is not None:
+            if self._remaining:
+                raise WireDecodeError("Incomplete data")
+            return Deployment(nodes=frozenset(self._nodes))
+        if self._result is _NOTHING:
+            raise WireDecodeError("Incomplete data")
+        return self._result
+
+
+def wire_decode(data):
+    """
+    Decode data created by ``wire_encode``.
+
+    :param bytes data: The encoded object.
+
+    :raises WireDecodeError: If the data is not valid.
+
+    :return: The decoded object.
+    """
+    decoder = WireDecoder()
+    decoder.feed(data)
+    return decoder.result()
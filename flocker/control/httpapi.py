@@ -4,12 +4,15 @@ A HTTP REST API for controlling the Dataset Manager.
 """
 
 import yaml
+from bisect import bisect_left, bisect_right
+from hashlib import sha1
+from itertools import islice
 from uuid import uuid4
 
 from pyrsistent import pmap, thaw
 
 from twisted.python.filepath import FilePath
-from twisted.web.http import CONFLICT, CREATED
+from twisted.web.http import CONFLICT, CREATED, OK
 from twisted.web.server import Site
 from twisted.web.resource import Resource
 from twisted.application.internet import StreamServerEndpointService
@@ -17,9 +20,12 @@ from twisted.application.internet import StreamServerEndpointService
 from klein import Klein
 
 from ..restapi import (
-    EndpointResponse, structured, user_documentation, make_bad_request
+    EndpointResponse, structured, user_documentation, make_bad_request,
+    InvalidRequestJSON, get_validator,
 )
 from . import Dataset, Manifestation, Node, Deployment
+from ._views import DeploymentIndex
+from ..common import MetricsRegistry
 from .. import __version__
 
 
@@ -32,10 +38,20 @@ SCHEMAS = {
     }
 
 
+# Individual datasets are validated separately when created in bulk, so
+# that each can fail on its own:
+_DATASET_VALIDATOR = get_validator(
+    {'$ref': '/v1/endpoints.json#/definitions/datasets'}, SCHEMAS)
+
+
 DATASET_ID_COLLISION = make_bad_request(
     code=CONFLICT, description=u"The provided dataset_id is already in use.")
 PRIMARY_NODE_NOT_FOUND = make_bad_request(
     description=u"The provided primary node is not part of the cluster.")
+WATCH_WITH_QUERY = make_bad_request(
+    description=u"The watch argument can't be combined with other arguments.")
+WATCH_INVALID = make_bad_request(
+    description=u"The watch argument isn't a generation of the cluster state.")
 
 
 class DatasetAPIUserV1(object):
@@ -45,19 +61,41 @@ class DatasetAPIUserV1(object):
     The APIs exposed here typically operate on cluster configuration.  They
     frequently return success results when a configuration change has been made
     durable but has not yet been deployed onto the cluster.
+
+    :ivar int output_validation: Validate one in this many responses against
+        their schema, or none if ``0``.
+    :ivar MetricsRegistry metrics: Statistics about the API and the rest of
+        the control service.
     """
     app = Klein()
 
-    def __init__(self, persistence_service, cluster_state_service):
+    def __init__(self, persistence_service, cluster_state_service,
+                 output_validation=1, metrics=None):
         """
         :param ConfigurationPersistenceService persistence_service: Service
             for retrieving and setting desired configuration.
 
         :param ClusterStateService cluster_state_service: Service that
             knows about the current state of the cluster.
+
+        :param int output_validation: Validate one in this many responses
+            against their schema, or none if ``0``.
+
+        :param MetricsRegistry metrics: Registry in which to record
+            statistics about the API, or ``None`` to create a new one.
         """
         self.persistence_service = persistence_service
         self.cluster_state_service = cluster_state_service
+        self.output_validation = output_validation
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self.metrics = metrics
+        # Generations start from zero whenever the control service starts,
+        # so entity tags and watched generations also identify this
+        # instance:
+        self._instance = uuid4().hex
+        self._state_datasets = (None, None)
+        self._state_changes = (None, None)
 
     @app.route("/version", methods=['GET'])
     @user_documentation("""
@@ -74,6 +112,19 @@ class DatasetAPIUserV1(object):
         """
         return {u"flocker":  __version__}
 
+    @app.route("/metrics", methods=['GET'])
+    @user_documentation("""
+        Get statistics about the API and the rest of the control service in
+        the Prometheus text format.
+        """)
+    def get_metrics(self, request):
+        """
+        Return the current statistics in the Prometheus text format.
+        """
+        request.responseHeaders.setRawHeaders(
+            b"content-type", [b"text/plain; version=0.0.4"])
+        return self.metrics.render()
+
     @app.route("/datasets", methods=['POST'])
     @user_documentation(
         """
@@ -120,90 +171,424 @@ class DatasetAPIUserV1(object):
             cluster configuration or giving error information if this is not
             possible.
         """
-        if dataset_id is None:
-            dataset_id = unicode(uuid4())
-        dataset_id = dataset_id.lower()
-
-        if metadata is None:
-            metadata = {}
-
         # Use persistence_service to get a Deployment for the cluster
-        # configuration.
-        deployment = self.persistence_service.get()
-        for node in deployment.nodes:
-            for manifestation in node.manifestations():
-                if manifestation.dataset.dataset_id == dataset_id:
-                    raise DATASET_ID_COLLISION
+        # configuration, along with indexes of it.
+        index = self.persistence_service.index()
+        manifestation, result = _new_dataset(
+            primary, dataset_id, maximum_size, metadata)
+        if manifestation.dataset.dataset_id in index.manifestations:
+            raise DATASET_ID_COLLISION
 
         # XXX Check cluster state to determine if the given primary node
         # actually exists.  If not, raise PRIMARY_NODE_NOT_FOUND.
         # See FLOC-1278
 
-        dataset = Dataset(
-            dataset_id=dataset_id,
-            maximum_size=maximum_size,
-            metadata=pmap(metadata)
-        )
-        manifestation = Manifestation(dataset=dataset, primary=True)
-
-        primary_nodes = list(
-            node for node in deployment.nodes if primary == node.hostname
-        )
-        if len(primary_nodes) == 0:
-            # The node wasn't found in the configuration so create a new node
-            # to which a manifestation can be added.  FLOC-1278 will make sure
-            # we're not creating nonsense configuration in this step.
-            primary_node = Node(hostname=primary)
-        else:
-            # One was found.  Add the manifestation to it.
-            (primary_node,) = primary_nodes
+        saving = self.persistence_service.save(
+            _add_manifestations(index, {primary: [manifestation]}))
+        saving.addCallback(lambda _: EndpointResponse(CREATED, result))
+        return saving
 
-        new_node_config = Node(
-            hostname=primary_node.hostname,
-            applications=primary_node.applications,
-            other_manifestations=(
-                primary_node.other_manifestations | frozenset({manifestation})
-            )
-        )
-        other_nodes = frozenset(
-            node for node in deployment.nodes if node is not primary_node
-        )
-        new_deployment = Deployment(
-            nodes=other_nodes | frozenset({new_node_config})
-        )
-        saving = self.persistence_service.save(new_deployment)
-
-        def saved(ignored):
-            result = {
-                u"dataset_id": dataset_id,
-                u"primary": primary,
-                u"metadata": metadata,
-            }
-            if maximum_size is not None:
-                result[u"maximum_size"] = maximum_size
-            return EndpointResponse(CREATED, result)
-        saving.addCallback(saved)
+    @app.route("/datasets/bulk", methods=['POST'])
+    @user_documentation(
+        """
+        Create many new datasets at once.
+
+        Each item of ``datasets`` is handled like the body of a request to
+        create a single dataset, but all of the datasets are added to the
+        cluster configuration in a single change.  The response has a result
+        for each item, in the same order: either ``dataset``, describing the
+        dataset which was added, or ``error``, describing why it wasn't.
+        """,
+        examples=[u"create datasets in bulk"]
+    )
+    @structured(
+        inputSchema={'$ref': '/v1/endpoints.json#/definitions/bulk_datasets'},
+        outputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/bulk_datasets_results'
+            },
+        schema_store=SCHEMAS
+    )
+    def create_datasets(self, datasets):
+        """
+        Create new datasets in the cluster configuration.
+
+        :param list datasets: ``dict`` instances with the same structure as
+            the arguments of ``create_dataset``.
+
+        :return: A ``list`` with a ``dict`` for each item of ``datasets``,
+            describing either the dataset which has been added to the
+            cluster configuration or why it could not be added.
+        """
+        index = self.persistence_service.index()
+        results = []
+        added = {}
+        for item in datasets:
+            errors = [error.message
+                      for error in _DATASET_VALIDATOR.iter_errors(item)]
+            if errors:
+                results.append({u"error": InvalidRequestJSON(
+                    errors=errors, schema=None).result})
+                continue
+            manifestation, result = _new_dataset(**item)
+            dataset_id = manifestation.dataset.dataset_id
+            if dataset_id in index.manifestations or any(
+                    dataset_id in by_id for by_id in added.itervalues()):
+                results.append({u"error": DATASET_ID_COLLISION.result})
+                continue
+            added.setdefault(item[u"primary"], {})[dataset_id] = manifestation
+            results.append({u"dataset": result})
+
+        if not added:
+            return results
+        saving = self.persistence_service.save(_add_manifestations(
+            index, {primary: by_id.values()
+                    for primary, by_id in added.iteritems()}))
+        saving.addCallback(lambda _: results)
         return saving
 
     @app.route("/state/datasets", methods=['GET'])
     @user_documentation("""
         Get current cluster datasets.
-        """, examples=[u"get state datasets"])
+
+        The response has an ``ETag`` header which changes whenever the
+        cluster state changes. If the request has an ``If-None-Match`` header
+        with the same value the response is ``304 Not Modified`` and has an
+        empty body.
+
+        The datasets can be restricted to those with their primary
+        manifestation on a particular node, those with a particular metadata
+        item, and those with a ``maximum_size`` in a range.  If ``limit`` is
+        given the response is a page of at most that many datasets, ordered
+        by ``dataset_id``, along with a ``next`` cursor if there are more.
+        Pass that as the ``cursor`` argument to get the next page.
+
+        If the ``watch`` argument is given the response is instead held
+        until the cluster state is newer than the given generation.  It then
+        describes the datasets which changed since that generation and the
+        new generation, to be watched by the next request.  If the
+        generation is ``0``, or the control service can no longer tell what
+        changed since it, the response is sent at once and has ``full`` set
+        to ``true``: it describes every dataset, and any others the client
+        knows about have gone.  This can't be combined with the other
+        arguments.
+        """, examples=[u"get state datasets",
+                       u"get state datasets page"])
     @structured(
-        inputSchema={},
+        inputSchema={
+            '$ref': '/v1/endpoints.json#/definitions/state_datasets_query'
+            },
         outputSchema={
-            '$ref': '/v1/endpoints.json#/definitions/datasets_array'
+            '$ref': '/v1/endpoints.json#/definitions/state_datasets'
             },
         schema_store=SCHEMAS
     )
-    def datasets(self):
+    def datasets(self, watch=None, **query):
         """
         Return the current primary datasets in the cluster.
 
-        :return: A ``list`` containing all datasets in the cluster.
+        :param unicode watch: A generation of the cluster state to wait to
+            be superseded, as given out in an earlier response, ``0`` to
+            describe all datasets as changes, or ``None`` to return all
+            datasets immediately.
+
+        :param query: The other query arguments, as described by
+            ``/v1/endpoints.json#/definitions/state_datasets_query``.
+
+        :return: An ``EndpointResponse`` with a ``list`` containing all
+            datasets in the cluster, or those selected by ``query``, tagged
+            with the cluster state's generation.  If ``watch`` was given, a
+            ``Deferred`` firing with a ``dict`` describing the changes since
+            that generation instead.
+        """
+        if watch is not None and query:
+            raise WATCH_WITH_QUERY
+        if query:
+            return self._query(**query)
+        if watch is not None:
+            since = self._watched_generation(watch)
+            if since is None:
+                # The client doesn't know the current state at all, so it is
+                # told about everything straight away:
+                return self._changes(
+                    None, self.cluster_state_service.generation)
+            waiting = self.cluster_state_service.wait(since)
+            waiting.addCallback(
+                lambda generation: self._changes(since, generation))
+            return waiting
+
+        generation = self.cluster_state_service.generation
+        if self._state_datasets[0] != generation:
+            index = self.cluster_state_service.index()
+            self._state_datasets = (
+                generation, list(datasets_from_index(index)))
+        return EndpointResponse(
+            OK, self._state_datasets[1],
+            etag=b"%s-%d" % (self._instance, generation))
+
+    def _query(self, primary=None, metadata_key=None, metadata_value=None,
+               minimum_size=None, maximum_size=None, cursor=None,
+               limit=None):
         """
-        deployment = self.cluster_state_service.as_deployment()
-        return list(datasets_from_deployment(deployment))
+        Return selected primary datasets in the cluster.
+
+        :see: ``select_datasets`` for the arguments, which are given as
+            ``unicode`` strings.
+
+        :return: An ``EndpointResponse`` with a ``list`` of the datasets, or
+            a ``dict`` describing a page of them if ``limit`` was given,
+            tagged with the cluster state's generation and the arguments.
+        """
+        generation = self.cluster_state_service.generation
+        etag = b"%s-%d-%s" % (
+            self._instance, generation,
+            sha1(repr((primary, metadata_key, metadata_value, minimum_size,
+                       maximum_size, cursor, limit))).hexdigest())
+        metadata = None
+        if metadata_key is not None:
+            metadata = (metadata_key, metadata_value)
+        datasets, next_cursor = select_datasets(
+            self.cluster_state_service.index(), primary=primary,
+            metadata=metadata,
+            minimum_size=_optional_int(minimum_size),
+            maximum_size=_optional_int(maximum_size),
+            after=cursor, limit=_optional_int(limit))
+        if limit is None:
+            return EndpointResponse(OK, datasets, etag=etag)
+        result = {u"datasets": datasets}
+        if next_cursor is not None:
+            result[u"next"] = next_cursor
+        return EndpointResponse(OK, result, etag=etag)
+
+    def _watched_generation(self, watch):
+        """
+        Find the generation a ``watch`` argument refers to.
+
+        :param unicode watch: ``0``, or the ``generation`` of an earlier
+            response describing changes.
+
+        :raises BadRequest: If the argument isn't a generation.
+
+        :return: The ``int`` generation, or ``None`` if the argument was
+            ``0`` or was given out by an earlier instance of the control
+            service, whose generations are unrelated to the current ones.
+        """
+        try:
+            instance, _, generation = watch.encode("ascii").partition(b"-")
+            if instance != self._instance:
+                return None
+            generation = int(generation)
+        except ValueError:
+            raise WATCH_INVALID
+        if generation > self.cluster_state_service.generation:
+            return None
+        return generation
+
+    def _changes(self, since, generation):
+        """
+        Describe the changes to the cluster state's datasets between two
+        generations.
+
+        The result is cached, since all requests watching the same
+        generation are answered at once when the state changes.
+
+        :param since: The earlier ``int`` generation, or ``None`` to describe
+            all of the datasets.  All of them are also described if the
+            changes since the generation have been forgotten.
+        :param int generation: The current generation.
+
+        :return: A ``dict`` conforming to
+            ``/v1/endpoints.json#/definitions/dataset_changes``.
+        """
+        if self._state_changes[0] != (since, generation):
+            index = self.cluster_state_service.index()
+            changed = None
+            if since is not None:
+                changed = self.cluster_state_service.changed_datasets(since)
+            if changed is None:
+                datasets = list(datasets_from_index(index))
+                removed = set()
+            else:
+                datasets = list(datasets_from_index(index, changed))
+                removed = changed - set(
+                    dataset[u"dataset_id"] for dataset in datasets)
+            self._state_changes = ((since, generation), {
+                u"generation": (
+                    b"%s-%d" % (self._instance, generation)).decode("ascii"),
+                u"full": changed is None,
+                u"datasets": datasets,
+                u"removed": sorted(removed),
+            })
+        return self._state_changes[1]
+
+
+def _new_dataset(primary, dataset_id=None, maximum_size=None, metadata=None):
+    """
+    Create the primary manifestation of a new dataset from the arguments of
+    a request to create it.
+
+    :param unicode primary: The address of the node on which the primary
+        manifestation of the dataset will be created.
+    :param unicode dataset_id: A unique identifier to assign to the dataset,
+        or ``None`` to generate one.
+    :param int maximum_size: The maximum number of bytes the dataset will be
+        capable of storing, or ``None``.
+    :param dict metadata: Unicode key/value pairs to associate with the
+        dataset, or ``None``.
+
+    :return: Tuple of the ``Manifestation`` and a ``dict`` describing the
+        dataset in the API's format.
+    """
+    if dataset_id is None:
+        dataset_id = unicode(uuid4())
+    dataset_id = dataset_id.lower()
+
+    if metadata is None:
+        metadata = {}
+
+    dataset = Dataset(
+        dataset_id=dataset_id,
+        maximum_size=maximum_size,
+        metadata=pmap(metadata)
+    )
+    result = {
+        u"dataset_id": dataset_id,
+        u"primary": primary,
+        u"metadata": metadata,
+    }
+    if maximum_size is not None:
+        result[u"maximum_size"] = maximum_size
+    return Manifestation(dataset=dataset, primary=True), result
+
+
+def _add_manifestations(index, manifestations):
+    """
+    Add manifestations to the nodes of a deployment.
+
+    :param DeploymentIndex index: Indexes of the deployment to change.
+    :param dict manifestations: Map hostnames to iterables of
+        ``Manifestation`` instances to add to that node.
+
+    :return Deployment: The new deployment.
+    """
+    old_nodes = []
+    new_nodes = []
+    for hostname, added in manifestations.iteritems():
+        node = index.nodes.get(hostname)
+        if node is None:
+            # The node wasn't found in the configuration so create a new node
+            # to which a manifestation can be added.  FLOC-1278 will make sure
+            # we're not creating nonsense configuration in this step.
+            node = Node(hostname=hostname)
+        else:
+            old_nodes.append(node)
+        new_nodes.append(Node(
+            hostname=node.hostname,
+            applications=node.applications,
+            other_manifestations=(
+                node.other_manifestations | frozenset(added)
+            )
+        ))
+    # Set operations reuse the hashes of the other nodes, so this is
+    # much cheaper than building a new set of nodes:
+    return Deployment(
+        nodes=index.deployment.nodes - frozenset(old_nodes) |
+        frozenset(new_nodes)
+    )
+
+
+def _optional_int(value):
+    """
+    :param value: A ``unicode`` string of decimal digits, or ``None``.
+
+    :return: The ``int`` value, or ``None``.
+    """
+    if value is None:
+        return None
+    return int(value)
+
+
+def select_datasets(index, primary=None, metadata=None, minimum_size=None,
+                    maximum_size=None, after=None, limit=None):
+    """
+    Extract selected primary datasets from the supplied deployment indexes,
+    in order of their identifiers.
+
+    The indexes are used to find the manifestations matching each given
+    criterion, so only those need to be looked at.
+
+    :param DeploymentIndex index: Indexes of a ``Deployment`` describing the
+        state of the cluster.
+    :param unicode primary: Only include datasets with their primary
+        manifestation on the node with this hostname, or ``None``.
+    :param tuple metadata: Only include datasets with this ``(key, value)``
+        metadata item, or ``None``.
+    :param int minimum_size: Only include datasets with a maximum size of at
+        least this, or ``None``.
+    :param int maximum_size: Only include datasets with a maximum size of at
+        most this, or ``None``.
+    :param unicode after: Only include datasets whose identifiers sort after
+        this one, or ``None``.
+    :param int limit: The maximum number of datasets to include, or ``None``.
+
+    :return: Tuple of a ``list`` of dataset ``dict`` instances and the
+        identifier of the last dataset included if there are more, or
+        ``None``.
+    """
+    selections = []
+    if primary is not None:
+        node = index.nodes.get(primary)
+        selections.append(set() if node is None else set(
+            (manifestation.dataset.dataset_id, primary)
+            for manifestation in node.manifestations()))
+    if metadata is not None:
+        selections.append(index.metadata.get(metadata, set()))
+    if minimum_size is not None or maximum_size is not None:
+        start = 0
+        if minimum_size is not None:
+            start = bisect_left(index.sizes, (minimum_size,))
+        end = len(index.sizes)
+        if maximum_size is not None:
+            end = bisect_left(index.sizes, (maximum_size + 1,))
+        selections.append(set(
+            entry[1:] for entry in islice(index.sizes, start, end)))
+
+    if selections:
+        selections.sort(key=len)
+        keys = selections[0].intersection(*selections[1:])
+        keys = sorted(key for key in keys if after is None or key[0] > after)
+    else:
+        keys = _manifestation_keys(index, after)
+
+    datasets = []
+    for dataset_id, hostname in keys:
+        manifestation = index.manifestations[dataset_id][hostname]
+        if not manifestation.primary:
+            continue
+        # There may be more than one primary manifestation of a dataset
+        # (see FLOC-1303), so pages end between datasets:
+        last = datasets[-1][u"dataset_id"] if datasets else None
+        if len(datasets) == limit and dataset_id != last:
+            return datasets, last
+        datasets.append(api_dataset_from_dataset_and_node(
+            manifestation.dataset, hostname))
+    return datasets, None
+
+
+def _manifestation_keys(index, after):
+    """
+    :param DeploymentIndex index: Indexes of a ``Deployment``.
+    :param unicode after: Only include datasets whose identifiers sort after
+        this one, or ``None``.
+
+    :return: Iterable of ``(dataset_id, hostname)`` tuples identifying all
+        manifestations in order.
+    """
+    start = 0
+    if after is not None:
+        start = bisect_right(index.ordered, after)
+    for dataset_id in islice(index.ordered, start, None):
+        for hostname in sorted(index.manifestations[dataset_id]):
+            yield dataset_id, hostname
 
 
 def datasets_from_deployment(deployment):
@@ -219,15 +604,34 @@ def datasets_from_deployment(deployment):
 
     :return: Iterable returning all datasets.
     """
-    for node in deployment.nodes:
-        for manifestation in node.manifestations():
+    return datasets_from_index(DeploymentIndex(deployment))
+
+
+def datasets_from_index(index, dataset_ids=None):
+    """
+    Extract the primary datasets from the supplied deployment indexes.
+
+    :param DeploymentIndex index: Indexes of a ``Deployment`` describing the
+        state of the cluster.
+    :param dataset_ids: Iterable of the identifiers of the datasets to
+        extract, or ``None`` to extract all of them.
+
+    :return: Iterable returning all datasets.
+    """
+    if dataset_ids is None:
+        manifestations = index.manifestations.itervalues()
+    else:
+        manifestations = (index.manifestations.get(dataset_id, {})
+                          for dataset_id in dataset_ids)
+    for by_hostname in manifestations:
+        for hostname, manifestation in by_hostname.iteritems():
             if manifestation.primary:
                 # There may be multiple datasets marked as primary until we
                 # implement consistency checking when state is reported by each
                 # node.
                 # See https://clusterhq.atlassian.net/browse/FLOC-1303
                 yield api_dataset_from_dataset_and_node(
-                    manifestation.dataset, node.hostname
+                    manifestation.dataset, hostname
                 )
 
 
@@ -253,7 +657,8 @@ def api_dataset_from_dataset_and_node(dataset, node_hostname):
     return result
 
 
-def create_api_service(persistence_service, cluster_state_service, endpoint):
+def create_api_service(persistence_service, cluster_state_service, endpoint,
+                       output_validation=1, metrics=None):
     """
     Create a Twisted Service that serves the API on the given endpoint.
 
@@ -265,10 +670,17 @@ def create_api_service(persistence_service, cluster_state_service, endpoint):
 
     :param endpoint: Twisted endpoint to listen on.
 
+    :param int output_validation: Validate one in this many responses
+        against their schema, or none if ``0``.
+
+    :param MetricsRegistry metrics: Registry in which to record statistics
+        about the API, or ``None`` to create a new one.
+
     :return: Service that will listen on the endpoint using HTTP API server.
     """
     api_root = Resource()
-    user = DatasetAPIUserV1(persistence_service, cluster_state_service)
+    user = DatasetAPIUserV1(persistence_service, cluster_state_service,
+                            output_validation, metrics)
     api_root.putChild('v1', user.app.resource())
     api_root._v1_user = user  # For unit testing purposes, alas
     return StreamServerEndpointService(endpoint, Site(api_root))
@@ -4,7 +4,7 @@
 Script for starting control service server.
 """
 
-from twisted.python.usage import Options
+from twisted.python.usage import Options, UsageError
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.python.filepath import FilePath
 from twisted.application.service import MultiService
@@ -12,6 +12,7 @@ from twisted.application.service import MultiService
 from .httpapi import create_api_service
 from ._persistence import ConfigurationPersistenceService
 from ._clusterstate import ClusterStateService
+from ..common import MetricsRegistry
 from ..common.script import (
     flocker_standard_options, FlockerScriptRunner, main_for_service)
 from ._protocol import ControlAMPService
@@ -28,8 +29,34 @@ class ControlOptions(Options):
         ["port", "p", 4523, "The external API port to listen on.", int],
         ["agent-port", "a", 4524,
          "The port convergence agents will connect to.", int],
+        ["broadcast-window", None, 0.1,
+         "Seconds to wait for further node state updates before sending "
+         "the combined cluster state to convergence agents.", float],
+        ["broadcast-max-delay", None, 1.0,
+         "The maximum number of seconds a node state update will be "
+         "delayed while waiting for further updates.", float],
+        ["commit-window", None, 0.05,
+         "Seconds to wait for further configuration changes before writing "
+         "them to disk together.", float],
+        ["output-validation", None, 1,
+         "Validate one in this many API responses against their schema, or "
+         "none if 0.", int],
     ]
 
+    def postOptions(self):
+        if self["broadcast-window"] < 0:
+            raise UsageError(
+                "--broadcast-window must not be negative.")
+        if self["broadcast-max-delay"] < self["broadcast-window"]:
+            raise UsageError(
+                "--broadcast-max-delay must be at least --broadcast-window.")
+        if self["commit-window"] < 0:
+            raise UsageError(
+                "--commit-window must not be negative.")
+        if self["output-validation"] < 0:
+            raise UsageError(
+                "--output-validation must not be negative.")
+
 
 class ControlScript(object):
     """
@@ -38,16 +65,26 @@ class ControlScript(object):
     """
     def main(self, reactor, options):
         top_service = MultiService()
+        metrics = MetricsRegistry(reactor)
         persistence = ConfigurationPersistenceService(
-            reactor, options["data-path"])
+            reactor, options["data-path"],
+            commit_window=options["commit-window"])
         persistence.setServiceParent(top_service)
         cluster_state = ClusterStateService()
         cluster_state.setServiceParent(top_service)
-        create_api_service(persistence, cluster_state, TCP4ServerEndpoint(
-            reactor, options["port"])).setServiceParent(top_service)
+        create_api_service(
+            persistence, cluster_state,
+            TCP4ServerEndpoint(reactor, options["port"]),
+            output_validation=options["output-validation"],
+            metrics=metrics,
+        ).setServiceParent(top_service)
         amp_service = ControlAMPService(
             cluster_state, persistence, TCP4ServerEndpoint(
-                reactor, options["agent-port"]))
+                reactor, options["agent-port"]),
+            reactor=reactor,
+            broadcast_window=options["broadcast-window"],
+            broadcast_max_delay=options["broadcast-max-delay"],
+            metrics=metrics)
         amp_service.setServiceParent(top_service)
         return main_for_service(reactor, top_service)
 
@@ -6,6 +6,7 @@ Tests for ``flocker.control._clusterstate``.
 
 from uuid import uuid4
 
+from twisted.internet.defer import CancelledError
 from twisted.trial.unittest import SynchronousTestCase
 
 from .._clusterstate import ClusterStateService
@@ -97,3 +98,167 @@ class ClusterStateServiceTests(SynchronousTestCase):
                                  hostname=u"host2",
                                  applications=frozenset([APP2])),
                          ])))
+
+    def test_cached(self):
+        """
+        ``ClusterStateService.as_deployment`` returns the same object until
+        the state changes.
+        """
+        service = self.service()
+        service.update_node_state(u"host1",
+                                  NodeState(running=[APP1], not_running=[]))
+        first = service.as_deployment()
+        second = service.as_deployment()
+        service.update_node_state(u"host2",
+                                  NodeState(running=[APP2], not_running=[]))
+        self.assertEqual(
+            (first is second, service.as_deployment() is first),
+            (True, False))
+
+    def test_generation(self):
+        """
+        ``ClusterStateService.generation`` is incremented by every update
+        that changes the state.
+        """
+        service = self.service()
+        initial = service.generation
+        service.update_node_state(u"host1",
+                                  NodeState(running=[APP1], not_running=[]))
+        service.update_node_state(u"host1",
+                                  NodeState(running=[APP2], not_running=[]))
+        self.assertEqual(service.generation, initial + 2)
+
+    def test_unchanged_update(self):
+        """
+        An update equal to the node's previous state doesn't change the
+        generation or invalidate the ``Deployment`` returned by
+        ``ClusterStateService.as_deployment``.
+        """
+        service = self.service()
+        service.update_node_state(u"host1",
+                                  NodeState(running=[APP1], not_running=[]))
+        deployment = service.as_deployment()
+        generation = service.generation
+        service.update_node_state(u"host1",
+                                  NodeState(running=[APP1], not_running=[]))
+        self.assertEqual(
+            (service.as_deployment() is deployment, service.generation),
+            (True, generation))
+
+    def test_unchanged_node(self):
+        """
+        An update which differs from the node's previous state only in ways
+        that aren't part of the cluster state doesn't change the generation
+        or invalidate the ``Deployment`` returned by
+        ``ClusterStateService.as_deployment``.
+        """
+        service = self.service()
+        service.update_node_state(u"host1",
+                                  NodeState(running=[APP1], not_running=[]))
+        deployment = service.as_deployment()
+        generation = service.generation
+        service.update_node_state(u"host1",
+                                  NodeState(running=[APP1], not_running=[],
+                                            used_ports=frozenset([1234])))
+        self.assertEqual(
+            (service.as_deployment() is deployment, service.generation),
+            (True, generation))
+
+    def test_index(self):
+        """
+        ``ClusterStateService.index`` returns indexes of the current cluster
+        state.
+        """
+        service = self.service()
+        service.update_node_state(
+            u"host1",
+            NodeState(running=[], not_running=[],
+                      other_manifestations=frozenset([MANIFESTATION])))
+        index = service.index()
+        self.assertEqual(
+            (index.deployment, index.manifestations),
+            (service.as_deployment(),
+             {MANIFESTATION.dataset.dataset_id: {u"host1": MANIFESTATION}}))
+
+    def test_changed_datasets(self):
+        """
+        ``ClusterStateService.changed_datasets`` returns the identifiers of
+        datasets whose manifestations were added, changed or removed after
+        the given generation.
+        """
+        service = self.service()
+        replica = Manifestation(dataset=MANIFESTATION.dataset, primary=False)
+        other = Manifestation(dataset=Dataset(dataset_id=unicode(uuid4())),
+                              primary=True)
+        service.update_node_state(
+            u"host1", NodeState(running=[], not_running=[],
+                                other_manifestations=frozenset([other])))
+        service.update_node_state(
+            u"host2", NodeState(
+                running=[], not_running=[],
+                other_manifestations=frozenset([MANIFESTATION])))
+        service.update_node_state(
+            u"host2", NodeState(running=[], not_running=[],
+                                other_manifestations=frozenset([replica])))
+        self.assertEqual(
+            (service.changed_datasets(0), service.changed_datasets(1),
+             service.changed_datasets(3)),
+            ({MANIFESTATION.dataset.dataset_id, other.dataset.dataset_id},
+             {MANIFESTATION.dataset.dataset_id}, set()))
+
+    def test_changed_datasets_forgotten(self):
+        """
+        ``ClusterStateService.changed_datasets`` only remembers the changes in
+        the last ``change_retention`` generations, and returns ``None`` for
+        generations older than that.
+        """
+        service = ClusterStateService(change_retention=2)
+        service.startService()
+        self.addCleanup(service.stopService)
+        manifestations = [
+            Manifestation(dataset=Dataset(dataset_id=unicode(uuid4())),
+                          primary=True)
+            for i in range(3)]
+        for i, manifestation in enumerate(manifestations):
+            service.update_node_state(
+                u"host%d" % (i,), NodeState(
+                    running=[], not_running=[],
+                    other_manifestations=frozenset([manifestation])))
+        self.assertEqual(
+            (service.changed_datasets(0), service.changed_datasets(1),
+             len(service._changed)),
+            (None, {manifestation.dataset.dataset_id
+                    for manifestation in manifestations[1:]}, 2))
+
+    def test_wait_changed(self):
+        """
+        ``ClusterStateService.wait`` returns a ``Deferred`` which has already
+        fired with the current generation if it is newer than the given one.
+        """
+        service = self.service()
+        service.update_node_state(u"host1",
+                                  NodeState(running=[APP1], not_running=[]))
+        self.assertEqual(self.successResultOf(service.wait(0)), 1)
+
+    def test_wait(self):
+        """
+        ``ClusterStateService.wait`` returns a ``Deferred`` which fires with
+        the new generation when the state next changes.
+        """
+        service = self.service()
+        waiting = service.wait(0)
+        self.assertNoResult(waiting)
+        service.update_node_state(u"host1",
+                                  NodeState(running=[APP1], not_running=[]))
+        self.assertEqual(self.successResultOf(waiting), 1)
+
+    def test_wait_cancelled(self):
+        """
+        A cancelled ``Deferred`` returned by ``ClusterStateService.wait`` is
+        forgotten by the service.
+        """
+        service = self.service()
+        waiting = service.wait(0)
+        waiting.cancel()
+        self.failureResultOf(waiting, CancelledError)
+        self.assertEqual(service._waiting, [])
@@ -0,0 +1,162 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.control._diff``.
+"""
+
+from uuid import uuid4
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._diff import DeploymentDiff, NodeDiff, diff_deployments
+from .._model import (
+    Deployment, Application, DockerImage, Node, Manifestation, Dataset,
+)
+
+
+APP1 = Application(
+    name=u'myapp',
+    image=DockerImage.from_string(u'postgresql'))
+APP2 = Application(
+    name=u'myapp2',
+    image=DockerImage.from_string(u'mysql'))
+MANIFESTATION = Manifestation(dataset=Dataset(dataset_id=unicode(uuid4())),
+                              primary=True)
+NODE1 = Node(hostname=u'node1.example.com',
+             applications=frozenset([APP1]),
+             other_manifestations=frozenset([MANIFESTATION]))
+NODE2 = Node(hostname=u'node2.example.com',
+             applications=frozenset([APP2]))
+
+
+class DiffDeploymentsTests(SynchronousTestCase):
+    """
+    Tests for ``diff_deployments`` and ``DeploymentDiff.apply``.
+    """
+    def assertRoundTrip(self, old, new):
+        """
+        Applying the difference between two deployments to the first
+        results in the second.
+
+        :param Deployment old: The old deployment.
+        :param Deployment new: The new deployment.
+        """
+        self.assertEqual(diff_deployments(old, new).apply(old), new)
+
+    def test_unchanged(self):
+        """
+        Identical deployments have no differences.
+        """
+        deployment = Deployment(nodes=frozenset([NODE1, NODE2]))
+        self.assertEqual(diff_deployments(deployment, deployment),
+                         DeploymentDiff())
+
+    def test_node_added(self):
+        """
+        New nodes are included in full.
+        """
+        old = Deployment(nodes=frozenset([NODE1]))
+        new = Deployment(nodes=frozenset([NODE1, NODE2]))
+        self.assertEqual(
+            (diff_deployments(old, new),
+             diff_deployments(old, new).apply(old)),
+            (DeploymentDiff(nodes_added=frozenset([NODE2])), new))
+
+    def test_node_removed(self):
+        """
+        Removed nodes are identified by their hostname.
+        """
+        old = Deployment(nodes=frozenset([NODE1, NODE2]))
+        new = Deployment(nodes=frozenset([NODE1]))
+        self.assertEqual(
+            (diff_deployments(old, new),
+             diff_deployments(old, new).apply(old)),
+            (DeploymentDiff(nodes_removed=frozenset([NODE2.hostname])), new))
+
+    def test_application_added(self):
+        """
+        Applications added to an existing node are included in a
+        ``NodeDiff``.
+        """
+        old = Deployment(nodes=frozenset([NODE1]))
+        new = Deployment(nodes=frozenset([
+            Node(hostname=NODE1.hostname,
+                 applications=frozenset([APP1, APP2]),
+                 other_manifestations=NODE1.other_manifestations)]))
+        self.assertEqual(
+            diff_deployments(old, new),
+            DeploymentDiff(nodes_changed=frozenset([
+                NodeDiff(hostname=NODE1.hostname,
+                         applications_added=frozenset([APP2]))])))
+
+    def test_application_changes(self):
+        """
+        Applications which are added, removed or changed on an existing node
+        are reflected in the result of applying the difference.
+        """
+        changed = Application(
+            name=APP1.name, image=DockerImage.from_string(u'postgresql:9'))
+        old = Deployment(nodes=frozenset([
+            Node(hostname=u'node1', applications=frozenset([APP1, APP2]))]))
+        new = Deployment(nodes=frozenset([
+            Node(hostname=u'node1', applications=frozenset([changed]))]))
+        self.assertEqual(
+            (diff_deployments(old, new),
+             diff_deployments(old, new).apply(old)),
+            (DeploymentDiff(nodes_changed=frozenset([
+                NodeDiff(hostname=u'node1',
+                         applications_removed=frozenset(
+                             [APP1.name, APP2.name]),
+                         applications_added=frozenset([changed]))])),
+             new))
+
+    def test_manifestation_changes(self):
+        """
+        Manifestations which are added or removed on an existing node are
+        reflected in the result of applying the difference.
+        """
+        replica = Manifestation(dataset=MANIFESTATION.dataset, primary=False)
+        old = Deployment(nodes=frozenset([NODE1]))
+        new = Deployment(nodes=frozenset([
+            Node(hostname=NODE1.hostname, applications=NODE1.applications,
+                 other_manifestations=frozenset([replica]))]))
+        self.assertRoundTrip(old, new)
+
+    def test_many_changes(self):
+        """
+        Nodes being added, removed and changed at the same time are all
+        reflected in the result of applying the difference.
+        """
+        old = Deployment(nodes=frozenset([
+            NODE1, Node(hostname=u'node3', applications=frozenset([APP1]))]))
+        new = Deployment(nodes=frozenset([
+            NODE2, Node(hostname=u'node3', applications=frozenset([APP2]))]))
+        self.assertRoundTrip(old, new)
+
+
+class NodeDiffTests(SynchronousTestCase):
+    """
+    Tests for ``NodeDiff.apply``.
+    """
+    def test_keeps_unmentioned(self):
+        """
+        Applications and manifestations which are not mentioned in the
+        ``NodeDiff`` are kept.
+        """
+        node_diff = NodeDiff(hostname=NODE1.hostname,
+                             applications_added=frozenset([APP2]))
+        self.assertEqual(
+            node_diff.apply(NODE1),
+            Node(hostname=NODE1.hostname,
+                 applications=frozenset([APP1, APP2]),
+                 other_manifestations=NODE1.other_manifestations))
+
+    def test_missing_node(self):
+        """
+        Applying changes to a node which isn't in the deployment raises
+        ``KeyError``.
+        """
+        deployment_diff = DeploymentDiff(nodes_changed=frozenset([
+            NodeDiff(hostname=u'missing')]))
+        self.assertRaises(KeyError, deployment_diff.apply,
+                          Deployment(nodes=frozenset([NODE1])))
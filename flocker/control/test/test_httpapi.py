@@ -15,7 +15,9 @@ from twisted.internet.defer import gatherResults
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import MemoryReactor
-from twisted.web.http import CREATED, OK, CONFLICT, BAD_REQUEST
+from twisted.web.http import (
+    CREATED, OK, CONFLICT, BAD_REQUEST, NOT_MODIFIED,
+)
 from twisted.web.http_headers import Headers
 from twisted.web.server import Site
 from twisted.web.client import FileBodyProducer, readBody
@@ -24,15 +26,17 @@ from twisted.python.filepath import FilePath
 
 from ...restapi.testtools import (
     buildIntegrationTests, dumps, loads)
+from ...restapi._error import BadRequest
 
 from .. import (
-    Application, Dataset, Manifestation, Node, NodeState,
+    Application, Dataset, DockerImage, Manifestation, Node, NodeState,
     Deployment, AttachedVolume
 )
 from ..httpapi import (
     DatasetAPIUserV1, create_api_service, datasets_from_deployment,
-    api_dataset_from_dataset_and_node
+    api_dataset_from_dataset_and_node, select_datasets, WATCH_INVALID,
 )
+from .._views import DeploymentIndex
 from .._persistence import ConfigurationPersistenceService
 from .._clusterstate import ClusterStateService
 from ... import __version__
@@ -145,6 +149,14 @@ class VersionTestsMixin(APITestsMixin):
             b"GET", b"/version", None, OK, {u'flocker': __version__}
         )
 
+    def test_version_query(self):
+        """
+        Query arguments are ignored by the ``/version`` command.
+        """
+        return self.assertResult(
+            b"GET", b"/version?x=1", None, OK, {u'flocker': __version__}
+        )
+
 
 def _build_app(test):
     test.initialize()
@@ -154,6 +166,34 @@ RealTestsAPI, MemoryTestsAPI = buildIntegrationTests(
     VersionTestsMixin, "API", _build_app)
 
 
+class MetricsTestsMixin(APITestsMixin):
+    """
+    Tests for the API statistics endpoint at ``/metrics``.
+    """
+    def test_metrics(self):
+        """
+        The ``/metrics`` command returns the statistics of earlier requests
+        in the Prometheus text format.
+        """
+        requesting = self.assertResponseCode(b"GET", b"/version", None, OK)
+        requesting.addCallback(readBody)
+        requesting.addCallback(lambda _: self.assertResponseCode(
+            b"GET", b"/metrics", None, OK))
+
+        def got_response(response):
+            self.assertEqual(
+                response.headers.getRawHeaders(b"content-type"),
+                [b"text/plain; version=0.0.4"])
+            return readBody(response)
+        requesting.addCallback(got_response)
+        requesting.addCallback(lambda body: self.assertIn(
+            b'flocker_api_responses_total{endpoint="version",code="200"} 1.0',
+            body))
+        return requesting
+RealTestsMetrics, MemoryTestsMetrics = buildIntegrationTests(
+    MetricsTestsMixin, "Metrics", _build_app)
+
+
 class CreateDatasetTestsMixin(APITestsMixin):
     """
     Tests for the dataset creation endpoint at ``/datasets``.
@@ -455,6 +495,145 @@ RealTestsCreateDataset, MemoryTestsCreateDataset = buildIntegrationTests(
     CreateDatasetTestsMixin, "CreateDataset", _build_app)
 
 
+class CreateDatasetsTestsMixin(APITestsMixin):
+    """
+    Tests for the bulk dataset creation endpoint at ``/datasets/bulk``.
+    """
+    # These addresses taken from RFC 5737 (TEST-NET-1)
+    NODE_A = u"192.0.2.1"
+    NODE_B = u"192.0.2.2"
+
+    def count_changes(self):
+        """
+        :return: A ``list`` which has an item added each time the
+            configuration changes.
+        """
+        changes = []
+        self.persistence_service.register(lambda: changes.append(None))
+        return changes
+
+    def test_wrong_schema(self):
+        """
+        If ``datasets`` isn't an array, the response is an error and nothing
+        is created.
+        """
+        changes = self.count_changes()
+        posting = self.assertResponseCode(
+            b"POST", b"/datasets/bulk", {u"datasets": {}}, BAD_REQUEST)
+        posting.addCallback(lambda _: self.assertEqual(changes, []))
+        return posting
+
+    def test_create(self):
+        """
+        All of the datasets are added to the desired configuration with a
+        single change, and each is described in the response.
+        """
+        existing = Node(hostname=self.NODE_A, applications=frozenset({
+            Application(name=u'mysql-clusterhq',
+                        image=DockerImage.from_string(u"mysql"))}))
+        saving = self.persistence_service.save(
+            Deployment(nodes=frozenset({existing})))
+        changes = []
+        saving.addCallback(lambda _: self.persistence_service.register(
+            lambda: changes.append(None)))
+        ids = [unicode(uuid4()) for i in range(3)]
+        datasets = [
+            {u"primary": self.NODE_A, u"dataset_id": ids[0]},
+            {u"primary": self.NODE_A, u"dataset_id": ids[1],
+             u"metadata": {u"name": u"second"}},
+            {u"primary": self.NODE_B, u"dataset_id": ids[2],
+             u"maximum_size": 1024 * 1024 * 1024},
+        ]
+        results = [
+            {u"dataset": dict(metadata={}, **datasets[0])},
+            {u"dataset": datasets[1]},
+            {u"dataset": dict(metadata={}, **datasets[2])},
+        ]
+        saving.addCallback(lambda _: self.assertResult(
+            b"POST", b"/datasets/bulk", {u"datasets": datasets}, OK,
+            results))
+
+        def created(ignored):
+            self.assertEqual(
+                (changes, self.persistence_service.get()),
+                ([None], Deployment(nodes=frozenset({
+                    Node(hostname=self.NODE_A,
+                         applications=existing.applications,
+                         other_manifestations=frozenset({
+                             Manifestation(
+                                 dataset=Dataset(dataset_id=ids[0]),
+                                 primary=True),
+                             Manifestation(
+                                 dataset=Dataset(
+                                     dataset_id=ids[1],
+                                     metadata=pmap({u"name": u"second"})),
+                                 primary=True)})),
+                    Node(hostname=self.NODE_B,
+                         other_manifestations=frozenset({
+                             Manifestation(
+                                 dataset=Dataset(
+                                     dataset_id=ids[2],
+                                     maximum_size=1024 * 1024 * 1024),
+                                 primary=True)}))}))))
+        saving.addCallback(created)
+        return saving
+
+    def test_errors(self):
+        """
+        Items which are invalid or whose ``dataset_id`` is already in use,
+        either in the configuration or earlier in the same request, have an
+        error as their result and are not created, without preventing the
+        creation of the other datasets.
+        """
+        existing = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4())), primary=True)
+        saving = self.persistence_service.save(Deployment(nodes=frozenset({
+            Node(hostname=self.NODE_A,
+                 other_manifestations=frozenset({existing}))})))
+        dataset_id = unicode(uuid4())
+        datasets = [
+            {u"dataset_id": unicode(uuid4())},
+            {u"primary": self.NODE_B,
+             u"dataset_id": existing.dataset.dataset_id},
+            {u"primary": self.NODE_B, u"dataset_id": dataset_id},
+            {u"primary": self.NODE_A, u"dataset_id": dataset_id.upper()},
+        ]
+        collision = {
+            u"description": u"The provided dataset_id is already in use."}
+        saving.addCallback(lambda _: self.assertResponseCode(
+            b"POST", b"/datasets/bulk", {u"datasets": datasets}, OK))
+        saving.addCallback(readBody)
+
+        def created(body):
+            results = loads(body)
+            self.assertEqual(
+                ([u"error"], results[1:],
+                 set(get_dataset_ids(self.persistence_service.get()))),
+                (results[0].keys(),
+                 [{u"error": collision},
+                  {u"dataset": {u"primary": self.NODE_B,
+                                u"dataset_id": dataset_id,
+                                u"metadata": {}}},
+                  {u"error": collision}],
+                 {existing.dataset.dataset_id, dataset_id}))
+        saving.addCallback(created)
+        return saving
+
+    def test_nothing_created(self):
+        """
+        If none of the datasets can be created the configuration is not
+        changed.
+        """
+        changes = self.count_changes()
+        posting = self.assertResult(
+            b"POST", b"/datasets/bulk", {u"datasets": []}, OK, [])
+        posting.addCallback(lambda _: self.assertEqual(changes, []))
+        return posting
+
+RealTestsCreateDatasets, MemoryTestsCreateDatasets = buildIntegrationTests(
+    CreateDatasetsTestsMixin, "CreateDatasets", _build_app)
+
+
 class CreateAPIServiceTests(SynchronousTestCase):
     """
     Tests for ``create_api_service``.
@@ -566,10 +745,291 @@ class DatasetsStateTestsMixin(APITestsMixin):
             b"GET", b"/state/datasets", None, OK, response
         )
 
+    def get_etag(self, headers=None):
+        """
+        Request the cluster state datasets.
+
+        :param Headers headers: Headers for the request, or ``None``.
+
+        :return: ``Deferred`` firing with tuple of response code and the value
+            of the ``ETag`` header.
+        """
+        requesting = self.agent.request(b"GET", b"/state/datasets", headers)
+        requesting.addCallback(lambda response: (
+            response.code, response.headers.getRawHeaders(b"etag")[0]))
+        return requesting
+
+    def test_etag_not_modified(self):
+        """
+        The response has an ``ETag`` header, and a request with the same
+        value in its ``If-None-Match`` header gets a ``304 Not Modified``
+        response with the same ``ETag``.
+        """
+        first = self.get_etag()
+
+        def got_etag((code, etag)):
+            requesting = self.get_etag(
+                Headers({b"if-none-match": [etag]}))
+            requesting.addCallback(self.assertEqual, (NOT_MODIFIED, etag))
+            return requesting
+        first.addCallback(got_etag)
+        return first
+
+    def test_etag_changes(self):
+        """
+        The ``ETag`` changes when the cluster state changes, and a request
+        with the old value in its ``If-None-Match`` header gets the full
+        response.
+        """
+        first = self.get_etag()
+
+        def got_etag((code, etag)):
+            self.cluster_state_service.update_node_state(
+                u"192.0.2.101", NodeState(running=[], not_running=[]))
+            requesting = self.get_etag(
+                Headers({b"if-none-match": [etag]}))
+            requesting.addCallback(
+                lambda (code, new_etag): self.assertEqual(
+                    (code, new_etag == etag), (OK, False)))
+            return requesting
+        first.addCallback(got_etag)
+        return first
+
+    def watch(self, watch):
+        """
+        Request the changes to the cluster state datasets.
+
+        :param bytes watch: The ``watch`` argument of the request.
+
+        :return: ``Deferred`` firing with the decoded response body.
+        """
+        requesting = self.assertResponseCode(
+            b"GET", b"/state/datasets?watch=" + watch, None, OK)
+        requesting.addCallback(readBody)
+        requesting.addCallback(loads)
+        return requesting
+
+    def watch_token(self, generation):
+        """
+        Find the ``watch`` argument referring to a generation of the cluster
+        state.
+
+        :param int generation: The generation, no later than the current
+            one.
+
+        :return: ``Deferred`` firing with the ``bytes`` argument.
+        """
+        requesting = self.watch(b"0")
+        requesting.addCallback(lambda result: b"%s-%d" % (
+            result[u"generation"].encode("ascii").rsplit(b"-", 1)[0],
+            generation))
+        return requesting
+
+    def test_watch_full(self):
+        """
+        When the ``watch`` argument is ``0`` the response describes every
+        dataset straight away, and says so.
+        """
+        expected = self.update_datasets()
+        requesting = self.watch(b"0")
+        requesting.addCallback(lambda result: self.assertEqual(
+            (result[u"full"], result[u"removed"],
+             sorted(result[u"datasets"], key=lambda d: d[u"dataset_id"])),
+            (True, [], expected)))
+        return requesting
+
+    def test_watch(self):
+        """
+        When the ``watch`` argument is a generation given out by an earlier
+        response, the response describes the datasets which changed after
+        that generation once the cluster state changes.
+        """
+        dataset = Dataset(dataset_id=unicode(uuid4()))
+        requesting = self.watch_token(0)
+
+        def got_token(token):
+            watching = self.watch(token)
+            self.cluster_state_service.update_node_state(
+                u"192.0.2.101", NodeState(
+                    running=[], not_running=[],
+                    other_manifestations=frozenset([
+                        Manifestation(dataset=dataset, primary=True)])))
+            watching.addCallback(self.assertEqual, {
+                u"generation": token[:-1].decode("ascii") + u"1",
+                u"full": False,
+                u"datasets": [{u"dataset_id": dataset.dataset_id,
+                               u"primary": u"192.0.2.101",
+                               u"metadata": {}}],
+                u"removed": []})
+            return watching
+        requesting.addCallback(got_token)
+        return requesting
+
+    def test_watch_removed(self):
+        """
+        Datasets which no longer have a primary manifestation are listed as
+        removed, and datasets which didn't change after the given generation
+        are omitted.
+        """
+        unchanged = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4())), primary=True)
+        removed = Manifestation(
+            dataset=Dataset(dataset_id=unicode(uuid4())), primary=True)
+        self.cluster_state_service.update_node_state(
+            u"192.0.2.101", NodeState(
+                running=[], not_running=[],
+                other_manifestations=frozenset([unchanged])))
+        self.cluster_state_service.update_node_state(
+            u"192.0.2.102", NodeState(
+                running=[], not_running=[],
+                other_manifestations=frozenset([removed])))
+        self.cluster_state_service.update_node_state(
+            u"192.0.2.102", NodeState(running=[], not_running=[]))
+        requesting = self.watch_token(2)
+        requesting.addCallback(self.watch)
+        requesting.addCallback(lambda result: self.assertEqual(
+            (result[u"full"], result[u"datasets"], result[u"removed"]),
+            (False, [], [removed.dataset.dataset_id])))
+        return requesting
+
+    def test_watch_forgotten(self):
+        """
+        If the changes since the generation given as the ``watch`` argument
+        have been forgotten, the response describes every dataset.
+        """
+        self.cluster_state_service._change_retention = 1
+        expected = self.update_datasets()
+        requesting = self.watch_token(0)
+        requesting.addCallback(self.watch)
+        requesting.addCallback(lambda result: self.assertEqual(
+            (result[u"full"],
+             sorted(result[u"datasets"], key=lambda d: d[u"dataset_id"])),
+            (True, expected)))
+        return requesting
+
+    def test_watch_other_instance(self):
+        """
+        If the ``watch`` argument was given out by another instance of the
+        control service, as happens when it restarts, the response describes
+        every dataset straight away.
+        """
+        expected = self.update_datasets()
+        requesting = self.watch(uuid4().hex.encode("ascii") + b"-100")
+        requesting.addCallback(lambda result: self.assertEqual(
+            (result[u"full"],
+             sorted(result[u"datasets"], key=lambda d: d[u"dataset_id"])),
+            (True, expected)))
+        return requesting
+
+    def update_datasets(self):
+        """
+        Add two datasets to the cluster state, on two nodes.
+
+        :return: ``list`` of the expected descriptions of the datasets in
+            order.
+        """
+        ids = sorted(unicode(uuid4()) for i in range(2))
+        for dataset_id, hostname in zip(ids, [u"192.0.2.101",
+                                              u"192.0.2.102"]):
+            self.cluster_state_service.update_node_state(
+                hostname, NodeState(
+                    running=[], not_running=[],
+                    other_manifestations=frozenset([Manifestation(
+                        dataset=Dataset(dataset_id=dataset_id),
+                        primary=True)])))
+        return [{u"dataset_id": dataset_id, u"primary": hostname,
+                 u"metadata": {}}
+                for dataset_id, hostname in zip(ids, [u"192.0.2.101",
+                                                      u"192.0.2.102"])]
+
+    def test_filter(self):
+        """
+        When a filter argument is given only the matching datasets are
+        returned.
+        """
+        expected = self.update_datasets()
+        return self.assertResult(
+            b"GET", b"/state/datasets?primary=192.0.2.102", None, OK,
+            expected[1:])
+
+    def test_pages(self):
+        """
+        When ``limit`` is given the response is a page of datasets with a
+        cursor identifying the next page, which is given as ``cursor`` to
+        get the next page.
+        """
+        expected = self.update_datasets()
+        requesting = self.assertResult(
+            b"GET", b"/state/datasets?limit=1", None, OK,
+            {u"datasets": expected[:1],
+             u"next": expected[0][u"dataset_id"]})
+        requesting.addCallback(lambda _: self.assertResult(
+            b"GET",
+            b"/state/datasets?limit=1&cursor=" +
+            expected[0][u"dataset_id"].encode("ascii"),
+            None, OK, {u"datasets": expected[1:]}))
+        return requesting
+
+    def test_unknown_query_argument(self):
+        """
+        Query arguments which the endpoint doesn't know about, such as a
+        cache-buster, are ignored.
+        """
+        expected = self.update_datasets()
+        return self.assertResultItems(
+            b"GET", b"/state/datasets?_=123", None, OK, expected)
+
+    def test_metadata_key_only(self):
+        """
+        A ``metadata_key`` argument without a ``metadata_value`` results in a
+        ``BAD_REQUEST`` response.
+        """
+        return self.assertResponseCode(
+            b"GET", b"/state/datasets?metadata_key=name", None, BAD_REQUEST)
+
+    def test_watch_with_query(self):
+        """
+        A ``watch`` argument combined with other arguments results in a
+        ``BAD_REQUEST`` response.
+        """
+        return self.assertResponseCode(
+            b"GET", b"/state/datasets?watch=0&limit=10", None, BAD_REQUEST)
+
+    def test_watch_invalid(self):
+        """
+        A ``watch`` argument which isn't a generation results in a
+        ``BAD_REQUEST`` response.
+        """
+        return self.assertResponseCode(
+            b"GET", b"/state/datasets?watch=abc", None, BAD_REQUEST)
+
+    def test_watch_malformed_generation(self):
+        """
+        A ``watch`` argument whose generation isn't a number results in a
+        ``BAD_REQUEST`` response.
+        """
+        return self.assertResponseCode(
+            b"GET", b"/state/datasets?watch=1-x", None, BAD_REQUEST)
+
 RealTestsDatasetsStateAPI, MemoryTestsDatasetsStateAPI = buildIntegrationTests(
     DatasetsStateTestsMixin, "DatasetsStateAPI", _build_app)
 
 
+class WatchedGenerationTests(SynchronousTestCase):
+    """
+    Tests for ``DatasetAPIUserV1._watched_generation``.
+    """
+    def test_malformed_generation(self):
+        """
+        ``BadRequest`` is raised for an argument with this instance's
+        identifier but a generation which isn't a number.
+        """
+        api = DatasetAPIUserV1(None, ClusterStateService())
+        exception = self.assertRaises(
+            BadRequest, api._watched_generation, api._instance + u"-x")
+        self.assertIs(exception, WATCH_INVALID)
+
+
 class DatasetsFromDeploymentTests(SynchronousTestCase):
     """
     Tests for ``datasets_from_deployment``.
@@ -780,3 +1240,95 @@ class APIDatasetFromDatasetAndNodeTests(SynchronousTestCase):
             expected,
             api_dataset_from_dataset_and_node(dataset, expected_hostname)
         )
+
+
+class SelectDatasetsTests(SynchronousTestCase):
+    """
+    Tests for ``select_datasets``.
+    """
+    def setUp(self):
+        self.index = DeploymentIndex(Deployment(nodes=frozenset([
+            Node(hostname=u'node1', other_manifestations=frozenset([
+                Manifestation(dataset=Dataset(
+                    dataset_id=u'a', maximum_size=100,
+                    metadata=pmap({u'owner': u'alice'})), primary=True),
+                Manifestation(dataset=Dataset(
+                    dataset_id=u'c', maximum_size=300), primary=True),
+                Manifestation(dataset=Dataset(
+                    dataset_id=u'd'), primary=False)])),
+            Node(hostname=u'node2', other_manifestations=frozenset([
+                Manifestation(dataset=Dataset(
+                    dataset_id=u'b', maximum_size=200,
+                    metadata=pmap({u'owner': u'alice'})), primary=True),
+                Manifestation(dataset=Dataset(
+                    dataset_id=u'd'), primary=True)])),
+        ])))
+
+    def select(self, **kwargs):
+        """
+        Call ``select_datasets`` with the test's index.
+
+        :return: Tuple of the identifiers of the selected datasets and the
+            cursor.
+        """
+        datasets, cursor = select_datasets(self.index, **kwargs)
+        return [dataset[u"dataset_id"] for dataset in datasets], cursor
+
+    def test_all(self):
+        """
+        Without arguments all primary datasets are returned, ordered by
+        identifier.
+        """
+        self.assertEqual(self.select(), ([u'a', u'b', u'c', u'd'], None))
+
+    def test_primary(self):
+        """
+        ``primary`` selects the datasets with their primary manifestation on
+        the given node.
+        """
+        self.assertEqual(
+            (self.select(primary=u'node1'), self.select(primary=u'node3')),
+            (([u'a', u'c'], None), ([], None)))
+
+    def test_metadata(self):
+        """
+        ``metadata`` selects the datasets with the given metadata item.
+        """
+        self.assertEqual(
+            (self.select(metadata=(u'owner', u'alice')),
+             self.select(metadata=(u'owner', u'bob'))),
+            (([u'a', u'b'], None), ([], None)))
+
+    def test_size_range(self):
+        """
+        ``minimum_size`` and ``maximum_size`` select the datasets whose
+        maximum size is in that inclusive range.
+        """
+        self.assertEqual(
+            (self.select(minimum_size=200),
+             self.select(maximum_size=200),
+             self.select(minimum_size=150, maximum_size=300)),
+            (([u'b', u'c'], None), ([u'a', u'b'], None),
+             ([u'b', u'c'], None)))
+
+    def test_combined(self):
+        """
+        Datasets must match all of the given criteria to be selected.
+        """
+        self.assertEqual(
+            self.select(primary=u'node2', metadata=(u'owner', u'alice'),
+                        minimum_size=150),
+            ([u'b'], None))
+
+    def test_pages(self):
+        """
+        With ``limit`` at most that many datasets are returned, along with
+        the identifier of the last one if there are more, which can be
+        given as ``after`` to get the following datasets.
+        """
+        self.assertEqual(
+            (self.select(limit=2), self.select(limit=2, after=u'b'),
+             self.select(primary=u'node1', limit=1),
+             self.select(primary=u'node1', limit=1, after=u'a')),
+            (([u'a', u'b'], u'b'), ([u'c', u'd'], None),
+             ([u'a'], u'a'), ([u'c'], None)))
@@ -5,10 +5,15 @@ Tests for ``flocker.control._persistence``.
 """
 
 from twisted.internet import reactor
-from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase, SynchronousTestCase
 from twisted.python.filepath import FilePath
+from twisted.python.failure import Failure
 
-from .._persistence import ConfigurationPersistenceService
+from .._persistence import (
+    ConfigurationPersistenceService, CorruptConfiguration,
+    serialize_deployment,
+)
 from .._model import Deployment, Application, DockerImage, Node
 
 
@@ -56,11 +61,15 @@ class ConfigurationPersistenceServiceTests(TestCase):
 
     def test_file_is_created(self):
         """
-        If no configuration file exists in the given path, it is created.
+        If no configuration file exists in the given path, a snapshot and an
+        empty log are created.
         """
         path = FilePath(self.mktemp())
         self.service(path)
-        self.assertTrue(path.child(b"current_configuration.pickle").exists())
+        self.assertEqual(
+            (path.child(b"configuration.snapshot").exists(),
+             path.child(b"configuration.log").getContent()),
+            (True, b""))
 
     def test_save_then_get(self):
         """
@@ -108,3 +117,433 @@ class ConfigurationPersistenceServiceTests(TestCase):
             self.assertEqual((l, l2), ([1, 1], [1]))
         d.addCallback(saved_again)
         return d
+
+
+def deployment(count):
+    """
+    :param int count: Number of nodes.
+
+    :return Deployment: A deployment with ``count`` nodes, each running an
+        application.
+    """
+    return Deployment(nodes=frozenset(
+        Node(hostname=u'node%d.example.com' % (i,),
+             applications=frozenset([
+                 Application(name=u'app%d' % (i,),
+                             image=DockerImage.from_string(u'image'))]))
+        for i in range(count)))
+
+
+class FakeThreadPool(object):
+    """
+    Thread pool which runs functions only when told to.
+
+    :ivar list calls: Functions and arguments waiting to be run.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, on_result, function, *args, **kwargs):
+        self.calls.append((on_result, function, args, kwargs))
+
+    def run(self):
+        """
+        Run the first waiting function.
+        """
+        on_result, function, args, kwargs = self.calls.pop(0)
+        try:
+            result = function(*args, **kwargs)
+        except:
+            on_result(False, Failure())
+        else:
+            on_result(True, result)
+
+
+class FakeReactor(Clock):
+    """
+    Reactor with a ``FakeThreadPool``.
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self.pool = FakeThreadPool()
+
+    def getThreadPool(self):
+        return self.pool
+
+    def callFromThread(self, function, *args, **kwargs):
+        function(*args, **kwargs)
+
+
+class BrokenFile(object):
+    """
+    File which can't be written to.
+    """
+    def write(self, data):
+        raise IOError("Disk full")
+
+    def close(self):
+        pass
+
+
+class ChangeLogTests(SynchronousTestCase):
+    """
+    Tests for ``ConfigurationPersistenceService`` storing configuration as a
+    snapshot and a log of changes.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+
+    def service(self, **kwargs):
+        """
+        Start a service doing synchronous I/O, schedule its stop.
+
+        :param kwargs: Additional keyword arguments for
+            ``ConfigurationPersistenceService``.
+
+        :return: Started ``ConfigurationPersistenceService``.
+        """
+        service = ConfigurationPersistenceService(None, self.path, **kwargs)
+        service.startService()
+        self.addCleanup(service.stopService)
+        return service
+
+    def restart(self, service):
+        """
+        Stop a service and load its configuration in a new one.
+
+        :param ConfigurationPersistenceService service: The service to stop.
+
+        :return Deployment: The configuration the new service loaded.
+        """
+        self.successResultOf(service.stopService())
+        return self.service().get()
+
+    def test_change_appended(self):
+        """
+        Saving a configuration appends only the change to the log, leaving
+        the snapshot untouched.
+        """
+        service = self.service()
+        self.successResultOf(service.save(deployment(100)))
+        snapshot = self.path.child(b"configuration.snapshot").getContent()
+        log_size = self.path.child(b"configuration.log").getsize()
+        self.successResultOf(service.save(deployment(101)))
+        self.assertEqual(
+            (self.path.child(b"configuration.snapshot").getContent(),
+             self.path.child(b"configuration.log").getsize() - log_size <
+             log_size / 10),
+            (snapshot, True))
+
+    def test_replay(self):
+        """
+        All changes in the log are applied to the snapshot on startup.
+        """
+        service = self.service()
+        for count in [3, 1, 2]:
+            self.successResultOf(service.save(deployment(count)))
+        self.assertEqual(self.restart(service), deployment(2))
+
+    def test_unchanged_not_logged(self):
+        """
+        Saving an unchanged configuration doesn't add to the log, but still
+        notifies registered callbacks.
+        """
+        service = self.service()
+        called = []
+        service.register(lambda: called.append(True))
+        self.successResultOf(service.save(service.get()))
+        self.assertEqual(
+            (self.path.child(b"configuration.log").getContent(), called),
+            (b"", [True]))
+
+    def test_compaction(self):
+        """
+        Once the log has ``snapshot_interval`` records it is compacted into a
+        new snapshot.
+        """
+        service = self.service(snapshot_interval=2)
+        for count in [1, 2, 3]:
+            self.successResultOf(service.save(deployment(count)))
+        log_size = self.path.child(b"configuration.log").getsize()
+        snapshot_size = self.path.child(b"configuration.snapshot").getsize()
+        self.assertEqual(
+            (self.restart(service), log_size < snapshot_size),
+            (deployment(3), True))
+
+    def test_compacted_records_ignored(self):
+        """
+        Log records already included in the snapshot are ignored, as happens
+        if the control service crashed while compacting the log.
+        """
+        service = self.service(snapshot_interval=2)
+        log = self.path.child(b"configuration.log")
+        self.successResultOf(service.save(deployment(1)))
+        old_log = log.getContent()
+        self.successResultOf(service.save(deployment(2)))
+        self.successResultOf(service.stopService())
+        log.setContent(old_log)
+        self.assertEqual(self.service().get(), deployment(2))
+
+    def test_incomplete_record(self):
+        """
+        An incomplete record at the end of the log is discarded, and further
+        changes are appended after the last complete record.
+        """
+        service = self.service()
+        self.successResultOf(service.save(deployment(1)))
+        self.successResultOf(service.stopService())
+        log = self.path.child(b"configuration.log")
+        content = log.getContent()
+        log.setContent(content + content[:-3])
+        service = self.service()
+        loaded = service.get()
+        self.successResultOf(service.save(deployment(2)))
+        self.assertEqual((loaded, self.restart(service)),
+                         (deployment(1), deployment(2)))
+
+    def test_legacy_configuration(self):
+        """
+        Configuration saved by older versions is loaded.
+        """
+        self.path.makedirs()
+        self.path.child(b"current_configuration.pickle").setContent(
+            serialize_deployment(TEST_DEPLOYMENT))
+        self.assertEqual(self.service().get(), TEST_DEPLOYMENT)
+
+    def test_corrupt_snapshot(self):
+        """
+        ``CorruptConfiguration`` is raised if the snapshot can't be read.
+        """
+        self.service()
+        self.path.child(b"configuration.snapshot").setContent(b"garbage")
+        service = ConfigurationPersistenceService(None, self.path)
+        self.assertRaises(CorruptConfiguration, service.startService)
+
+    def test_failed_write(self):
+        """
+        If writing a change fails the caller is told, and the next change is
+        written as a complete snapshot since the log is no longer usable.
+        """
+        service = self.service()
+        self.successResultOf(service.save(deployment(1)))
+        self.patch(service._store, "_log", BrokenFile())
+        self.failureResultOf(service.save(deployment(2)), IOError)
+        self.successResultOf(service.save(deployment(3)))
+        self.assertEqual(self.restart(service), deployment(3))
+
+    def test_thread_pool(self):
+        """
+        When given a reactor, changes are written in its thread pool, one at a
+        time, and the result of ``save`` fires when they are durable.
+        """
+        fake_reactor = FakeReactor()
+        service = ConfigurationPersistenceService(fake_reactor, self.path)
+        service.startService()
+        first = service.save(deployment(1))
+        second = service.save(deployment(2))
+        log_size = self.path.child(b"configuration.log").getsize()
+        waiting = len(fake_reactor.pool.calls)
+        fake_reactor.pool.run()
+        self.successResultOf(first)
+        self.assertNoResult(second)
+        fake_reactor.pool.run()
+        self.successResultOf(second)
+        stopping = service.stopService()
+        fake_reactor.pool.run()
+        self.successResultOf(stopping)
+        self.assertEqual(
+            (log_size, waiting, service.get(), self.service().get()),
+            (0, 1, deployment(2), deployment(2)))
+
+
+class GroupCommitTests(SynchronousTestCase):
+    """
+    Tests for ``ConfigurationPersistenceService`` writing concurrent saves
+    together.
+    """
+    def service(self, commit_window=0):
+        """
+        Start a service using a ``FakeReactor``.
+
+        :param float commit_window: The commit window to use.
+
+        :return: Tuple of started ``ConfigurationPersistenceService``, the
+            ``FakeReactor`` and a list that has an entry appended every time
+            registered callbacks are notified of a change.
+        """
+        fake_reactor = FakeReactor()
+        service = ConfigurationPersistenceService(
+            fake_reactor, FilePath(self.mktemp()),
+            commit_window=commit_window)
+        service.startService()
+        notifications = []
+        service.register(lambda: notifications.append(service.get()))
+        return service, fake_reactor, notifications
+
+    def test_saves_during_write(self):
+        """
+        Saves made while a write is in progress are written together once it
+        has finished, with a single notification.
+        """
+        service, fake_reactor, notifications = self.service()
+        first = service.save(deployment(1))
+        rest = [service.save(deployment(count)) for count in [2, 3]]
+        fake_reactor.pool.run()
+        self.successResultOf(first)
+        for d in rest:
+            self.assertNoResult(d)
+        fake_reactor.pool.run()
+        self.assertEqual(
+            ([self.successResultOf(d) for d in rest],
+             notifications, fake_reactor.pool.calls),
+            ([None, None], [deployment(3), deployment(3)], []))
+
+    def test_commit_window(self):
+        """
+        Saves made within the commit window are written together when it
+        ends, with a single notification.
+        """
+        service, fake_reactor, notifications = self.service(0.1)
+        saves = [service.save(deployment(count)) for count in [1, 2, 3]]
+        waiting = len(fake_reactor.pool.calls)
+        fake_reactor.advance(0.1)
+        fake_reactor.pool.run()
+        self.assertEqual(
+            (waiting, [self.successResultOf(d) for d in saves],
+             notifications, fake_reactor.pool.calls),
+            (0, [None] * 3, [deployment(3)], []))
+
+    def test_not_durable(self):
+        """
+        The result of ``save`` doesn't fire until the batch has been written.
+        """
+        service, fake_reactor, notifications = self.service(0.1)
+        saving = service.save(deployment(1))
+        fake_reactor.advance(0.1)
+        self.assertNoResult(saving)
+        self.assertEqual(notifications, [])
+
+    def test_failure(self):
+        """
+        If writing a batch fails, all the saves in it fail.
+        """
+        service, fake_reactor, notifications = self.service(0.1)
+        self.patch(service._store, "_log", BrokenFile())
+        saves = [service.save(deployment(count)) for count in [1, 2]]
+        fake_reactor.advance(0.1)
+        fake_reactor.pool.run()
+        for d in saves:
+            self.failureResultOf(d, IOError)
+        self.assertEqual(notifications, [])
+
+    def test_failure_reverts(self):
+        """
+        If writing a batch fails, the configuration and its indexes revert
+        to the last configuration written.
+        """
+        service, fake_reactor, notifications = self.service()
+        service.save(deployment(1))
+        fake_reactor.pool.run()
+        self.patch(service._store, "_log", BrokenFile())
+        failing = service.save(deployment(2))
+        fake_reactor.pool.run()
+        self.failureResultOf(failing, IOError)
+        self.assertEqual(
+            (service.get(), service.index().deployment),
+            (deployment(1), deployment(1)))
+
+    def test_failure_keeps_later_saves(self):
+        """
+        If writing a batch fails, saves made while it was being written are
+        kept and written by the next batch.
+        """
+        service, fake_reactor, notifications = self.service()
+        self.patch(service._store, "_log", BrokenFile())
+        failing = service.save(deployment(1))
+        later = service.save(deployment(2))
+        fake_reactor.pool.run()
+        self.failureResultOf(failing, IOError)
+        current = service.get()
+        fake_reactor.pool.run()
+        self.successResultOf(later)
+        self.assertEqual((current, notifications),
+                         (deployment(2), [deployment(2)]))
+
+    def test_stop_writes(self):
+        """
+        Stopping the service writes pending saves without waiting for the
+        commit window to end.
+        """
+        service, fake_reactor, notifications = self.service(0.1)
+        saving = service.save(deployment(1))
+        stopping = service.stopService()
+        fake_reactor.pool.run()
+        fake_reactor.pool.run()
+        self.successResultOf(saving)
+        self.successResultOf(stopping)
+        restarted = ConfigurationPersistenceService(None, service._path)
+        restarted.startService()
+        self.addCleanup(restarted.stopService)
+        self.assertEqual(
+            (restarted.get(), fake_reactor.getDelayedCalls()),
+            (deployment(1), []))
+
+
+class TraceTests(SynchronousTestCase):
+    """
+    Tests for ``ConfigurationPersistenceService.trace``.
+    """
+    def service(self):
+        """
+        :return: Started ``ConfigurationPersistenceService`` timed by a
+            ``Clock``, and the ``Clock``.
+        """
+        clock = Clock()
+        service = ConfigurationPersistenceService(
+            None, FilePath(self.mktemp()), clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        return service, clock
+
+    def test_initial(self):
+        """
+        ``trace`` is ``None`` before anything is saved.
+        """
+        service, _ = self.service()
+        self.assertIs(service.trace, None)
+
+    def test_save(self):
+        """
+        Each save is given a new trace identifier, recorded with the time of
+        the save.
+        """
+        service, clock = self.service()
+        service.save(TEST_DEPLOYMENT)
+        first = service.trace
+        clock.advance(2)
+        service.save(TEST_DEPLOYMENT)
+        second = service.trace
+        self.assertEqual(
+            (type(first[0]), first[1], second[1], first[0] != second[0]),
+            (unicode, 0, 2, True))
+
+
+class IndexTests(SynchronousTestCase):
+    """
+    Tests for ``ConfigurationPersistenceService.index``.
+    """
+    def test_index(self):
+        """
+        ``ConfigurationPersistenceService.index`` returns indexes of the
+        current configuration, updated by ``save``.
+        """
+        service = ConfigurationPersistenceService(
+            None, FilePath(self.mktemp()))
+        service.startService()
+        self.addCleanup(service.stopService)
+        initial = service.index().nodes
+        service.save(TEST_DEPLOYMENT)
+        self.assertEqual(
+            (initial, service.index().deployment, service.index().nodes),
+            ({}, TEST_DEPLOYMENT,
+             {node.hostname: node for node in TEST_DEPLOYMENT.nodes}))
@@ -12,25 +12,37 @@ from characteristic import attributes, Attribute
 
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import StringTransport, MemoryReactor
-from twisted.protocols.amp import UnknownRemoteError, RemoteAmpError
+from twisted.protocols.amp import (
+    UnknownRemoteError, RemoteAmpError, MAX_VALUE_LENGTH, AmpBox, parseString,
+)
 from twisted.python.failure import Failure
 from twisted.internet.error import ConnectionLost
 from twisted.internet.endpoints import TCP4ServerEndpoint
-from twisted.internet.defer import succeed
+from twisted.internet.defer import succeed, fail, Deferred
+from twisted.internet.task import Clock
+from twisted.test.iosim import connectedServerAndClient
 from twisted.python.filepath import FilePath
 from twisted.application.internet import StreamServerEndpointService
 
+from eliot.testing import validateLogging, assertHasMessage
+
 from .._protocol import (
     NodeStateArgument, DeploymentArgument,
     VersionCommand, ClusterStatusCommand, NodeStateCommand, IConvergenceAgent,
-    build_agent_client, ControlAMPService, ControlAMP
+    build_agent_client, ControlAMPService, ControlAMP, _CachingEncoder,
+    CLUSTER_STATUS_BROADCAST, ClusterStatusDeltaCommand, StaleGeneration,
+    DeploymentDiffArgument, PROTOCOL_MINOR_VERSION, DELTA_MINOR_VERSION,
+    CHANGE_CONVERGED,
 )
+from .. import _protocol
+from .._diff import DeploymentDiff, diff_deployments
 from .._clusterstate import ClusterStateService
 from .._model import (
     Deployment, Application, DockerImage, Node, NodeState, Manifestation,
     Dataset,
 )
 from .._persistence import ConfigurationPersistenceService
+from ...common import MetricsRegistry
 
 
 class LoopbackAMPClient(object):
@@ -115,12 +127,142 @@ class SerializationTests(SynchronousTestCase):
         self.assertEqual([bytes, TEST_DEPLOYMENT],
                          [type(as_bytes), deserialized])
 
+    def test_deployment_diff(self):
+        """
+        ``DeploymentDiffArgument`` can round-trip a ``DeploymentDiff``
+        instance.
+        """
+        argument = DeploymentDiffArgument()
+        deployment_diff = diff_deployments(
+            Deployment(nodes=frozenset()), TEST_DEPLOYMENT)
+        as_bytes = argument.toString(deployment_diff)
+        deserialized = argument.fromString(as_bytes)
+        self.assertEqual([bytes, deployment_diff],
+                         [type(as_bytes), deserialized])
+
+    def test_large_deployment_split(self):
+        """
+        ``DeploymentArgument`` splits deployments too large for a single AMP
+        value across several keys of the box, and reassembles them.
+        """
+        deployment = Deployment(nodes=frozenset(
+            Node(hostname=u'node%d.example.com' % (i,),
+                 applications=frozenset([
+                     Application(name=u'app%d' % (i,),
+                                 image=DockerImage.from_string(u'image'))]))
+            for i in range(2000)))
+        argument = DeploymentArgument()
+        strings = {}
+        argument.toBox(b"state", strings, {"state": deployment}, None)
+        objects = {}
+        argument.fromBox(b"state", strings, objects, None)
+        self.assertEqual(
+            (len(strings) > 1,
+             max(len(value) for value in strings.values()) <=
+             MAX_VALUE_LENGTH,
+             objects),
+            (True, True, {"state": deployment}))
+
+    def test_small_deployment_single_key(self):
+        """
+        ``DeploymentArgument`` encodes deployments which fit in a single AMP
+        value using a single key.
+        """
+        strings = {}
+        DeploymentArgument().toBox(
+            b"state", strings, {"state": TEST_DEPLOYMENT}, None)
+        self.assertEqual(strings.keys(), [b"state.0"])
 
-def build_control_amp_service(test):
+
+class CachingEncoderTests(SynchronousTestCase):
+    """
+    Tests for ``_CachingEncoder``.
+    """
+    def test_no_caching(self):
+        """
+        Outside of a ``cache()`` block every call serializes the object
+        anew.
+        """
+        encoder = _CachingEncoder()
+        first = encoder.encode(TEST_DEPLOYMENT)
+        second = encoder.encode(TEST_DEPLOYMENT)
+        self.assertEqual((first, first is second), (second, False))
+
+    def test_caching(self):
+        """
+        Within a ``cache()`` block the same object is serialized only once
+        and the same ``bytes`` are returned for every call.
+        """
+        encoder = _CachingEncoder()
+        with encoder.cache():
+            first = encoder.encode(TEST_DEPLOYMENT)
+            second = encoder.encode(TEST_DEPLOYMENT)
+        self.assertEqual((first is second, encoder.encodes,
+                          encoder.encoded_bytes),
+                         (True, 1, len(b"".join(first))))
+
+    def test_distinct_objects(self):
+        """
+        Distinct objects are serialized separately within a ``cache()``
+        block.
+        """
+        encoder = _CachingEncoder()
+        empty = Deployment(nodes=frozenset())
+        with encoder.cache():
+            first = encoder.encode(TEST_DEPLOYMENT)
+            second = encoder.encode(empty)
+        self.assertEqual(
+            (DeploymentArgument().fromString(b"".join(first)),
+             DeploymentArgument().fromString(b"".join(second)),
+             encoder.encodes),
+            (TEST_DEPLOYMENT, empty, 2))
+
+    def test_cache_cleared(self):
+        """
+        Cached results are discarded at the end of the ``cache()`` block.
+        """
+        encoder = _CachingEncoder()
+        with encoder.cache():
+            first = encoder.encode(TEST_DEPLOYMENT)
+        self.assertIsNot(first, encoder.encode(TEST_DEPLOYMENT))
+
+
+def acknowledge(protocol):
+    """
+    Respond successfully to all commands a ``ControlAMP`` connected to a
+    ``StringTransport`` has sent so far, as a convergence agent would.
+
+    :param ControlAMP protocol: The protocol whose commands to respond to.
+    """
+    boxes = parseString(protocol.transport.value())
+    protocol.transport.clear()
+    for box in boxes:
+        if b"_ask" in box:
+            protocol.dataReceived(AmpBox(_answer=box[b"_ask"]).serialize())
+
+
+def connect(service):
+    """
+    Connect a new ``ControlAMP`` to a service and acknowledge the initial
+    cluster status it is sent.
+
+    :param ControlAMPService service: The service to connect to.
+
+    :return ControlAMP: The connected protocol.
+    """
+    protocol = ControlAMP(service)
+    protocol.makeConnection(StringTransport())
+    acknowledge(protocol)
+    return protocol
+
+
+def build_control_amp_service(test, **kwargs):
     """
     Create a new ``ControlAMPService``.
 
     :param TestCase test: The test this service is for.
+    :param kwargs: Additional keyword arguments for ``ControlAMPService``.
+        Its ``reactor``, if given, is also used to time saves.
 
     :return ControlAMPService: Not started.
     """
@@ -128,11 +270,12 @@ def build_control_amp_service(test):
     cluster_state.startService()
     test.addCleanup(cluster_state.stopService)
     persistence_service = ConfigurationPersistenceService(
-        None, FilePath(test.mktemp()))
+        None, FilePath(test.mktemp()), clock=kwargs.get("reactor"))
     persistence_service.startService()
     test.addCleanup(persistence_service.stopService)
     return ControlAMPService(cluster_state, persistence_service,
-                             TCP4ServerEndpoint(MemoryReactor(), 1234))
+                             TCP4ServerEndpoint(MemoryReactor(), 1234),
+                             **kwargs)
 
 
 class ControlAMPTests(SynchronousTestCase):
@@ -174,7 +317,9 @@ class ControlAMPTests(SynchronousTestCase):
             sent[0],
             (((ClusterStatusCommand,),
               dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state))))
+                   state=cluster_state,
+                   generation=self.protocol.generation,
+                   trace_id=self.protocol.trace_id))))
 
     def test_connection_lost(self):
         """
@@ -196,7 +341,19 @@ class ControlAMPTests(SynchronousTestCase):
         """
         self.assertEqual(
             self.successResultOf(self.client.callRemote(VersionCommand)),
-            {"major": 1})
+            {"major": 2, "minor": 0})
+
+    def test_version_minor(self):
+        """
+        ``VersionCommand`` with a minor version negotiates the highest minor
+        version supported by both sides and records it on the connection.
+        """
+        result = self.successResultOf(
+            self.client.callRemote(VersionCommand, minor=1000))
+        self.assertEqual(
+            (result, self.protocol.protocol_minor),
+            ({"major": 2, "minor": PROTOCOL_MINOR_VERSION},
+             PROTOCOL_MINOR_VERSION))
 
     def test_nodestate_updates_node_state(self):
         """
@@ -222,8 +379,8 @@ class ControlAMPTests(SynchronousTestCase):
         """
         self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
         self.protocol.makeConnection(StringTransport())
-        another_protocol = ControlAMP(self.control_amp_service)
-        another_protocol.makeConnection(StringTransport())
+        acknowledge(self.protocol)
+        another_protocol = connect(self.control_amp_service)
         sent1 = []
         sent2 = []
         self.patch(self.protocol, "callRemote",
@@ -241,7 +398,9 @@ class ControlAMPTests(SynchronousTestCase):
             [sent1[-1], sent2[-1]],
             [(((ClusterStatusCommand,),
               dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state)))] * 2)
+                   state=cluster_state,
+                   generation=self.protocol.generation,
+                   trace_id=self.protocol.trace_id)))] * 2)
 
 
 class ControlAMPServiceTests(SynchronousTestCase):
@@ -296,8 +455,7 @@ class ControlAMPServiceTests(SynchronousTestCase):
         """
         service = build_control_amp_service(self)
         service.startService()
-        protocol = ControlAMP(service)
-        protocol.makeConnection(StringTransport())
+        protocol = connect(service)
         sent = []
         self.patch(protocol, "callRemote",
                    lambda *args, **kwargs: sent.append((args, kwargs))
@@ -306,14 +464,681 @@ class ControlAMPServiceTests(SynchronousTestCase):
 
         self.assertEqual(sent, [((ClusterStatusCommand,),
                                  dict(configuration=TEST_DEPLOYMENT,
-                                      state=Deployment(nodes=frozenset())))])
+                                      state=Deployment(nodes=frozenset()),
+                                      generation=protocol.generation,
+                                      trace_id=protocol.trace_id))])
+
+    def test_broadcast_encodes_once(self):
+        """
+        Sending cluster status to many connections serializes the
+        configuration and state only once, and every connection is sent
+        the same bytes.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        connections = [connect(service) for i in range(3)]
+        encodes = service.broadcast_encodes
+        service.configuration_service.save(TEST_DEPLOYMENT)
+        sent = [c.transport.value() for c in connections]
+        self.assertEqual(
+            (service.broadcast_encodes - encodes,
+             sent[0] == sent[1] == sent[2], bool(sent[0])),
+            (2, True, True))
+
+    @validateLogging(assertHasMessage, CLUSTER_STATUS_BROADCAST,
+                     {u"connections": 2, u"encodes": 2})
+    def test_broadcast_logged(self, logger):
+        """
+        Each broadcast logs the number of connections, the number of
+        serializations and the number of serialized bytes.
+        """
+        service = build_control_amp_service(self)
+        service.logger = logger
+        service.startService()
+        for i in range(2):
+            connect(service)
+        del logger.messages[:]
+        service.configuration_service.save(TEST_DEPLOYMENT)
+        self.assertEqual(
+            logger.messages[0][u"encoded_bytes"],
+            len(DeploymentArgument().toString(TEST_DEPLOYMENT)) +
+            len(DeploymentArgument().toString(
+                service.cluster_state.as_deployment())))
+
+
+class CoalescingTests(SynchronousTestCase):
+    """
+    Tests for coalescing of node state updates by ``ControlAMPService``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.service = build_control_amp_service(
+            self, reactor=self.clock, broadcast_window=0.1,
+            broadcast_max_delay=0.5)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.protocol = connect(self.service)
+        self.sent = []
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: self.sent.append((args, kwargs))
+                   or succeed(None))
+
+    def node_changed(self, hostname):
+        """
+        Report new state for a node to the service.
+
+        :param unicode hostname: The node's hostname.
+        """
+        self.service.node_changed(hostname, NODE_STATE)
+
+    def test_no_immediate_broadcast(self):
+        """
+        A node state update is not broadcast before the window has passed.
+        """
+        self.node_changed(u"node1")
+        self.clock.advance(0.09)
+        self.assertEqual(self.sent, [])
+
+    def test_broadcast_after_window(self):
+        """
+        Once the window has passed the latest cluster state is broadcast.
+        """
+        self.node_changed(u"node1")
+        self.clock.advance(0.1)
+        self.assertEqual(
+            self.sent,
+            [((ClusterStatusCommand,),
+              dict(configuration=Deployment(nodes=frozenset()),
+                   state=self.service.cluster_state.as_deployment(),
+                   generation=self.protocol.generation,
+                   trace_id=None))])
+
+    def test_updates_merged(self):
+        """
+        All updates arriving within the window of each other result in a
+        single broadcast.
+        """
+        for i in range(3):
+            self.node_changed(u"node%d" % (i,))
+            self.clock.advance(0.05)
+        self.clock.advance(0.1)
+        self.assertEqual(
+            (len(self.sent), self.service.merged_node_updates,
+             self.service.node_updates,
+             len(self.sent[0][1]["state"].nodes)),
+            (1, 3, 3, 3))
+
+    def test_max_delay(self):
+        """
+        A steady stream of updates does not delay the broadcast by more than
+        the maximum delay.
+        """
+        for i in range(6):
+            self.node_changed(u"node%d" % (i,))
+            self.clock.advance(0.09)
+        self.assertEqual(
+            (len(self.sent), self.service.merged_node_updates), (1, 6))
+
+    def test_configuration_change(self):
+        """
+        A configuration change is broadcast immediately, along with any
+        pending node state updates.
+        """
+        self.node_changed(u"node1")
+        self.service.configuration_service.save(TEST_DEPLOYMENT)
+        self.clock.advance(1)
+        self.assertEqual(
+            (len(self.sent), self.service.merged_node_updates,
+             self.clock.getDelayedCalls()),
+            (1, 1, []))
+
+    def test_stop_cancels(self):
+        """
+        Stopping the service cancels any pending broadcast.
+        """
+        self.node_changed(u"node1")
+        self.service.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @validateLogging(assertHasMessage, CLUSTER_STATUS_BROADCAST,
+                     {u"connections": 1, u"node_updates": 2})
+    def test_merged_updates_logged(self, logger):
+        """
+        The number of node state updates merged into a broadcast is logged.
+        """
+        self.service.logger = logger
+        self.node_changed(u"node1")
+        self.node_changed(u"node2")
+        self.clock.advance(0.1)
+
+
+class DeltaTests(SynchronousTestCase):
+    """
+    Tests for ``ControlAMPService`` sending changes to convergence agents
+    which support ``ClusterStatusDeltaCommand``.
+    """
+    def setUp(self):
+        self.service = build_control_amp_service(self)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.protocol = self.connect(PROTOCOL_MINOR_VERSION)
+
+    def connect(self, minor):
+        """
+        Connect a new protocol to the service and record what it is sent.
+
+        :param int minor: The minor protocol version the connection
+            negotiated.
+
+        :return: The new ``ControlAMP``, with a ``sent`` attribute listing
+            the commands sent after connecting.
+        """
+        protocol = connect(self.service)
+        protocol.protocol_minor = minor
+        protocol.sent = []
+        self.patch(protocol, "callRemote",
+                   lambda *args, **kwargs: protocol.sent.append(
+                       (args, kwargs)) or succeed(None))
+        return protocol
+
+    def test_changes_sent(self):
+        """
+        After the initial cluster status, a connection which negotiated
+        delta support is sent only the changes since the generation it was
+        last sent.
+        """
+        initial = self.protocol.generation
+        self.service.node_changed(u"node1", NODE_STATE)
+        state = self.service.cluster_state.as_deployment()
+        self.assertEqual(
+            self.protocol.sent,
+            [((ClusterStatusDeltaCommand,),
+              dict(from_generation=initial,
+                   generation=self.protocol.generation,
+                   trace_id=None,
+                   configuration=DeploymentDiff(),
+                   state=diff_deployments(Deployment(nodes=frozenset()),
+                                          state)))])
+
+    def test_legacy_connection(self):
+        """
+        A connection which did not negotiate delta support is sent the full
+        configuration and state.
+        """
+        legacy = self.connect(0)
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.assertEqual(
+            [args[0] for args, kwargs in legacy.sent],
+            [ClusterStatusCommand])
+
+    def test_unchanged_not_sent(self):
+        """
+        If neither configuration nor state changed since the generation a
+        connection which negotiated delta support was last sent, nothing is
+        sent to it.
+        """
+        other = self.connect(PROTOCOL_MINOR_VERSION)
+        self.service.node_changed(u"node1", NODE_STATE)
+        # Connecting again doesn't change anything:
+        connect(self.service)
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.assertEqual((len(self.protocol.sent), len(other.sent)), (1, 1))
+
+    def test_unknown_cluster_status(self):
+        """
+        A connection for which the service has no record of the cluster
+        status it was last sent is sent the full configuration and state.
+        """
+        self.protocol.cluster_status = None
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.assertEqual(
+            self.protocol.sent,
+            [((ClusterStatusCommand,),
+              dict(configuration=Deployment(nodes=frozenset()),
+                   state=self.service.cluster_state.as_deployment(),
+                   generation=self.protocol.generation,
+                   trace_id=None))])
+
+    def test_changes_computed_once(self):
+        """
+        The changes for a broadcast are calculated and serialized only once
+        for all connections at the same generation.
+        """
+        protocols = [self.protocol] + [
+            self.connect(PROTOCOL_MINOR_VERSION) for i in range(3)]
+        self.service.node_changed(u"node1", NODE_STATE)
+        changes = [protocol.sent[0][1]["state"] for protocol in protocols]
+        self.assertEqual(
+            [change is changes[0] for change in changes], [True] * 4)
+
+    def test_rejected_changes(self):
+        """
+        If the convergence agent rejects the changes with
+        ``StaleGeneration``, the full configuration and state are sent.
+        """
+        sent = []
+
+        def callRemote(command, **kwargs):
+            sent.append(command)
+            if command is ClusterStatusDeltaCommand:
+                return fail(StaleGeneration())
+            return succeed({})
+        self.patch(self.protocol, "callRemote", callRemote)
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.assertEqual(sent,
+                         [ClusterStatusDeltaCommand, ClusterStatusCommand])
+
+    def test_filtered_view(self):
+        """
+        Once a connection which negotiated filtering reports its node's
+        state, it is only sent the parts of the cluster relevant to its
+        node.
+        """
+        self.service.configuration_service.save(Deployment(nodes=frozenset([
+            Node(hostname=u"node1", applications=frozenset([APP1])),
+            Node(hostname=u"node2", applications=frozenset([APP2]))])))
+        self.successResultOf(
+            LoopbackAMPClient(self.protocol.locator).callRemote(
+                NodeStateCommand, hostname=u"node1", node_state=NODE_STATE))
+        self.assertEqual(
+            (self.protocol.hostname, self.protocol.cluster_status),
+            (u"node1",
+             (Deployment(nodes=frozenset([
+                 Node(hostname=u"node1", applications=frozenset([APP1]))])),
+              self.service.cluster_state.as_deployment())))
+
+    def test_unfiltered_view(self):
+        """
+        A connection which negotiated delta support but not filtering is
+        sent the whole cluster even once it has reported its node's state.
+        """
+        self.protocol.protocol_minor = DELTA_MINOR_VERSION
+        configuration = Deployment(nodes=frozenset([
+            Node(hostname=u"node1", applications=frozenset([APP1])),
+            Node(hostname=u"node2", applications=frozenset([APP2]))]))
+        self.service.configuration_service.save(configuration)
+        self.successResultOf(
+            LoopbackAMPClient(self.protocol.locator).callRemote(
+                NodeStateCommand, hostname=u"node1", node_state=NODE_STATE))
+        self.assertEqual(self.protocol.cluster_status[0], configuration)
+
+    def test_end_to_end(self):
+        """
+        A convergence agent connected to the control service negotiates
+        delta support and ends up with the same configuration and state as
+        the control service.
+        """
+        agent = FakeAgent()
+        client, server, pump = connectedServerAndClient(
+            lambda: ControlAMP(self.service),
+            lambda: build_agent_client(agent))
+        pump.flush()
+        self.service.configuration_service.save(TEST_DEPLOYMENT)
+        pump.flush()
+        self.service.node_changed(u"node1", NODE_STATE)
+        pump.flush()
+        self.assertEqual(
+            (server.protocol_minor, agent.desired, agent.actual),
+            (PROTOCOL_MINOR_VERSION, TEST_DEPLOYMENT,
+             self.service.cluster_state.as_deployment()))
+
+
+class SendQueueTests(SynchronousTestCase):
+    """
+    Tests for ``ControlAMPService`` limiting each connection to one
+    outstanding cluster status command.
+    """
+    def setUp(self):
+        self.service = build_control_amp_service(self)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.protocol = connect(self.service)
+        self.sent = []
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: self.sent.append(
+                       (args, kwargs, Deferred())) or self.sent[-1][2])
+
+    def test_one_in_flight(self):
+        """
+        While a command is outstanding further updates are not sent, but are
+        recorded as pending.
+        """
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.service.node_changed(u"node2", NODE_STATE)
+        self.assertEqual(
+            (len(self.sent), self.protocol.in_flight, self.protocol.pending,
+             self.protocol.queue_depth),
+            (1, True, True, 2))
+
+    def test_latest_sent_on_response(self):
+        """
+        When the outstanding command is responded to, only the latest
+        cluster status is sent, superseding the intermediate updates.
+        """
+        for i in range(4):
+            self.service.node_changed(u"node%d" % (i,), NODE_STATE)
+        self.sent[0][2].callback({})
+        self.assertEqual(
+            (len(self.sent), self.sent[1][0][0], self.protocol.cluster_status,
+             self.protocol.superseded, self.service.superseded,
+             self.protocol.queue_depth),
+            (2, ClusterStatusCommand,
+             (Deployment(nodes=frozenset()),
+              self.service.cluster_state.as_deployment()),
+             2, 2, 1))
+
+    def test_superseded_not_broadcast(self):
+        """
+        Sending the latest cluster status to a connection once its
+        outstanding command is responded to is not counted as a broadcast.
+        """
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.service.node_changed(u"node2", NODE_STATE)
+        broadcasts = self.service.broadcasts
+        self.sent[0][2].callback({})
+        self.assertEqual(
+            (len(self.sent), self.service.broadcasts), (2, broadcasts))
+
+    def test_nothing_pending(self):
+        """
+        When the outstanding command is responded to and nothing has changed
+        meanwhile, nothing more is sent.
+        """
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.sent[0][2].callback({})
+        self.assertEqual((len(self.sent), self.protocol.queue_depth), (1, 0))
+
+    def test_disconnected(self):
+        """
+        Pending updates are not sent to connections which have been lost by
+        the time the outstanding command is responded to.
+        """
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.service.node_changed(u"node2", NODE_STATE)
+        self.service.disconnected(self.protocol)
+        self.sent[0][2].errback(ConnectionLost())
+        self.assertEqual(len(self.sent), 1)
+
+    @validateLogging(None)
+    def test_failure_logged(self, logger):
+        """
+        If a command fails the failure is logged and the latest cluster
+        status is sent once there is an update.
+        """
+        self.service.logger = logger
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.sent[0][2].errback(ZeroDivisionError())
+        self.service.node_changed(u"node2", NODE_STATE)
+        self.assertEqual(
+            (len(logger.flushTracebacks(ZeroDivisionError)), len(self.sent)),
+            (1, 2))
+
+
+class ControlMetricsTests(SynchronousTestCase):
+    """
+    Tests for the statistics ``ControlAMPService`` records.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.service = build_control_amp_service(self, reactor=self.clock)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.protocol = connect(self.service)
+        self.sent = []
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: self.sent.append(
+                       (args, kwargs, Deferred())) or self.sent[-1][2])
+
+    def sample(self, name, *labels):
+        """
+        :param bytes name: The name of a metric.
+        :param labels: Values of the metric's labels.
+
+        :return: The metric's value for those labels.
+        """
+        return self.service.metrics._metrics[name].labels(*labels)
+
+    def test_metrics(self):
+        """
+        ``ControlAMPService`` records statistics in the given
+        ``MetricsRegistry``.
+        """
+        metrics = MetricsRegistry(self.clock)
+        service = build_control_amp_service(self, metrics=metrics)
+        self.assertIs(service.metrics, metrics)
+
+    def test_connected_agents(self):
+        """
+        The number of connected agents is recorded.
+        """
+        connect(self.service)
+        before = self.sample(b"flocker_control_connected_agents").value
+        self.service.disconnected(self.protocol)
+        self.assertEqual(
+            (before, self.sample(b"flocker_control_connected_agents").value),
+            (2, 1))
+
+    def test_node_updates(self):
+        """
+        The number of node state updates received is recorded.
+        """
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.service.node_changed(u"node2", NODE_STATE)
+        self.assertEqual(
+            self.sample(b"flocker_control_node_updates_total").value, 2)
+
+    def test_broadcast(self):
+        """
+        The duration of each broadcast and the size of the deployments
+        serialized for it are recorded.
+        """
+        self.service.node_changed(u"node1", NODE_STATE)
+        encoded = self.service.broadcast_bytes
+        sizes = self.sample(b"flocker_control_broadcast_bytes")
+        durations = self.sample(b"flocker_control_broadcast_encode_seconds")
+        self.assertEqual(
+            (sum(sizes.counts), sizes.sum, sum(durations.counts)),
+            (self.service.broadcasts, encoded, self.service.broadcasts))
+
+    def test_round_trip(self):
+        """
+        The time each agent takes to respond to a cluster status command is
+        recorded, labelled with the agent's hostname.
+        """
+        self.protocol.locator.node_changed(u"node1", NODE_STATE, None)
+        self.clock.advance(0.5)
+        self.sent[0][2].callback({})
+        round_trip = self.sample(
+            b"flocker_control_cluster_status_seconds", u"node1")
+        self.assertEqual((sum(round_trip.counts), round_trip.sum), (1, 0.5))
+
+    def test_queued_updates(self):
+        """
+        The total queue depth of all connections is recorded.
+        """
+        # Never responds, so has an outstanding and a pending update:
+        connect(self.service)
+        self.service.node_changed(u"node1", NODE_STATE)
+        self.service.node_changed(u"node2", NODE_STATE)
+        before = self.sample(b"flocker_control_queued_updates").value
+        self.sent[0][2].callback({})
+        self.assertEqual(
+            (before, self.sample(b"flocker_control_queued_updates").value),
+            (4, 3))
+
+
+class ConvergenceTraceTests(SynchronousTestCase):
+    """
+    Tests for ``ControlAMPService`` tracing the convergence of
+    configuration changes.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.service = build_control_amp_service(self, reactor=self.clock)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+    def connect(self, hostname):
+        """
+        Connect a new protocol for a node to the service and record what it
+        is sent.
+
+        :param unicode hostname: The hostname of the node.
+
+        :return: The new ``ControlAMP``, with a ``sent`` attribute listing
+            the commands sent after connecting.
+        """
+        protocol = connect(self.service)
+        protocol.protocol_minor = PROTOCOL_MINOR_VERSION
+        protocol.sent = []
+        self.patch(protocol, "callRemote",
+                   lambda *args, **kwargs: protocol.sent.append(
+                       (args, kwargs)) or succeed(None))
+        protocol.locator.node_changed(hostname, NODE_STATE, None)
+        return protocol
+
+    def save(self, hostname):
+        """
+        Save a configuration change affecting a node.
+
+        :param unicode hostname: The hostname of the node.
+
+        :return unicode: The trace identifier of the change.
+        """
+        configuration = self.service.configuration_service
+        application = Application(name=unicode(uuid4()),
+                                  image=DockerImage.from_string(u"busybox"))
+        nodes = configuration.get().nodes
+        old = [node for node in nodes if node.hostname == hostname]
+        applications = frozenset([application])
+        for node in old:
+            applications |= node.applications
+        node = Node(hostname=hostname, applications=applications)
+        configuration.save(
+            Deployment(nodes=nodes - frozenset(old) | frozenset([node])))
+        return configuration.trace[0]
+
+    def sample(self, name, *labels):
+        """
+        :param bytes name: The name of a metric.
+        :param labels: Values of the metric's labels.
+
+        :return: The metric's value for those labels.
+        """
+        return self.service.metrics._metrics[name].labels(*labels)
+
+    def test_trace_sent(self):
+        """
+        The trace identifier of the latest configuration change is sent with
+        the cluster status.
+        """
+        protocol = self.connect(u"node1")
+        trace_id = self.save(u"node1")
+        self.assertEqual(
+            (protocol.sent[-1][1][u"trace_id"], protocol.trace_id),
+            (trace_id, trace_id))
+
+    def test_node_convergence(self):
+        """
+        The time from a change being saved to each node reporting it is
+        recorded, labelled with the node's hostname.
+        """
+        self.connect(u"node1")
+        trace_id = self.save(u"node1")
+        self.clock.advance(3)
+        self.service.node_changed(u"node1", NODE_STATE, trace_id)
+        converged = self.sample(
+            b"flocker_control_node_convergence_seconds", u"node1")
+        self.assertEqual((sum(converged.counts), converged.sum), (1, 3))
+
+    @validateLogging(None)
+    def test_convergence(self, logger):
+        """
+        Once all the nodes which were sent a change have reported it, the time
+        taken for the change to converge is recorded and logged.
+        """
+        self.service.logger = logger
+        self.connect(u"node1")
+        self.connect(u"node2")
+        trace_id = self.save(u"node2")
+        self.clock.advance(1)
+        self.service.node_changed(u"node1", NODE_STATE, trace_id)
+        converged = self.sample(b"flocker_control_convergence_seconds")
+        before = sum(converged.counts)
+        self.clock.advance(1)
+        self.service.node_changed(u"node2", NODE_STATE, trace_id)
+        self.assertEqual((before, sum(converged.counts), converged.sum),
+                         (0, 1, 2))
+        assertHasMessage(self, logger, CHANGE_CONVERGED,
+                         dict(trace_id=trace_id, seconds=2.0))
+
+    def test_earlier_changes(self):
+        """
+        A node reporting a change has also acted on the changes saved before
+        it.
+        """
+        self.connect(u"node1")
+        self.save(u"node1")
+        self.clock.advance(1)
+        trace_id = self.save(u"node1")
+        self.clock.advance(1)
+        self.service.node_changed(u"node1", NODE_STATE, trace_id)
+        converged = self.sample(b"flocker_control_convergence_seconds")
+        self.assertEqual((sum(converged.counts), converged.sum), (2, 3))
+
+    def test_unchanged(self):
+        """
+        A node which didn't need to be sent a change isn't waited for.
+        """
+        self.connect(u"node1")
+        other = self.connect(u"node2")
+        sent = len(other.sent)
+        trace_id = self.save(u"node1")
+        self.service.node_changed(u"node1", NODE_STATE, trace_id)
+        self.assertEqual(
+            (len(other.sent),
+             sum(self.sample(b"flocker_control_convergence_seconds").counts)),
+            (sent, 1))
+
+    def test_disconnected(self):
+        """
+        A node which disconnects isn't waited for; changes which only it had
+        yet to report are forgotten without being recorded as converged.
+        """
+        protocol = self.connect(u"node1")
+        self.save(u"node1")
+        self.service.disconnected(protocol)
+        self.assertEqual(
+            (self.service._traces,
+             sum(self.sample(b"flocker_control_convergence_seconds").counts)),
+            ({}, 0))
+
+    def test_unknown(self):
+        """
+        Reports of unknown trace identifiers are ignored.
+        """
+        self.connect(u"node1")
+        self.save(u"node1")
+        self.service.node_changed(u"node1", NODE_STATE, unicode(uuid4()))
+        self.assertEqual(len(self.service._traces), 1)
+
+    def test_maximum_traces(self):
+        """
+        At most ``MAX_TRACES`` changes are tracked at once.
+        """
+        self.patch(_protocol, "MAX_TRACES", 2)
+        self.connect(u"node1")
+        self.save(u"node1")
+        latest = [self.save(u"node1"), self.save(u"node1")]
+        self.assertEqual(list(self.service._traces), latest)
 
 
 @implementer(IConvergenceAgent)
 @attributes([Attribute("is_connected", default_value=False),
              Attribute("is_disconnected", default_value=False),
              Attribute("desired", default_value=None),
-             Attribute("actual", default_value=None)])
+             Attribute("actual", default_value=None),
+             Attribute("trace_id", default_value=None)])
 class FakeAgent(object):
     """
     Fake agent for testing.
@@ -328,9 +1153,10 @@ class FakeAgent(object):
     def disconnected(self):
         self.is_disconnected = True
 
-    def cluster_updated(self, configuration, cluster_state):
+    def cluster_updated(self, configuration, cluster_state, trace_id):
         self.desired = configuration
         self.actual = cluster_state
+        self.trace_id = trace_id
 
 
 class AgentClientTests(SynchronousTestCase):
@@ -383,3 +1209,75 @@ class AgentClientTests(SynchronousTestCase):
         self.assertEqual(self.agent, FakeAgent(is_connected=True,
                                                desired=TEST_DEPLOYMENT,
                                                actual=actual))
+
+    def test_trace_id(self):
+        """
+        The trace identifier sent with a ``ClusterStatusCommand`` is passed on
+        to the agent.
+        """
+        self.client.makeConnection(StringTransport())
+        empty = Deployment(nodes=frozenset())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand, configuration=empty, state=empty,
+            trace_id=u"abc"))
+        self.assertEqual(self.agent.trace_id, u"abc")
+
+    def test_version_negotiated(self):
+        """
+        Once connected the client sends a ``VersionCommand`` with the minor
+        protocol version it supports.
+        """
+        transport = StringTransport()
+        self.client.makeConnection(transport)
+        self.assertIn(b"VersionCommand", transport.value())
+
+    def test_cluster_changed(self):
+        """
+        ``ClusterStatusDeltaCommand`` sent to the ``AgentClient`` results in
+        the agent being told the cluster status with the changes applied.
+        """
+        self.client.makeConnection(StringTransport())
+        empty = Deployment(nodes=frozenset())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand, configuration=empty, state=empty,
+            generation=1))
+        d = self.server.callRemote(
+            ClusterStatusDeltaCommand, from_generation=1, generation=2,
+            configuration=diff_deployments(empty, TEST_DEPLOYMENT),
+            state=DeploymentDiff())
+        self.successResultOf(d)
+        self.assertEqual(self.agent, FakeAgent(is_connected=True,
+                                               desired=TEST_DEPLOYMENT,
+                                               actual=empty))
+
+    def test_cluster_changed_trace_id(self):
+        """
+        The trace identifier sent with a ``ClusterStatusDeltaCommand`` is
+        passed on to the agent.
+        """
+        self.client.makeConnection(StringTransport())
+        empty = Deployment(nodes=frozenset())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand, configuration=empty, state=empty,
+            generation=1, trace_id=u"abc"))
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusDeltaCommand, from_generation=1, generation=2,
+            configuration=DeploymentDiff(), state=DeploymentDiff(),
+            trace_id=u"def"))
+        self.assertEqual(self.agent.trace_id, u"def")
+
+    def test_cluster_changed_stale(self):
+        """
+        ``ClusterStatusDeltaCommand`` relative to a generation other than the
+        one the ``AgentClient`` last received fails with
+        ``StaleGeneration``.
+        """
+        self.client.makeConnection(StringTransport())
+        empty = Deployment(nodes=frozenset())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand, configuration=empty, state=empty,
+            generation=1))
+        d = self.server.callRemote(
+            ClusterStatusDeltaCommand, from_generation=5, generation=6,
+            configuration=DeploymentDiff(), state=DeploymentDiff())
+        self.failureResultOf(d, StaleGeneration)
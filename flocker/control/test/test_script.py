@@ -2,6 +2,7 @@
 
 from twisted.web.server import Site
 from twisted.trial.unittest import SynchronousTestCase
+from twisted.python.usage import UsageError
 from twisted.python.filepath import FilePath
 
 from ..script import ControlOptions, ControlScript
@@ -68,6 +69,89 @@ class ControlOptionsTests(StandardOptionsTestsMixin,
         options.parseOptions([b"--agent-port", b"1234"])
         self.assertEqual(options["agent-port"], 1234)
 
+    def test_default_broadcast_window(self):
+        """
+        By default node state updates are coalesced for 0.1 seconds, and
+        delayed by at most one second.
+        """
+        options = ControlOptions()
+        options.parseOptions([])
+        self.assertEqual(
+            (options["broadcast-window"], options["broadcast-max-delay"]),
+            (0.1, 1.0))
+
+    def test_custom_broadcast_window(self):
+        """
+        The ``--broadcast-window`` and ``--broadcast-max-delay`` command-line
+        options configure coalescing of node state updates.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--broadcast-window", b"0.5",
+                              b"--broadcast-max-delay", b"2.5"])
+        self.assertEqual(
+            (options["broadcast-window"], options["broadcast-max-delay"]),
+            (0.5, 2.5))
+
+    def test_negative_broadcast_window(self):
+        """
+        A negative ``--broadcast-window`` is rejected.
+        """
+        options = ControlOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--broadcast-window", b"-1"])
+
+    def test_max_delay_less_than_window(self):
+        """
+        A ``--broadcast-max-delay`` smaller than ``--broadcast-window`` is
+        rejected.
+        """
+        options = ControlOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--broadcast-window", b"0.5",
+                           b"--broadcast-max-delay", b"0.2"])
+
+    def test_commit_window(self):
+        """
+        By default configuration changes are written to disk together if
+        made within 0.05 seconds of each other; ``--commit-window`` changes
+        this.
+        """
+        default = ControlOptions()
+        default.parseOptions([])
+        custom = ControlOptions()
+        custom.parseOptions([b"--commit-window", b"0.5"])
+        self.assertEqual(
+            (default["commit-window"], custom["commit-window"]), (0.05, 0.5))
+
+    def test_negative_commit_window(self):
+        """
+        A negative ``--commit-window`` is rejected.
+        """
+        options = ControlOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--commit-window", b"-1"])
+
+    def test_output_validation(self):
+        """
+        By default every API response is validated; ``--output-validation``
+        changes this.
+        """
+        default = ControlOptions()
+        default.parseOptions([])
+        custom = ControlOptions()
+        custom.parseOptions([b"--output-validation", b"100"])
+        self.assertEqual(
+            (default["output-validation"], custom["output-validation"]),
+            (1, 100))
+
+    def test_negative_output_validation(self):
+        """
+        A negative ``--output-validation`` is rejected.
+        """
+        options = ControlOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--output-validation", b"-1"])
+
 
 class ControlScriptEffectsTests(SynchronousTestCase):
     """
@@ -136,3 +220,74 @@ class ControlScriptEffectsTests(SynchronousTestCase):
         self.assertEqual(
             (port, protocol.__class__, protocol.control_amp_service.__class__),
             (8001, ControlAMP, ControlAMPService))
+
+    def test_control_amp_service_broadcast_window(self):
+        """
+        ``ControlScript.main`` configures the AMP service with the given
+        broadcast window and maximum delay.
+        """
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--broadcast-window", b"0.3", b"--broadcast-max-delay", b"3",
+             b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        service = reactor.tcpServers[1][1].buildProtocol(
+            None).control_amp_service
+        self.assertEqual(
+            (service.broadcast_window, service.broadcast_max_delay,
+             service._reactor),
+            (0.3, 3.0, reactor))
+
+    def test_persistence_commit_window(self):
+        """
+        ``ControlScript.main`` configures the persistence service with the
+        given commit window.
+        """
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--commit-window", b"0.2", b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        service = reactor.tcpServers[1][1].buildProtocol(
+            None).control_amp_service
+        self.assertEqual(service.configuration_service.commit_window, 0.2)
+
+    def test_api_output_validation(self):
+        """
+        ``ControlScript.main`` configures the HTTP API with the given output
+        validation interval.
+        """
+        options = ControlOptions()
+        options.parseOptions(
+            [b"--output-validation", b"10", b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        site = reactor.tcpServers[0][1]
+        self.assertEqual(site.resource._v1_user.output_validation, 10)
+
+    def test_api_metrics(self):
+        """
+        ``ControlScript.main`` configures the HTTP API to record statistics
+        using the reactor's clock.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        site = reactor.tcpServers[0][1]
+        self.assertIs(site.resource._v1_user.metrics.clock, reactor)
+
+    def test_amp_metrics(self):
+        """
+        ``ControlScript.main`` configures the AMP service to record
+        statistics alongside those of the HTTP API.
+        """
+        options = ControlOptions()
+        options.parseOptions([b"--data-path", self.mktemp()])
+        reactor = MemoryCoreReactor()
+        ControlScript().main(reactor, options)
+        site = reactor.tcpServers[0][1]
+        service = reactor.tcpServers[1][1].buildProtocol(
+            None).control_amp_service
+        self.assertIs(service.metrics, site.resource._v1_user.metrics)
@@ -0,0 +1,258 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.control._views``.
+"""
+
+from pyrsistent import pmap
+
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.python.filepath import FilePath
+
+from .._views import DeploymentIndex, cluster_view
+from .._model import (
+    Deployment, Application, DockerImage, Node, Manifestation, Dataset, Port,
+    AttachedVolume,
+)
+
+
+def manifestation(dataset_id, primary=True):
+    """
+    :param unicode dataset_id: The identifier of the dataset.
+    :param bool primary: Whether the manifestation is primary.
+
+    :return Manifestation: A manifestation of a dataset with the given
+        identifier.
+    """
+    return Manifestation(dataset=Dataset(dataset_id=dataset_id),
+                         primary=primary)
+
+
+WEB = Application(
+    name=u'web', image=DockerImage.from_string(u'nginx'),
+    ports=frozenset([Port(internal_port=80, external_port=8080)]))
+WORKER = Application(
+    name=u'worker', image=DockerImage.from_string(u'worker'))
+DATABASE = Application(
+    name=u'database', image=DockerImage.from_string(u'postgresql'),
+    volume=AttachedVolume(manifestation=manifestation(u'db'),
+                          mountpoint=FilePath(b"/var/lib/postgresql")))
+
+
+def views(hostname, configuration, state):
+    """
+    Index the given deployments and extract the view for a node.
+
+    :param unicode hostname: The hostname of the node.
+    :param Deployment configuration: The desired configuration.
+    :param Deployment state: The cluster state.
+
+    :return: The result of ``cluster_view``.
+    """
+    return cluster_view(hostname, DeploymentIndex(configuration),
+                        DeploymentIndex(state))
+
+
+class ClusterViewTests(SynchronousTestCase):
+    """
+    Tests for ``cluster_view``.
+    """
+    def test_own_node(self):
+        """
+        The node's own configuration and state are included in full.
+        """
+        node = Node(hostname=u'node1', applications=frozenset([WORKER]),
+                    other_manifestations=frozenset([manifestation(u'x')]))
+        deployment = Deployment(nodes=frozenset([node]))
+        self.assertEqual(views(u'node1', deployment, deployment),
+                         (deployment, deployment))
+
+    def test_unrelated_node(self):
+        """
+        Other nodes with nothing relevant to the node are omitted.
+        """
+        node1 = Node(hostname=u'node1', applications=frozenset([WORKER]))
+        node2 = Node(hostname=u'node2', applications=frozenset([WORKER]),
+                     other_manifestations=frozenset([manifestation(u'x')]))
+        deployment = Deployment(nodes=frozenset([node1, node2]))
+        expected = Deployment(nodes=frozenset([node1]))
+        self.assertEqual(views(u'node1', deployment, deployment),
+                         (expected, expected))
+
+    def test_published_applications(self):
+        """
+        Applications exposing ports on other nodes are included in the
+        configuration, since the node proxies to them, but other
+        applications on those nodes are not.
+        """
+        node1 = Node(hostname=u'node1')
+        configuration = Deployment(nodes=frozenset([
+            node1,
+            Node(hostname=u'node2', applications=frozenset([WEB, WORKER]))]))
+        self.assertEqual(
+            views(u'node1', configuration, Deployment(nodes=frozenset())),
+            (Deployment(nodes=frozenset([
+                node1,
+                Node(hostname=u'node2', applications=frozenset([WEB]))])),
+             Deployment(nodes=frozenset())))
+
+    def test_shared_datasets(self):
+        """
+        Applications and manifestations on other nodes using datasets the
+        node has or wants are included.
+        """
+        node1_configuration = Node(
+            hostname=u'node1', applications=frozenset([DATABASE]))
+        node1_state = Node(
+            hostname=u'node1',
+            other_manifestations=frozenset([manifestation(u'other')]))
+        node2_state = Node(
+            hostname=u'node2', applications=frozenset([DATABASE, WORKER]),
+            other_manifestations=frozenset([
+                manifestation(u'other', False), manifestation(u'x')]))
+        configuration = Deployment(nodes=frozenset([node1_configuration]))
+        state = Deployment(nodes=frozenset([node1_state, node2_state]))
+        self.assertEqual(
+            views(u'node1', configuration, state),
+            (configuration,
+             Deployment(nodes=frozenset([
+                 node1_state,
+                 Node(hostname=u'node2',
+                      applications=frozenset([DATABASE]),
+                      other_manifestations=frozenset([
+                          manifestation(u'other', False)]))]))))
+
+    def test_unknown_dataset_ids(self):
+        """
+        If the configuration includes datasets without identifiers the whole
+        cluster is included.
+        """
+        configuration = Deployment(nodes=frozenset([
+            Node(hostname=u'node1'),
+            Node(hostname=u'node2',
+                 other_manifestations=frozenset([manifestation(None)]))]))
+        state = Deployment(nodes=frozenset([
+            Node(hostname=u'node3', applications=frozenset([WORKER]))]))
+        self.assertEqual(views(u'node1', configuration, state),
+                         (configuration, state))
+
+    def test_unknown_node(self):
+        """
+        A node which is in neither the configuration nor the state is only
+        told about published applications.
+        """
+        node2 = Node(hostname=u'node2', applications=frozenset([WEB]))
+        deployment = Deployment(nodes=frozenset([node2]))
+        self.assertEqual(views(u'node1', deployment, deployment),
+                         (deployment, Deployment(nodes=frozenset())))
+
+
+class DeploymentIndexTests(SynchronousTestCase):
+    """
+    Tests for ``DeploymentIndex``.
+    """
+    def test_manifestations(self):
+        """
+        ``DeploymentIndex.manifestations`` maps dataset identifiers to the
+        manifestations of those datasets on each node, including those
+        attached to applications.
+        """
+        index = DeploymentIndex(Deployment(nodes=frozenset([
+            Node(hostname=u'node1', applications=frozenset([DATABASE])),
+            Node(hostname=u'node2',
+                 other_manifestations=frozenset([manifestation(u'db')]))])))
+        self.assertEqual(
+            index.manifestations,
+            {u'db': {u'node1': DATABASE.volume.manifestation,
+                     u'node2': manifestation(u'db')}})
+
+    def test_dataset_ids(self):
+        """
+        ``DeploymentIndex.dataset_ids`` returns the identifiers of all
+        datasets on the given node, or an empty set for unknown nodes.
+        """
+        index = DeploymentIndex(Deployment(nodes=frozenset([
+            Node(hostname=u'node1', applications=frozenset([DATABASE]),
+                 other_manifestations=frozenset([manifestation(u'x')]))])))
+        self.assertEqual(
+            (index.dataset_ids(u'node1'), index.dataset_ids(u'node2')),
+            ({u'db', u'x'}, set()))
+
+    def test_update(self):
+        """
+        ``DeploymentIndex.update`` changes the indexes to describe a new
+        deployment, as if the index had been created for it.
+        """
+        node1 = Node(hostname=u'node1', applications=frozenset([DATABASE]))
+        node2 = Node(hostname=u'node2', applications=frozenset([WEB]),
+                     other_manifestations=frozenset([manifestation(u'x')]))
+        new = Deployment(nodes=frozenset([
+            node1,
+            Node(hostname=u'node2', applications=frozenset([WORKER]),
+                 other_manifestations=frozenset([manifestation(u'y')])),
+            Node(hostname=u'node3', applications=frozenset([WEB]))]))
+        index = DeploymentIndex(Deployment(nodes=frozenset([node1, node2])))
+        index.update(new)
+        expected = DeploymentIndex(new)
+        self.assertEqual(
+            (index.deployment, index.nodes, index.manifestations,
+             index.published, index.ordered, index.metadata, index.sizes),
+            (new, expected.nodes, expected.manifestations,
+             expected.published, expected.ordered, expected.metadata,
+             expected.sizes))
+
+    def test_update_datasets(self):
+        """
+        ``DeploymentIndex.update`` removes datasets from ``ordered``,
+        ``metadata`` and ``sizes`` when their manifestations are removed.
+        """
+        dataset = Dataset(dataset_id=u'x', maximum_size=100,
+                          metadata=pmap({u'name': u'x'}))
+        node = Node(hostname=u'node1', other_manifestations=frozenset([
+            Manifestation(dataset=dataset, primary=True)]))
+        index = DeploymentIndex(Deployment(nodes=frozenset([node])))
+        index.update(Deployment(nodes=frozenset([Node(hostname=u'node1')])))
+        self.assertEqual((index.ordered, index.metadata, index.sizes),
+                         ([], {}, []))
+
+    def test_datasets(self):
+        """
+        ``DeploymentIndex.ordered`` lists the dataset identifiers in order,
+        ``DeploymentIndex.metadata`` maps metadata items to the
+        manifestations with them and ``DeploymentIndex.sizes`` lists the
+        manifestations with a maximum size in order of size.
+        """
+        big = Dataset(dataset_id=u'b', maximum_size=200,
+                      metadata=pmap({u'name': u'big', u'owner': u'alice'}))
+        small = Dataset(dataset_id=u'a', maximum_size=100,
+                        metadata=pmap({u'owner': u'alice'}))
+        index = DeploymentIndex(Deployment(nodes=frozenset([
+            Node(hostname=u'node1', other_manifestations=frozenset([
+                Manifestation(dataset=big, primary=True),
+                manifestation(u'c')])),
+            Node(hostname=u'node2', other_manifestations=frozenset([
+                Manifestation(dataset=small, primary=True),
+                Manifestation(dataset=big, primary=False)]))])))
+        self.assertEqual(
+            (index.ordered, index.metadata, index.sizes),
+            ([u'a', u'b', u'c'],
+             {(u'name', u'big'): {(u'b', u'node1'), (u'b', u'node2')},
+              (u'owner', u'alice'): {(u'b', u'node1'), (u'b', u'node2'),
+                                     (u'a', u'node2')}},
+             [(100, u'a', u'node2'), (200, u'b', u'node1'),
+              (200, u'b', u'node2')]))
+
+    def test_update_unchanged_nodes(self):
+        """
+        ``DeploymentIndex.update`` doesn't re-index nodes which are the same
+        objects as in the previously indexed deployment.
+        """
+        node1 = Node(hostname=u'node1', applications=frozenset([DATABASE]))
+        node2 = Node(hostname=u'node2', applications=frozenset([WEB]))
+        index = DeploymentIndex(Deployment(nodes=frozenset([node1])))
+        added = []
+        original_add = index._add
+        self.patch(index, "_add",
+                   lambda node: added.append(node) or original_add(node))
+        index.update(Deployment(nodes=frozenset([node1, node2])))
+        self.assertEqual(added, [node2])
@@ -0,0 +1,217 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.control._wire``.
+"""
+
+from pickle import dumps
+from uuid import uuid4
+
+from pyrsistent import pmap
+
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.python.filepath import FilePath
+
+from .._wire import (
+    wire_encode, wire_decode, WireDecoder, WireDecodeError, WIRE_VERSION,
+)
+from .._diff import diff_deployments
+from .._model import (
+    Deployment, Application, DockerImage, Node, NodeState, Manifestation,
+    Dataset, AttachedVolume, Port, Link, RestartAlways, RestartOnFailure,
+)
+
+
+DATASET = Dataset(dataset_id=unicode(uuid4()), maximum_size=1024 * 1024,
+                  metadata=pmap({u"name": u"database"}))
+MANIFESTATION = Manifestation(dataset=DATASET, primary=True)
+APP1 = Application(
+    name=u'database',
+    image=DockerImage.from_string(u'postgresql:9.4'),
+    ports=frozenset([Port(internal_port=5432, external_port=5432)]),
+    volume=AttachedVolume(manifestation=MANIFESTATION,
+                          mountpoint=FilePath(b"/var/lib/postgresql")),
+    environment=frozenset({u"PGDATA": u"/var/lib/postgresql"}.items()),
+    memory_limit=100000000, cpu_shares=512,
+    restart_policy=RestartOnFailure(maximum_retry_count=5))
+APP2 = Application(
+    name=u'web',
+    image=DockerImage.from_string(u'nginx'),
+    links=frozenset([Link(local_port=5432, remote_port=5432,
+                          alias=u'db')]),
+    restart_policy=RestartAlways())
+
+
+def deployment(count):
+    """
+    :param int count: Number of nodes.
+
+    :return Deployment: A deployment with ``count`` similar nodes.
+    """
+    return Deployment(nodes=frozenset(
+        Node(hostname=u'node%d.example.com' % (i,),
+             applications=frozenset([APP1, APP2]))
+        for i in range(count)))
+
+
+class RoundTripTests(SynchronousTestCase):
+    """
+    Tests for ``wire_encode`` and ``wire_decode``.
+    """
+    def assertRoundTrip(self, obj):
+        """
+        An object can be encoded and decoded again.
+
+        :param obj: The object to encode.
+        """
+        as_bytes = wire_encode(obj)
+        self.assertEqual([bytes, obj], [type(as_bytes), wire_decode(as_bytes)])
+
+    def test_deployment(self):
+        """
+        ``Deployment`` instances, including every kind of record they may
+        contain, round-trip.
+        """
+        self.assertRoundTrip(deployment(3))
+
+    def test_empty_deployment(self):
+        """
+        ``Deployment`` instances with no nodes round-trip.
+        """
+        self.assertRoundTrip(Deployment(nodes=frozenset()))
+
+    def test_node_state(self):
+        """
+        ``NodeState`` instances round-trip.
+        """
+        self.assertRoundTrip(
+            NodeState(running=[APP1], not_running=[APP2], used_ports=[1, 2],
+                      other_manifestations=frozenset([MANIFESTATION])))
+
+    def test_deployment_diff(self):
+        """
+        ``DeploymentDiff`` instances round-trip.
+        """
+        self.assertRoundTrip(diff_deployments(deployment(2), deployment(3)))
+
+    def test_basic_types(self):
+        """
+        Basic Python types round-trip.
+        """
+        self.assertRoundTrip([None, True, 1, 2 ** 70, 1.5, u"text", b"\xff",
+                              (1, u"x"), frozenset([u"a"]), {2},
+                              pmap({u"k": [1]}), FilePath(b"/tmp")])
+
+    def test_unknown_type(self):
+        """
+        Objects of types that aren't supported can't be encoded.
+        """
+        self.assertRaises(TypeError, wire_encode, object())
+
+    def test_interning(self):
+        """
+        Repeated long strings are only included once in the encoded data.
+        """
+        as_bytes = wire_encode([u"a long repeated string"] * 10)
+        self.assertEqual(as_bytes.count(b"a long repeated string"), 1)
+
+    def test_record_interning(self):
+        """
+        Repeated records are only included once in the encoded data, and
+        decode to equal values.
+        """
+        value = [APP1, Application(name=APP1.name, image=APP1.image,
+                                   ports=APP1.ports, volume=APP1.volume,
+                                   environment=APP1.environment,
+                                   memory_limit=APP1.memory_limit,
+                                   cpu_shares=APP1.cpu_shares,
+                                   restart_policy=APP1.restart_policy)]
+        as_bytes = wire_encode(value)
+        self.assertEqual(
+            (as_bytes.count(b"Application"), wire_decode(as_bytes)),
+            (1, value))
+
+    def test_unhashable_records(self):
+        """
+        Records containing unhashable values are encoded in full every time
+        they occur.
+        """
+        node_state = NodeState(running=[APP1], not_running=[])
+        self.assertEqual(
+            (wire_encode([node_state, node_state]).count(b"NodeState"),
+             wire_decode(wire_encode([node_state, node_state, APP1]))),
+            (2, [node_state, node_state, APP1]))
+
+    def test_smaller_than_pickle(self):
+        """
+        The encoding of a large ``Deployment`` is smaller than its pickle.
+        """
+        value = deployment(100)
+        self.assertTrue(len(wire_encode(value)) < len(dumps(value)))
+
+    def test_versioned(self):
+        """
+        Encoded data starts with a header including the wire format version.
+        """
+        self.assertEqual(wire_encode(None)[:3], b"FW" + chr(WIRE_VERSION))
+
+
+class WireDecoderTests(SynchronousTestCase):
+    """
+    Tests for ``WireDecoder`` and decoding errors.
+    """
+    def test_incremental(self):
+        """
+        Data can be fed to ``WireDecoder`` a byte at a time.
+        """
+        value = deployment(3)
+        decoder = WireDecoder()
+        for byte in wire_encode(value):
+            decoder.feed(byte)
+        self.assertEqual(decoder.result(), value)
+
+    def test_incomplete(self):
+        """
+        ``WireDecoder.result`` raises ``WireDecodeError`` if the data is
+        incomplete.
+        """
+        as_bytes = wire_encode(deployment(3))
+        for length in [0, 2, 5, len(as_bytes) - 1]:
+            decoder = WireDecoder()
+            decoder.feed(as_bytes[:length])
+            self.assertRaises(WireDecodeError, decoder.result)
+
+    def test_bad_header(self):
+        """
+        Data with an unsupported version can't be decoded.
+        """
+        as_bytes = wire_encode(None)
+        self.assertRaises(WireDecodeError, wire_decode,
+                          b"FW" + chr(WIRE_VERSION + 1) + as_bytes[3:])
+
+    def test_pickle(self):
+        """
+        Data in the pickle format previously used can't be decoded.
+        """
+        self.assertRaises(WireDecodeError, wire_decode, dumps(deployment(1)))
+
+    def test_trailing_data(self):
+        """
+        Data following a complete value can't be decoded.
+        """
+        self.assertRaises(WireDecodeError, wire_decode,
+                          wire_encode(1) + wire_encode(2)[3:])
+
+    def test_unknown_record(self):
+        """
+        Records with unknown names can't be decoded.
+        """
+        as_bytes = wire_encode(None)[:3] + b'\x00\x00\x00\x0b["Unknown"]'
+        self.assertRaises(WireDecodeError, wire_decode, as_bytes)
+
+    def test_invalid_json(self):
+        """
+        Frames that aren't valid JSON can't be decoded.
+        """
+        as_bytes = wire_encode(None)[:3] + b'\x00\x00\x00\x01['
+        self.assertRaises(WireDecodeError, wire_decode, as_bytes)
@@ -2,10 +2,8 @@
 
 """
 Local node manager for Flocker.
-"""
-
-from ._deploy import Deployer
 
-__all__ = [
-    'Deployer',
-]
+``Deployer`` lives in ``flocker.node._deploy`` and is not re-exported here,
+since importing it brings in docker-py, which the node's command line
+tools should only import when a command needs it.
+"""
@@ -14,6 +14,9 @@ from characteristic import attributes
 from pyrsistent import pmap
 from pickle import loads, dumps
 
+from eliot import Logger, ActionType, Field
+from eliot.twisted import DeferredContext
+
 from twisted.internet.defer import gatherResults, fail, succeed
 
 from ._docker import DockerClient, PortMap, Environment, Volume as DockerVolume
@@ -22,12 +25,24 @@ from ..control._model import (
     NodeState, DockerImage, Port, Link, Manifestation, Dataset
     )
 from ..route import make_host_network, Proxy
-from ..volume._ipc import RemoteVolumeManager, standard_node
+from ..volume._protocol import standard_volume_manager
 from ..volume._model import VolumeSize
 from ..volume.service import VolumeName
 from ..common import gather_deferreds
 
 
+_TRACE_ID = Field.forTypes(
+    u"trace_id", [unicode, None],
+    u"The trace identifier of the configuration change being acted on, if "
+    u"known.")
+
+CHANGE_NODE_STATE = ActionType(
+    u"flocker:node:change_node_state",
+    [_TRACE_ID],
+    [],
+    u"The local node is being changed to match the desired configuration.")
+
+
 def _to_volume_name(dataset_id):
     """
     Convert dataset ID to ``VolumeName`` with ``u"default"`` namespace.
@@ -255,10 +270,9 @@ class HandoffDataset(object):
     """
     def run(self, deployer):
         service = deployer.volume_service
-        destination = standard_node(self.hostname)
         return service.handoff(
             service.get(_to_volume_name(self.dataset.dataset_id)),
-            RemoteVolumeManager(destination))
+            standard_volume_manager(self.hostname))
 
 
 @implementer(IStateChange)
@@ -276,10 +290,9 @@ class PushDataset(object):
     """
     def run(self, deployer):
         service = deployer.volume_service
-        destination = standard_node(self.hostname)
         return service.push(
             service.get(_to_volume_name(self.dataset.dataset_id)),
-            RemoteVolumeManager(destination))
+            standard_volume_manager(self.hostname))
 
 
 @implementer(IStateChange)
@@ -317,6 +330,8 @@ class Deployer(object):
     :ivar INetwork network: The network routing API to use in
         deployment operations. Default is iptables-based implementation.
     """
+    logger = Logger()
+
     def __init__(self, volume_service, docker_client=None, network=None):
         if docker_client is None:
             docker_client = DockerClient()
@@ -642,7 +657,7 @@ class Deployer(object):
 
     def change_node_state(self, desired_state,
                           current_cluster_state,
-                          hostname):
+                          hostname, trace_id=None):
         """
         Change the local state to match the given desired state.
 
@@ -652,15 +667,21 @@ class Deployer(object):
             of all nodes.
         :param unicode hostname: The hostname of the node that this is running
             on.
+        :param trace_id: The trace identifier of the configuration change
+            ``desired_state`` includes, as sent by the control service, or
+            ``None``. It is logged so the changes made can be correlated
+            with it.
 
         :return: ``Deferred`` that fires when the necessary changes are done.
         """
-        d = self.calculate_necessary_state_changes(
-            desired_state=desired_state,
-            current_cluster_state=current_cluster_state,
-            hostname=hostname)
-        d.addCallback(lambda change: change.run(self))
-        return d
+        action = CHANGE_NODE_STATE(self.logger, trace_id=trace_id)
+        with action.context():
+            d = DeferredContext(self.calculate_necessary_state_changes(
+                desired_state=desired_state,
+                current_cluster_state=current_cluster_state,
+                hostname=hostname))
+            d.addCallback(lambda change: change.run(self))
+            return d.addActionFinish()
 
 
 def find_dataset_changes(hostname, current_state, desired_state):
@@ -7,6 +7,7 @@ Docker API client.
 
 from __future__ import absolute_import
 
+from httplib import NOT_FOUND, INTERNAL_SERVER_ERROR
 from time import sleep
 
 from zope.interface import Interface, implementer
@@ -21,7 +22,6 @@ from twisted.python.components import proxyForInterface
 from twisted.python.filepath import FilePath
 from twisted.internet.defer import succeed, fail
 from twisted.internet.threads import deferToThread
-from twisted.web.http import NOT_FOUND, INTERNAL_SERVER_ERROR
 
 from ..control._model import RestartNever, RestartAlways, RestartOnFailure
 
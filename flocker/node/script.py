@@ -9,27 +9,27 @@ tools.
 import sys
 
 from twisted.python.usage import Options, UsageError
-
-
-from yaml import safe_load, safe_dump
-from yaml.error import YAMLError
+from twisted.python.filepath import FilePath
+from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.application.service import MultiService
 
 from zope.interface import implementer
 
-from ..control._config import (
-    FlockerConfiguration, marshal_configuration,
-    )
-
 from ..volume.service import (
     ICommandLineVolumeScript, VolumeScript)
 
 from ..volume.script import flocker_volume_options
+from ..volume._ipc import SSH_PRIVATE_KEY_PATH
+from ..volume._protocol import (
+    VOLUME_AGENT_PORT, VOLUME_DATA_PORT, VolumeAgentService,
+)
 from ..common.script import (
     flocker_standard_options, FlockerScriptRunner, main_for_service)
-from ..control import (
-    ConfigurationError, current_from_configuration, model_from_configuration,
-)
-from . import Deployer
+
+# flocker-changestate and flocker-reportstate run as separate short-lived
+# processes, so the heavier dependencies (``yaml``, the configuration parser
+# and, through ``Deployer``, docker-py) are imported only by the commands
+# that use them.
 
 
 __all__ = [
@@ -88,6 +88,12 @@ class ChangeStateOptions(Options):
         :raises UsageError: If the configuration files cannot be parsed as YAML
             or if the hostname can not be decoded as ASCII.
         """
+        from yaml import safe_load
+        from yaml.error import YAMLError
+        from ..control import (
+            FlockerConfiguration, ConfigurationError,
+            current_from_configuration, model_from_configuration,
+        )
         try:
             deployment_config = safe_load(deployment_config)
         except YAMLError as e:
@@ -147,6 +153,7 @@ class ChangeStateScript(object):
         self._docker_client = docker_client
 
     def main(self, reactor, options, volume_service):
+        from ._deploy import Deployer
         deployer = Deployer(volume_service, self._docker_client)
         return deployer.change_node_state(
             desired_state=options['deployment'],
@@ -198,6 +205,9 @@ class ReportStateScript(object):
         self._network = network
 
     def main(self, reactor, options, volume_service):
+        from yaml import safe_dump
+        from ..control._config import marshal_configuration
+        from ._deploy import Deployer
         deployer = Deployer(volume_service, self._docker_client, self._network)
         d = deployer.discover_node_configuration()
         d.addCallback(marshal_configuration)
@@ -219,6 +229,20 @@ class VolumeServeOptions(Options):
     """
     Command line options for ``flocker-zfs-agent`` cluster management process.
     """
+    optParameters = [
+        ["agent-port", None, VOLUME_AGENT_PORT,
+         "The port the volume managers on other nodes will connect to.", int],
+        ["agent-secret", None, SSH_PRIVATE_KEY_PATH,
+         "A file containing the secret shared by all the nodes in the "
+         "cluster, used to authenticate connections.", FilePath],
+        ["data-port", None, VOLUME_DATA_PORT,
+         "The port the volume managers on other nodes will send volume data "
+         "to.", int],
+        ["data-tls", None, None,
+         "A file containing a certificate and private key shared by all the "
+         "nodes in the cluster. If given, volume data is sent over TLS.",
+         FilePath],
+    ]
 
 
 @implementer(ICommandLineVolumeScript)
@@ -226,9 +250,21 @@ class VolumeServeScript(object):
     """
     A command to start a long-running process to manage volumes on one node of
     a Flocker cluster.
+
+    The volume managers on other nodes can connect to it to push volumes to
+    this node and hand them off.
     """
     def main(self, reactor, options, volume_service):
-        return main_for_service(reactor, volume_service)
+        top_service = MultiService()
+        volume_service.setServiceParent(top_service)
+        VolumeAgentService(
+            volume_service,
+            TCP4ServerEndpoint(reactor, options["agent-port"]),
+            TCP4ServerEndpoint(reactor, options["data-port"]),
+            secret_path=options["agent-secret"],
+            tls_path=options["data-tls"],
+        ).setServiceParent(top_service)
+        return main_for_service(reactor, top_service)
 
 
 def flocker_volume_main():
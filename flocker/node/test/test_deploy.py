@@ -11,18 +11,20 @@ from zope.interface import implementer
 
 from pyrsistent import pmap
 
+from eliot.testing import validateLogging, assertHasAction
+
 from twisted.internet.defer import fail, FirstError, succeed, Deferred
 from twisted.trial.unittest import SynchronousTestCase, TestCase
 from twisted.python.filepath import FilePath
 
-from .. import Deployer
+from .._deploy import Deployer
 from ...control import (
     Application, DockerImage, Deployment, Node, Port, Link,
     NodeState)
 from .._deploy import (
     IStateChange, Sequentially, InParallel, StartApplication, StopApplication,
     CreateDataset, WaitForDataset, HandoffDataset, SetProxies, PushDataset,
-    ResizeDataset, _link_environment, _to_volume_name)
+    ResizeDataset, _link_environment, _to_volume_name, CHANGE_NODE_STATE)
 from ...control._model import AttachedVolume, Dataset, Manifestation
 from .._docker import (
     FakeDockerClient, AlreadyExists, Unit, PortMap, Environment,
@@ -33,6 +35,7 @@ from ...volume.service import Volume, VolumeName
 from ...volume._model import VolumeSize
 from ...volume.testtools import create_volume_service
 from ...volume._ipc import RemoteVolumeManager, standard_node
+from ...volume._protocol import AgentVolumeManager
 
 
 class DeployerAttributesTests(SynchronousTestCase):
@@ -2919,6 +2922,25 @@ class DeployerChangeNodeStateTests(SynchronousTestCase):
         api.change_node_state(desired, state, host)
         self.assertEqual(arguments, [desired, state, host])
 
+    @validateLogging(None)
+    def test_trace_id_logged(self, logger):
+        """
+        The changes are made within an action logging the trace identifier
+        of the configuration change being acted on.
+        """
+        api = Deployer(create_volume_service(self),
+                       docker_client=FakeDockerClient(),
+                       network=make_memory_network())
+        api.logger = logger
+        self.patch(api, "calculate_necessary_state_changes",
+                   lambda *args, **kwargs: succeed(FakeChange(succeed(None))))
+        api.change_node_state(desired_state=EMPTY,
+                              current_cluster_state=EMPTY,
+                              hostname=u'node.example.com',
+                              trace_id=u"abc")
+        assertHasAction(self, logger, CHANGE_NODE_STATE, True,
+                        dict(trace_id=u"abc"))
+
 
 class CreateVolumeTests(SynchronousTestCase):
     """
@@ -3086,7 +3108,8 @@ class HandoffVolumeTests(SynchronousTestCase):
         self.assertEqual(
             result,
             [volume_service.get(_to_volume_name(DATASET.dataset_id)),
-             RemoteVolumeManager(standard_node(hostname))])
+             AgentVolumeManager(
+                 hostname, RemoteVolumeManager(standard_node(hostname)))])
 
     def test_return(self):
         """
@@ -3134,7 +3157,8 @@ class PushVolumeTests(SynchronousTestCase):
         self.assertEqual(
             result,
             [volume_service.get(_to_volume_name(DATASET.dataset_id)),
-             RemoteVolumeManager(standard_node(hostname))])
+             AgentVolumeManager(
+                 hostname, RemoteVolumeManager(standard_node(hostname)))])
 
     def test_return(self):
         """
@@ -5,6 +5,8 @@ Tests for :module:`flocker.node.script`.
 """
 
 from StringIO import StringIO
+from sys import executable
+from subprocess import check_output
 
 from pyrsistent import pmap
 
@@ -18,6 +20,7 @@ from ...testtools import StandardOptionsTestsMixin, MemoryCoreReactor
 from ...volume.testtools import make_volume_options_tests
 from ...route import make_memory_network
 
+import flocker
 from ..script import (
     VolumeServeOptions, VolumeServeScript,
     ChangeStateOptions, ChangeStateScript,
@@ -29,6 +32,28 @@ from ...control._model import (
     Manifestation)
 
 from ...volume.testtools import create_volume_service
+from ...volume._ipc import SSH_PRIVATE_KEY_PATH
+from ...volume._protocol import VOLUME_AGENT_PORT, VOLUME_DATA_PORT
+
+
+class ImportTests(SynchronousTestCase):
+    """
+    Tests for the modules imported by ``flocker.node.script``.
+    """
+    def test_lazy_imports(self):
+        """
+        Importing ``flocker.node.script`` doesn't import docker-py or
+        ``yaml``, which only some of the commands need.
+        """
+        root = FilePath(flocker.__file__)
+        result = check_output(
+            [executable, b"-c", (b"import sys, flocker.node.script; " +
+                                 b"print(sorted(set(m.split('.')[0] " +
+                                 b"for m in sys.modules) & " +
+                                 b"{'docker', 'yaml'}))")],
+            # Make sure we can import flocker package:
+            cwd=root.parent().parent().path)
+        self.assertEqual(result, b"[]\n")
 
 
 class ChangeStateScriptTests(SynchronousTestCase):
@@ -407,12 +432,26 @@ class VolumeServeScriptOptions(SynchronousTestCase):
     """
     Tests for ``VolumeServeScript``.
     """
+    def options(self, *arguments):
+        """
+        :param arguments: Command line arguments for ``flocker-zfs-agent``.
+
+        :return VolumeServeOptions: Options parsed from the arguments and a
+            newly created secret file.
+        """
+        secret = FilePath(self.mktemp())
+        secret.setContent(b"secret")
+        options = VolumeServeOptions()
+        options.parseOptions([b"--agent-secret", secret.path] +
+                             list(arguments))
+        return options
+
     def test_main_starts_service(self):
         """
         ``VolumeServeScript.main`` starts the given service.
         """
         service = Service()
-        VolumeServeScript().main(MemoryCoreReactor(), None, service)
+        VolumeServeScript().main(MemoryCoreReactor(), self.options(), service)
         self.assertTrue(service.running)
 
     def test_no_immediate_stop(self):
@@ -420,7 +459,64 @@ class VolumeServeScriptOptions(SynchronousTestCase):
         The ``Deferred`` returned from ``VolumeServeScript`` is not fired.
         """
         script = VolumeServeScript()
-        self.assertNoResult(script.main(MemoryCoreReactor(), None, Service()))
+        self.assertNoResult(
+            script.main(MemoryCoreReactor(), self.options(), Service()))
+
+    def test_agent_port(self):
+        """
+        ``VolumeServeScript.main`` listens for connections from other volume
+        managers on the port given by ``--agent-port``.
+        """
+        reactor = MemoryCoreReactor()
+        VolumeServeScript().main(
+            reactor, self.options(b"--agent-port", b"1234"), Service())
+        self.assertIn(1234, [port for (port, _, _, _)
+                             in reactor.tcpServers])
+
+    def test_data_port(self):
+        """
+        ``VolumeServeScript.main`` listens for volume data from other volume
+        managers on the port given by ``--data-port``.
+        """
+        reactor = MemoryCoreReactor()
+        VolumeServeScript().main(
+            reactor, self.options(b"--data-port", b"1235"), Service())
+        self.assertIn(1235, [port for (port, _, _, _)
+                             in reactor.tcpServers])
+
+
+class VolumeServeOptionsTests(SynchronousTestCase):
+    """
+    Tests for ``VolumeServeOptions``.
+    """
+    def test_defaults(self):
+        """
+        By default the volume agent listens on ``VOLUME_AGENT_PORT`` and
+        ``VOLUME_DATA_PORT``, authenticates connections with the cluster's
+        SSH private key and doesn't use TLS.
+        """
+        options = VolumeServeOptions()
+        options.parseOptions([])
+        self.assertEqual(
+            (VOLUME_AGENT_PORT, VOLUME_DATA_PORT, SSH_PRIVATE_KEY_PATH, None),
+            (options["agent-port"], options["data-port"],
+             options["agent-secret"], options["data-tls"]))
+
+    def test_agent_secret(self):
+        """
+        ``--agent-secret`` is converted to a ``FilePath``.
+        """
+        options = VolumeServeOptions()
+        options.parseOptions([b"--agent-secret", b"/etc/secret"])
+        self.assertEqual(FilePath(b"/etc/secret"), options["agent-secret"])
+
+    def test_data_tls(self):
+        """
+        ``--data-tls`` is converted to a ``FilePath``.
+        """
+        options = VolumeServeOptions()
+        options.parseOptions([b"--data-tls", b"/etc/data.pem"])
+        self.assertEqual(FilePath(b"/etc/data.pem"), options["data-tls"])
 
 
 class StandardServeOptionsTests(
@@ -8,10 +8,11 @@ from ._infrastructure import (
     structured, EndpointResponse, user_documentation,
     )
 
-from ._error import makeBadRequest as make_bad_request
+from ._error import makeBadRequest as make_bad_request, InvalidRequestJSON
+from ._schema import getValidator as get_validator
 
 
 __all__ = [
     "structured", "EndpointResponse", "user_documentation",
-    "make_bad_request",
+    "make_bad_request", "InvalidRequestJSON", "get_validator",
 ]
@@ -9,20 +9,27 @@ __all__ = [
     "EndpointResponse", "structured", "user_documentation",
     ]
 
+from collections import OrderedDict
 from functools import wraps
+from itertools import count
 
 from json import loads, dumps
 
 from twisted.internet.defer import maybeDeferred
-from twisted.web.http import OK, INTERNAL_SERVER_ERROR
+from twisted.web.http import OK, INTERNAL_SERVER_ERROR, NOT_MODIFIED
 
 from eliot import Logger, writeFailure
+
+from ..common._metrics import SIZE_BUCKETS
 from eliot.twisted import DeferredContext
 
 from ._error import (
     ILLEGAL_CONTENT_TYPE, DECODING_ERROR, BadRequest, InvalidRequestJSON)
 from ._logging import LOG_SYSTEM, REQUEST
-from ._schema import getValidator
+from ._schema import getValidator, resolveSchema
+
+# The number of encoded response bodies each endpoint keeps for reuse:
+_ETAG_CACHE_SIZE = 32
 
 _ASCENDING = b"ascending"
 _DESCENDING = b"descending"
@@ -34,17 +41,26 @@ class EndpointResponse(object):
     """
     An endpoint can return an L{EndpointResponse} instance to return a custom
     response code to the client along with a successful response body.
+
+    If an entity tag is given it is sent in an I{ETag} header, and requests
+    with a matching I{If-None-Match} header receive an empty I{NOT MODIFIED}
+    response.  The encoded response body is cached by entity tag, so
+    responses with the same tag must have the same result.
     """
-    def __init__(self, code, result):
+    def __init__(self, code, result, etag=None):
         """
         @param code: The HTTP response code to set in the response.
         @type code: L{int}
 
         @param result: The (structured) value to put into the response
             body.  This must be JSON encodeable.
+
+        @param etag: An opaque entity tag identifying C{result}, or C{None}.
+        @type etag: L{bytes}
         """
         self.code = code
         self.result = result
+        self.etag = etag
 
 
 def _logging(original):
@@ -97,31 +113,156 @@ def _logging(original):
     return logger
 
 
+def _measured(endpoint):
+    """
+    Decorate a method which implements an API endpoint to record statistics
+    about requests to it.
+
+    If the object the endpoint belongs to has a C{metrics} attribute that
+    isn't C{None}, it must be a L{MetricsRegistry}.  Request latency, request
+    and response sizes, response codes and the number of requests in
+    progress are recorded in it, labelled with the name of the endpoint.
+
+    @param endpoint: The name of the endpoint.
+    @type endpoint: L{unicode}
+
+    @return: A decorator for a function which takes a request and returns a
+        L{Deferred} that fires with the response body.
+    """
+    def deco(original):
+        @wraps(original)
+        def measured(self, request, **routeArguments):
+            metrics = getattr(self, "metrics", None)
+            if metrics is None:
+                return original(self, request, **routeArguments)
+
+            in_flight = metrics.gauge(
+                b"flocker_api_requests_in_flight",
+                b"Requests to the API which are being handled.",
+                (b"endpoint",)).labels(endpoint)
+            started = metrics.clock.seconds()
+            in_flight.inc()
+            metrics.histogram(
+                b"flocker_api_request_bytes",
+                b"Sizes of the bodies of requests to the API.",
+                (b"endpoint",), SIZE_BUCKETS).labels(endpoint).observe(
+                    int(request.getHeader(b"content-length") or 0))
+
+            def finished(body):
+                in_flight.dec()
+                metrics.histogram(
+                    b"flocker_api_request_duration_seconds",
+                    b"Time taken to handle requests to the API.",
+                    (b"endpoint",)).labels(endpoint).observe(
+                        metrics.clock.seconds() - started)
+                if isinstance(body, bytes):
+                    metrics.histogram(
+                        b"flocker_api_response_bytes",
+                        b"Sizes of the bodies of responses from the API.",
+                        (b"endpoint",), SIZE_BUCKETS).labels(endpoint).observe(
+                            len(body))
+                metrics.counter(
+                    b"flocker_api_responses_total",
+                    b"Responses from the API.",
+                    (b"endpoint", b"code"),
+                ).labels(endpoint, request.code).inc()
+                return body
+
+            d = original(self, request, **routeArguments)
+            d.addBoth(finished)
+            return d
+        return measured
+    return deco
+
+
+def _not_modified(request, etag):
+    """
+    Set the I{ETag} header of a response and determine whether the client
+    already has the response.
+
+    @param request: The L{IRequest} being responded to.
+
+    @param etag: The entity tag of the response.
+    @type etag: L{bytes}
+
+    @return: C{True} if the request has an I{If-None-Match} header matching
+        C{etag}, otherwise C{False}.
+    """
+    quoted = b'"' + etag + b'"'
+    request.responseHeaders.setRawHeaders(b"etag", [quoted])
+    if request.method not in (b"GET", b"HEAD"):
+        return False
+    for header in request.requestHeaders.getRawHeaders(
+            b"if-none-match", []):
+        for tag in header.split(b","):
+            tag = tag.strip()
+            if tag.startswith(b"W/"):
+                tag = tag[2:]
+            if tag in (quoted, b"*"):
+                return True
+    return False
+
+
 def _serialize(outputValidator):
     """
     Decorate a function so that its return value is automatically JSON encoded
     into a structure indicating a successful result.
 
+    Validating large results is expensive, so if the object the endpoint
+    belongs to has an C{output_validation} attribute only one in that many
+    results is validated, or none if it is C{0}.  Otherwise every result is
+    validated.
+
     @param outputValidator: A L{jsonschema} validator for the returned JSON.
 
     @return: A decorator that decorates a function with the signature
         of a Klein route endpoint that may return a Deferred.
     """
     def deco(original):
-        def success(result, request):
+        # Map the entity tags of recent responses to their encoded bodies,
+        # least recently used first.  Each endpoint has its own cache, and
+        # responses to different queries have different tags, so requests
+        # with different arguments don't evict each other:
+        cache = OrderedDict()
+        # Counts the results encoded:
+        counter = count()
+
+        def success(result, request, interval):
             code = OK
+            etag = None
             if isinstance(result, EndpointResponse):
                 code = result.code
+                etag = result.etag
                 result = result.result
-            outputValidator.validate(result)
+            if etag is not None:
+                if _not_modified(request, etag):
+                    request.setResponseCode(NOT_MODIFIED)
+                    return b""
+                body = cache.pop(etag, None)
+                if body is not None:
+                    cache[etag] = body
+            else:
+                body = None
+            if body is None:
+                if interval:
+                    encoded = next(counter)
+                    if encoded % interval == 0:
+                        outputValidator.validate(result)
+                body = dumps(result)
+                if etag is not None:
+                    cache[etag] = body
+                    if len(cache) > _ETAG_CACHE_SIZE:
+                        cache.popitem(last=False)
             request.responseHeaders.setRawHeaders(
                 b"content-type", [b"application/json"])
             request.setResponseCode(code)
-            return dumps(result)
+            return body
 
+        @wraps(original)
         def doit(self, request, **routeArguments):
             result = maybeDeferred(original, self, request, **routeArguments)
-            result.addCallback(success, request)
+            result.addCallback(
+                success, request, getattr(self, "output_validation", 1))
             return result
 
         return doit
@@ -143,6 +284,13 @@ def structured(inputSchema, outputSchema, schema_store=None):
 
         original(foo="bar")
 
+    For I{GET} and I{DELETE} requests, which have no body, the arguments are
+    instead taken from the query string.  Only the arguments named in the
+    C{properties} of C{inputSchema} are used, so that unrelated ones (for
+    example, cache-busters) are ignored.  Each is passed as a L{unicode}
+    string, using the last value if an argument is repeated, and the
+    resulting object is validated against C{inputSchema} in the same way.
+
     The encoded form of the object returned by C{original} will define the
     response body.
 
@@ -156,14 +304,27 @@ def structured(inputSchema, outputSchema, schema_store=None):
         schema_store = {}
     inputValidator = getValidator(inputSchema, schema_store)
     outputValidator = getValidator(outputSchema, schema_store)
+    queryArguments = frozenset(
+        resolveSchema(inputSchema, schema_store).get(u"properties", {}))
 
     def deco(original):
         @wraps(original)
+        @_measured(original.__name__.decode("ascii"))
         @_logging
         @_serialize(outputValidator)
         def loadAndDispatch(self, request, **routeArguments):
             if request.method in (b"GET", b"DELETE"):
+                # These requests have no body, so arguments are taken from
+                # the query string instead.
                 objects = {}
+                for name, values in request.args.items():
+                    if name not in queryArguments:
+                        continue
+                    try:
+                        objects[name.decode("utf-8")] = (
+                            values[-1].decode("utf-8"))
+                    except UnicodeDecodeError:
+                        raise DECODING_ERROR
             else:
                 contentType = request.requestHeaders.getRawHeaders(
                     b"content-type", [None])[0]
@@ -176,11 +337,11 @@ def structured(inputSchema, outputSchema, schema_store=None):
                 except ValueError:
                     raise DECODING_ERROR
 
-                errors = []
-                for error in inputValidator.iter_errors(objects):
-                    errors.append(error.message)
-                if errors:
-                    raise InvalidRequestJSON(errors=errors, schema=inputSchema)
+            errors = []
+            for error in inputValidator.iter_errors(objects):
+                errors.append(error.message)
+            if errors:
+                raise InvalidRequestJSON(errors=errors, schema=inputSchema)
 
             # Just assume there are no conflicts between these collections
             # of arguments right now.  When there is a schema for the JSON
@@ -12,12 +12,13 @@ from twisted.internet.defer import succeed, fail
 from twisted.web.http_headers import Headers
 from twisted.web.http import (
     BAD_REQUEST, INTERNAL_SERVER_ERROR, PAYMENT_REQUIRED, GONE,
-    NOT_ALLOWED, NOT_FOUND)
+    NOT_ALLOWED, NOT_FOUND, OK, NOT_MODIFIED)
 
+from twisted.internet.task import Clock
 from twisted.trial.unittest import SynchronousTestCase
 
 from .._infrastructure import (
-    EndpointResponse, user_documentation, structured)
+    _ETAG_CACHE_SIZE, EndpointResponse, user_documentation, structured)
 from .._logging import REQUEST
 from .._error import (
     ILLEGAL_CONTENT_TYPE_DESCRIPTION, DECODING_ERROR_DESCRIPTION,
@@ -29,6 +30,7 @@ from eliot.testing import validateLogging, LoggedAction
 from ..testtools import (EventChannel, dumps, loads,
                          CloseEnoughJSONResponse, dummyRequest, render,
                          asResponse)
+from ...common import MetricsRegistry
 from .utils import (
     _assertRequestLogged, _assertTracebackLogged, FAILED_INPUT_VALIDATION)
 
@@ -262,6 +264,16 @@ class ResultHandlingApplication(object):
         self.kwargs = kwargs
         return self._constructSuccess(self.result)
 
+    @app.route(b"/foo/query")
+    @structured({
+        u'properties': {u'foo': {u'type': u'string'},
+                        u'baz': {u'type': u'string'}},
+        u'additionalProperties': False,
+        }, {})
+    def query(self, **kwargs):
+        self.kwargs = kwargs
+        return self._constructSuccess(self.result)
+
     @app.route(b"/foo/badrequest")
     @structured({}, {})
     def badrequest(self):
@@ -274,6 +286,18 @@ class ResultHandlingApplication(object):
         return self._constructSuccess(EndpointResponse(
             self.EXPLICIT_RESPONSE_CODE, self.EXPLICIT_RESPONSE_RESULT))
 
+    @app.route(b"/foo/etag")
+    @structured({}, {'type': 'object'})
+    def etag(self):
+        return self._constructSuccess(EndpointResponse(
+            OK, self.result, etag=b"tag"))
+
+    @app.route(b"/foo/etag/<tag>")
+    @structured({}, {'type': 'object'})
+    def tagged(self, tag):
+        return self._constructSuccess(EndpointResponse(
+            OK, self.result, etag=tag.encode("ascii")))
+
     @app.route(b"/baz/<routingValue>")
     @structured({}, {})
     def baz(self, **kwargs):
@@ -338,6 +362,182 @@ class AsynchronousStructuredResultHandlingTests(StructuredResultHandlingMixin,
         return app
 
 
+class ETagTests(SynchronousTestCase):
+    """
+    Tests for L{EndpointResponse} instances with an entity tag.
+    """
+    def get(self, application, headers=None, path=b"/foo/etag"):
+        """
+        Issue a I{GET} request.
+
+        @param application: The L{ResultHandlingApplication} to request from.
+        @param headers: L{dict} of request headers.
+        @param path: The path to request, by default C{/foo/etag}.
+
+        @return: The rendered request.
+        """
+        request = dummyRequest(
+            b"GET", path, Headers(headers or {}), b"")
+        render(application.app.resource(), request)
+        return request
+
+    @validateLogging(_assertRequestLogged(b"/foo/etag"))
+    def test_etag(self, logger):
+        """
+        The entity tag is sent in an I{ETag} header along with the response.
+        """
+        application = ResultHandlingApplication(
+            Execution.SYNCHRONOUS, logger, {u"a": 1})
+        request = self.get(application)
+        self.assertEqual(
+            (request._code, request.responseHeaders.getRawHeaders(b"etag"),
+             loads(request._responseBody)),
+            (OK, [b'"tag"'], {u"a": 1}))
+
+    @validateLogging(_assertRequestLogged(b"/foo/etag"))
+    def test_not_modified(self, logger):
+        """
+        A request with an I{If-None-Match} header matching the entity tag
+        receives an empty I{NOT MODIFIED} response.
+        """
+        application = ResultHandlingApplication(
+            Execution.SYNCHRONOUS, logger, {u"a": 1})
+        request = self.get(application, {b"if-none-match": [b'"tag"']})
+        self.assertEqual((request._code, request._responseBody),
+                         (NOT_MODIFIED, b""))
+
+    @validateLogging(_assertRequestLogged(b"/foo/etag"))
+    def test_modified(self, logger):
+        """
+        A request with an I{If-None-Match} header that doesn't match the
+        entity tag receives the full response.
+        """
+        application = ResultHandlingApplication(
+            Execution.SYNCHRONOUS, logger, {u"a": 1})
+        request = self.get(application, {b"if-none-match": [b'"other"']})
+        self.assertEqual((request._code, loads(request._responseBody)),
+                         (OK, {u"a": 1}))
+
+    @validateLogging(None)
+    def test_cached(self, logger):
+        """
+        The encoded body is reused for later responses with the same entity
+        tag, without validating or encoding their result again.
+        """
+        application = ResultHandlingApplication(
+            Execution.SYNCHRONOUS, logger, {u"a": 1})
+        self.get(application)
+        # Would fail output validation and encoding if it were used:
+        application.result = object()
+        request = self.get(application)
+        self.assertEqual((request._code, loads(request._responseBody)),
+                         (OK, {u"a": 1}))
+
+
+    @validateLogging(None)
+    def test_cached_several(self, logger):
+        """
+        The encoded bodies of responses with different entity tags are all
+        reused.
+        """
+        application = ResultHandlingApplication(
+            Execution.SYNCHRONOUS, logger, {u"a": 1})
+        self.get(application, path=b"/foo/etag/a")
+        application.result = {u"b": 1}
+        self.get(application, path=b"/foo/etag/b")
+        application.result = object()
+        self.assertEqual(
+            [loads(self.get(application, path=path)._responseBody)
+             for path in [b"/foo/etag/a", b"/foo/etag/b"]],
+            [{u"a": 1}, {u"b": 1}])
+
+    @validateLogging(None)
+    def test_cache_bounded(self, logger):
+        """
+        Only the encoded bodies of the most recently used entity tags are
+        kept.
+        """
+        application = ResultHandlingApplication(
+            Execution.SYNCHRONOUS, logger, {u"a": 1})
+        for i in range(_ETAG_CACHE_SIZE + 1):
+            self.get(application, path=b"/foo/etag/%d" % (i,))
+        application.result = {u"b": 1}
+        self.assertEqual(
+            [loads(self.get(application, path=path)._responseBody)
+             for path in [b"/foo/etag/0", b"/foo/etag/%d" % (
+                 _ETAG_CACHE_SIZE,)]],
+            [{u"b": 1}, {u"a": 1}])
+
+
+class MetricsTests(SynchronousTestCase):
+    """
+    Tests for the statistics about requests recorded by L{structured}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = MetricsRegistry(self.clock)
+
+    def sample(self, name, *labels):
+        """
+        @return: The value of a sample of a metric recorded so far.
+        """
+        return self.metrics._metrics[name].labels(*labels)
+
+    @validateLogging(None)
+    def test_request(self, logger):
+        """
+        The duration of requests, the sizes of their bodies and the bodies of
+        their responses, and the response codes are recorded, labelled with
+        the name of the endpoint.
+        """
+        application = ResultHandlingApplication(
+            Execution.ASYNCHRONOUS, logger, {u"a": 1})
+        application.metrics = self.metrics
+        request = dummyRequest(
+            b"PUT", b"/foo/bar",
+            Headers({b"content-type": [b"application/json"],
+                     b"content-length": [b"2"]}), b"{}")
+        render(application.app.resource(), request)
+        self.clock.advance(0.5)
+        application.ready.callback(None)
+        self.assertEqual(
+            (self.sample(b"flocker_api_request_duration_seconds",
+                         u"foo").sum,
+             self.sample(b"flocker_api_request_bytes", u"foo").sum,
+             self.sample(b"flocker_api_response_bytes", u"foo").sum,
+             self.sample(b"flocker_api_responses_total", u"foo", OK).value),
+            (0.5, 2, len(dumps({u"a": 1})), 1))
+
+    @validateLogging(None)
+    def test_in_flight(self, logger):
+        """
+        The number of requests being handled is recorded.
+        """
+        application = ResultHandlingApplication(
+            Execution.ASYNCHRONOUS, logger, {})
+        application.metrics = self.metrics
+        render(application.app.resource(),
+               dummyRequest(b"GET", b"/foo/bar", Headers(), b""))
+        in_flight = self.sample(b"flocker_api_requests_in_flight", u"foo")
+        before = in_flight.value
+        application.ready.callback(None)
+        self.assertEqual((before, in_flight.value), (1, 0))
+
+    @validateLogging(_assertTracebackLogged(ArbitraryException))
+    def test_error(self, logger):
+        """
+        The codes of error responses are recorded.
+        """
+        application = ResultHandlingApplication(
+            Execution.SYNCHRONOUS, logger, None)
+        application.metrics = self.metrics
+        render(application.app.resource(),
+               dummyRequest(b"GET", b"/foo/exception", Headers(), b""))
+        self.assertEqual(
+            self.sample(b"flocker_api_responses_total", u"bar",
+                        INTERNAL_SERVER_ERROR).value, 1)
+
+
 class StructuredJSONTests(SynchronousTestCase):
     """
     Tests for the L{structured} behavior related to decoding JSON requests and
@@ -402,6 +602,53 @@ class StructuredJSONTests(SynchronousTestCase):
         """
         self.assertNoDecodeLogged(logger, b"DELETE")
 
+    @validateLogging(_assertRequestLogged(b"/foo/query"))
+    def test_queryArguments(self, logger):
+        """
+        The query arguments of a I{GET} request are passed as keyword
+        arguments to the decorated function, using the last value of
+        repeated arguments.
+        """
+        request = dummyRequest(
+            b"GET", b"/foo/query?foo=bar&baz=1&baz=2", Headers(), b"")
+
+        app = self.Application(logger, None)
+        render(app.app.resource(), request)
+        self.assertEqual({u"foo": u"bar", u"baz": u"2"}, app.kwargs)
+
+    @validateLogging(_assertRequestLogged(b"/foo/query"))
+    def test_unknownQueryArguments(self, logger):
+        """
+        Query arguments of a I{GET} request which aren't properties of the
+        input schema are ignored.
+        """
+        request = dummyRequest(
+            b"GET", b"/foo/query?foo=bar&_=123", Headers(), b"")
+
+        app = self.Application(logger, None)
+        render(app.app.resource(), request)
+        self.assertEqual((OK, {u"foo": u"bar"}), (request._code, app.kwargs))
+
+    @validateLogging(_assertRequestLogged(b"/foo/validation"))
+    def test_queryValidationError(self, logger):
+        """
+        If the query arguments of a I{GET} request don't match the provided
+        schema, then the request automatically receives a I{BAD REQUEST}
+        response.
+        """
+        request = dummyRequest(
+            b"GET", b"/foo/validation?int=1", Headers(), b"")
+
+        app = self.Application(logger, None)
+        render(app.app.resource(), request)
+
+        response = loads(request._responseBody)
+
+        self.assertEqual(
+            (request._code, response[u'description'],
+             len(response[u'errors'])),
+            (BAD_REQUEST, FAILED_INPUT_VALIDATION, 2))
+
     @validateLogging(_assertRequestLogged(b"/foo/bar"))
     def test_malformedRequest(self, logger):
         """
@@ -461,6 +708,44 @@ class StructuredJSONTests(SynchronousTestCase):
 
         self.assertEqual(request._code, INTERNAL_SERVER_ERROR)
 
+    def badResponseCodes(self, logger, output_validation, count):
+        """
+        Request C{/foo/badresponse}, whose response doesn't match its schema,
+        several times from an application with the given
+        C{output_validation} attribute.
+
+        @return: A L{list} of the response codes.
+        """
+        app = self.Application(logger, None)
+        app.output_validation = output_validation
+        codes = []
+        for i in range(count):
+            request = dummyRequest(
+                b"GET", b"/foo/badresponse", Headers(), b"")
+            render(app.app.resource(), request)
+            codes.append(request._code)
+        return codes
+
+    @validateLogging(None)
+    def test_responseValidationSampled(self, logger):
+        """
+        If the application has an C{output_validation} attribute, only one
+        in that many responses is validated.
+        """
+        codes = self.badResponseCodes(logger, 3, 6)
+        self.assertEqual(
+            (codes.count(INTERNAL_SERVER_ERROR), codes[:3] == codes[3:],
+             len(logger.flushTracebacks(ValidationError))),
+            (2, True, 2))
+
+    @validateLogging(None)
+    def test_responseValidationDisabled(self, logger):
+        """
+        If the application's C{output_validation} attribute is C{0}, no
+        responses are validated.
+        """
+        self.assertEqual(self.badResponseCodes(logger, 0, 2), [OK, OK])
+
     @validateLogging(_assertRequestLogged(b"/foo/bar"))
     def test_wrongContentTypeRequest(self, logger):
         """
@@ -14,7 +14,6 @@ from zope.interface import implementer
 from ipaddr import IPAddress
 from characteristic import attributes
 from eliot import Logger
-from psutil import net_connections
 from twisted.python.filepath import FilePath
 
 from ._logging import CREATE_PROXY_TO, DELETE_PROXY, IPTABLES
@@ -335,6 +334,9 @@ class HostNetwork(object):
         :see: :meth:`INetwork.enumerate_used_ports` for parameter
             documentation.
         """
+        # psutil is slow to import and only needed here, so don't make every
+        # user of this module pay for it:
+        from psutil import net_connections
         listening = set(
             conn.laddr[1]
             for conn
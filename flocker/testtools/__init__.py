@@ -34,6 +34,7 @@ from twisted.trial.unittest import SynchronousTestCase, SkipTest
 from twisted.internet.protocol import Factory, Protocol
 from twisted.test.proto_helpers import MemoryReactor
 from twisted.python.procutils import which
+from twisted.python.usage import UsageError
 from twisted.trial.unittest import TestCase
 
 from characteristic import attributes
@@ -46,17 +47,45 @@ from ..common.script import (
 @implementer(IProcessTransport)
 class FakeProcessTransport(object):
     """
-    Mock process transport to observe signals sent to a process.
+    Mock process transport to observe signals sent to a process, data
+    written to its standard input and whether its output is paused.
 
     @ivar signals: L{list} of signals sent to process.
+    @ivar data: L{bytes} written to the process's standard input.
+    @ivar stdin_closed: Whether the process's standard input was closed.
+    @ivar paused: Whether reading the process's output is paused.
+    @ivar producer: The producer registered with the process's standard
+        input, or L{None}.
     """
 
     def __init__(self):
         self.signals = []
+        self.data = b""
+        self.stdin_closed = False
+        self.paused = False
+        self.producer = None
 
     def signalProcess(self, signal):
         self.signals.append(signal)
 
+    def write(self, data):
+        self.data += data
+
+    def closeStdin(self):
+        self.stdin_closed = True
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
 
 class SpawnProcessArguments(namedtuple(
                             'ProcessData',
@@ -381,6 +410,54 @@ class StandardOptionsTestsMixin(object):
         options.parseOptions(['-v', '--verbose'])
         self.assertEqual(2, options['verbosity'])
 
+    def test_profile_default(self):
+        """
+        Flocker commands aren't profiled by default.
+        """
+        options = self.options()
+        self.assertEqual((None, None),
+                         (options['profile'], options['profile-interval']))
+
+    def test_profile_option(self):
+        """
+        Flocker commands have a `--profile` option giving the path to write
+        profiling results to.
+        """
+        options = self.options()
+        # The command may otherwise give a UsageError
+        # "Wrong number of arguments." if there are arguments required.
+        # See https://clusterhq.atlassian.net/browse/FLOC-184 about a solution
+        # which does not involve patching.
+        self.patch(options, "parseArgs", lambda: None)
+        options.parseOptions(['--profile', 'out.prof'])
+        self.assertEqual('out.prof', options['profile'])
+
+    def test_profile_interval_option(self):
+        """
+        Flocker commands have a `--profile-interval` option giving the
+        interval in seconds between samples of the call stack.
+        """
+        options = self.options()
+        self.patch(options, "parseArgs", lambda: None)
+        options.parseOptions(
+            ['--profile', 'out.prof', '--profile-interval', '0.01'])
+        self.assertEqual(0.01, options['profile-interval'])
+
+    def test_profile_interval_requires_profile(self):
+        """
+        `--profile-interval` without `--profile` is a usage error.
+        """
+        options = self.options()
+        options['profile-interval'] = 0.01
+        self.assertRaises(UsageError, options.postOptions)
+
+    def test_profile_interval_positive(self):
+        """
+        `--profile-interval` must be a positive number.
+        """
+        options = self.options()
+        self.assertRaises(UsageError, options.opt_profile_interval, '0')
+
 
 def make_with_init_tests(record_type, kwargs, expected_defaults=None):
     """
@@ -0,0 +1,376 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.volume.test.test_codec -*-
+
+"""
+Compression of the volume data sent between volume managers.
+
+The sender of a volume offers the codecs it supports in order of
+preference and the receiver picks the first one it also supports. ``zlib``
+is always available. ``lz4`` and ``zstd`` are used if the ``lz4`` and
+``zstandard`` Python packages are installed, and ``none`` sends the data
+unchanged.
+
+Which codec is best depends on how compressible the data is, how fast the
+network is and how busy the CPUs are, so ``CodecSelector`` measures the
+throughput of each transfer to a peer (in uncompressed bytes per second,
+including the time spent compressing) and prefers the codec that did best.
+"""
+
+from timeit import default_timer
+import zlib
+
+from characteristic import attributes
+
+from zope.interface import implementer
+
+from eliot import Field, MessageType
+
+from twisted.internet.interfaces import IConsumer
+
+from .filesystems.interfaces import IFilesystemReceiver
+
+
+class _Identity(object):
+    """
+    A compressor and decompressor that leaves the data unchanged.
+    """
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+class _ZstdDecompressor(object):
+    """
+    Adapt a ``zstandard`` decompression object, which may not have a
+    ``flush`` method, to the ``zlib`` API.
+    """
+    def __init__(self, decompressobj):
+        """
+        :param decompressobj: The ``zstandard`` decompression object.
+        """
+        self._decompressobj = decompressobj
+
+    def decompress(self, data):
+        return self._decompressobj.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+class _LZ4Compressor(object):
+    """
+    Adapt an ``lz4.frame`` compressor, which must write a frame header
+    first, to the ``zlib`` API.
+    """
+    def __init__(self, compressor):
+        """
+        :param compressor: The ``lz4.frame.LZ4FrameCompressor``.
+        """
+        self._compressor = compressor
+        self._started = False
+
+    def compress(self, data):
+        header = b""
+        if not self._started:
+            self._started = True
+            header = self._compressor.begin()
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header = b""
+        if not self._started:
+            self._started = True
+            header = self._compressor.begin()
+        return header + self._compressor.flush()
+
+
+class _LZ4Decompressor(object):
+    """
+    Adapt an ``lz4.frame`` decompressor to the ``zlib`` API.
+    """
+    def __init__(self, decompressor):
+        """
+        :param decompressor: The ``lz4.frame.LZ4FrameDecompressor``.
+        """
+        self._decompressor = decompressor
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+@attributes(["name", "compressor", "decompressor"])
+class Codec(object):
+    """
+    A way of compressing volume data.
+
+    :ivar bytes name: The name the codec is negotiated by.
+    :ivar compressor: Callable with no arguments returning a new object
+        with the ``compress`` and ``flush`` methods of ``zlib``'s
+        compression objects.
+    :ivar decompressor: Callable with no arguments returning a new object
+        with the ``decompress`` and ``flush`` methods of ``zlib``'s
+        decompression objects.
+    """
+
+
+NO_COMPRESSION = Codec(name=b"none", compressor=_Identity,
+                       decompressor=_Identity)
+
+# Level 1 compresses most of what higher levels would at a fraction of the
+# CPU cost, which matters more when the data is going over a fast network:
+ZLIB = Codec(name=b"zlib", compressor=lambda: zlib.compressobj(1),
+             decompressor=zlib.decompressobj)
+
+
+def _optional_codecs():
+    """
+    :return: ``list`` of the ``Codec``\ s whose libraries are installed,
+        fastest first.
+    """
+    codecs = []
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        codecs.append(Codec(
+            name=b"zstd",
+            compressor=lambda: zstandard.ZstdCompressor(level=1).compressobj(),
+            decompressor=lambda: _ZstdDecompressor(
+                zstandard.ZstdDecompressor().decompressobj())))
+    try:
+        import lz4.frame
+    except ImportError:
+        pass
+    else:
+        codecs.append(Codec(
+            name=b"lz4",
+            compressor=lambda: _LZ4Compressor(
+                lz4.frame.LZ4FrameCompressor()),
+            decompressor=lambda: _LZ4Decompressor(
+                lz4.frame.LZ4FrameDecompressor())))
+    return codecs
+
+
+# The codecs this process supports, in order of preference when nothing is
+# known about a peer:
+CODECS = _optional_codecs() + [ZLIB, NO_COMPRESSION]
+
+
+def negotiate(offered, supported=CODECS):
+    """
+    Pick the codec to use for a transfer.
+
+    :param offered: ``list`` of the names of the codecs the sender
+        supports, in order of preference, or ``None`` if the sender doesn't
+        know about codecs.
+    :param supported: ``list`` of the ``Codec``\ s the receiver supports.
+
+    :return Codec: The first offered codec the receiver supports, or
+        ``NO_COMPRESSION`` if there isn't one.
+    """
+    by_name = dict((codec.name, codec) for codec in supported)
+    for name in offered or []:
+        if name in by_name:
+            return by_name[name]
+    return NO_COMPRESSION
+
+
+class CodecSelector(object):
+    """
+    Choose the codec to prefer for each transfer to a peer from the
+    throughput of earlier transfers to it.
+
+    Each codec is tried once, in the default order of preference, and from
+    then on the one with the best smoothed throughput is preferred. Codecs
+    a peer turned down in favour of one offered after them are taken not
+    to be supported by it, and are offered last.
+
+    :ivar dict rates: Map ``(peer, codec name)`` to the smoothed throughput
+        of transfers to that peer using that codec, in uncompressed bytes
+        per second.
+    """
+    def __init__(self, codecs=CODECS, smoothing=0.5):
+        """
+        :param codecs: ``list`` of the ``Codec``\ s this side supports, in
+            the default order of preference.
+        :param float smoothing: The weight given to the latest measurement
+            when updating a smoothed throughput.
+        """
+        self._codecs = codecs
+        self._smoothing = smoothing
+        self.rates = {}
+        self._unsupported = set()
+
+    def offer(self, peer):
+        """
+        :param peer: The peer the transfer is to.
+
+        :return: ``list`` of the names of the codecs to offer, in order of
+            preference.
+        """
+        names = []
+        unsupported = []
+        for codec in self._codecs:
+            if (peer, codec.name) in self._unsupported:
+                unsupported.append(codec.name)
+            else:
+                names.append(codec.name)
+        if not names:
+            return unsupported
+        untried = [name for name in names if (peer, name) not in self.rates]
+        if untried:
+            first = untried[0]
+        else:
+            first = max(names, key=lambda name: self.rates[(peer, name)])
+        return [first] + [name for name in names if name != first] + (
+            unsupported)
+
+    def negotiated(self, peer, offered, codec):
+        """
+        Record which codec a peer chose from an offer.
+
+        :param peer: The peer the transfer is to.
+        :param list offered: The names of the codecs offered, as returned by
+            ``offer``.
+        :param bytes codec: The name of the codec the peer chose.
+        """
+        for name in offered:
+            if name == codec:
+                break
+            self._unsupported.add((peer, name))
+
+    def record(self, peer, codec, raw_bytes, seconds):
+        """
+        Record the throughput of a transfer.
+
+        :param peer: The peer the transfer was to.
+        :param bytes codec: The name of the codec used.
+        :param int raw_bytes: The number of uncompressed bytes sent.
+        :param float seconds: How long the transfer took.
+        """
+        rate = raw_bytes / max(seconds, 1e-6)
+        key = (peer, codec)
+        if key in self.rates:
+            rate = (self._smoothing * rate +
+                    (1 - self._smoothing) * self.rates[key])
+        self.rates[key] = rate
+
+
+@implementer(IConsumer)
+class CompressingConsumer(object):
+    """
+    Compress the data written to it and write the result to another
+    consumer.
+
+    :ivar int raw_bytes: The number of bytes written to this consumer.
+    :ivar int compressed_bytes: The number of bytes written to the
+        wrapped consumer.
+    :ivar float compress_seconds: The time spent compressing.
+    """
+    def __init__(self, consumer, codec, timer=default_timer):
+        """
+        :param IConsumer consumer: The consumer to write to.
+        :param Codec codec: The codec to compress with.
+        :param timer: Callable with no arguments returning the current time
+            in seconds.
+        """
+        self._consumer = consumer
+        self._compressor = codec.compressor()
+        self._timer = timer
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_seconds = 0.0
+
+    def registerProducer(self, producer, streaming):
+        self._consumer.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._consumer.unregisterProducer()
+
+    def _write(self, compress, *args):
+        """
+        Compress something and write the result.
+
+        :param compress: Callable returning compressed ``bytes``.
+        :param args: Arguments for ``compress``.
+        """
+        start = self._timer()
+        data = compress(*args)
+        self.compress_seconds += self._timer() - start
+        if data:
+            self.compressed_bytes += len(data)
+            self._consumer.write(data)
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        self._write(self._compressor.compress, data)
+
+    def flush(self):
+        """
+        Write whatever the compressor has buffered. Call once all the data
+        has been written.
+        """
+        self._write(self._compressor.flush)
+
+
+@implementer(IFilesystemReceiver)
+class DecompressingReceiver(object):
+    """
+    Decompress the data written to it and write the result to an
+    ``IFilesystemReceiver``.
+    """
+    def __init__(self, receiver, codec):
+        """
+        :param IFilesystemReceiver receiver: The receiver to write to.
+        :param Codec codec: The codec the data was compressed with.
+        """
+        self._receiver = receiver
+        self._decompressor = codec.decompressor()
+
+    def registerProducer(self, producer, streaming):
+        self._receiver.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._receiver.unregisterProducer()
+
+    def write(self, data):
+        data = self._decompressor.decompress(data)
+        if data:
+            self._receiver.write(data)
+
+    def finish(self):
+        data = self._decompressor.flush()
+        if data:
+            self._receiver.write(data)
+        return self._receiver.finish()
+
+    def abort(self):
+        return self._receiver.abort()
+
+
+_CODEC = Field.forTypes(
+    u"codec", [bytes], u"The name of the codec the data was compressed with.")
+_RAW_BYTES = Field.forTypes(
+    u"raw_bytes", [int, long], u"The size of the data before compression.")
+_SENT_BYTES = Field.forTypes(
+    u"sent_bytes", [int, long], u"The size of the data sent.")
+_RATIO = Field.forTypes(
+    u"ratio", [float], u"The uncompressed size divided by the sent size.")
+_SECONDS = Field.forTypes(
+    u"seconds", [float], u"The time the whole transfer took.")
+_COMPRESS_SECONDS = Field.forTypes(
+    u"compress_seconds", [float], u"The time spent compressing.")
+
+VOLUME_SENT = MessageType(
+    u"flocker:volume:sent",
+    [_CODEC, _RAW_BYTES, _SENT_BYTES, _RATIO, _SECONDS, _COMPRESS_SECONDS],
+    u"A volume's data was sent to another volume manager.")
@@ -4,10 +4,11 @@
 Inter-process communication for the volume manager.
 
 Specific volume managers ("nodes") may wish to push data to other
-nodes. In the current iteration this is done over SSH using a blocking
-API. In some future iteration this will be replaced with an actual
-well-specified communication protocol between daemon processes using
-Twisted's event loop (https://clusterhq.atlassian.net/browse/FLOC-154).
+nodes. ``RemoteVolumeManager`` does this over SSH using a blocking API.
+``flocker.volume._protocol.AgentVolumeManager`` instead talks to the
+long-running ``flocker-zfs-agent`` on the other node using Twisted's event
+loop (https://clusterhq.atlassian.net/browse/FLOC-154), and sends volume
+data to it over a separate TCP connection.
 """
 
 from contextlib import contextmanager
@@ -17,7 +18,8 @@ from characteristic import with_cmp
 
 from zope.interface import Interface, implementer
 
-from twisted.internet.defer import succeed
+from twisted.internet.defer import maybeDeferred, succeed
+from twisted.internet.interfaces import IConsumer
 from twisted.python.filepath import FilePath
 
 from ..common._ipc import ProcessNode
@@ -32,6 +34,56 @@ from .filesystems.zfs import Snapshot
 SSH_PRIVATE_KEY_PATH = FilePath(b"/etc/flocker/id_rsa_flocker")
 
 
+@implementer(IConsumer)
+class _FileConsumer(object):
+    """
+    Write everything given to a consumer to a file-like object.
+    """
+    def __init__(self, file):
+        """
+        :param file: The file-like object to write to.
+        """
+        self._file = file
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self._file.write(data)
+
+
+def copy_to_receiver(remote, volume, send, resume=False):
+    """
+    Implement ``IRemoteVolumeManager.receive_stream`` by writing the
+    contents into ``IRemoteVolumeManager.receive``.
+
+    Writes to the file returned by ``receive`` may block.
+
+    :param IRemoteVolumeManager remote: The volume manager to send to.
+    :param Volume volume: The volume being sent.
+    :param send: As for ``IRemoteVolumeManager.receive_stream``.
+    :param bool resume: As for ``IRemoteVolumeManager.receive_stream``.
+
+    :return: A ``Deferred`` that fires once the contents have been sent.
+    """
+    receiving = remote.receive(volume, resume)
+    receiver = receiving.__enter__()
+    d = maybeDeferred(send, _FileConsumer(receiver))
+
+    def sent(_):
+        receiving.__exit__(None, None, None)
+
+    def not_sent(reason):
+        if not receiving.__exit__(reason.type, reason.value,
+                                  reason.getTracebackObject()):
+            return reason
+    d.addCallbacks(sent, not_sent)
+    return d
+
+
 def standard_node(hostname):
     """
     Create the default production ``INode`` for the given hostname.
@@ -60,7 +112,20 @@ class IRemoteVolumeManager(Interface):
             ordered from oldest to newest.
         """
 
-    def receive(volume):
+    def resume_token(volume):
+        """
+        Find out whether an earlier transfer of a volume to the remote
+        volume manager was interrupted, and how much of it was received.
+
+        :param Volume volume: The volume which will be pushed to the
+            remote volume manager.
+
+        :return: A ``Deferred`` that fires with the token to pass to
+            ``IFilesystem.send_to`` to send the rest of the interrupted
+            transfer, or ``None`` if there isn't one.
+        """
+
+    def receive(volume, resume=False):
         """
         Context manager that returns a file-like object to which a volume's
         contents can be written.
@@ -68,10 +133,32 @@ class IRemoteVolumeManager(Interface):
         :param Volume volume: The volume which will be pushed to the
             remote volume manager.
 
+        :param bool resume: Whether the contents continue an interrupted
+            transfer, as for ``IFilesystem.writer``.
+
         :return: A file-like object that can be written to, which will
              update the volume on the remote volume manager.
         """
 
+    def receive_stream(volume, send, resume=False):
+        """
+        Send a volume's contents to the remote volume manager.
+
+        :param Volume volume: The volume which will be pushed to the
+            remote volume manager.
+
+        :param send: A callable which writes the volume's contents to the
+            ``IConsumer`` it is given, typically by registering a producer
+            with it, and returns a ``Deferred`` that fires once it is done.
+
+        :param bool resume: Whether ``send`` writes the rest of an
+            interrupted transfer, from ``IFilesystem.send_to`` given
+            ``resume_token``.
+
+        :return: A ``Deferred`` that fires once the remote volume manager
+            has stored the contents.
+        """
+
     def acquire(volume):
         """
         Tell the remote volume manager to acquire the given volume.
@@ -79,7 +166,8 @@ class IRemoteVolumeManager(Interface):
         :param Volume volume: The volume which will be acquired by the
             remote volume manager.
 
-        :return: The node ID of the remote volume manager (as ``unicode``).
+        :return: The node ID of the remote volume manager (as ``unicode``),
+            or a ``Deferred`` that fires with it.
         """
 
     def clone_to(parent, name):
@@ -128,12 +216,38 @@ class RemoteVolumeManager(object):
             in data.splitlines()
         ])
 
-    def receive(self, volume):
-        return self._destination.run([b"flocker-volume",
-                                      b"--config", self._config_path.path,
-                                      b"receive",
-                                      volume.node_id.encode(b"ascii"),
-                                      volume.name.to_bytes()])
+    def resume_token(self, volume):
+        """
+        Run ``flocker-volume resume_token`` on the destination, which
+        outputs the token if there is one.
+
+        If the command fails there is taken to be no token, since a
+        ``flocker-volume`` from before transfers could be resumed doesn't
+        have it, and keeps nothing from interrupted transfers.
+        """
+        try:
+            data = self._destination.get_output(
+                [b"flocker-volume",
+                 b"--config", self._config_path.path,
+                 b"resume_token",
+                 volume.node_id.encode("ascii"),
+                 volume.name.to_bytes()]
+            )
+        except IOError:
+            return succeed(None)
+        return succeed(data.strip() or None)
+
+    def receive(self, volume, resume=False):
+        command = [b"flocker-volume",
+                   b"--config", self._config_path.path,
+                   b"receive"]
+        if resume:
+            command.append(b"--resume")
+        return self._destination.run(command + [
+            volume.node_id.encode(b"ascii"), volume.name.to_bytes()])
+
+    def receive_stream(self, volume, send, resume=False):
+        return copy_to_receiver(self, volume, send, resume)
 
     def acquire(self, volume):
         return self._destination.get_output(
@@ -171,12 +285,19 @@ class LocalVolumeManager(object):
         """
         return volume.get_filesystem().snapshots()
 
+    def resume_token(self, volume):
+        return self._service.resume_token(volume.node_id, volume.name)
+
     @contextmanager
-    def receive(self, volume):
+    def receive(self, volume, resume=False):
         input_file = BytesIO()
         yield input_file
         input_file.seek(0, 0)
-        self._service.receive(volume.node_id, volume.name, input_file)
+        self._service.receive(volume.node_id, volume.name, input_file,
+                              resume)
+
+    def receive_stream(self, volume, send, resume=False):
+        return copy_to_receiver(self, volume, send, resume)
 
     def acquire(self, volume):
         self._service.acquire(volume.node_id, volume.name)
@@ -0,0 +1,1124 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.volume.test.test_protocol -*-
+
+"""
+Communication protocol between volume managers.
+
+``flocker-zfs-agent`` listens for AMP connections from the volume managers
+on other nodes and answers the ``IRemoteVolumeManager`` operations that
+used to each require a new SSH session and ``flocker-volume`` process.
+Clients keep one connection open per peer and reuse it, so the control
+part of a push or handoff costs a round trip rather than an SSH handshake
+and interpreter startup.
+
+Connections are authenticated with a secret shared by all the nodes in
+the cluster; by default the cluster's SSH private key, which every node
+already has. Each side proves knowledge of the secret by sending an HMAC
+of a pair of random nonces, one chosen by each side, so neither can
+replay an earlier exchange. Until the client has authenticated the
+server refuses all other commands. The connection is not encrypted: only
+volume names, snapshot names and node IDs are sent over it.
+
+Volume data doesn't go over the AMP connection. The sender asks the agent
+to expect a volume with ``StartReceiveCommand`` and is given a one-time
+token and the agent's data port. It then opens a separate TCP connection
+to that port, sends the token followed by the stream, and closes the
+connection. Finally ``FinishReceiveCommand`` waits for the agent to store
+the volume and checks that it got every byte. The data goes straight
+from the sending filesystem's producer to the socket and from the socket
+to the receiving filesystem, without SSH encryption or intermediate
+processes, and each side pauses the other when it can't keep up. The data
+is compressed with a codec negotiated by ``StartReceiveCommand`` (see
+``flocker.volume._codec``). If the agent is given a TLS certificate and
+key shared by the cluster, data connections are encrypted with TLS and
+both ends must present that certificate.
+
+If a data connection is lost the agent keeps what it received. Before the
+next push of the volume the sender asks for a resume token with
+``ResumeTokenCommand`` and, if there is one, sends only the rest of the
+interrupted stream.
+"""
+
+import hmac
+from hashlib import sha256
+from os import urandom
+from timeit import default_timer
+
+from characteristic import with_cmp
+
+from zope.interface import implementer
+
+from eliot import Logger
+
+from twisted.application.service import Service
+from twisted.internet.defer import (
+    Deferred, succeed, fail, maybeDeferred, gatherResults,
+)
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.error import (
+    ConnectError, ConnectionDone, TimeoutError,
+)
+from twisted.internet.protocol import Factory, Protocol, ServerFactory
+from twisted.protocols.amp import (
+    AMP, Boolean, Command, CommandLocator, Integer, ListOf, String, Unicode,
+    UnhandledCommand,
+)
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+
+from ._ipc import (
+    IRemoteVolumeManager, RemoteVolumeManager, SSH_PRIVATE_KEY_PATH,
+    standard_node,
+)
+from ._codec import (
+    NO_COMPRESSION, VOLUME_SENT, CodecSelector, CompressingConsumer,
+    DecompressingReceiver, negotiate,
+)
+from .filesystems.zfs import Snapshot
+from .service import Volume, VolumeName
+
+
+# The port on which ``flocker-zfs-agent`` accepts connections from other
+# volume managers:
+VOLUME_AGENT_PORT = 4525
+
+# The port on which ``flocker-zfs-agent`` accepts volume data:
+VOLUME_DATA_PORT = 4526
+
+# Certificate and private key, in PEM format, shared by the cluster and used
+# to encrypt volume data if the agent is configured to:
+DATA_TLS_PATH = FilePath(b"/etc/flocker/volume-data.pem")
+
+# Length in bytes of the nonces used for authentication:
+NONCE_LENGTH = 16
+
+# Length in bytes of the tokens identifying volume data connections:
+TOKEN_LENGTH = 16
+
+# Seconds to wait for a connection to a volume agent before falling back to
+# SSH:
+CONNECT_TIMEOUT = 5
+
+# Seconds for which a failure to reach a volume agent is remembered, during
+# which operations fall back to SSH straight away instead of trying again:
+CONNECT_RETRY_INTERVAL = 30
+
+
+class AuthenticationFailed(Exception):
+    """
+    The other side of a connection did not prove it knows the cluster
+    secret.
+    """
+
+
+class NotAuthenticated(Exception):
+    """
+    A command was sent before the connection was authenticated.
+    """
+
+
+class VolumeOwnedLocally(ValueError):
+    """
+    Another node tried to send data for a volume owned by the receiving
+    node, which would overwrite it.
+    """
+
+
+class TransferFailed(Exception):
+    """
+    Volume data sent over a data connection was not stored.
+    """
+
+
+def tls_options(path):
+    """
+    Load the TLS certificate and key shared by the cluster.
+
+    Twisted's TLS support depends on pyOpenSSL, which is only needed (and
+    only imported) if TLS is used.
+
+    :param FilePath path: File containing the certificate and private key
+        in PEM format.
+
+    :return: ``CertificateOptions`` that present the certificate and require
+        the other side to present it too.
+    """
+    from twisted.internet.ssl import PrivateCertificate
+    certificate = PrivateCertificate.loadPEM(path.getContent())
+    return certificate.options(certificate)
+
+
+def _wrap_tls(options, is_client, factory):
+    """
+    Wrap a factory so its connections use TLS.
+
+    :param options: ``CertificateOptions`` from ``tls_options``.
+    :param bool is_client: Whether the connections are made by this side.
+    :param factory: The factory to wrap.
+
+    :return TLSMemoryBIOFactory: The wrapping factory.
+    """
+    from twisted.protocols.tls import TLSMemoryBIOFactory
+    return TLSMemoryBIOFactory(options, is_client, factory)
+
+
+def _digest(secret, role, server_nonce, client_nonce):
+    """
+    Compute the proof that one side of a connection knows the secret.
+
+    :param bytes secret: The secret shared by the cluster.
+    :param bytes role: ``b"client"`` or ``b"server"``, so that one side's
+        proof can't be reflected back as the other's.
+    :param bytes server_nonce: The nonce chosen by the server.
+    :param bytes client_nonce: The nonce chosen by the client.
+
+    :return bytes: The HMAC-SHA256 digest.
+    """
+    return hmac.new(
+        secret, role + server_nonce + client_nonce, sha256).digest()
+
+
+class ChallengeCommand(Command):
+    """
+    Ask the server for a nonce to authenticate with.
+    """
+    arguments = []
+    response = [('nonce', String())]
+
+
+class AuthenticateCommand(Command):
+    """
+    Prove to the server that the client knows the cluster secret, and get
+    the server's proof in return.
+    """
+    arguments = [('nonce', String()),
+                 ('digest', String())]
+    response = [('digest', String())]
+    errors = {AuthenticationFailed: 'AUTHENTICATION_FAILED'}
+
+
+class SnapshotsCommand(Command):
+    """
+    List the snapshots the server has of a volume.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String())]
+    response = [('snapshots', ListOf(String()))]
+    errors = {NotAuthenticated: 'NOT_AUTHENTICATED'}
+
+
+class AcquireCommand(Command):
+    """
+    Make the server the owner of a volume it has a copy of.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String())]
+    response = [('node_id', Unicode())]
+    errors = {NotAuthenticated: 'NOT_AUTHENTICATED'}
+
+
+class CloneToCommand(Command):
+    """
+    Clone one of the server's volumes to a new volume.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('parent_name', String()),
+                 ('child_name', String())]
+    response = []
+    errors = {NotAuthenticated: 'NOT_AUTHENTICATED'}
+
+
+class ResumeTokenCommand(Command):
+    """
+    Ask the server how much of an interrupted transfer of a volume it
+    received.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String())]
+    response = [('token', String(optional=True))]
+    errors = {NotAuthenticated: 'NOT_AUTHENTICATED'}
+
+
+class StartReceiveCommand(Command):
+    """
+    Ask the server to expect a volume's data on a data connection.
+
+    The client offers the codecs it can compress the data with, in order of
+    preference, and says whether the data continues an interrupted
+    transfer. The response gives the token to send at the start of the
+    data connection, the port to make it to, whether it must use TLS and
+    the codec the server chose. The codecs are optional so that a server or
+    client which doesn't know about them sends the data uncompressed.
+    """
+    arguments = [('node_id', Unicode()),
+                 ('name', String()),
+                 ('codecs', ListOf(String(), optional=True)),
+                 ('resume', Boolean(optional=True))]
+    response = [('transfer', String()),
+                ('port', Integer()),
+                ('tls', Boolean()),
+                ('codec', String(optional=True))]
+    errors = {NotAuthenticated: 'NOT_AUTHENTICATED',
+              VolumeOwnedLocally: 'VOLUME_OWNED_LOCALLY'}
+
+
+class FinishReceiveCommand(Command):
+    """
+    Wait for the server to store the volume data it was sent on a data
+    connection.
+    """
+    arguments = [('transfer', String()),
+                 ('length', Integer())]
+    response = []
+    errors = {NotAuthenticated: 'NOT_AUTHENTICATED',
+              TransferFailed: 'TRANSFER_FAILED'}
+
+
+class _IncomingTransfer(object):
+    """
+    A volume being received on a data connection.
+
+    :ivar Volume volume: The volume being received.
+    :ivar Codec codec: The codec the data is compressed with.
+    :ivar bool resume: Whether the data continues an interrupted transfer.
+    :ivar bool started: Whether a data connection has claimed the transfer.
+    :ivar int received: The number of bytes received so far, before
+        decompression.
+    :ivar result: ``None`` until the data connection is closed and the
+        volume's ``IFilesystemReceiver`` is done, then the number of bytes
+        stored or a ``Failure`` if storing them failed.
+    """
+    def __init__(self, volume, codec=NO_COMPRESSION, resume=False,
+                 forget=lambda: None):
+        """
+        :param Volume volume: The volume to receive.
+        :param Codec codec: The codec the data is compressed with.
+        :param bool resume: Whether the data continues an interrupted
+            transfer.
+        :param forget: Callable with no arguments which stops the transfer
+            from being found by its token, called if the data connection
+            isn't closed cleanly.
+        """
+        self.volume = volume
+        self.codec = codec
+        self.resume = resume
+        self._forget = forget
+        self.started = False
+        self.received = 0
+        self.result = None
+        self._receiving = None
+        self._receiver = None
+        self._pending = []
+        self._waiting = []
+
+    def start(self, transport):
+        """
+        Start receiving the volume's filesystem.
+
+        The data connection is paused until the filesystem is ready, and
+        then registered with the filesystem's receiver so it is paused
+        whenever the receiver can't keep up.
+
+        :param transport: The data connection's transport.
+        """
+        self.started = True
+        transport.pauseProducing()
+
+        def ready(receiver):
+            receiver = DecompressingReceiver(receiver, self.codec)
+            self._receiver = receiver
+            transport.resumeProducing()
+            receiver.registerProducer(transport, True)
+            pending, self._pending = self._pending, []
+            for data in pending:
+                receiver.write(data)
+            return receiver
+
+        def not_ready(reason):
+            transport.abortConnection()
+            return reason
+        self._receiving = self.volume.get_filesystem().receiver(self.resume)
+        self._receiving.addCallbacks(ready, not_ready)
+
+    def write(self, data):
+        """
+        :param bytes data: More of the volume's data.
+        """
+        self.received += len(data)
+        if self._receiver is None:
+            self._pending.append(data)
+        else:
+            self._receiver.write(data)
+
+    def finish(self, reason):
+        """
+        Finish receiving once the data connection is closed.
+
+        :param Failure reason: Why the data connection was closed. Unless
+            it was closed cleanly the receiver is aborted, keeping the data
+            received for a later transfer to resume from, and the transfer
+            is forgotten, since the sender won't try to finish it.
+        """
+        if not reason.check(ConnectionDone):
+            self._forget()
+        if self._receiving is None:
+            self._finished(Failure(TransferFailed()))
+            return
+
+        def done(receiver):
+            receiver.unregisterProducer()
+            if reason.check(ConnectionDone):
+                return receiver.finish()
+            aborting = receiver.abort()
+            aborting.addCallback(lambda _: Failure(TransferFailed()))
+            return aborting
+        d = self._receiving
+        d.addCallback(done)
+        d.addCallbacks(lambda _: self._finished(self.received),
+                       self._finished)
+
+    def _finished(self, result):
+        """
+        Record the result of the transfer and tell anyone waiting for it.
+
+        :param result: The number of bytes stored or a ``Failure``.
+        """
+        self.result = result
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(result)
+
+    def wait(self):
+        """
+        :return: ``Deferred`` firing with the number of bytes stored once
+            the data connection is closed, or failing if they weren't.
+        """
+        if self.result is not None:
+            return succeed(self.result)
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+
+class VolumeAgent(object):
+    """
+    The state shared by all the connections to a volume agent.
+
+    :ivar VolumeService volume_service: The local volume manager.
+    :ivar int data_port: The port on which data connections are accepted.
+    :ivar tls: ``CertificateOptions`` data connections must use, or
+        ``None`` if they are not encrypted.
+    :ivar dict transfers: Map tokens to the ``_IncomingTransfer`` they
+        identify.
+    """
+    def __init__(self, volume_service, secret, data_port=VOLUME_DATA_PORT,
+                 tls=None):
+        """
+        :param VolumeService volume_service: The local volume manager.
+        :param bytes secret: The secret shared by the cluster.
+        :param int data_port: The port on which data connections are
+            accepted.
+        :param tls: ``CertificateOptions`` data connections must use, or
+            ``None`` if they are not encrypted.
+        """
+        self.volume_service = volume_service
+        self.secret = secret
+        self.data_port = data_port
+        self.tls = tls
+        self.transfers = {}
+
+    def control_factory(self):
+        """
+        :return ServerFactory: Factory building an ``AMP`` protocol for
+            each connection from another volume manager.
+        """
+        return ServerFactory.forProtocol(lambda: _VolumeAgentServer(self))
+
+    def data_factory(self):
+        """
+        :return ServerFactory: Factory for data connections, wrapped with
+            TLS if that is required.
+        """
+        factory = ServerFactory.forProtocol(lambda: _DataReceiver(self))
+        if self.tls is not None:
+            factory = _wrap_tls(self.tls, False, factory)
+        return factory
+
+
+class _DataReceiver(Protocol):
+    """
+    Volume agent side of a data connection: write the data following the
+    token into the volume the token identifies.
+    """
+    def __init__(self, agent):
+        """
+        :param VolumeAgent agent: The agent accepting the connection.
+        """
+        self._agent = agent
+        self._buffer = b""
+        self._transfer = None
+
+    def dataReceived(self, data):
+        if self._transfer is None:
+            self._buffer += data
+            if len(self._buffer) < TOKEN_LENGTH:
+                return
+            token = self._buffer[:TOKEN_LENGTH]
+            data = self._buffer[TOKEN_LENGTH:]
+            self._buffer = b""
+            transfer = self._agent.transfers.get(token)
+            if transfer is None or transfer.started:
+                self.transport.abortConnection()
+                return
+            self._transfer = transfer
+            transfer.start(self.transport)
+        if data:
+            self._transfer.write(data)
+
+    def connectionLost(self, reason):
+        if self._transfer is not None:
+            self._transfer.finish(reason)
+
+
+class VolumeAgentLocator(CommandLocator):
+    """
+    Volume agent side of the protocol.
+
+    :ivar bool authenticated: Whether the client has proven it knows the
+        secret.
+    :ivar set transfers: The tokens of the transfers started by this
+        connection which haven't been finished.
+    """
+    def __init__(self, agent):
+        """
+        :param VolumeAgent agent: The agent accepting the connection.
+        """
+        CommandLocator.__init__(self)
+        self.agent = agent
+        self.volume_service = agent.volume_service
+        self._secret = agent.secret
+        self._nonce = None
+        self.authenticated = False
+        self.transfers = set()
+
+    def _volume(self, node_id, name):
+        """
+        :param unicode node_id: The node ID of the volume's owner.
+        :param bytes name: The volume's name, as encoded by
+            ``VolumeName.to_bytes``.
+
+        :raises NotAuthenticated: If the client hasn't authenticated.
+
+        :return Volume: The volume as stored by the local volume manager.
+        """
+        if not self.authenticated:
+            raise NotAuthenticated()
+        return Volume(node_id=node_id, name=VolumeName.from_bytes(name),
+                      service=self.volume_service)
+
+    @ChallengeCommand.responder
+    def challenge(self):
+        self._nonce = urandom(NONCE_LENGTH)
+        return {"nonce": self._nonce}
+
+    @AuthenticateCommand.responder
+    def authenticate(self, nonce, digest):
+        server_nonce, self._nonce = self._nonce, None
+        if server_nonce is None or not hmac.compare_digest(
+                digest,
+                _digest(self._secret, b"client", server_nonce, nonce)):
+            raise AuthenticationFailed()
+        self.authenticated = True
+        return {"digest": _digest(
+            self._secret, b"server", server_nonce, nonce)}
+
+    @SnapshotsCommand.responder
+    def snapshots(self, node_id, name):
+        d = self._volume(node_id, name).get_filesystem().snapshots()
+        d.addCallback(lambda snapshots: {
+            "snapshots": [snapshot.name for snapshot in snapshots]})
+        return d
+
+    @AcquireCommand.responder
+    def acquire(self, node_id, name):
+        self._volume(node_id, name)
+        d = self.volume_service.acquire(node_id, VolumeName.from_bytes(name))
+        d.addCallback(lambda _: {"node_id": self.volume_service.node_id})
+        return d
+
+    @CloneToCommand.responder
+    def clone_to(self, node_id, parent_name, child_name):
+        parent = self._volume(node_id, parent_name)
+        d = self.volume_service.clone_to(
+            parent, VolumeName.from_bytes(child_name))
+        d.addCallback(lambda _: {})
+        return d
+
+    @ResumeTokenCommand.responder
+    def resume_token(self, node_id, name):
+        d = self._volume(node_id, name).get_filesystem().resume_token()
+        d.addCallback(lambda token: {"token": token})
+        return d
+
+    @StartReceiveCommand.responder
+    def start_receive(self, node_id, name, codecs=None, resume=False):
+        volume = self._volume(node_id, name)
+        if volume.locally_owned():
+            # Remote nodes can't overwrite locally-owned volumes:
+            raise VolumeOwnedLocally()
+        codec = negotiate(codecs)
+        token = urandom(TOKEN_LENGTH)
+        self.agent.transfers[token] = _IncomingTransfer(
+            volume, codec, bool(resume), lambda: self._forget(token))
+        self.transfers.add(token)
+        return {"transfer": token, "port": self.agent.data_port,
+                "tls": self.agent.tls is not None, "codec": codec.name}
+
+    @FinishReceiveCommand.responder
+    def finish_receive(self, transfer, length):
+        if not self.authenticated:
+            raise NotAuthenticated()
+        if transfer not in self.transfers:
+            raise TransferFailed()
+        self.transfers.remove(transfer)
+        d = self.agent.transfers.pop(transfer).wait()
+
+        def stored(received):
+            if received != length:
+                raise TransferFailed()
+            return {}
+        d.addCallback(stored)
+        return d
+
+    def _forget(self, token):
+        """
+        Forget a transfer started by the connection.
+
+        :param bytes token: The token identifying the transfer.
+        """
+        self.transfers.discard(token)
+        self.agent.transfers.pop(token, None)
+
+    def disconnected(self):
+        """
+        Forget the transfers started by the connection, since it won't
+        finish them.
+        """
+        for token in list(self.transfers):
+            self._forget(token)
+
+
+class _VolumeAgentServer(AMP):
+    """
+    Volume agent side of a connection from another volume manager.
+    """
+    def __init__(self, agent):
+        """
+        :param VolumeAgent agent: The agent accepting the connection.
+        """
+        AMP.__init__(self, locator=VolumeAgentLocator(agent))
+
+    def connectionLost(self, reason):
+        AMP.connectionLost(self, reason)
+        self.locator.disconnected()
+
+
+class VolumeAgentService(Service):
+    """
+    Accept connections from the volume managers on other nodes.
+
+    :ivar VolumeAgent agent: The state shared by the connections, once the
+        service has started.
+    """
+    def __init__(self, volume_service, endpoint, data_endpoint,
+                 secret_path=SSH_PRIVATE_KEY_PATH, tls_path=None):
+        """
+        :param VolumeService volume_service: The local volume manager.
+        :param endpoint: Endpoint to listen on for AMP connections.
+        :param data_endpoint: Endpoint to listen on for data connections.
+        :param FilePath secret_path: File containing the secret shared by
+            the cluster.
+        :param tls_path: ``FilePath`` of the TLS certificate and private key
+            shared by the cluster, or ``None`` to send data unencrypted.
+        """
+        self.volume_service = volume_service
+        self._endpoint = endpoint
+        self._data_endpoint = data_endpoint
+        self._secret_path = secret_path
+        self._tls_path = tls_path
+        self.agent = None
+        self._listening = []
+
+    def startService(self):
+        Service.startService(self)
+        tls = None
+        if self._tls_path is not None:
+            tls = tls_options(self._tls_path)
+        self.agent = VolumeAgent(
+            self.volume_service, self._secret_path.getContent(), tls=tls)
+        self._listening = [
+            self._data_endpoint.listen(self.agent.data_factory()),
+            self._endpoint.listen(self.agent.control_factory()),
+        ]
+
+        def data_listening(port):
+            self.agent.data_port = port.getHost().port
+            return port
+        self._listening[0].addCallback(data_listening)
+
+    def stopService(self):
+        Service.stopService(self)
+        listening, self._listening = self._listening, []
+        return gatherResults([
+            d.addCallback(lambda port: port.stopListening())
+            for d in listening])
+
+
+class _VolumeAgentClient(AMP):
+    """
+    Client side of a connection to a volume agent, which tells its pool
+    when it is closed.
+    """
+    def __init__(self, disconnected):
+        """
+        :param disconnected: Callable with no arguments to call when the
+            connection is lost.
+        """
+        AMP.__init__(self)
+        self._disconnected = disconnected
+        self._waiting = []
+
+    def when_disconnected(self):
+        """
+        :return: ``Deferred`` that fires when the connection is lost.
+        """
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def connectionLost(self, reason):
+        AMP.connectionLost(self, reason)
+        self._disconnected()
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+
+class _DataSender(Protocol):
+    """
+    Sending side of a data connection: send the token and then the volume's
+    data, compressed with the negotiated codec. The producer writing the
+    data is registered with the transport, so it is paused whenever the
+    connection can't keep up.
+
+    :ivar Deferred done: Fires with the ``CompressingConsumer`` the data was
+        written to, which knows how much was sent, once it has all been
+        sent and the connection closed. It fails with the reason the data
+        couldn't be written, or else why the connection was lost first.
+    """
+    def __init__(self, token, send, codec):
+        """
+        :param bytes token: The token identifying the transfer.
+        :param send: Callable which writes the volume's data to the
+            ``IConsumer`` it is given, returning a ``Deferred`` that fires
+            once it is done.
+        :param Codec codec: The codec to compress the data with.
+        """
+        self._token = token
+        self._send = send
+        self._codec = codec
+        self._consumer = None
+        self._complete = False
+        self._failure = None
+        self.done = Deferred()
+
+    def connectionMade(self):
+        self.transport.write(self._token)
+        self._consumer = CompressingConsumer(self.transport, self._codec)
+        sending = maybeDeferred(self._send, self._consumer)
+
+        def sent(_):
+            self._consumer.flush()
+            self._complete = True
+            self.transport.loseConnection()
+
+        def not_sent(reason):
+            self._failure = reason
+            self.transport.abortConnection()
+        sending.addCallbacks(sent, not_sent)
+
+    def connectionLost(self, reason):
+        if self._complete and reason.check(ConnectionDone):
+            self.done.callback(self._consumer)
+        elif self._failure is not None:
+            self.done.errback(self._failure)
+        else:
+            self.done.errback(reason)
+
+
+class AgentConnectionPool(object):
+    """
+    Authenticated connections to volume agents, at most one per peer.
+
+    :ivar dict _connections: Map ``(host, port)`` to the connected
+        ``AMP`` protocol.
+    :ivar dict _connecting: Map ``(host, port)`` to a ``list`` of
+        ``Deferred``\ s waiting for a connection that is being made.
+    :ivar dict _unreachable: Map ``(host, port)`` to a tuple of the time a
+        connection to that agent last failed and the ``Failure``, for
+        agents which couldn't be reached within the last
+        ``CONNECT_RETRY_INTERVAL`` seconds.
+    """
+    def __init__(self, reactor=None, secret_path=SSH_PRIVATE_KEY_PATH,
+                 tls_path=DATA_TLS_PATH):
+        """
+        :param reactor: ``IReactorTCP`` and ``IReactorTime`` provider used
+            to connect. Defaults to the global reactor.
+        :param FilePath secret_path: File containing the secret shared by
+            the cluster.
+        :param FilePath tls_path: File containing the TLS certificate and
+            private key shared by the cluster, used if an agent requires
+            data connections to use TLS.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._secret_path = secret_path
+        self._tls_path = tls_path
+        self.codec_selector = CodecSelector()
+        self._connections = {}
+        self._connecting = {}
+        self._unreachable = {}
+
+    def send(self, host, port, tls, token, send, codec=NO_COMPRESSION):
+        """
+        Make a data connection to a volume agent and send a volume over it.
+
+        :param bytes host: The host the agent runs on.
+        :param int port: The agent's data port.
+        :param bool tls: Whether the agent requires TLS.
+        :param bytes token: The token identifying the transfer.
+        :param send: Callable which writes the volume's data to the
+            ``IConsumer`` it is given, returning a ``Deferred`` that fires
+            once it is done.
+        :param Codec codec: The codec the agent chose.
+
+        :return: ``Deferred`` firing with the ``CompressingConsumer`` the
+            data was written to once the connection is closed.
+        """
+        sender = _DataSender(token, send, codec)
+        factory = Factory.forProtocol(lambda: sender)
+        if tls:
+            factory = _wrap_tls(tls_options(self._tls_path), True, factory)
+        d = TCP4ClientEndpoint(self._reactor, host, port,
+                               timeout=CONNECT_TIMEOUT).connect(factory)
+        d.addCallback(lambda _: sender.done)
+        return d
+
+    def connect(self, host, port):
+        """
+        Get an authenticated connection to a volume agent, making one if
+        there isn't one already.
+
+        :param bytes host: The host the agent runs on.
+        :param int port: The port the agent listens on.
+
+        :return: ``Deferred`` firing with a connected ``AMP`` protocol, or
+            failing with ``ConnectError`` if the agent can't be reached or
+            ``AuthenticationFailed`` if it doesn't know the secret. If the
+            agent couldn't be reached within the last
+            ``CONNECT_RETRY_INTERVAL`` seconds it fails straight away with
+            the same error.
+        """
+        key = (host, port)
+        if key in self._connections:
+            return succeed(self._connections[key])
+        unreachable = self._unreachable.get(key)
+        if unreachable is not None:
+            failed_at, reason = unreachable
+            if self._reactor.seconds() < failed_at + CONNECT_RETRY_INTERVAL:
+                return fail(reason)
+            del self._unreachable[key]
+        result = Deferred()
+        waiting = self._connecting.get(key)
+        if waiting is not None:
+            waiting.append(result)
+            return result
+        self._connecting[key] = [result]
+
+        def disconnected():
+            if self._connections.get(key) is protocol:
+                del self._connections[key]
+
+        protocol = _VolumeAgentClient(disconnected)
+        d = connectProtocol(
+            TCP4ClientEndpoint(self._reactor, host, port,
+                               timeout=CONNECT_TIMEOUT), protocol)
+        d.addCallback(self._authenticate)
+
+        def authenticated(protocol):
+            self._connections[key] = protocol
+            for waiter in self._connecting.pop(key):
+                waiter.callback(protocol)
+
+        def failed(reason):
+            if reason.check(ConnectError, TimeoutError):
+                self._unreachable[key] = (self._reactor.seconds(), reason)
+            for waiter in self._connecting.pop(key):
+                waiter.errback(reason)
+        d.addCallbacks(authenticated, failed)
+        return result
+
+    def _authenticate(self, protocol):
+        """
+        Run the authentication exchange on a new connection.
+
+        :param AMP protocol: The connected protocol.
+
+        :return: ``Deferred`` firing with ``protocol`` once both sides have
+            proven they know the secret.
+        """
+        secret = self._secret_path.getContent()
+        client_nonce = urandom(NONCE_LENGTH)
+        d = protocol.callRemote(ChallengeCommand)
+
+        def got_challenge(response):
+            server_nonce = response["nonce"]
+            authenticating = protocol.callRemote(
+                AuthenticateCommand, nonce=client_nonce,
+                digest=_digest(secret, b"client", server_nonce, client_nonce))
+            authenticating.addCallback(check_server, server_nonce)
+            return authenticating
+
+        def check_server(response, server_nonce):
+            if not hmac.compare_digest(
+                    response["digest"],
+                    _digest(secret, b"server", server_nonce, client_nonce)):
+                raise AuthenticationFailed()
+            return protocol
+
+        def failed(reason):
+            protocol.transport.loseConnection()
+            return reason
+        d.addCallback(got_challenge)
+        d.addErrback(failed)
+        return d
+
+    def disconnect(self):
+        """
+        Close all the connections in the pool.
+
+        :return: ``Deferred`` that fires once they are closed.
+        """
+        protocols = self._connections.values()
+        self._connections.clear()
+        closing = []
+        for protocol in protocols:
+            closing.append(protocol.when_disconnected())
+            protocol.transport.loseConnection()
+        return gatherResults(closing)
+
+
+# Pool shared by all the AgentVolumeManager instances of a process that
+# aren't given one:
+_POOL = None
+
+
+def _default_pool():
+    """
+    :return AgentConnectionPool: The pool shared by the process, created on
+        first use.
+    """
+    global _POOL
+    if _POOL is None:
+        _POOL = AgentConnectionPool()
+    return _POOL
+
+
+@implementer(IRemoteVolumeManager)
+@with_cmp(["_host", "_port", "_fallback"])
+class AgentVolumeManager(object):
+    """
+    Communication with the ``flocker-zfs-agent`` on a remote node.
+
+    Operations are sent over a connection from an ``AgentConnectionPool``.
+    If the agent can't be reached they are done by another
+    ``IRemoteVolumeManager`` instead, typically one using SSH. Volume data
+    given to ``receive_stream`` is sent over a data connection; the
+    blocking ``receive`` API is left to the other volume manager.
+
+    The codec used to compress each transfer is negotiated with the agent,
+    preferring whichever the pool's ``CodecSelector`` suggests, and the
+    outcome is logged as a ``VOLUME_SENT`` message.
+    """
+    logger = Logger()
+
+    def __init__(self, host, fallback, port=VOLUME_AGENT_PORT, pool=None):
+        """
+        :param bytes host: The host the agent runs on.
+        :param IRemoteVolumeManager fallback: Volume manager to use for
+            ``receive``, and for everything else if the agent can't be
+            reached.
+        :param int port: The port the agent listens on.
+        :param AgentConnectionPool pool: The pool to get connections from,
+            or ``None`` to use one shared by the whole process.
+        """
+        self._host = host
+        self._fallback = fallback
+        self._port = port
+        self._pool = pool
+
+    def _get_pool(self):
+        """
+        :return AgentConnectionPool: The pool to get connections from.
+        """
+        return self._pool if self._pool is not None else _default_pool()
+
+    def _connected(self, fallback, connected):
+        """
+        Do something with a connection to the agent.
+
+        :param fallback: Callable with no arguments to call instead if the
+            agent can't be reached.
+        :param connected: Callable to call with the connected ``AMP``
+            protocol.
+
+        :return: ``Deferred`` firing with the result of whichever callable
+            was called.
+        """
+        d = self._get_pool().connect(self._host, self._port)
+
+        def not_connected(reason):
+            reason.trap(ConnectError, TimeoutError)
+            return maybeDeferred(fallback)
+        d.addCallbacks(connected, not_connected)
+        return d
+
+    def _call(self, fallback, command, convert, **kwargs):
+        """
+        Send a command to the agent.
+
+        :param fallback: Callable with no arguments to call instead if the
+            agent can't be reached.
+        :param command: The ``Command`` to send.
+        :param convert: Callable which converts the command's response to
+            the result ``fallback`` would have had.
+        :param kwargs: The command's arguments.
+
+        :return: ``Deferred`` firing with the result.
+        """
+        return self._connected(
+            fallback,
+            lambda protocol: protocol.callRemote(
+                command, **kwargs).addCallback(convert))
+
+    def snapshots(self, volume):
+        return self._call(
+            lambda: self._fallback.snapshots(volume),
+            SnapshotsCommand,
+            lambda response: [Snapshot(name=name)
+                              for name in response["snapshots"]],
+            node_id=volume.node_id, name=volume.name.to_bytes())
+
+    def resume_token(self, volume):
+        d = self._call(
+            lambda: self._fallback.resume_token(volume),
+            ResumeTokenCommand,
+            lambda response: response["token"],
+            node_id=volume.node_id, name=volume.name.to_bytes())
+
+        def unsupported(reason):
+            # Agents from before transfers could be resumed don't know the
+            # command, and keep nothing from interrupted transfers:
+            reason.trap(UnhandledCommand)
+            return None
+        d.addErrback(unsupported)
+        return d
+
+    def receive(self, volume, resume=False):
+        return self._fallback.receive(volume, resume)
+
+    def receive_stream(self, volume, send, resume=False):
+        pool = self._get_pool()
+        start = default_timer()
+
+        def connected(protocol):
+            offered = pool.codec_selector.offer(self._host)
+            d = protocol.callRemote(
+                StartReceiveCommand,
+                node_id=volume.node_id, name=volume.name.to_bytes(),
+                codecs=offered, resume=resume)
+            d.addCallback(started, protocol, offered)
+            return d
+
+        def started(response, protocol, offered):
+            codec = negotiate([response["codec"] or NO_COMPRESSION.name])
+            pool.codec_selector.negotiated(self._host, offered, codec.name)
+            d = pool.send(self._host, response["port"], response["tls"],
+                          response["transfer"], send, codec)
+
+            def sent(consumer):
+                finishing = protocol.callRemote(
+                    FinishReceiveCommand, transfer=response["transfer"],
+                    length=consumer.compressed_bytes)
+                finishing.addCallback(
+                    lambda _: self._report(pool, codec, consumer, start))
+                return finishing
+            d.addCallback(sent)
+            return d
+
+        return self._connected(
+            lambda: self._fallback.receive_stream(volume, send, resume),
+            connected)
+
+    def _report(self, pool, codec, consumer, start):
+        """
+        Log the outcome of a transfer and tell the pool's ``CodecSelector``
+        how fast it was.
+
+        :param AgentConnectionPool pool: The pool used for the transfer.
+        :param Codec codec: The codec used.
+        :param CompressingConsumer consumer: The consumer the data was
+            written to.
+        :param float start: When the transfer started.
+        """
+        seconds = default_timer() - start
+        pool.codec_selector.record(
+            self._host, codec.name, consumer.raw_bytes, seconds)
+        VOLUME_SENT(
+            codec=codec.name, raw_bytes=consumer.raw_bytes,
+            sent_bytes=consumer.compressed_bytes,
+            ratio=(float(consumer.raw_bytes) /
+                   max(consumer.compressed_bytes, 1)),
+            seconds=seconds, compress_seconds=consumer.compress_seconds,
+        ).write(self.logger)
+
+    def acquire(self, volume):
+        return self._call(
+            lambda: self._fallback.acquire(volume),
+            AcquireCommand,
+            lambda response: response["node_id"],
+            node_id=volume.node_id, name=volume.name.to_bytes())
+
+    def clone_to(self, parent, name):
+        return self._call(
+            lambda: self._fallback.clone_to(parent, name),
+            CloneToCommand,
+            lambda response: None,
+            node_id=parent.node_id, parent_name=parent.name.to_bytes(),
+            child_name=name.to_bytes())
+
+
+def standard_volume_manager(hostname):
+    """
+    Create the default production ``IRemoteVolumeManager`` for the given
+    hostname.
+
+    That is, one that talks to the volume agent on the standard port,
+    falling back to ``flocker-volume`` over SSH.
+
+    :param bytes hostname: The host to connect to.
+    :return: An ``AgentVolumeManager`` for the given hostname.
+    """
+    return AgentVolumeManager(
+        hostname, RemoteVolumeManager(standard_node(hostname)))
@@ -6,6 +6,8 @@ from __future__ import absolute_import
 
 from zope.interface import Attribute, Interface
 
+from twisted.internet.interfaces import IConsumer
+
 
 class FilesystemAlreadyExists(Exception):
     """
@@ -14,6 +16,13 @@ class FilesystemAlreadyExists(Exception):
     """
 
 
+class ResumeFailed(Exception):
+    """
+    Raised when an interrupted transfer can't be continued from its resume
+    token, for example because the data it was sending no longer exists.
+    """
+
+
 class IFilesystemSnapshots(Interface):
     """
     Support creating and listing snapshots of a specific filesystem.
@@ -41,6 +50,36 @@ class IFilesystemSnapshots(Interface):
         """
 
 
+class IFilesystemReceiver(IConsumer):
+    """
+    Consumer of a data stream generated by :meth:`IFilesystem.send_to`,
+    which updates a filesystem with it.
+
+    A producer registered with the receiver is paused while the receiver
+    can't keep up with the data written to it.
+    """
+
+    def finish():
+        """
+        Indicate that the whole data stream has been written.
+
+        :return: ``Deferred`` that fires once the filesystem has been
+            updated, or errbacks if the data could not be stored.
+        """
+
+    def abort():
+        """
+        Indicate that the data stream is incomplete, leaving the filesystem
+        unchanged.
+
+        The data written so far is kept, so that a later transfer can
+        continue from :meth:`IFilesystem.resume_token` instead of starting
+        again.
+
+        :return: ``Deferred`` that fires once the receiver has stopped.
+        """
+
+
 class IFilesystem(Interface):
     """
     A filesystem that is part of a pool.
@@ -74,7 +113,8 @@ class IFilesystem(Interface):
         """
         Context manager that allows reading the contents of the filesystem.
 
-        A blocking API, for now.
+        A blocking API, suitable for command-line tools. Long-running
+        processes should use :meth:`send_to` instead.
 
         The returned file-like object will be closed by this object.
 
@@ -88,10 +128,11 @@ class IFilesystem(Interface):
             read as ``bytes``.
         """
 
-    def writer():
+    def writer(resume=False):
         """Context manager that allows writing new contents to the filesystem.
 
-        This receiver is a blocking API, for now.
+        This receiver is a blocking API, suitable for command-line tools.
+        Long-running processes should use :meth:`receiver` instead.
 
         The returned file-like object will be closed by this object.
 
@@ -101,11 +142,64 @@ class IFilesystem(Interface):
 
         :param Volume volume: A volume that is being pushed to us.
 
+        :param bool resume: If ``True`` the data written continues an
+            interrupted transfer, as sent by :meth:`send_to` given
+            :meth:`resume_token`. Otherwise the data kept from any
+            interrupted transfer is discarded.
+
         :return: A file-like object which when written to with output of
             :meth:`IFilesystem.reader` will populate the volume's
             filesystem.
         """
 
+    def send_to(consumer, remote_snapshots=None, resume_token=None):
+        """
+        Write the contents of the filesystem to a consumer without blocking.
+
+        An ``IPushProducer`` is registered with the consumer for the
+        duration of the transfer, so the consumer can pause it if it can't
+        keep up.
+
+        :param IConsumer consumer: The consumer to write the data to.
+
+        :param remote_snapshots: As for :meth:`reader`. When resuming a
+            transfer these should be the same as for the interrupted one.
+
+        :param resume_token: ``bytes`` from :meth:`resume_token` on the
+            receiving filesystem, to send only what an interrupted transfer
+            didn't, or ``None`` to send everything.
+
+        :return: ``Deferred`` that fires once all of the data has been
+            written and the producer unregistered, or errbacks if the data
+            could not be generated. If the transfer can't be resumed from
+            ``resume_token`` it errbacks with ``ResumeFailed`` without
+            writing anything.
+        """
+
+    def receiver(resume=False):
+        """
+        Prepare to receive new contents for the filesystem without blocking.
+
+        As with :meth:`writer`, the new contents overwrite the filesystem's
+        existing data.
+
+        :param bool resume: As for :meth:`writer`.
+
+        :return: ``Deferred`` that fires with an ``IFilesystemReceiver``
+            to which output of :meth:`send_to` can be written.
+        """
+
+    def resume_token():
+        """
+        Find out how much of an interrupted transfer to this filesystem was
+        received.
+
+        :return: ``Deferred`` that fires with ``bytes`` identifying the data
+            received so far, to pass to :meth:`send_to` on the sending
+            filesystem, or ``None`` if there is no interrupted transfer to
+            continue.
+        """
+
     def __eq__(other):
         """True if and only if underlying OS filesystem is the same."""
 
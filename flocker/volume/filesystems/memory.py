@@ -6,6 +6,7 @@ from __future__ import absolute_import
 
 from errno import ENOENT
 from contextlib import contextmanager
+from hashlib import sha256
 from tarfile import TarFile
 from io import BytesIO
 
@@ -13,12 +14,13 @@ from zope.interface import implementer
 
 from characteristic import with_init, with_cmp, with_repr
 
-from twisted.internet.defer import succeed, fail
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.interfaces import IPushProducer
 from twisted.application.service import Service
 
 from .interfaces import (
-    IFilesystemSnapshots, IStoragePool, IFilesystem,
-    FilesystemAlreadyExists)
+    IFilesystemSnapshots, IStoragePool, IFilesystem, IFilesystemReceiver,
+    FilesystemAlreadyExists, ResumeFailed)
 from .zfs import Snapshot
 
 from .._model import VolumeSize
@@ -44,6 +46,105 @@ class CannedFilesystemSnapshots(object):
         return succeed(self._snapshots)
 
 
+class ProducerStopped(Exception):
+    """
+    The consumer stopped a producer before all of its data was written.
+    """
+
+
+@implementer(IPushProducer)
+class _BytesProducer(object):
+    """
+    Write some bytes to a consumer in chunks, stopping whenever the consumer
+    pauses the producer.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, consumer, data):
+        """
+        :param IConsumer consumer: The consumer to write to.
+        :param bytes data: The data to write.
+        """
+        self._consumer = consumer
+        self._data = data
+        self._offset = 0
+        self._paused = False
+        self._done = Deferred()
+
+    def start(self):
+        """
+        Register with the consumer and start writing.
+
+        :return: ``Deferred`` that fires once all the data has been written
+            and the producer unregistered, or errbacks with
+            ``ProducerStopped`` if the consumer stopped the producer.
+        """
+        self._consumer.registerProducer(self, True)
+        self.resumeProducing()
+        return self._done
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        while not self._paused and self._offset < len(self._data):
+            chunk = self._data[self._offset:self._offset + self.CHUNK_SIZE]
+            self._offset += len(chunk)
+            self._consumer.write(chunk)
+        if self._offset == len(self._data) and not self._done.called:
+            self._consumer.unregisterProducer()
+            self._done.callback(None)
+
+    def stopProducing(self):
+        self._paused = True
+        if not self._done.called:
+            self._done.errback(ProducerStopped())
+
+
+def _resume_token(data):
+    """
+    :param bytes data: The data received so far by a transfer.
+
+    :return bytes: A token identifying the data by its length and digest.
+    """
+    return b"%d:%s" % (len(data), sha256(data).hexdigest())
+
+
+@implementer(IFilesystemReceiver)
+class _DirectoryReceiver(object):
+    """
+    Accumulate a tarball in a ``DirectoryFilesystem``'s partial file and
+    extract it into the filesystem once it is complete.
+    """
+    def __init__(self, filesystem, resume):
+        """
+        :param DirectoryFilesystem filesystem: The filesystem to update.
+        :param bool resume: Whether to append to the partial file rather
+            than replace it.
+        """
+        self._filesystem = filesystem
+        self._file = filesystem._partial().open("ab" if resume else "wb")
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self._file.write(data)
+
+    def finish(self):
+        self._file.close()
+        self._filesystem._extract_partial()
+        return succeed(None)
+
+    def abort(self):
+        self._file.close()
+        return succeed(None)
+
+
 @implementer(IFilesystem)
 @with_cmp(["path"])
 @with_repr(["path", "size"])
@@ -64,6 +165,35 @@ class DirectoryFilesystem(object):
     def get_path(self):
         return self.path
 
+    def _partial(self):
+        """
+        :return FilePath: The file where the data sent to the filesystem is
+            kept until it has all been received, with an extension so it
+            isn't part of the filesystem's contents. What it contains is a
+            byte-offset checkpoint of an interrupted transfer.
+        """
+        return self.path.siblingExtension(b".partial")
+
+    def _extract_partial(self):
+        """
+        Replace the contents of the filesystem with the tarball in the
+        partial file. The partial file is removed, unless the tarball can't
+        be extracted because it is incomplete.
+        """
+        partial = self._partial()
+        try:
+            tarball = TarFile(fileobj=BytesIO(partial.getContent()), mode="r")
+            if self.path.exists():
+                self.path.remove()
+            self.path.createDirectory()
+            tarball.extractall(self.path.path)
+        except:
+            # This should really be dealt with, e.g. logged:
+            # https://clusterhq.atlassian.net/browse/FLOC-122
+            pass
+        else:
+            partial.remove()
+
     def _snapshots(self):
         """
         Load the pretend snapshot data.
@@ -126,21 +256,47 @@ class DirectoryFilesystem(object):
         yield result
 
     @contextmanager
-    def writer(self):
+    def writer(self, resume=False):
         """Expect written bytes to be a tarball."""
-        result = BytesIO()
-        yield result
-        result.seek(0, 0)
-        try:
-            tarball = TarFile(fileobj=result, mode="r")
-            if self.path.exists():
-                self.path.remove()
-            self.path.createDirectory()
-            tarball.extractall(self.path.path)
-        except:
-            # This should really be dealt with, e.g. logged:
-            # https://clusterhq.atlassian.net/browse/FLOC-122
-            pass
+        with self._partial().open("ab" if resume else "wb") as result:
+            yield result
+        self._extract_partial()
+
+    def send_to(self, consumer, remote_snapshots=None, resume_token=None):
+        """
+        Package up filesystem contents as a tarball and write it to the
+        consumer.
+
+        When resuming, only the part of the tarball after the offset in the
+        token is written, provided the part before it is what the receiver
+        has.
+        """
+        with self.reader(remote_snapshots) as reader:
+            data = reader.read()
+        if resume_token is not None:
+            try:
+                offset = int(resume_token.split(b":", 1)[0])
+            except ValueError:
+                return fail(ResumeFailed())
+            if _resume_token(data[:offset]) != resume_token:
+                return fail(ResumeFailed())
+            data = data[offset:]
+        return _BytesProducer(consumer, data).start()
+
+    def receiver(self, resume=False):
+        """
+        Expect written bytes to be a tarball.
+        """
+        return succeed(_DirectoryReceiver(self, resume))
+
+    def resume_token(self):
+        """
+        Identify the data in the partial file, if there is any.
+        """
+        partial = self._partial()
+        if not partial.exists() or partial.getsize() == 0:
+            return succeed(None)
+        return succeed(_resume_token(partial.getContent()))
 
 
 @implementer(IStoragePool)
@@ -215,6 +371,9 @@ class FilesystemStoragePool(Service):
         filesystems = set()
         if self._root.isdir():
             for path in self._root.children():
+                if not path.isdir():
+                    # The partial file of an interrupted transfer:
+                    continue
                 if path.child(b".size").exists():
                     maximum_size = int(
                         path.child(b".size").getContent().decode("ascii"))
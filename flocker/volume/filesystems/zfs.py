@@ -22,15 +22,18 @@ from eliot import Field, MessageType, Logger
 from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
 from twisted.internet.endpoints import ProcessEndpoint, connectProtocol
-from twisted.internet.protocol import Protocol
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol, ProcessProtocol
 from twisted.internet.defer import Deferred, succeed
-from twisted.internet.error import ConnectionDone, ProcessTerminated
+from twisted.internet.error import (
+    ConnectionDone, ProcessDone, ProcessExitedAlready, ProcessTerminated,
+)
 from twisted.application.service import Service
 
 from .errors import MaximumSizeTooSmall
 from .interfaces import (
-    IFilesystemSnapshots, IStoragePool, IFilesystem,
-    FilesystemAlreadyExists)
+    IFilesystemSnapshots, IStoragePool, IFilesystem, IFilesystemReceiver,
+    FilesystemAlreadyExists, ResumeFailed)
 
 from .._model import VolumeSize
 
@@ -95,6 +98,122 @@ def zfs_command(reactor, arguments):
     return d
 
 
+@implementer(IPushProducer)
+class _SendProtocol(ProcessProtocol):
+    """
+    Write the output of ``zfs send`` to a consumer, pausing the process's
+    output while the consumer can't keep up.
+
+    :ivar Deferred done: Fires once the process has exited and the producer
+        has been unregistered, or errbacks with ``CommandFailed`` if the
+        process failed.
+    """
+    def __init__(self, consumer):
+        """
+        :param IConsumer consumer: The consumer to write the stream to.
+        """
+        self._consumer = consumer
+        self.done = Deferred()
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+        self._consumer.registerProducer(self, True)
+
+    def outReceived(self, data):
+        self._consumer.write(data)
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        try:
+            self.transport.signalProcess("TERM")
+        except ProcessExitedAlready:
+            pass
+
+    def processEnded(self, reason):
+        self._consumer.unregisterProducer()
+        if reason.check(ProcessDone):
+            self.done.callback(None)
+        else:
+            self.done.errback(CommandFailed())
+
+
+@implementer(IFilesystemReceiver)
+class _ReceiveProtocol(ProcessProtocol):
+    """
+    Write a data stream to ``zfs receive``. The process's standard input
+    pauses the registered producer while ``zfs`` can't keep up.
+
+    Once ``zfs`` has closed its standard input (for example because it
+    rejected the stream) anything else written is discarded.
+
+    Aborting kills ``zfs receive``, which keeps what it has received since
+    it is run with ``-s``.
+    """
+    def __init__(self, reactor, filesystem):
+        """
+        :param reactor: A ``IReactorProcess`` provider.
+        :param Filesystem filesystem: The filesystem being received.
+        """
+        self._reactor = reactor
+        self._filesystem = filesystem
+        self._ended = Deferred()
+        self._stdin_open = True
+
+    def inConnectionLost(self):
+        self._stdin_open = False
+
+    def write(self, data):
+        if self._stdin_open:
+            self.transport.write(data)
+
+    def registerProducer(self, producer, streaming):
+        if self._stdin_open:
+            self.transport.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        if self._stdin_open:
+            self.transport.unregisterProducer()
+
+    def _close_stdin(self):
+        """
+        Tell ``zfs`` the stream is over, unless it already stopped reading.
+        """
+        if self._stdin_open:
+            self._stdin_open = False
+            self.transport.closeStdin()
+
+    def processEnded(self, reason):
+        if reason.check(ProcessDone):
+            self._ended.callback(None)
+        else:
+            self._ended.errback(CommandFailed())
+
+    def finish(self):
+        self._close_stdin()
+        d = self._ended
+        d.addCallback(lambda _: zfs_command(
+            self._reactor,
+            [b"set", b"mountpoint=" + self._filesystem.get_path().path,
+             self._filesystem.name]))
+        d.addCallback(lambda _: None)
+        return d
+
+    def abort(self):
+        try:
+            self.transport.signalProcess("TERM")
+        except ProcessExitedAlready:
+            pass
+        self._close_stdin()
+        d = self._ended
+        d.addErrback(lambda _: None)
+        return d
+
+
 _ZFS_COMMAND = Field.forTypes(
     "zfs_command", [bytes], u"The command which was run.")
 _OUTPUT = Field.forTypes(
@@ -135,6 +254,20 @@ def _sync_command_error_squashed(arguments, logger):
         message.write(logger)
 
 
+def _parse_resume_token(output):
+    """
+    Parse the output of ``zfs get -H -o value receive_resume_token``.
+
+    :param bytes output: The output of the command.
+
+    :return: The token as ``bytes``, or ``None`` if there isn't one.
+    """
+    token = output.strip()
+    if token in (b"", b"-"):
+        return None
+    return token
+
+
 @attributes(["name"])
 class Snapshot(object):
     """
@@ -203,6 +336,22 @@ class Filesystem(object):
         """
         Determine whether this filesystem exists locally.
 
+        :return: ``Deferred`` that fires with ``True`` if there is a
+            filesystem with this name, ``False`` otherwise.
+        """
+        d = zfs_command(self._reactor, [b"list", self.name])
+
+        def not_found(reason):
+            reason.trap(CommandFailed)
+            return False
+        d.addCallbacks(lambda _: True, not_found)
+        return d
+
+    def _exists_blocking(self):
+        """
+        Determine whether this filesystem exists locally, blocking until
+        ``zfs`` answers. Only for use by the blocking :meth:`writer`.
+
         :return: ``True`` if there is a filesystem with this name, ``False``
             otherwise.
         """
@@ -213,14 +362,19 @@ class Filesystem(object):
         return True
 
     def snapshots(self):
-        if self._exists():
+        d = self._exists()
+
+        def got_exists(exists):
+            if not exists:
+                return []
             zfs_snapshots = ZFSSnapshots(self._reactor, self)
-            d = zfs_snapshots.list()
-            d.addCallback(lambda snapshots:
-                          [Snapshot(name=name)
-                           for name in snapshots])
-            return d
-        return succeed([])
+            listing = zfs_snapshots.list()
+            listing.addCallback(lambda snapshots:
+                                [Snapshot(name=name)
+                                 for name in snapshots])
+            return listing
+        d.addCallback(got_exists)
+        return d
 
     @property
     def name(self):
@@ -251,30 +405,10 @@ class Filesystem(object):
         snapshot = b"%s@%s" % (self.name, uuid4())
         check_call([b"zfs", b"snapshot", snapshot])
 
-        # Determine whether there is a shared snapshot which can be used as the
-        # basis for an incremental send.
-        local_snapshots = list(
-            Snapshot(name=name) for name in
-            _parse_snapshots(
-                check_output([b"zfs"] + _list_snapshots_command(self)),
-                self
-            ))
-
-        if remote_snapshots is None:
-            remote_snapshots = []
-
-        latest_common_snapshot = _latest_common_snapshot(
-            remote_snapshots, local_snapshots)
-
-        if latest_common_snapshot is None:
-            identifier = [snapshot]
-        else:
-            identifier = [
-                b"-i",
-                u"{}@{}".format(
-                    self.name, latest_common_snapshot.name).encode("ascii"),
-                snapshot,
-            ]
+        local_snapshots = _parse_snapshots(
+            check_output([b"zfs"] + _list_snapshots_command(self)), self)
+        identifier = self._send_identifier(
+            snapshot, local_snapshots, remote_snapshots)
 
         process = Popen([b"zfs", b"send"] + identifier, stdout=PIPE)
         try:
@@ -283,12 +417,110 @@ class Filesystem(object):
             process.stdout.close()
             process.wait()
 
-    @contextmanager
-    def writer(self):
+    def send_to(self, consumer, remote_snapshots=None, resume_token=None):
         """
-        Read in zfs stream.
+        Send zfs stream of contents to a consumer.
+
+        :param IConsumer consumer: The consumer to write the stream to.
+        :param list remote_snapshots: As for :meth:`reader`.
+        :param bytes resume_token: The ``receive_resume_token`` of the
+            receiving filesystem, or ``None``. ``zfs send -t`` sends the
+            rest of the interrupted stream it describes.
+        """
+        if resume_token is not None:
+            return self._send_resumed(consumer, resume_token)
+        snapshot = b"%s@%s" % (self.name, uuid4())
+        d = zfs_command(self._reactor, [b"snapshot", snapshot])
+        d.addCallback(lambda _: _list_snapshots(self._reactor, self))
+
+        def got_snapshots(local_snapshots):
+            identifier = self._send_identifier(
+                snapshot, local_snapshots, remote_snapshots)
+            return self._send(consumer, identifier)
+        d.addCallback(got_snapshots)
+        return d
+
+    def _send_resumed(self, consumer, resume_token):
+        """
+        Send the rest of an interrupted stream, after a dry run checks that
+        the snapshots it was generated from still exist.
+
+        :param IConsumer consumer: The consumer to write the stream to.
+        :param bytes resume_token: The ``receive_resume_token`` of the
+            receiving filesystem.
+        """
+        d = zfs_command(self._reactor, [b"send", b"-n", b"-t", resume_token])
+
+        def cannot_resume(reason):
+            reason.trap(CommandFailed, BadArguments)
+            raise ResumeFailed()
+        d.addCallbacks(
+            lambda _: self._send(consumer, [b"-t", resume_token]),
+            cannot_resume)
+        return d
+
+    def _send(self, consumer, identifier):
+        """
+        Run ``zfs send``, writing its output to a consumer.
+
+        :param IConsumer consumer: The consumer to write the stream to.
+        :param list identifier: ``bytes`` arguments to ``zfs send``
+            identifying what to send.
+
+        :return: ``_SendProtocol.done``.
+        """
+        protocol = _SendProtocol(consumer)
+        self._reactor.spawnProcess(
+            protocol, b"zfs", [b"zfs", b"send"] + identifier, os.environ)
+        return protocol.done
+
+    def _send_identifier(self, snapshot, local_snapshots, remote_snapshots):
+        """
+        Determine whether there is a shared snapshot which can be used as the
+        basis for an incremental send.
+
+        :param bytes snapshot: The full name of the snapshot to send.
+        :param list local_snapshots: The names of the local snapshots, as
+            ``bytes``, ordered from oldest to newest.
+        :param list remote_snapshots: ``Snapshot`` instances, ordered from
+            oldest to newest, which are available on the writer, or
+            ``None``.
+
+        :return: ``list`` of ``bytes``, the arguments to ``zfs send``
+            identifying what to send.
+        """
+        if remote_snapshots is None:
+            remote_snapshots = []
+
+        latest_common_snapshot = _latest_common_snapshot(
+            remote_snapshots,
+            [Snapshot(name=name) for name in local_snapshots])
+
+        if latest_common_snapshot is None:
+            return [snapshot]
+        return [
+            b"-i",
+            u"{}@{}".format(
+                self.name, latest_common_snapshot.name).encode("ascii"),
+            snapshot,
+        ]
+
+    def _receive_command(self, exists, resume=False):
         """
-        if self._exists():
+        :param bool exists: Whether the filesystem already exists.
+        :param bool resume: Whether the stream continues an interrupted
+            one.
+
+        :return: ``list`` of ``bytes``, the ``zfs receive`` command line.
+            ``-s`` means that if the stream is interrupted ``zfs`` keeps
+            what was received and sets the filesystem's
+            ``receive_resume_token`` so the rest can be sent later.
+        """
+        if resume:
+            # The stream continues the partially received state, whether
+            # that was for a complete or an incremental stream.
+            return [b"zfs", b"receive", b"-s", self.name]
+        elif exists:
             # If the filesystem already exists then this should be an
             # incremental data stream to up date it to a more recent snapshot.
             # If that's not the case then we're about to screw up - but that's
@@ -308,11 +540,68 @@ class Filesystem(object):
             # it in order to receive the stream.  To do that you have to
             # force.
             #
-            cmd = [b"zfs", b"receive", b"-F", self.name]
+            return [b"zfs", b"receive", b"-F", b"-s", self.name]
         else:
             # If the filesystem doesn't already exist then this is a complete
             # data stream.
-            cmd = [b"zfs", b"receive", self.name]
+            return [b"zfs", b"receive", b"-s", self.name]
+
+    def resume_token(self):
+        """
+        Get the filesystem's ``receive_resume_token``.
+        """
+        d = zfs_command(
+            self._reactor, [b"get", b"-H", b"-o", b"value",
+                            b"receive_resume_token", self.name])
+
+        def not_found(reason):
+            reason.trap(CommandFailed)
+            return None
+        d.addCallbacks(_parse_resume_token, not_found)
+        return d
+
+    def _resume_token_blocking(self):
+        """
+        Get the filesystem's ``receive_resume_token``, blocking until
+        ``zfs`` answers. Only for use by the blocking :meth:`writer`.
+
+        :return: The token as ``bytes``, or ``None`` if there isn't one.
+        """
+        try:
+            output = check_output(
+                [b"zfs", b"get", b"-H", b"-o", b"value",
+                 b"receive_resume_token", self.name], stderr=STDOUT)
+        except CalledProcessError:
+            return None
+        return _parse_resume_token(output)
+
+    def _discard_partial(self):
+        """
+        Discard the partially received state of an interrupted stream, if
+        there is any; ``zfs`` refuses new streams while it is kept.
+
+        :return: ``Deferred`` that fires once it is gone.
+        """
+        d = self.resume_token()
+
+        def got_token(token):
+            if token is not None:
+                return zfs_command(
+                    self._reactor, [b"receive", b"-A", self.name])
+        d.addCallback(got_token)
+        return d
+
+    @contextmanager
+    def writer(self, resume=False):
+        """
+        Read in zfs stream.
+        """
+        if resume:
+            cmd = self._receive_command(True, resume=True)
+        else:
+            if self._resume_token_blocking() is not None:
+                check_call([b"zfs", b"receive", b"-A", self.name])
+            cmd = self._receive_command(self._exists_blocking())
         process = Popen(cmd, stdin=PIPE)
         succeeded = False
         try:
@@ -325,6 +614,25 @@ class Filesystem(object):
                         b"mountpoint=" + self._mountpoint.path,
                         self.name])
 
+    def receiver(self, resume=False):
+        """
+        Start ``zfs receive`` to read in a zfs stream.
+        """
+        if resume:
+            d = succeed(self._receive_command(True, resume=True))
+        else:
+            d = self._discard_partial()
+            d.addCallback(lambda _: self._exists())
+            d.addCallback(self._receive_command)
+
+        def got_command(command):
+            protocol = _ReceiveProtocol(self._reactor, self)
+            self._reactor.spawnProcess(
+                protocol, b"zfs", command, os.environ)
+            return protocol
+        d.addCallback(got_command)
+        return d
+
 
 @implementer(IFilesystemSnapshots)
 class ZFSSnapshots(object):
@@ -102,3 +102,24 @@ class FlockerVolumeSnapshotsTests(TestCase):
             b"--pool", pool_name,
             b"snapshots", b"myuuid", b"myns.myfilesystem")
         self.assertEqual(snapshots, b"somesnapshot\nlastsnapshot\n")
+
+
+class FlockerVolumeResumeTokenTests(TestCase):
+    """
+    Tests for ``flocker-volume resume_token``.
+    """
+    @_require_installed
+    def test_no_resume_token(self):
+        """
+        ``flocker-volume resume_token`` outputs nothing if no push of the
+        identified filesystem was interrupted.
+        """
+        pool_name = create_zfs_pool(self)
+        dataset = pool_name + b"/myuuid.myns.myfilesystem"
+        check_output([b"zfs", b"create", b"-p", dataset])
+        config_path = FilePath(self.mktemp())
+        output = run(
+            b"--config", config_path.path,
+            b"--pool", pool_name,
+            b"resume_token", b"myuuid", b"myns.myfilesystem")
+        self.assertEqual(output, b"")
@@ -93,6 +93,45 @@ class _SnapshotsSubcommandOptions(Options):
         return snapshots
 
 
+class _ResumeTokenSubcommandOptions(Options):
+    """
+    Command line options for ``flocker-volume resume_token``.
+    """
+
+    longdesc = """Identify the data received by an interrupted push of a
+    volume, so the rest of it can be sent with ``receive --resume``.
+
+    Outputs nothing if no push was interrupted.
+
+    Parameters:
+
+    * owner-node-id: The node ID of the volume manager that owns the volume.
+
+    * name: The name of the volume.
+    """
+
+    synopsis = "<owner-node-id> <name>"
+
+    def parseArgs(self, node_id, name):
+        self["node_id"] = node_id.decode("ascii")
+        self["name"] = name
+
+    def run(self, service):
+        """
+        Run the action for this sub-command.
+
+        :param VolumeService service: The volume manager service to utilize.
+        """
+        d = service.resume_token(self["node_id"],
+                                 VolumeName.from_bytes(self["name"]))
+
+        def got_token(token):
+            if token is not None:
+                sys.stdout.write(token + b"\n")
+        d.addCallback(got_token)
+        return d
+
+
 class _ReceiveSubcommandOptions(Options):
     """Command line options for ``flocker-volume receive``."""
 
@@ -110,6 +149,11 @@ class _ReceiveSubcommandOptions(Options):
 
     synopsis = "<owner-node-id> <name>"
 
+    optFlags = [
+        ["resume", None,
+         "The data continues a push that was interrupted."],
+    ]
+
     def parseArgs(self, node_id, name):
         self["node_id"] = node_id.decode("ascii")
         self["name"] = name
@@ -120,7 +164,7 @@ class _ReceiveSubcommandOptions(Options):
         :param VolumeService service: The volume manager service to utilize.
         """
         service.receive(self["node_id"], VolumeName.from_bytes(self["name"]),
-                        sys.stdin)
+                        sys.stdin, bool(self["resume"]))
 
 
 class _AcquireSubcommandOptions(Options):
@@ -217,6 +261,8 @@ class VolumeOptions(Options):
          "List snapshots for a volume."],
         ["receive", None, _ReceiveSubcommandOptions,
          "Receive a remotely pushed volume."],
+        ["resume_token", None, _ResumeTokenSubcommandOptions,
+         "Identify what an interrupted push has received."],
         ["acquire", None, _AcquireSubcommandOptions,
          "Acquire a remotely owned volume."],
         ["clone_to", None, _CloneToSubcommandOptions,
@@ -26,6 +26,7 @@ from twisted.internet.defer import fail
 # module... but in this case the usage is temporary and should go away as
 # part of https://clusterhq.atlassian.net/browse/FLOC-64
 from .filesystems.zfs import StoragePool
+from .filesystems.interfaces import ResumeFailed
 from ._model import VolumeSize
 from ..common.script import ICommandLineScript
 
@@ -284,7 +285,12 @@ class VolumeService(Service):
         """
         Push the latest data in the volume to a remote destination.
 
-        This is a blocking API for now.
+        Whether this blocks depends on the destination's
+        ``receive_stream``.
+
+        If an earlier push of the volume to the destination was interrupted,
+        only the rest of it is sent. If that isn't possible, for example
+        because the volume changed in the meantime, everything is sent.
 
         Only locally owned volumes (i.e. volumes whose ``uuid`` matches
         this service's) can be pushed.
@@ -303,15 +309,46 @@ class VolumeService(Service):
         getting_snapshots = destination.snapshots(volume)
 
         def got_snapshots(snapshots):
-            with destination.receive(volume) as receiver:
-                with fs.reader(snapshots) as contents:
-                    for chunk in iter(lambda: contents.read(1024 * 1024), b""):
-                        receiver.write(chunk)
+            getting_token = destination.resume_token(volume)
+            getting_token.addCallback(got_token, snapshots)
+            return getting_token
+
+        def got_token(token, snapshots):
+            if token is None:
+                return send(snapshots)
+            resuming = destination.receive_stream(
+                volume,
+                lambda consumer: fs.send_to(consumer, snapshots, token),
+                resume=True)
+
+            def cannot_resume(reason):
+                reason.trap(ResumeFailed)
+                return send(snapshots)
+            resuming.addErrback(cannot_resume)
+            return resuming
+
+        def send(snapshots):
+            return destination.receive_stream(
+                volume, lambda consumer: fs.send_to(consumer, snapshots))
 
         pushing = getting_snapshots.addCallback(got_snapshots)
         return pushing
 
-    def receive(self, volume_node_id, volume_name, input_file):
+    def resume_token(self, volume_node_id, volume_name):
+        """
+        Find out how much of an interrupted transfer of a volume was
+        received.
+
+        :param unicode volume_node_id: The volume's owner's node ID.
+        :param VolumeName volume_name: The volume's name.
+
+        :return: ``Deferred`` that fires with the token from the volume's
+            ``IFilesystem.resume_token``, or ``None``.
+        """
+        volume = Volume(node_id=volume_node_id, name=volume_name, service=self)
+        return volume.get_filesystem().resume_token()
+
+    def receive(self, volume_node_id, volume_name, input_file, resume=False):
         """
         Process a volume's data that can be read from a file-like object.
 
@@ -324,6 +361,8 @@ class VolumeService(Service):
         :param VolumeName volume_name: The volume's name.
         :param input_file: A file-like object, typically ``sys.stdin``, from
             which to read the data.
+        :param bool resume: Whether the data continues an interrupted
+            transfer, as for ``IFilesystem.writer``.
 
         :raises ValueError: If the uuid of the volume matches our own;
             remote nodes can't overwrite locally-owned volumes.
@@ -331,7 +370,7 @@ class VolumeService(Service):
         if volume_node_id == self.node_id:
             raise ValueError()
         volume = Volume(node_id=volume_node_id, name=volume_name, service=self)
-        with volume.get_filesystem().writer() as writer:
+        with volume.get_filesystem().writer(resume) as writer:
             for chunk in iter(lambda: input_file.read(1024 * 1024), b""):
                 writer.write(chunk)
 
@@ -375,8 +414,9 @@ class VolumeService(Service):
         pushing = maybeDeferred(self.push, volume, destination)
 
         def pushed(ignored):
-            remote_uuid = destination.acquire(volume)
-            return volume.change_owner(remote_uuid)
+            acquiring = maybeDeferred(destination.acquire, volume)
+            acquiring.addCallback(volume.change_owner)
+            return acquiring
         changing_owner = pushing.addCallback(pushed)
         return changing_owner
 
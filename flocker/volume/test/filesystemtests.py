@@ -10,10 +10,12 @@ instance as its first argument and returns some object to be used in a test.
 from __future__ import absolute_import
 
 from characteristic import attributes
+from zope.interface import implementer
 from zope.interface.verify import verifyObject
 
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import gatherResults
+from twisted.internet.interfaces import IConsumer
 from twisted.application.service import IService
 
 from ...testtools import (
@@ -83,6 +85,83 @@ def copy(from_volume, to_volume):
     return getting_snapshots
 
 
+def stream(from_volume, to_volume):
+    """Copy contents of one volume to another using the non-blocking APIs.
+
+    :param Volume from_volume: Volume to read from.
+    :param Volume to_volume: Volume to write to.
+
+    :return: ``Deferred`` that fires once the copy has been stored.
+    """
+    from_filesystem = from_volume.get_filesystem()
+    to_filesystem = to_volume.get_filesystem()
+    getting_snapshots = to_filesystem.snapshots()
+
+    def got_snapshots(snapshots):
+        receiving = to_filesystem.receiver()
+
+        def got_receiver(receiver):
+            sending = from_filesystem.send_to(receiver, snapshots)
+            sending.addCallback(lambda _: receiver.finish())
+            return sending
+        receiving.addCallback(got_receiver)
+        return receiving
+    getting_snapshots.addCallback(got_snapshots)
+    return getting_snapshots
+
+
+def interrupt(from_volume, to_volume):
+    """
+    Start copying one volume to another using the non-blocking APIs, but
+    abort the receiver after it has been given half of the data.
+
+    :param Volume from_volume: Volume to read from.
+    :param Volume to_volume: Volume to write to.
+
+    :return: ``Deferred`` that fires once the receiver has been aborted.
+    """
+    from_filesystem = from_volume.get_filesystem()
+    to_filesystem = to_volume.get_filesystem()
+    consumer = RecordingConsumer()
+    getting_snapshots = to_filesystem.snapshots()
+
+    def got_snapshots(snapshots):
+        sending = from_filesystem.send_to(consumer, snapshots)
+        sending.addCallback(lambda _: to_filesystem.receiver())
+        return sending
+
+    def got_receiver(receiver):
+        data = b"".join(consumer.data)
+        receiver.write(data[:len(data) // 2])
+        return receiver.abort()
+    getting_snapshots.addCallback(got_snapshots)
+    getting_snapshots.addCallback(got_receiver)
+    return getting_snapshots
+
+
+@implementer(IConsumer)
+class RecordingConsumer(object):
+    """
+    Record what a producer does with a consumer.
+
+    :ivar list producers: ``(producer, streaming)`` for each producer
+        registered, followed by ``None`` each time it is unregistered.
+    :ivar list data: The chunks of data written.
+    """
+    def __init__(self):
+        self.producers = []
+        self.data = []
+
+    def registerProducer(self, producer, streaming):
+        self.producers.append((producer, streaming))
+
+    def unregisterProducer(self):
+        self.producers.append(None)
+
+    def write(self, data):
+        self.data.append(data)
+
+
 @attributes(["from_volume", "to_volume"])
 class CopyVolumes(object):
     """A pair of volumes that had data copied from one to the other.
@@ -526,6 +605,147 @@ def make_istoragepool_tests(fixture):
             d.addCallback(got_volumes)
             return d
 
+        def test_stream_new_filesystem(self):
+            """
+            Writing the output of ``send_to`` for one pool's filesystem to a
+            receiver for another pool's filesystem updates that filesystem
+            with the given contents.
+            """
+            d = create_and_copy(self, fixture)
+
+            def got_volumes(copied):
+                volume, volume2 = copied.from_volume, copied.to_volume
+                path = volume.get_filesystem().get_path()
+                path.child(b"anotherfile").setContent(b"hello")
+                copying = stream(volume, volume2)
+
+                def copied(ignored):
+                    assertVolumesEqual(self, volume, volume2)
+                copying.addCallback(copied)
+                return copying
+            d.addCallback(got_volumes)
+            return d
+
+        def test_send_to_streaming_producer(self):
+            """
+            ``send_to`` writes the data through a streaming producer which it
+            registers with the consumer, and unregisters before the
+            ``Deferred`` it returns fires.
+            """
+            pool = fixture(self)
+            service = service_for_pool(self, pool)
+            volume = service.get(MY_VOLUME)
+            d = pool.create(volume)
+            consumer = RecordingConsumer()
+
+            def created_filesystem(filesystem):
+                return filesystem.send_to(consumer)
+            d.addCallback(created_filesystem)
+
+            def sent(ignored):
+                self.assertEqual(
+                    ([True, None], True),
+                    ([consumer.producers[0][1], consumer.producers[-1]],
+                     len(b"".join(consumer.data)) > 0))
+            d.addCallback(sent)
+            return d
+
+        def test_receiver_abort(self):
+            """
+            If a receiver is aborted, no changes are made to the filesystem.
+            """
+            d = create_and_copy(self, fixture)
+
+            def got_volumes(copied):
+                volume, volume2 = copied.from_volume, copied.to_volume
+                path = volume.get_filesystem().get_path()
+                path.child(b"anotherfile").setContent(b"hello")
+                receiving = volume2.get_filesystem().receiver()
+
+                def got_receiver(receiver):
+                    sending = volume.get_filesystem().send_to(receiver)
+                    sending.addCallback(lambda _: receiver.abort())
+                    return sending
+                receiving.addCallback(got_receiver)
+
+                def aborted(ignored):
+                    to_path = volume2.get_filesystem().get_path()
+                    self.assertFalse(to_path.child(b"anotherfile").exists())
+                receiving.addCallback(aborted)
+                return receiving
+            d.addCallback(got_volumes)
+            return d
+
+        def test_no_resume_token(self):
+            """
+            ``resume_token`` fires with ``None`` if no transfer to the
+            filesystem was interrupted.
+            """
+            d = create_and_copy(self, fixture)
+            d.addCallback(
+                lambda copied: copied.to_volume.get_filesystem(
+                    ).resume_token())
+            d.addCallback(self.assertIs, None)
+            return d
+
+        def test_resume(self):
+            """
+            After a receiver is aborted, giving the receiving filesystem's
+            ``resume_token`` to ``send_to`` sends the rest of the data to a
+            receiver created with ``resume=True``.
+            """
+            d = create_and_copy(self, fixture)
+
+            def got_volumes(copied):
+                volume, volume2 = copied.from_volume, copied.to_volume
+                path = volume.get_filesystem().get_path()
+                path.child(b"anotherfile").setContent(b"hello" * 100000)
+                to_filesystem = volume2.get_filesystem()
+                interrupting = interrupt(volume, volume2)
+                interrupting.addCallback(
+                    lambda _: to_filesystem.resume_token())
+
+                def got_token(token):
+                    receiving = to_filesystem.receiver(resume=True)
+
+                    def got_receiver(receiver):
+                        sending = volume.get_filesystem().send_to(
+                            receiver, resume_token=token)
+                        sending.addCallback(lambda _: receiver.finish())
+                        return sending
+                    receiving.addCallback(got_receiver)
+                    return receiving
+                interrupting.addCallback(got_token)
+                interrupting.addCallback(
+                    lambda _: assertVolumesEqual(self, volume, volume2))
+                return interrupting
+            d.addCallback(got_volumes)
+            return d
+
+        def test_receive_discards_interrupted(self):
+            """
+            A receiver created without ``resume`` discards the data kept from
+            an interrupted transfer and receives a complete stream.
+            """
+            d = create_and_copy(self, fixture)
+
+            def got_volumes(copied):
+                volume, volume2 = copied.from_volume, copied.to_volume
+                path = volume.get_filesystem().get_path()
+                path.child(b"anotherfile").setContent(b"hello" * 100000)
+                copying = interrupt(volume, volume2)
+                copying.addCallback(lambda _: stream(volume, volume2))
+                copying.addCallback(
+                    lambda _: volume2.get_filesystem().resume_token())
+
+                def copied(token):
+                    self.assertIs(None, token)
+                    assertVolumesEqual(self, volume, volume2)
+                copying.addCallback(copied)
+                return copying
+            d.addCallback(got_volumes)
+            return d
+
         def test_exception_passes_through_read(self):
             """
             If an exception is raised in the context of the reader, it is not
@@ -0,0 +1,255 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.volume._codec``.
+"""
+
+from __future__ import absolute_import
+
+from zope.interface.verify import verifyObject
+
+from twisted.internet.interfaces import IConsumer
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._codec import (
+    CODECS, NO_COMPRESSION, ZLIB, Codec, CodecSelector, CompressingConsumer,
+    DecompressingReceiver, negotiate,
+)
+from ..filesystems.interfaces import IFilesystemReceiver
+from .filesystemtests import RecordingConsumer
+
+
+# Compressible data, spanning several chunks written by a producer:
+DATA = b"".join(b"line %d of some compressible data\n" % (i,)
+                for i in range(10000))
+
+
+class _Receiver(RecordingConsumer):
+    """
+    An ``IFilesystemReceiver`` which records what is done to it.
+
+    :ivar list finished: ``"finish"`` or ``"abort"`` for each call to
+        ``finish`` or ``abort``.
+    """
+    def __init__(self):
+        RecordingConsumer.__init__(self)
+        self.finished = []
+
+    def finish(self):
+        self.finished.append("finish")
+
+    def abort(self):
+        self.finished.append("abort")
+
+
+class NegotiateTests(SynchronousTestCase):
+    """
+    Tests for ``negotiate``.
+    """
+    def test_first_supported(self):
+        """
+        ``negotiate`` returns the first offered codec which is supported.
+        """
+        self.assertEqual(
+            ZLIB, negotiate([b"unknown", b"zlib", b"none"]))
+
+    def test_nothing_offered(self):
+        """
+        If the sender doesn't offer any codecs, ``negotiate`` returns
+        ``NO_COMPRESSION``.
+        """
+        self.assertEqual(NO_COMPRESSION, negotiate(None))
+
+    def test_nothing_supported(self):
+        """
+        If none of the offered codecs is supported, ``negotiate`` returns
+        ``NO_COMPRESSION``.
+        """
+        self.assertEqual(
+            NO_COMPRESSION, negotiate([b"zlib"], supported=[NO_COMPRESSION]))
+
+    def test_defaults(self):
+        """
+        ``zlib`` and no compression are always supported, and no compression
+        is the least preferred.
+        """
+        self.assertEqual(
+            (True, NO_COMPRESSION), (ZLIB in CODECS, CODECS[-1]))
+
+
+class CodecSelectorTests(SynchronousTestCase):
+    """
+    Tests for ``CodecSelector``.
+    """
+    def test_default_order(self):
+        """
+        Before any transfers to a peer, ``CodecSelector.offer`` offers the
+        codecs in the default order of preference.
+        """
+        selector = CodecSelector([ZLIB, NO_COMPRESSION])
+        self.assertEqual([b"zlib", b"none"], selector.offer(b"peer"))
+
+    def test_untried_first(self):
+        """
+        ``CodecSelector.offer`` prefers codecs which haven't been used with
+        the peer yet.
+        """
+        selector = CodecSelector([ZLIB, NO_COMPRESSION])
+        selector.record(b"peer", b"zlib", 100, 10.0)
+        self.assertEqual([b"none", b"zlib"], selector.offer(b"peer"))
+
+    def test_fastest(self):
+        """
+        Once every codec has been used with the peer, ``CodecSelector.offer``
+        prefers the one with the best throughput.
+        """
+        selector = CodecSelector([ZLIB, NO_COMPRESSION])
+        selector.record(b"peer", b"zlib", 100, 1.0)
+        selector.record(b"peer", b"none", 100, 2.0)
+        self.assertEqual([b"zlib", b"none"], selector.offer(b"peer"))
+
+    def test_per_peer(self):
+        """
+        Throughput is measured separately for each peer.
+        """
+        selector = CodecSelector([ZLIB, NO_COMPRESSION])
+        selector.record(b"peer", b"zlib", 100, 1.0)
+        self.assertEqual([b"zlib", b"none"], selector.offer(b"other"))
+
+    def test_unsupported(self):
+        """
+        Codecs a peer turned down in favour of a later one are offered last
+        to that peer, so the others are all tried and then compared.
+        """
+        unknown = Codec(name=b"unknown", compressor=None, decompressor=None)
+        selector = CodecSelector([unknown, ZLIB, NO_COMPRESSION])
+        offers = []
+        for rate in [100, 200]:
+            offered = selector.offer(b"peer")
+            offers.append(offered)
+            chosen = negotiate(offered)
+            selector.negotiated(b"peer", offered, chosen.name)
+            selector.record(b"peer", chosen.name, rate, 1.0)
+        offers.append(selector.offer(b"peer"))
+        self.assertEqual(
+            [[b"unknown", b"zlib", b"none"], [b"none", b"zlib", b"unknown"],
+             [b"none", b"zlib", b"unknown"]],
+            offers)
+
+    def test_unsupported_per_peer(self):
+        """
+        Codecs turned down by one peer are still offered first to others.
+        """
+        selector = CodecSelector([ZLIB, NO_COMPRESSION])
+        selector.negotiated(b"peer", [b"zlib", b"none"], b"none")
+        self.assertEqual([b"zlib", b"none"], selector.offer(b"other"))
+
+    def test_smoothing(self):
+        """
+        ``CodecSelector.record`` combines the latest throughput with the
+        earlier ones, weighted by the smoothing factor.
+        """
+        selector = CodecSelector([ZLIB], smoothing=0.25)
+        selector.record(b"peer", b"zlib", 100, 1.0)
+        selector.record(b"peer", b"zlib", 500, 1.0)
+        self.assertEqual({(b"peer", b"zlib"): 200.0}, selector.rates)
+
+
+class CompressionTests(SynchronousTestCase):
+    """
+    Tests for ``CompressingConsumer`` and ``DecompressingReceiver``.
+    """
+    def test_interfaces(self):
+        """
+        ``CompressingConsumer`` provides ``IConsumer`` and
+        ``DecompressingReceiver`` provides ``IFilesystemReceiver``.
+        """
+        self.assertEqual(
+            (True, True),
+            (verifyObject(IConsumer, CompressingConsumer(
+                RecordingConsumer(), ZLIB)),
+             verifyObject(IFilesystemReceiver, DecompressingReceiver(
+                 _Receiver(), ZLIB))))
+
+    def round_trip(self, codec):
+        """
+        Compress ``DATA`` with a codec and decompress it again.
+
+        :param Codec codec: The codec to use.
+
+        :return: ``tuple`` of the ``CompressingConsumer`` and the
+            ``_Receiver`` the decompressed data was written to.
+        """
+        receiver = _Receiver()
+        decompressing = DecompressingReceiver(receiver, codec)
+        compressing = CompressingConsumer(decompressing, codec)
+        for i in range(0, len(DATA), 4096):
+            compressing.write(DATA[i:i + 4096])
+        compressing.flush()
+        decompressing.finish()
+        return compressing, receiver
+
+    def test_round_trip(self):
+        """
+        Every supported codec decompresses what it compressed.
+        """
+        results = []
+        for codec in CODECS:
+            compressing, receiver = self.round_trip(codec)
+            results.append((codec.name, b"".join(receiver.data) == DATA,
+                            receiver.finished))
+        self.assertEqual(
+            [(codec.name, True, ["finish"]) for codec in CODECS], results)
+
+    def test_counts(self):
+        """
+        ``CompressingConsumer`` counts the bytes written to it and the bytes
+        it writes.
+        """
+        consumer = RecordingConsumer()
+        compressing = CompressingConsumer(consumer, ZLIB)
+        compressing.write(DATA)
+        compressing.flush()
+        self.assertEqual(
+            (len(DATA), len(b"".join(consumer.data))),
+            (compressing.raw_bytes, compressing.compressed_bytes))
+
+    def test_compresses(self):
+        """
+        ``ZLIB`` makes compressible data smaller.
+        """
+        compressing, _ = self.round_trip(ZLIB)
+        self.assertTrue(compressing.compressed_bytes < len(DATA) / 10)
+
+    def test_compress_time(self):
+        """
+        ``CompressingConsumer`` adds up the time spent compressing.
+        """
+        times = iter([1.0, 1.5, 2.0, 2.25])
+        compressing = CompressingConsumer(
+            RecordingConsumer(), NO_COMPRESSION, timer=lambda: next(times))
+        compressing.write(b"data")
+        compressing.flush()
+        self.assertEqual(0.75, compressing.compress_seconds)
+
+    def test_producer(self):
+        """
+        Producers registered with ``CompressingConsumer`` and
+        ``DecompressingReceiver`` are registered with what they wrap.
+        """
+        consumer = RecordingConsumer()
+        receiver = _Receiver()
+        producer = object()
+        CompressingConsumer(consumer, ZLIB).registerProducer(producer, True)
+        DecompressingReceiver(receiver, ZLIB).registerProducer(
+            producer, True)
+        self.assertEqual([[(producer, True)], [(producer, True)]],
+                         [consumer.producers, receiver.producers])
+
+    def test_abort(self):
+        """
+        ``DecompressingReceiver.abort`` aborts the wrapped receiver.
+        """
+        receiver = _Receiver()
+        DecompressingReceiver(receiver, ZLIB).abort()
+        self.assertEqual(["abort"], receiver.finished)
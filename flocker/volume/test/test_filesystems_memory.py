@@ -6,17 +6,21 @@ Tests for :module:`flocker.filesystems.memory`.
 
 from __future__ import absolute_import
 
+from hashlib import sha256
+
 from twisted.internet.defer import succeed, fail
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
 
 from .filesystemtests import (
-    make_ifilesystemsnapshots_tests, make_istoragepool_tests,
+    RecordingConsumer, make_ifilesystemsnapshots_tests,
+    make_istoragepool_tests,
 )
 from ..filesystems.memory import (
     CannedFilesystemSnapshots, FilesystemStoragePool,
-    DirectoryFilesystem,
+    DirectoryFilesystem, ProducerStopped, _BytesProducer,
 )
+from ..filesystems.interfaces import ResumeFailed
 from ...testtools import (
     assert_equal_comparison, assert_not_equal_comparison
 )
@@ -94,3 +98,76 @@ class DirectoryFilesystemTests(SynchronousTestCase):
             repr(DirectoryFilesystem(
                 path=FilePath(b"/foo/bar"), size=123))
         )
+
+    def filesystem(self):
+        """
+        :return: A ``DirectoryFilesystem`` containing a file.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        path.child(b"file").setContent(b"data")
+        return DirectoryFilesystem(path=path)
+
+    def test_resume_token(self):
+        """
+        ``resume_token`` identifies the data given to an aborted receiver by
+        its length and SHA-256 digest.
+        """
+        filesystem = self.filesystem()
+        receiver = self.successResultOf(filesystem.receiver())
+        receiver.write(b"some data")
+        self.successResultOf(receiver.abort())
+        self.assertEqual(b"9:" + sha256(b"some data").hexdigest(),
+                         self.successResultOf(filesystem.resume_token()))
+
+    def test_resume_changed(self):
+        """
+        If the start of the data ``send_to`` would send isn't the data the
+        resume token identifies, it fails with ``ResumeFailed`` without
+        writing anything.
+        """
+        consumer = RecordingConsumer()
+        d = self.filesystem().send_to(
+            consumer, resume_token=b"9:" + sha256(b"some data").hexdigest())
+        self.failureResultOf(d, ResumeFailed)
+        self.assertEqual([], consumer.data)
+
+
+class _PausingConsumer(RecordingConsumer):
+    """
+    A consumer which pauses its producer after every write.
+    """
+    def write(self, data):
+        RecordingConsumer.write(self, data)
+        self.producers[0][0].pauseProducing()
+
+
+class BytesProducerTests(SynchronousTestCase):
+    """
+    Tests for ``_BytesProducer``, used by ``DirectoryFilesystem.send_to``.
+    """
+    def test_pause(self):
+        """
+        ``_BytesProducer`` stops writing while it is paused and carries on
+        where it left off when resumed.
+        """
+        consumer = _PausingConsumer()
+        data = b"x" * (_BytesProducer.CHUNK_SIZE + 1)
+        d = _BytesProducer(consumer, data).start()
+        written = len(consumer.data)
+        consumer.producers[0][0].resumeProducing()
+        self.successResultOf(d)
+        self.assertEqual(
+            (1, data, None),
+            (written, b"".join(consumer.data), consumer.producers[-1]))
+
+    def test_stop(self):
+        """
+        If the consumer stops ``_BytesProducer``, the ``Deferred`` returned
+        by ``start`` errbacks with ``ProducerStopped``.
+        """
+        consumer = _PausingConsumer()
+        d = _BytesProducer(
+            consumer, b"x" * (_BytesProducer.CHUNK_SIZE + 1)).start()
+        consumer.producers[0][0].stopProducing()
+        self.failureResultOf(d, ProducerStopped)
@@ -20,12 +20,14 @@ from ...testtools import (
     FakeProcessReactor, assert_equal_comparison, assert_not_equal_comparison
 )
 
+from .filesystemtests import RecordingConsumer
 from ..filesystems.zfs import (
     _DatasetInfo,
     zfs_command, CommandFailed, BadArguments, Filesystem, ZFSSnapshots,
     _sync_command_error_squashed, _latest_common_snapshot, ZFS_ERROR,
     Snapshot,
 )
+from ..filesystems.interfaces import ResumeFailed
 
 
 class FilesystemTests(SynchronousTestCase):
@@ -330,6 +332,261 @@ class ZFSSnapshotsTests(SynchronousTestCase):
         self.assertEqual(self.successResultOf(d), [b"name2"])
 
 
+def exit_process(reactor, index, output=b"", code=0):
+    """
+    Make a process spawned by a ``FakeProcessReactor`` produce some output
+    and exit.
+
+    :param FakeProcessReactor reactor: The reactor.
+    :param int index: The index of the process in ``reactor.processes``.
+    :param bytes output: The output to produce.
+    :param int code: The exit code.
+    """
+    process_protocol = reactor.processes[index].processProtocol
+    if output:
+        process_protocol.childDataReceived(1, output)
+    if code == 0:
+        reason = ProcessDone(0)
+    else:
+        reason = ProcessTerminated(code)
+    process_protocol.processEnded(Failure(reason))
+
+
+class FilesystemStreamingTests(SynchronousTestCase):
+    """
+    Tests for ``Filesystem.send_to`` and ``Filesystem.receiver``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.filesystem = Filesystem(
+            b"pool", b"fs", mountpoint=FilePath(b"/flocker/fs"),
+            reactor=self.reactor)
+
+    def send(self):
+        """
+        Call ``send_to`` and let it snapshot the filesystem and list its
+        snapshots.
+
+        :return: ``tuple`` of the ``RecordingConsumer`` and the ``Deferred``
+            returned by ``send_to``.
+        """
+        consumer = RecordingConsumer()
+        d = self.filesystem.send_to(consumer)
+        exit_process(self.reactor, 0)
+        exit_process(self.reactor, 1, b"pool/fs@abc\n")
+        return consumer, d
+
+    def test_send_to(self):
+        """
+        ``send_to`` runs ``zfs send`` for a new snapshot and writes its output
+        to the consumer.
+        """
+        consumer, d = self.send()
+        snapshot = self.reactor.processes[0].args[2]
+        exit_process(self.reactor, 2, b"data")
+        self.successResultOf(d)
+        self.assertEqual(
+            ([b"zfs", b"send", snapshot], [b"data"]),
+            (self.reactor.processes[2].args, consumer.data))
+
+    def test_send_to_pause(self):
+        """
+        While the consumer pauses the producer ``send_to`` registered, the
+        output of ``zfs send`` isn't read.
+        """
+        consumer, d = self.send()
+        transport = self.reactor.processes[2].transport
+        [(producer, streaming)] = consumer.producers
+        producer.pauseProducing()
+        paused = transport.paused
+        producer.resumeProducing()
+        self.assertEqual((True, True, False),
+                         (streaming, paused, transport.paused))
+
+    def test_send_to_failed(self):
+        """
+        If ``zfs send`` fails, the ``Deferred`` returned by ``send_to``
+        errbacks with ``CommandFailed`` after the producer is unregistered.
+        """
+        consumer, d = self.send()
+        exit_process(self.reactor, 2, code=1)
+        self.failureResultOf(d, CommandFailed)
+        self.assertEqual(None, consumer.producers[-1])
+
+    def test_send_to_resume(self):
+        """
+        Given a resume token, ``send_to`` checks it with a dry run of ``zfs
+        send -t`` and then writes the output of ``zfs send -t`` to the
+        consumer.
+        """
+        consumer = RecordingConsumer()
+        d = self.filesystem.send_to(consumer, resume_token=b"1-abc")
+        exit_process(self.reactor, 0)
+        exit_process(self.reactor, 1, b"data")
+        self.successResultOf(d)
+        self.assertEqual(
+            ([b"zfs", b"send", b"-n", b"-t", b"1-abc"],
+             [b"zfs", b"send", b"-t", b"1-abc"], [b"data"]),
+            (self.reactor.processes[0].args, self.reactor.processes[1].args,
+             consumer.data))
+
+    def test_send_to_resume_failed(self):
+        """
+        If the dry run of ``zfs send -t`` fails, ``send_to`` errbacks with
+        ``ResumeFailed`` without sending anything.
+        """
+        consumer = RecordingConsumer()
+        d = self.filesystem.send_to(consumer, resume_token=b"1-abc")
+        exit_process(self.reactor, 0, code=1)
+        self.failureResultOf(d, ResumeFailed)
+        self.assertEqual(([], 1),
+                         (consumer.producers, len(self.reactor.processes)))
+
+    def resume_token(self, output=b"-\n", code=0):
+        """
+        Call ``resume_token`` and let ``zfs get`` answer.
+
+        :param bytes output: The output of ``zfs get``.
+        :param int code: The exit code of ``zfs get``.
+
+        :return: The result of ``resume_token``.
+        """
+        d = self.filesystem.resume_token()
+        exit_process(self.reactor, 0, output, code)
+        return self.successResultOf(d)
+
+    def test_resume_token(self):
+        """
+        ``resume_token`` gets the filesystem's ``receive_resume_token``
+        property.
+        """
+        token = self.resume_token(b"1-abc\n")
+        self.assertEqual(
+            (b"1-abc",
+             [b"zfs", b"get", b"-H", b"-o", b"value",
+              b"receive_resume_token", b"pool/fs"]),
+            (token, self.reactor.processes[0].args))
+
+    def test_no_resume_token(self):
+        """
+        If the filesystem's ``receive_resume_token`` is unset,
+        ``resume_token`` returns ``None``.
+        """
+        self.assertIs(None, self.resume_token())
+
+    def test_resume_token_no_filesystem(self):
+        """
+        If the filesystem doesn't exist, ``resume_token`` returns ``None``.
+        """
+        self.assertIs(None, self.resume_token(b"", code=1))
+
+    def receive(self, exists=True):
+        """
+        Call ``receiver`` and let it check that there is no partially
+        received stream and whether the filesystem exists.
+
+        :param bool exists: Whether the filesystem exists.
+
+        :return: The ``IFilesystemReceiver``.
+        """
+        d = self.filesystem.receiver()
+        exit_process(self.reactor, 0, b"-\n")
+        exit_process(self.reactor, 1, code=0 if exists else 1)
+        return self.successResultOf(d)
+
+    def test_receiver_new(self):
+        """
+        If the filesystem doesn't exist, ``receiver`` runs ``zfs receive -s``
+        for a complete stream.
+        """
+        self.receive(exists=False)
+        self.assertEqual([b"zfs", b"receive", b"-s", b"pool/fs"],
+                         self.reactor.processes[2].args)
+
+    def test_receiver_existing(self):
+        """
+        If the filesystem exists, ``receiver`` runs ``zfs receive -F -s``
+        for an incremental stream.
+        """
+        self.receive()
+        self.assertEqual([b"zfs", b"receive", b"-F", b"-s", b"pool/fs"],
+                         self.reactor.processes[2].args)
+
+    def test_receiver_discards_partial(self):
+        """
+        If the filesystem has a resume token, ``receiver`` discards the
+        partially received stream with ``zfs receive -A`` first.
+        """
+        d = self.filesystem.receiver()
+        exit_process(self.reactor, 0, b"1-abc\n")
+        exit_process(self.reactor, 1)
+        exit_process(self.reactor, 2)
+        self.successResultOf(d)
+        self.assertEqual(
+            ([b"zfs", b"receive", b"-A", b"pool/fs"],
+             [b"zfs", b"receive", b"-F", b"-s", b"pool/fs"]),
+            (self.reactor.processes[1].args, self.reactor.processes[3].args))
+
+    def test_receiver_resume(self):
+        """
+        ``receiver(resume=True)`` runs ``zfs receive -s`` to continue the
+        partially received stream.
+        """
+        self.successResultOf(self.filesystem.receiver(resume=True))
+        self.assertEqual([[b"zfs", b"receive", b"-s", b"pool/fs"]],
+                         [process.args for process in self.reactor.processes])
+
+    def test_receiver_producer(self):
+        """
+        Data written to the receiver goes to the standard input of
+        ``zfs receive``, which the registered producer is registered with.
+        """
+        receiver = self.receive()
+        producer = object()
+        receiver.registerProducer(producer, True)
+        receiver.write(b"data")
+        transport = self.reactor.processes[2].transport
+        self.assertEqual((producer, b"data"),
+                         (transport.producer, transport.data))
+
+    def test_receiver_finish(self):
+        """
+        ``IFilesystemReceiver.finish`` closes the standard input of ``zfs
+        receive`` and, once it succeeds, sets the filesystem's mountpoint.
+        """
+        receiver = self.receive()
+        d = receiver.finish()
+        stdin_closed = self.reactor.processes[2].transport.stdin_closed
+        exit_process(self.reactor, 2)
+        exit_process(self.reactor, 3)
+        self.successResultOf(d)
+        self.assertEqual(
+            (True, [b"zfs", b"set", b"mountpoint=/flocker/fs", b"pool/fs"]),
+            (stdin_closed, self.reactor.processes[3].args))
+
+    def test_receiver_finish_failed(self):
+        """
+        If ``zfs receive`` fails, ``IFilesystemReceiver.finish`` errbacks with
+        ``CommandFailed``.
+        """
+        receiver = self.receive()
+        d = receiver.finish()
+        exit_process(self.reactor, 2, code=1)
+        self.failureResultOf(d, CommandFailed)
+
+    def test_receiver_abort(self):
+        """
+        ``IFilesystemReceiver.abort`` kills ``zfs receive`` and fires once it
+        has exited.
+        """
+        receiver = self.receive()
+        d = receiver.abort()
+        exit_process(self.reactor, 2, code=1)
+        self.successResultOf(d)
+        self.assertEqual(["TERM"],
+                         self.reactor.processes[2].transport.signals)
+
+
 class LatestCommonSnapshotTests(SynchronousTestCase):
     """
     Tests for ``_latest_common_snapshot``.
@@ -8,17 +8,20 @@ from __future__ import absolute_import
 
 from zope.interface.verify import verifyObject
 
+from twisted.internet.defer import fail, maybeDeferred
 from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath
 from twisted.trial.unittest import TestCase
 
 from ..service import VolumeService, Volume, DEFAULT_CONFIG_PATH, VolumeName
+from ..filesystems.interfaces import ResumeFailed
 from ..filesystems.zfs import Snapshot
 from ..filesystems.memory import FilesystemStoragePool
 from .._ipc import (
     IRemoteVolumeManager, RemoteVolumeManager, LocalVolumeManager,
     standard_node, SSH_PRIVATE_KEY_PATH)
 from ..testtools import ServicePair
+from .filesystemtests import RecordingConsumer
 from ...common import FakeNode
 from ...common._ipc import ProcessNode
 
@@ -136,6 +139,109 @@ def make_iremote_volume_manager(fixture):
 
             return created
 
+        def test_receive_stream_creates_files(self):
+            """
+            ``receive_stream`` recreates files pushed from origin, and the
+            ``Deferred`` it returns fires once they have been stored.
+            """
+            service_pair = fixture(self)
+            created = service_pair.from_service.create(
+                service_pair.from_service.get(MY_VOLUME)
+            )
+
+            def do_push(volume):
+                root = volume.get_filesystem().get_path()
+                root.child(b"afile.txt").setContent(b"WORKS!")
+
+                return service_pair.remote.receive_stream(
+                    volume, volume.get_filesystem().send_to)
+            created.addCallback(do_push)
+
+            def pushed(_):
+                to_volume = Volume(node_id=service_pair.from_service.node_id,
+                                   name=MY_VOLUME,
+                                   service=service_pair.to_service)
+                root = to_volume.get_filesystem().get_path()
+                self.assertEqual(root.child(b"afile.txt").getContent(),
+                                 b"WORKS!")
+            created.addCallback(pushed)
+
+            return created
+
+        def test_receive_stream_send_failed(self):
+            """
+            If the callable given to ``receive_stream`` fails, the
+            ``Deferred`` it returns fails with the same exception.
+            """
+            service_pair = fixture(self)
+            created = service_pair.from_service.create(
+                service_pair.from_service.get(MY_VOLUME)
+            )
+            created.addCallback(
+                lambda volume: service_pair.remote.receive_stream(
+                    volume, lambda consumer: fail(ResumeFailed())))
+            return self.assertFailure(created, ResumeFailed)
+
+        def test_no_resume_token(self):
+            """
+            ``resume_token`` fires with ``None`` if no transfer of the volume
+            was interrupted.
+            """
+            service_pair = fixture(self)
+            created = service_pair.from_service.create(
+                service_pair.from_service.get(MY_VOLUME)
+            )
+            created.addCallback(service_pair.remote.resume_token)
+            created.addCallback(self.assertIs, None)
+            return created
+
+        def test_push_resumes(self):
+            """
+            Pushing a volume whose previous transfer was interrupted finishes
+            that transfer, after which there is nothing left to resume.
+            """
+            service_pair = fixture(self)
+            created = service_pair.from_service.create(
+                service_pair.from_service.get(MY_VOLUME)
+            )
+            to_volume = Volume(node_id=service_pair.from_service.node_id,
+                               name=MY_VOLUME,
+                               service=service_pair.to_service)
+
+            def interrupt(volume):
+                volume.get_filesystem().get_path().child(
+                    b"afile.txt").setContent(b"WORKS!" * 1000)
+                consumer = RecordingConsumer()
+                d = volume.get_filesystem().send_to(consumer)
+                d.addCallback(
+                    lambda _: to_volume.get_filesystem().receiver())
+
+                def got_receiver(receiver):
+                    data = b"".join(consumer.data)
+                    receiver.write(data[:len(data) // 2])
+                    return receiver.abort()
+                d.addCallback(got_receiver)
+                d.addCallback(
+                    lambda _: service_pair.remote.resume_token(volume))
+                d.addCallback(lambda token: tokens.append(token))
+                d.addCallback(lambda _: service_pair.from_service.push(
+                    volume, service_pair.remote))
+                d.addCallback(
+                    lambda _: service_pair.remote.resume_token(volume))
+                d.addCallback(lambda token: tokens.append(token))
+                return d
+            tokens = []
+            created.addCallback(interrupt)
+
+            def pushed(_):
+                root = to_volume.get_filesystem().get_path()
+                self.assertEqual(
+                    (True, None, b"WORKS!" * 1000),
+                    (tokens[0] is not None, tokens[1],
+                     root.child(b"afile.txt").getContent()))
+            created.addCallback(pushed)
+            return created
+
         def remotely_owned_volume(self, service_pair):
             """
             Create a volume ``MY_VOLUME`` on the origin service and a copy
@@ -167,8 +273,8 @@ def make_iremote_volume_manager(fixture):
             created = self.remotely_owned_volume(service_pair)
 
             def got_volume(pushed_volume):
-                service_pair.remote.acquire(pushed_volume)
-                d = to_service.enumerate()
+                d = maybeDeferred(service_pair.remote.acquire, pushed_volume)
+                d.addCallback(lambda _: to_service.enumerate())
                 d.addCallback(lambda results: self.assertEqual(
                     list(results),
                     [Volume(node_id=to_service.node_id,
@@ -195,8 +301,10 @@ def make_iremote_volume_manager(fixture):
                     pushed_volume, service_pair.remote)
 
                 def pushed(ignored):
-                    service_pair.remote.acquire(pushed_volume)
+                    return maybeDeferred(
+                        service_pair.remote.acquire, pushed_volume)
 
+                def acquired(ignored):
                     filesystem = Volume(node_id=to_service.node_id,
                                         name=pushed_volume.name,
                                         service=to_service).get_filesystem()
@@ -204,6 +312,7 @@ def make_iremote_volume_manager(fixture):
                     self.assertEqual(new_root.child(b"test").getContent(),
                                      b"some data")
                 pushing.addCallback(pushed)
+                pushing.addCallback(acquired)
                 return pushing
 
             created.addCallback(got_volume)
@@ -218,9 +327,10 @@ def make_iremote_volume_manager(fixture):
             created = self.remotely_owned_volume(service_pair)
 
             def got_volume(pushed_volume):
-                result = service_pair.remote.acquire(pushed_volume)
-                self.assertEqual(result, to_service.node_id)
+                return maybeDeferred(service_pair.remote.acquire,
+                                     pushed_volume)
             created.addCallback(got_volume)
+            created.addCallback(self.assertEqual, to_service.node_id)
             return created
 
         def test_clone_to(self):
@@ -355,6 +465,57 @@ class RemoteVolumeManagerTests(TestCase):
                           b"receive", self.volume.node_id.encode("ascii"),
                           b"myns.myvol"])
 
+    def test_resume_token_destination_run(self):
+        """
+        ``RemoteVolumeManager.resume_token`` calls ``flocker-volume``
+        remotely with the ``resume_token`` sub-command and returns its
+        output.
+        """
+        node = FakeNode([b"1-abc\n"])
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        token = self.successResultOf(remote.resume_token(self.volume))
+        self.assertEqual(
+            ([b"flocker-volume", b"--config", b"/path/to/json",
+              b"resume_token", self.volume.node_id.encode("ascii"),
+              b"myns.myvol"], b"1-abc"),
+            (node.remote_command, token))
+
+    def test_no_resume_token(self):
+        """
+        If ``flocker-volume resume_token`` outputs nothing,
+        ``RemoteVolumeManager.resume_token`` returns ``None``.
+        """
+        remote = RemoteVolumeManager(FakeNode([b""]))
+        self.assertIs(None,
+                      self.successResultOf(remote.resume_token(self.volume)))
+
+    def test_resume_token_unsupported(self):
+        """
+        If ``flocker-volume resume_token`` fails, as it does when the
+        destination's ``flocker-volume`` doesn't have the sub-command,
+        ``RemoteVolumeManager.resume_token`` returns ``None``.
+        """
+        remote = RemoteVolumeManager(FakeNode([IOError("Bad exit", 2)]))
+        self.assertIs(None,
+                      self.successResultOf(remote.resume_token(self.volume)))
+
+    def test_receive_resume(self):
+        """
+        Receiving the rest of an interrupted transfer calls
+        ``flocker-volume receive`` remotely with ``--resume``.
+        """
+        node = FakeNode()
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        with remote.receive(self.volume, resume=True):
+            pass
+        self.assertEqual(node.remote_command,
+                         [b"flocker-volume", b"--config", b"/path/to/json",
+                          b"receive", b"--resume",
+                          self.volume.node_id.encode("ascii"),
+                          b"myns.myvol"])
+
     def test_acquire_destination_run(self):
         """
         ``RemoteVolumeManager.acquire()`` calls ``flocker-volume`` remotely
@@ -0,0 +1,567 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.volume._protocol``.
+"""
+
+from __future__ import absolute_import
+
+from hashlib import sha256
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import (
+    ConnectionDone, ConnectionLost, ConnectionRefusedError,
+)
+from twisted.protocols.amp import AMP
+from twisted.protocols.policies import WrappingFactory
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+from twisted.test.iosim import connectedServerAndClient
+from twisted.trial.unittest import SynchronousTestCase, TestCase
+
+from .._codec import CODECS, ZLIB, Codec, CodecSelector
+from ..filesystems.memory import DirectoryFilesystem
+from ..service import Volume
+from ..testtools import ServicePair, create_volume_service
+from .._ipc import RemoteVolumeManager, standard_node
+from .._protocol import (
+    CONNECT_RETRY_INTERVAL, AgentConnectionPool, AgentVolumeManager,
+    AuthenticationFailed,
+    NotAuthenticated, SnapshotsCommand, StartReceiveCommand, TransferFailed,
+    VOLUME_AGENT_PORT, VolumeAgent, VolumeAgentLocator, VolumeOwnedLocally,
+    standard_volume_manager,
+)
+from .test_ipc import (
+    MY_VOLUME, create_local_servicepair, make_iremote_volume_manager,
+)
+from ...testtools import find_free_port, loop_until
+
+
+SECRET = b"cluster secret"
+
+
+def secret_file(test, secret=SECRET):
+    """
+    :param TestCase test: The test the file is for.
+    :param bytes secret: The secret to store.
+
+    :return FilePath: A new file containing the secret.
+    """
+    path = FilePath(test.mktemp())
+    path.setContent(secret)
+    return path
+
+
+def listen(test, volume_service):
+    """
+    Run a volume agent on a loopback port until the test finishes.
+
+    :param TestCase test: The test to run the agent for.
+    :param VolumeService volume_service: The volume manager to serve.
+
+    :return int: The port the agent is listening on for AMP connections.
+    """
+    agent = VolumeAgent(volume_service, SECRET)
+    data_factory = WrappingFactory(agent.data_factory())
+    data_port = reactor.listenTCP(0, data_factory, interface=b"127.0.0.1")
+    test.addCleanup(data_port.stopListening)
+    test.addCleanup(loop_until, lambda: not data_factory.protocols)
+    agent.data_port = data_port.getHost().port
+    factory = WrappingFactory(agent.control_factory())
+    port = reactor.listenTCP(0, factory, interface=b"127.0.0.1")
+    test.addCleanup(port.stopListening)
+    test.addCleanup(loop_until, lambda: not factory.protocols)
+    return port.getHost().port
+
+
+def create_agent_servicepair(test):
+    """
+    Create a ``ServicePair`` allowing testing of ``AgentVolumeManager``
+    talking to a volume agent over loopback TCP.
+
+    :param TestCase test: A unit test.
+
+    :return: A new ``ServicePair``.
+    """
+    local = create_local_servicepair(test)
+    port = listen(test, local.to_service)
+    pool = AgentConnectionPool(reactor, secret_file(test))
+    test.addCleanup(pool.disconnect)
+    return ServicePair(
+        from_service=local.from_service, to_service=local.to_service,
+        remote=AgentVolumeManager(b"127.0.0.1", local.remote, port=port,
+                                  pool=pool))
+
+
+class AgentVolumeManagerInterfaceTests(
+        make_iremote_volume_manager(create_agent_servicepair)):
+    """
+    Tests for ``AgentVolumeManager`` as a ``IRemoteVolumeManager``.
+    """
+
+
+class _RecordingVolumeManager(object):
+    """
+    Record the operations done by an ``AgentVolumeManager`` without the
+    volume agent.
+
+    :ivar list calls: ``(method name, volume)`` tuples.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def snapshots(self, volume):
+        self.calls.append(("snapshots", volume))
+        return succeed([])
+
+    def acquire(self, volume):
+        self.calls.append(("acquire", volume))
+        return u"fallback"
+
+    def resume_token(self, volume):
+        self.calls.append(("resume_token", volume))
+        return succeed(None)
+
+    def receive_stream(self, volume, send, resume=False):
+        self.calls.append(("receive_stream", volume))
+        return succeed(None)
+
+
+class AgentConnectionPoolTests(TestCase):
+    """
+    Tests for ``AgentConnectionPool``.
+    """
+    def test_reuse(self):
+        """
+        ``AgentConnectionPool.connect`` returns the same connection each time
+        it is called for the same agent, including while the connection is
+        still being made.
+        """
+        port = listen(self, create_volume_service(self))
+        pool = AgentConnectionPool(reactor, secret_file(self))
+        self.addCleanup(pool.disconnect)
+        first = pool.connect(b"127.0.0.1", port)
+        second = pool.connect(b"127.0.0.1", port)
+        d = first.addCallback(lambda protocol: second.addCallback(
+            lambda other: (protocol, other)))
+
+        def connected(protocols):
+            self.assertIs(protocols[0], protocols[1])
+            third = pool.connect(b"127.0.0.1", port)
+            third.addCallback(self.assertIs, protocols[0])
+            return third
+        d.addCallback(connected)
+        return d
+
+    def test_reconnect(self):
+        """
+        Once a connection is lost, ``AgentConnectionPool.connect`` makes a
+        new one.
+        """
+        port = listen(self, create_volume_service(self))
+        pool = AgentConnectionPool(reactor, secret_file(self))
+        self.addCleanup(pool.disconnect)
+        d = pool.connect(b"127.0.0.1", port)
+
+        def connected(protocol):
+            lost = protocol.when_disconnected()
+            protocol.transport.loseConnection()
+            lost.addCallback(lambda _: pool.connect(b"127.0.0.1", port))
+            lost.addCallback(self.assertIsNot, protocol)
+            return lost
+        d.addCallback(connected)
+        return d
+
+    def test_wrong_secret(self):
+        """
+        If the client doesn't know the agent's secret,
+        ``AgentConnectionPool.connect`` fails with ``AuthenticationFailed``.
+        """
+        port = listen(self, create_volume_service(self))
+        pool = AgentConnectionPool(reactor, secret_file(self, b"wrong"))
+        self.addCleanup(pool.disconnect)
+        return self.assertFailure(
+            pool.connect(b"127.0.0.1", port), AuthenticationFailed)
+
+    def test_unreachable(self):
+        """
+        If an agent can't be reached, ``AgentConnectionPool.connect`` fails
+        straight away for ``CONNECT_RETRY_INTERVAL`` seconds, and then tries
+        to connect again.
+        """
+        clock = MemoryReactorClock()
+        pool = AgentConnectionPool(clock, secret_file(self))
+        connecting = pool.connect(b"192.0.2.1", 1234)
+        clock.tcpClients[0][2].clientConnectionFailed(
+            None, Failure(ConnectionRefusedError()))
+        self.failureResultOf(connecting, ConnectionRefusedError)
+        clock.advance(CONNECT_RETRY_INTERVAL - 1)
+        self.failureResultOf(
+            pool.connect(b"192.0.2.1", 1234), ConnectionRefusedError)
+        attempts = len(clock.tcpClients)
+        clock.advance(1)
+        retrying = pool.connect(b"192.0.2.1", 1234)
+        self.assertEqual((attempts, len(clock.tcpClients)), (1, 2))
+        self.assertNoResult(retrying)
+
+
+class AgentVolumeManagerTests(TestCase):
+    """
+    Tests for ``AgentVolumeManager``.
+    """
+    def test_fallback(self):
+        """
+        If the volume agent can't be reached, operations are done by the
+        fallback ``IRemoteVolumeManager``.
+        """
+        service = create_volume_service(self)
+        volume = Volume(node_id=u"other", name=MY_VOLUME, service=service)
+        fallback = _RecordingVolumeManager()
+        pool = AgentConnectionPool(reactor, secret_file(self))
+        remote = AgentVolumeManager(
+            b"127.0.0.1", fallback, port=find_free_port()[1], pool=pool)
+        d = remote.snapshots(volume)
+        d.addCallback(lambda _: remote.resume_token(volume))
+        d.addCallback(lambda _: remote.receive_stream(
+            volume, lambda consumer: succeed(None)))
+        d.addCallback(lambda _: remote.acquire(volume))
+
+        def done(node_id):
+            self.assertEqual(
+                (u"fallback", [("snapshots", volume),
+                               ("resume_token", volume),
+                               ("receive_stream", volume),
+                               ("acquire", volume)]),
+                (node_id, fallback.calls))
+        d.addCallback(done)
+        return d
+
+    def test_unreachable_fallback(self):
+        """
+        Once the volume agent couldn't be reached, further operations are
+        done by the fallback ``IRemoteVolumeManager`` without trying to
+        connect again.
+        """
+        service = create_volume_service(self)
+        volume = Volume(node_id=u"other", name=MY_VOLUME, service=service)
+        fallback = _RecordingVolumeManager()
+        clock = MemoryReactorClock()
+        remote = AgentVolumeManager(
+            b"192.0.2.1", fallback,
+            pool=AgentConnectionPool(clock, secret_file(self)))
+        snapshots = remote.snapshots(volume)
+        clock.tcpClients[0][2].clientConnectionFailed(
+            None, Failure(ConnectionRefusedError()))
+        self.successResultOf(snapshots)
+        self.successResultOf(remote.resume_token(volume))
+        self.assertEqual(
+            (len(clock.tcpClients), fallback.calls),
+            (1, [("snapshots", volume), ("resume_token", volume)]))
+
+    def test_wrong_secret_no_fallback(self):
+        """
+        If the volume agent rejects the client's secret, the operation fails
+        rather than being done by the fallback ``IRemoteVolumeManager``.
+        """
+        service = create_volume_service(self)
+        port = listen(self, service)
+        fallback = _RecordingVolumeManager()
+        pool = AgentConnectionPool(reactor, secret_file(self, b"wrong"))
+        remote = AgentVolumeManager(
+            b"127.0.0.1", fallback, port=port, pool=pool)
+        d = self.assertFailure(
+            remote.snapshots(service.get(MY_VOLUME)), AuthenticationFailed)
+        d.addCallback(lambda _: self.assertEqual([], fallback.calls))
+        return d
+
+    def test_records_throughput(self):
+        """
+        After sending a volume, ``AgentVolumeManager`` tells the pool's
+        ``CodecSelector`` the throughput of the codec it used.
+        """
+        service_pair = create_agent_servicepair(self)
+        from_service = service_pair.from_service
+        d = from_service.create(from_service.get(MY_VOLUME))
+        d.addCallback(
+            lambda volume: from_service.push(volume, service_pair.remote))
+        d.addCallback(lambda _: self.assertEqual(
+            [(b"127.0.0.1", CODECS[0].name)],
+            list(service_pair.remote._pool.codec_selector.rates)))
+        return d
+
+    def test_unsupported_codec(self):
+        """
+        If the agent doesn't support the codec ``AgentVolumeManager`` prefers,
+        the pool's ``CodecSelector`` offers it last from then on.
+        """
+        service_pair = create_agent_servicepair(self)
+        pool = service_pair.remote._pool
+        pool.codec_selector = CodecSelector(
+            [Codec(name=b"unknown", compressor=None, decompressor=None),
+             ZLIB])
+        from_service = service_pair.from_service
+        d = from_service.create(from_service.get(MY_VOLUME))
+        d.addCallback(
+            lambda volume: from_service.push(volume, service_pair.remote))
+        d.addCallback(lambda _: self.assertEqual(
+            ([(b"127.0.0.1", b"zlib")], [b"zlib", b"unknown"]),
+            (list(pool.codec_selector.rates),
+             pool.codec_selector.offer(b"127.0.0.1"))))
+        return d
+
+    def test_standard_volume_manager(self):
+        """
+        ``standard_volume_manager`` returns an ``AgentVolumeManager`` for the
+        standard port which falls back to ``flocker-volume`` over SSH.
+        """
+        self.assertEqual(
+            standard_volume_manager(b"example.com"),
+            AgentVolumeManager(
+                b"example.com",
+                RemoteVolumeManager(standard_node(b"example.com")),
+                port=VOLUME_AGENT_PORT))
+
+
+class VolumeAgentLocatorTests(SynchronousTestCase):
+    """
+    Tests for the volume agent side of the protocol.
+    """
+    def setUp(self):
+        self.service = create_volume_service(self)
+
+    def call_remote(self, command, authenticated=False, **kwargs):
+        """
+        Send a command to a volume agent over an in-memory connection.
+
+        :param command: The ``Command`` to send.
+        :param bool authenticated: Whether to treat the connection as
+            authenticated.
+        :param kwargs: The command's arguments.
+
+        :return: The response, or the ``Failure`` the command failed with.
+        """
+        factory = VolumeAgent(self.service, SECRET).control_factory()
+        client, server, pump = connectedServerAndClient(
+            lambda: factory.buildProtocol(None), AMP)
+        server.locator.authenticated = authenticated
+        result = []
+        # AMP logs and discards errors which nothing is waiting for when
+        # they arrive, so the result has to be collected before then:
+        client.callRemote(command, **kwargs).addBoth(result.append)
+        pump.flush()
+        return result[0]
+
+    def test_not_authenticated(self):
+        """
+        Commands sent before authenticating fail with ``NotAuthenticated``.
+        """
+        result = self.call_remote(
+            SnapshotsCommand, node_id=self.service.node_id,
+            name=MY_VOLUME.to_bytes())
+        self.assertTrue(result.check(NotAuthenticated))
+
+    def test_start_locally_owned(self):
+        """
+        ``StartReceiveCommand`` for a volume the agent owns fails with
+        ``VolumeOwnedLocally``.
+        """
+        result = self.call_remote(
+            StartReceiveCommand, authenticated=True,
+            node_id=self.service.node_id, name=MY_VOLUME.to_bytes())
+        self.assertTrue(result.check(VolumeOwnedLocally))
+
+
+class _FakeReceiver(object):
+    """
+    Record what is done to an ``IFilesystemReceiver``.
+
+    :ivar producer: ``(producer, streaming)`` for the registered producer,
+        or ``None``.
+    :ivar list written: The data written.
+    :ivar bool aborted: Whether ``abort`` was called.
+    """
+    def __init__(self):
+        self.producer = None
+        self.written = []
+        self.aborted = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = (producer, streaming)
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.written.append(data)
+
+    def abort(self):
+        self.aborted = True
+        return succeed(None)
+
+
+class DataTransferTests(SynchronousTestCase):
+    """
+    Tests for receiving volume data on a data connection.
+    """
+    def setUp(self):
+        self.service = create_volume_service(self)
+        self.agent = VolumeAgent(self.service, SECRET)
+        self.locator = VolumeAgentLocator(self.agent)
+        self.locator.authenticated = True
+
+    def start(self):
+        """
+        Start receiving a remotely owned volume.
+
+        :return: The token identifying the transfer.
+        """
+        return self.locator.start_receive(
+            u"other", MY_VOLUME.to_bytes())["transfer"]
+
+    def send(self, token, data, reason=ConnectionDone()):
+        """
+        Send data for a transfer as a data connection would.
+
+        :param bytes token: The token identifying the transfer.
+        :param bytes data: The data to send.
+        :param Exception reason: Why the data connection was closed.
+        """
+        protocol = self.agent.data_factory().buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(token + data)
+        protocol.connectionLost(Failure(reason))
+
+    def test_codec(self):
+        """
+        ``StartReceiveCommand`` chooses the first offered codec the agent
+        supports and decompresses the data with it.
+        """
+        response = self.locator.start_receive(
+            u"other", MY_VOLUME.to_bytes(), codecs=[b"unknown", b"zlib"])
+        self.assertEqual(
+            (b"zlib", ZLIB),
+            (response["codec"],
+             self.agent.transfers[response["transfer"]].codec))
+
+    def test_no_codecs(self):
+        """
+        If the client doesn't offer any codecs, ``StartReceiveCommand``
+        chooses no compression.
+        """
+        response = self.locator.start_receive(u"other", MY_VOLUME.to_bytes())
+        self.assertEqual(b"none", response["codec"])
+
+    def test_start_locally_owned(self):
+        """
+        A locally owned volume can't be received.
+        """
+        self.assertRaises(
+            VolumeOwnedLocally, self.locator.start_receive,
+            self.service.node_id, MY_VOLUME.to_bytes())
+
+    def test_finish(self):
+        """
+        ``FinishReceiveCommand`` succeeds once all the data has been stored.
+        """
+        token = self.start()
+        self.send(token, b"data")
+        self.assertEqual(
+            {}, self.successResultOf(self.locator.finish_receive(token, 4)))
+
+    def test_unknown_transfer(self):
+        """
+        ``FinishReceiveCommand`` fails with ``TransferFailed`` if the token
+        wasn't given out by ``StartReceiveCommand`` on that connection.
+        """
+        self.assertRaises(
+            TransferFailed, self.locator.finish_receive, b"x" * 16, 0)
+
+    def test_length_mismatch(self):
+        """
+        ``FinishReceiveCommand`` fails with ``TransferFailed`` if the agent
+        received a different number of bytes than were sent.
+        """
+        token = self.start()
+        self.send(token, b"data")
+        self.failureResultOf(
+            self.locator.finish_receive(token, 5), TransferFailed)
+
+    def test_connection_lost(self):
+        """
+        If the data connection isn't closed cleanly the receiver is aborted
+        and the transfer is forgotten, so ``FinishReceiveCommand`` fails
+        with ``TransferFailed``.
+        """
+        receiver = _FakeReceiver()
+        self.patch(DirectoryFilesystem, "receiver",
+                   lambda filesystem, resume=False: succeed(receiver))
+        token = self.start()
+        protocol = self.agent.data_factory().buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(token + b"da")
+        protocol.connectionLost(Failure(ConnectionLost()))
+        self.assertEqual(
+            (receiver.written, receiver.aborted, self.agent.transfers,
+             self.locator.transfers),
+            ([b"da"], True, {}, set()))
+        self.assertRaises(
+            TransferFailed, self.locator.finish_receive, token, 2)
+
+    def test_resume(self):
+        """
+        If a data connection is lost the agent keeps the data received, and
+        reports it with ``ResumeTokenCommand``. A transfer started with
+        ``resume`` continues from it.
+        """
+        self.send(self.start(), b"data", ConnectionLost())
+        token = self.locator.start_receive(
+            u"other", MY_VOLUME.to_bytes(), resume=True)["transfer"]
+        self.send(token, b"more", ConnectionLost())
+        self.assertEqual(
+            {"token": b"8:" + sha256(b"datamore").hexdigest()},
+            self.successResultOf(self.locator.resume_token(
+                u"other", MY_VOLUME.to_bytes())))
+
+    def test_no_resume(self):
+        """
+        A transfer started without ``resume`` discards the data kept from
+        an interrupted one.
+        """
+        self.send(self.start(), b"data", ConnectionLost())
+        self.send(self.start(), b"more", ConnectionLost())
+        self.assertEqual(
+            {"token": b"4:" + sha256(b"more").hexdigest()},
+            self.successResultOf(self.locator.resume_token(
+                u"other", MY_VOLUME.to_bytes())))
+
+    def test_disconnected(self):
+        """
+        Transfers started by a connection are forgotten once it is lost.
+        """
+        self.start()
+        self.locator.disconnected()
+        self.assertEqual({}, self.agent.transfers)
+
+    def test_paused_until_ready(self):
+        """
+        The data connection is paused until the volume's filesystem is ready
+        to receive, and then registered with the filesystem's receiver as a
+        streaming producer.
+        """
+        receiver = _FakeReceiver()
+        receiving = Deferred()
+        self.patch(DirectoryFilesystem, "receiver",
+                   lambda filesystem, resume=False: receiving)
+        token = self.start()
+        transport = StringTransport()
+        protocol = self.agent.data_factory().buildProtocol(None)
+        protocol.makeConnection(transport)
+        protocol.dataReceived(token + b"abc")
+        paused = transport.producerState
+        receiving.callback(receiver)
+        self.assertEqual(
+            ("paused", "producing", (transport, True), [b"abc"]),
+            (paused, transport.producerState, receiver.producer,
+             receiver.written))
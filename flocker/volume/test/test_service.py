@@ -8,6 +8,7 @@ from io import BytesIO
 import sys
 import json
 from contextlib import contextmanager
+from hashlib import sha256
 
 from uuid import uuid4
 from StringIO import StringIO
@@ -16,6 +17,7 @@ from zope.interface import implementer
 from zope.interface.verify import verifyObject
 
 from twisted.application.service import IService, Service
+from twisted.internet.defer import succeed
 from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath, Permissions
 from twisted.trial.unittest import SynchronousTestCase, TestCase
@@ -29,8 +31,11 @@ from ..script import VolumeOptions
 
 from ..filesystems.memory import FilesystemStoragePool
 from ..filesystems.zfs import StoragePool
-from .._ipc import RemoteVolumeManager, LocalVolumeManager
+from .._ipc import (
+    RemoteVolumeManager, LocalVolumeManager, copy_to_receiver,
+)
 from ..testtools import create_volume_service
+from .filesystemtests import RecordingConsumer
 from ...common import FakeNode
 from ...testtools import (
     skip_on_broken_permissions, attempt_effective_uid, make_with_init_tests,
@@ -441,6 +446,9 @@ class VolumeServiceAPITests(TestCase):
             # run.  It doesn't need to produce any particular output for this
             # test, it just needs to not fail.
             b"",
+            # Then `flocker-volume resume_token`, which outputs nothing if no
+            # earlier push was interrupted.
+            b"",
         ])
 
         self.successResultOf(service.push(volume, RemoteVolumeManager(node)))
@@ -461,12 +469,18 @@ class VolumeServiceAPITests(TestCase):
             def snapshots(self, volume):
                 return volume.get_filesystem().snapshots()
 
+            def resume_token(self, volume):
+                return succeed(None)
+
             @contextmanager
-            def receive(self, volume):
+            def receive(self, volume, resume=False):
                 writer = BytesIO()
                 yield writer
                 self.written.append(writer)
 
+            def receive_stream(self, volume, send, resume=False):
+                return copy_to_receiver(self, volume, send, resume)
+
         pool = FilesystemStoragePool(FilePath(self.mktemp()))
         service = VolumeService(FilePath(self.mktemp()), pool, reactor=Clock())
         service.startService()
@@ -483,6 +497,61 @@ class VolumeServiceAPITests(TestCase):
             [b"incremental stream based on", b"stuff"],
             writer.getvalue().splitlines()[-2:])
 
+    def interrupted_push(self, token):
+        """
+        Push a volume to a destination which says an earlier push was
+        interrupted.
+
+        :param token: A function which, given the complete data stream for
+            the volume, returns the destination's resume token.
+
+        :return: ``tuple`` of the complete data stream and a ``list`` of
+            ``(resume, data)`` for each ``receive_stream`` call on the
+            destination that succeeded.
+        """
+        class InterruptedVolumeManager(object):
+            def snapshots(self, volume):
+                return succeed([])
+
+            def resume_token(self, volume):
+                return succeed(token(data))
+
+            def receive_stream(self, volume, send, resume=False):
+                consumer = RecordingConsumer()
+                d = send(consumer)
+                d.addCallback(lambda _: received.append(
+                    (resume, b"".join(consumer.data))))
+                return d
+
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        filesystem = volume.get_filesystem()
+        filesystem.get_path().child(b"foo").setContent(b"blah" * 1000)
+        with filesystem.reader() as reader:
+            data = reader.read()
+        received = []
+        self.successResultOf(
+            service.push(volume, InterruptedVolumeManager()))
+        return data, received
+
+    def test_push_resumes(self):
+        """
+        If the destination has a resume token for the volume, only the data
+        after the part it received is pushed.
+        """
+        data, received = self.interrupted_push(
+            lambda data: b"1000:" + sha256(data[:1000]).hexdigest())
+        self.assertEqual([(True, data[1000:])], received)
+
+    def test_push_resume_failed(self):
+        """
+        If the push can't be resumed from the destination's resume token,
+        all of the data is pushed instead.
+        """
+        data, received = self.interrupted_push(
+            lambda data: b"1000:" + sha256(b"other data").hexdigest())
+        self.assertEqual([(False, data)], received)
+
     def test_receive_local_node_id(self):
         """
         If a volume with the same node ID as the service is received,